@@ -25,6 +25,7 @@ from server import lease_management
 from server import stats
 from server import task_result
 from server import task_scheduler
+from server import task_to_run
 
 
 class CronBotDiedHandler(webapp2.RequestHandler):
@@ -51,6 +52,28 @@ class CronAbortExpiredShardToRunHandler(webapp2.RequestHandler):
     self.response.out.write('Success.')
 
 
+class CronRefreshReadyQueuesHandler(webapp2.RequestHandler):
+  """Rebuilds the index of the TaskToRun ready queues."""
+
+  @decorators.require_cronjob
+  def get(self):
+    count = task_to_run.refresh_ready_hashes()
+    logging.info('Found %d ready queues', count)
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
+class CronUpdateBotInfoHandler(webapp2.RequestHandler):
+  """Stores the BotInfo updates buffered in memcache."""
+
+  @decorators.require_cronjob
+  def get(self):
+    count = bot_management.cron_update_bot_info()
+    logging.info('Stored %d BotInfo', count)
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
 class CronTriggerCleanupDataHandler(webapp2.RequestHandler):
   """Triggers task to delete orphaned blobs."""
 
@@ -214,6 +237,8 @@ def get_routes():
         CronAbortExpiredShardToRunHandler),
 
     ('/internal/cron/stats/update', stats.InternalStatsUpdateHandler),
+    ('/internal/cron/update_bot_info', CronUpdateBotInfoHandler),
+    ('/internal/cron/refresh_ready_queues', CronRefreshReadyQueuesHandler),
     ('/internal/cron/trigger_cleanup_data', CronTriggerCleanupDataHandler),
     ('/internal/cron/aggregate_bots_dimensions',
         CronBotsDimensionAggregationHandler),
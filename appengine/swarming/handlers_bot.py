@@ -8,6 +8,8 @@ import base64
 import json
 import logging
 import re
+import struct
+import zlib
 
 import webob
 import webapp2
@@ -31,6 +33,23 @@ from server import task_scheduler
 from server import task_to_run
 
 
+# Content type of the binary task_update requests. The body is the length of
+# the JSON encoded parameters as a 4 bytes big endian integer, the JSON encoded
+# parameters, then the zlib compressed output, if any. Keep synced with
+# remote_client.py.
+TASK_UPDATE_CONTENT_TYPE = 'application/x-swarming-task-update'
+
+
+# Maximum size of the decompressed output of a single binary task_update
+# request. The bot sends at most task_runner.MAX_CHUNK_SIZE per packet, so this
+# only protects the instance against a body that would expand to gigabytes.
+TASK_UPDATE_MAX_OUTPUT = 4*1024*1024
+
+
+# Maximum number of inputs a sleeping bot is asked to prefetch.
+PREFETCH_HINTS = 3
+
+
 def has_unexpected_subset_keys(expected_keys, minimum_keys, actual_keys, name):
   """Returns an error if unexpected keys are present or expected keys are
   missing.
@@ -488,11 +507,14 @@ class BotPollHandler(_BotBaseHandler):
       # This is a fairly complex function call, exceptions are expected.
       request, run_result = task_scheduler.bot_reap_task(
           res.dimensions, res.bot_id, res.version,
-          res.state.get('lease_expiration_ts'))
+          res.state.get('lease_expiration_ts'), res.state.get('named_caches'))
       if not request:
-        # No task found, tell it to sleep a bit.
+        # No task found, tell it to sleep a bit. It can meanwhile fetch the
+        # inputs of the tasks it will likely get.
         bot_event('request_sleep')
-        self._cmd_sleep(sleep_streak, quarantined)
+        self._cmd_sleep(
+            sleep_streak, quarantined,
+            task_to_run.get_prefetch_hints(res.dimensions, PREFETCH_HINTS))
         return
 
       try:
@@ -529,6 +551,7 @@ class BotPollHandler(_BotBaseHandler):
       'cmd': 'run',
       'manifest': {
         'bot_id': bot_id,
+        'caches': [c.to_dict() for c in request.properties.caches],
         'cipd_input': {
           'client_package': (
               request.properties.cipd_input.client_package.to_dict()),
@@ -556,12 +579,17 @@ class BotPollHandler(_BotBaseHandler):
     }
     self.send_response(utils.to_json_encodable(out))
 
-  def _cmd_sleep(self, sleep_streak, quarantined):
+  def _cmd_sleep(self, sleep_streak, quarantined, prefetch=None):
     out = {
       'cmd': 'sleep',
       'duration': task_scheduler.exponential_backoff(sleep_streak),
       'quarantined': quarantined,
     }
+    if prefetch:
+      out['prefetch'] = [
+        {'input': isolated, 'namespace': namespace, 'server': server}
+        for isolated, namespace, server in prefetch
+      ]
     self.send_response(out)
 
   def _cmd_terminate(self, task_id):
@@ -632,6 +660,9 @@ class BotTaskUpdateHandler(_BotApiHandler):
 
   The handler verifies packets are processed in order and will refuse
   out-of-order packets.
+
+  The request body is either a JSON dict with the output base64 encoded, or in
+  TASK_UPDATE_CONTENT_TYPE with the output zlib compressed.
   """
   ACCEPTED_KEYS = {
     u'bot_overhead', u'cipd_pins', u'cipd_stats', u'cost_usd', u'duration',
@@ -644,7 +675,22 @@ class BotTaskUpdateHandler(_BotApiHandler):
   def post(self, task_id=None):
     # Unlike handshake and poll, we do not accept invalid keys here. This code
     # path is much more strict.
-    request = self.parse_body()
+    if self.request.content_type == TASK_UPDATE_CONTENT_TYPE:
+      request, output = self._parse_binary_body()
+    else:
+      request = self.parse_body()
+      output = request.get('output')
+      if output is not None:
+        try:
+          output = base64.b64decode(output)
+        except UnicodeEncodeError as e:
+          logging.error('Failed to decode output\n%s\n%r', e, output)
+          output = output.encode('ascii', 'replace')
+        except TypeError as e:
+          # Save the output as-is instead. The error will be logged in
+          # ereporter2 and returning a HTTP 500 would only force the bot to stay
+          # in a retry loop.
+          logging.error('Failed to decode output\n%s\n%r', e, output)
     msg = log_unexpected_subset_keys(
         self.ACCEPTED_KEYS, self.REQUIRED_KEYS, request, self.request, 'bot',
         'keys')
@@ -667,7 +713,6 @@ class BotTaskUpdateHandler(_BotApiHandler):
     hard_timeout = request.get('hard_timeout')
     io_timeout = request.get('io_timeout')
     isolated_stats = request.get('isolated_stats')
-    output = request.get('output')
     output_chunk_start = request.get('output_chunk_start')
     outputs_ref = request.get('outputs_ref')
 
@@ -709,17 +754,6 @@ class BotTaskUpdateHandler(_BotApiHandler):
         performance_stats.package_installation = task_result.OperationStats(
             duration=cipd_stats.get('duration'))
 
-    if output is not None:
-      try:
-        output = base64.b64decode(output)
-      except UnicodeEncodeError as e:
-        logging.error('Failed to decode output\n%s\n%r', e, output)
-        output = output.encode('ascii', 'replace')
-      except TypeError as e:
-        # Save the output as-is instead. The error will be logged in ereporter2
-        # and returning a HTTP 500 would only force the bot to stay in a retry
-        # loop.
-        logging.error('Failed to decode output\n%s\n%r', e, output)
     if outputs_ref:
       outputs_ref = task_request.FilesRef(**outputs_ref)
 
@@ -778,6 +812,31 @@ class BotTaskUpdateHandler(_BotApiHandler):
     self.send_response(
         {'must_stop': state == task_result.State.CANCELED, 'ok': True})
 
+  def _parse_binary_body(self):
+    """Parses a body in TASK_UPDATE_CONTENT_TYPE.
+
+    Returns:
+      tuple(dict of the parameters, output or None).
+    """
+    body = self.request.body
+    try:
+      length = struct.unpack_from('>I', body)[0]
+      request = json.loads(body[4:4+length])
+      if not isinstance(request, dict) or u'output' in request:
+        raise ValueError('invalid parameters')
+      output = body[4+length:]
+      if not output:
+        return request, None
+      decompressor = zlib.decompressobj()
+      output = decompressor.decompress(output, TASK_UPDATE_MAX_OUTPUT)
+      if not decompressor.unconsumed_tail:
+        output += decompressor.flush()
+      if decompressor.unconsumed_tail or len(output) > TASK_UPDATE_MAX_OUTPUT:
+        raise ValueError('output larger than %d bytes' % TASK_UPDATE_MAX_OUTPUT)
+      return request, output
+    except (struct.error, ValueError, zlib.error) as e:
+      self.abort_with_error(400, error='Invalid task_update body: %s' % e)
+
 
 class BotTaskErrorHandler(_BotApiHandler):
   """It is a specialized version of ereporter2's /ereporter2/api/v1/on_error
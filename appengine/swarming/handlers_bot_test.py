@@ -6,13 +6,16 @@
 
 import base64
 import datetime
+import json
 import logging
 import os
 import random
 import StringIO
+import struct
 import sys
 import unittest
 import zipfile
+import zlib
 
 # Setups environment.
 import test_env_handlers
@@ -32,6 +35,8 @@ from server import bot_code
 from server import bot_groups_config
 from server import bot_management
 from server import stats
+from server import task_pack
+from server import task_to_run
 
 
 DATETIME_FORMAT = u'%Y-%m-%dT%H:%M:%S'
@@ -268,6 +273,7 @@ class BotApiTest(test_env_handlers.AppTestBase):
       u'cmd': u'run',
       u'manifest': {
         u'bot_id': u'bot1',
+        u'caches': [],
         u'cipd_input': {
           u'client_package': {
             u'package_name': u'infra/tools/cipd/${platform}',
@@ -333,6 +339,7 @@ class BotApiTest(test_env_handlers.AppTestBase):
       u'cmd': u'run',
       u'manifest': {
         u'bot_id': u'bot1',
+        u'caches': [],
         u'cipd_input': {
           u'client_package': {
             u'package_name': u'infra/tools/cipd/${platform}',
@@ -418,6 +425,7 @@ class BotApiTest(test_env_handlers.AppTestBase):
       u'cmd': u'run',
       u'manifest': {
         u'bot_id': u'bot1',
+        u'caches': [],
         u'cipd_input': {
           u'client_package': {
             u'package_name': u'infra/tools/cipd/${platform}',
@@ -553,6 +561,27 @@ class BotApiTest(test_env_handlers.AppTestBase):
     self.assertTrue(response.pop('duration'))
     self.assertEqual(expected, response)
 
+  def test_poll_not_enough_time_prefetch(self):
+    # The bot can't run the isolated task, it is asked to prefetch its inputs.
+    self.client_create_task_isolated()
+    task_to_run.refresh_ready_hashes()
+    params = self.do_handshake()
+    params['state']['lease_expiration_ts'] = 0
+    response = self.post_json('/swarming/api/v1/bot/poll', params)
+    expected = {
+      u'cmd': u'sleep',
+      u'prefetch': [
+        {
+          u'input': u'0123456789012345678901234567890123456789',
+          u'namespace': u'default-gzip',
+          u'server': u'http://localhost:1',
+        },
+      ],
+      u'quarantined': False,
+    }
+    self.assertTrue(response.pop('duration'))
+    self.assertEqual(expected, response)
+
   def test_poll_enough_time(self):
     # Successfully poll a task.
     self.mock(random, 'getrandbits', lambda _: 0x88)
@@ -570,6 +599,7 @@ class BotApiTest(test_env_handlers.AppTestBase):
       u'cmd': u'run',
       u'manifest': {
         u'bot_id': u'bot1',
+        u'caches': [],
         u'cipd_input': {
           u'client_package': {
             u'package_name': u'infra/tools/cipd/${platform}',
@@ -966,6 +996,51 @@ class BotApiTest(test_env_handlers.AppTestBase):
     }
     self.assertEqual(expected, response)
 
+  def test_task_update_binary(self):
+    params = self.do_handshake()
+    self.client_create_task_raw()
+    response = self.post_json('/swarming/api/v1/bot/poll', params)
+    task_id = response['manifest']['task_id']
+
+    def post(params, output, **kwargs):
+      header = json.dumps(params)
+      body = struct.pack('>I', len(header)) + header
+      if output:
+        body += zlib.compress(output)
+      return self.app.post(
+          '/swarming/api/v1/bot/task_update', body,
+          content_type=handlers_bot.TASK_UPDATE_CONTENT_TYPE, **kwargs).json
+
+    params = {
+      'cost_usd': 0.1,
+      'id': 'bot1',
+      'output_chunk_start': 0,
+      'task_id': task_id,
+    }
+    self.assertEqual(
+        {u'must_stop': False, u'ok': True}, post(params, 'result \0'))
+    params.update(duration=0.1, exit_code=0, output_chunk_start=8)
+    self.assertEqual(
+        {u'must_stop': False, u'ok': True}, post(params, 'string'))
+    run_result = task_pack.unpack_run_result_key(task_id).get()
+    self.assertEqual('result \0string', run_result.get_output())
+    self.assertEqual(u'COMPLETED', self.client_get_results(task_id)['state'])
+
+    # The output must not be in the parameters.
+    params['output'] = base64.b64encode('foo')
+    response = post(params, None, status=400)
+    self.assertIn(u'Invalid task_update body', response[u'error'])
+    # Truncated header.
+    response = self.app.post(
+        '/swarming/api/v1/bot/task_update', '\0\0',
+        content_type=handlers_bot.TASK_UPDATE_CONTENT_TYPE, status=400).json
+    self.assertIn(u'Invalid task_update body', response[u'error'])
+    # Output that decompresses past the limit.
+    self.mock(handlers_bot, 'TASK_UPDATE_MAX_OUTPUT', 1024)
+    del params['output']
+    response = post(params, 'a' * 1025, status=400)
+    self.assertIn(u'output larger than 1024 bytes', response[u'error'])
+
   def test_task_internal_failure(self):
     # E.g. task_runner blew up.
     self.mock(random, 'getrandbits', lambda _: 0x88)
@@ -48,14 +48,10 @@ def _decode_field(self, field, value):
 protojson.ProtoJson.decode_field = _decode_field
 
 
-def get_request_and_result(task_id):
-  """Provides the key and TaskRequest corresponding to a task ID.
-
-  Enforces the ACL for users. Allows bots all access for the moment.
+def _task_id_to_keys(task_id):
+  """Returns the TaskRequest ndb.Key and the result ndb.Key for a task ID.
 
-  Returns:
-    tuple(TaskRequest, result): result can be either for a TaskRunResult or a
-                                TaskResultSummay.
+  Raises endpoints.BadRequestException if the task ID is invalid.
   """
   try:
     key = task_pack.unpack_result_summary_key(task_id)
@@ -67,12 +63,39 @@ def get_request_and_result(task_id):
           task_pack.run_result_key_to_result_summary_key(key))
     except ValueError:
       raise endpoints.BadRequestException('%s is an invalid key.' % task_id)
-  request, result = ndb.get_multi((request_key, key))
-  if not request or not result:
-    raise endpoints.NotFoundException('%s not found.' % key.id())
-  if not acl.is_bot() and not request.has_access:
-    raise endpoints.ForbiddenException('%s is not accessible.' % key.id())
-  return request, result
+  return request_key, key
+
+
+def get_request_and_result(task_id):
+  """Provides the key and TaskRequest corresponding to a task ID.
+
+  Enforces the ACL for users. Allows bots all access for the moment.
+
+  Returns:
+    tuple(TaskRequest, result): result can be either for a TaskRunResult or a
+                                TaskResultSummay.
+  """
+  return get_requests_and_results([task_id])[0]
+
+
+def get_requests_and_results(task_ids):
+  """Same as get_request_and_result() for multiple task IDs, with a single
+  datastore fetch.
+
+  Returns:
+    list of tuple(TaskRequest, result), in the same order as task_ids.
+  """
+  keys = [_task_id_to_keys(task_id) for task_id in task_ids]
+  entities = ndb.get_multi([k for pair in keys for k in pair])
+  out = []
+  for i, (_, key) in enumerate(keys):
+    request, result = entities[2*i:2*i+2]
+    if not request or not result:
+      raise endpoints.NotFoundException('%s not found.' % key.id())
+    if not acl.is_bot() and not request.has_access:
+      raise endpoints.ForbiddenException('%s is not accessible.' % key.id())
+    out.append((request, result))
+  return out
 
 
 def get_or_raise(key):
@@ -110,9 +133,69 @@ def apply_property_defaults(properties):
         cfg.cipd.default_client_package.version)
 
 
+def _new_task_request_from_rpc(msg, now):
+  """Returns a task_request.TaskRequest ready to be scheduled from a
+  swarming_rpcs.NewTaskRequest.
+
+  Raises endpoints.BadRequestException if the request is invalid.
+  """
+  try:
+    request = message_conversion.new_task_request_from_rpc(msg, now)
+    apply_property_defaults(request.properties)
+    task_request.init_new_request(request, acl.is_bot_or_admin())
+  except (datastore_errors.BadValueError, TypeError, ValueError) as e:
+    raise endpoints.BadRequestException(e.message)
+  return request
+
+
+def _task_request_metadata(request, result_summary):
+  """Returns a swarming_rpcs.TaskRequestMetadata for a scheduled task."""
+  previous_result = None
+  if result_summary.deduped_from:
+    previous_result = message_conversion.task_result_to_rpc(
+        result_summary, False)
+  return swarming_rpcs.TaskRequestMetadata(
+      request=message_conversion.task_request_to_rpc(request),
+      task_id=task_pack.pack_result_summary_key(result_summary.key),
+      task_result=previous_result)
+
+
+def _get_wait_timeout(timeout_secs):
+  """Returns the duration to hold a wait call for, in seconds."""
+  if timeout_secs is None or timeout_secs < 0:
+    raise endpoints.BadRequestException('timeout_secs must be positive')
+  return min(timeout_secs, MAX_WAIT_SECS)
+
+
 ### API
 
 
+# Maximum number of tasks that can be created with a single tasks.new_batch
+# call.
+MAX_NEW_BATCH_SIZE = 1000
+
+
+# Maximum number of tasks that can be waited for with a single tasks.wait call.
+MAX_WAIT_BATCH_SIZE = 1000
+
+
+# Maximum number of tasks that can be fetched with a single tasks.results call,
+# without and with their output.
+MAX_RESULTS_BATCH_SIZE = 1000
+MAX_RESULTS_OUTPUT_BATCH_SIZE = 100
+
+
+# Maximum total size of the outputs sent by a single tasks.results call, in
+# bytes. It keeps the response well below the frontend response size limit, even
+# once encoded in JSON.
+MAX_RESULTS_OUTPUT_SIZE = 8*1024*1024
+
+
+# Maximum duration a task.wait or tasks.wait call is held, in seconds. It must
+# stay below the 60 seconds deadline of frontend requests.
+MAX_WAIT_SECS = 45
+
+
 swarming_api = auth.endpoints_api(
     name='swarming',
     version='v1',
@@ -249,6 +332,22 @@ TaskIdWithPerf = endpoints.ResourceContainer(
     include_performance_stats=messages.BooleanField(2, default=False))
 
 
+TaskWaitRequest = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    task_id=messages.StringField(1, required=True),
+    state=messages.EnumField(swarming_rpcs.StateField, 2),
+    timeout_secs=messages.IntegerField(3, default=MAX_WAIT_SECS),
+    include_performance_stats=messages.BooleanField(4, default=False))
+
+
+TaskOutputRequest = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    task_id=messages.StringField(1, required=True),
+    offset=messages.IntegerField(2, default=0),
+    length=messages.IntegerField(3, default=0),
+    wait_secs=messages.IntegerField(4, default=0))
+
+
 @swarming_api.api_class(resource_name='task', path='task')
 class SwarmingTaskService(remote.Service):
   """Swarming's task-related API."""
@@ -273,6 +372,32 @@ class SwarmingTaskService(remote.Service):
     return message_conversion.task_result_to_rpc(
         result, request.include_performance_stats)
 
+  @gae_ts_mon.instrument_endpoint()
+  @auth.endpoints_method(
+      TaskWaitRequest, swarming_rpcs.TaskResult,
+      name='wait',
+      path='{task_id}/wait',
+      http_method='GET')
+  @auth.require(acl.is_bot_or_user)
+  def wait(self, request):
+    """Reports the result of the task corresponding to a task ID as soon as its
+    state changes.
+
+    The call returns when the task state differs from 'state' or, if 'state' is
+    not specified, when the task is not pending or running anymore. Otherwise it
+    returns the current result after timeout_secs, which is capped to 45
+    seconds. This replaces polling 'result'.
+    """
+    logging.info('%s', request)
+    _, result = get_request_and_result(request.task_id)
+    last_state = request.state.number if request.state else None
+    result = task_result.wait_for_change(
+        [result.key], [last_state], _get_wait_timeout(request.timeout_secs))[0]
+    if not result:
+      raise endpoints.NotFoundException('%s not found.' % request.task_id)
+    return message_conversion.task_result_to_rpc(
+        result, request.include_performance_stats)
+
   @gae_ts_mon.instrument_endpoint()
   @auth.endpoints_method(
       TaskId, swarming_rpcs.TaskRequest,
@@ -304,23 +429,44 @@ class SwarmingTaskService(remote.Service):
 
   @gae_ts_mon.instrument_endpoint()
   @auth.endpoints_method(
-      TaskId, swarming_rpcs.TaskOutput,
+      TaskOutputRequest, swarming_rpcs.TaskOutput,
       name='stdout',
       path='{task_id}/stdout',
       http_method='GET')
   @auth.require(acl.is_bot_or_user)
   def stdout(self, request):
-    """Returns the output of the task corresponding to a task ID."""
-    # TODO(maruel): Add streaming. Real streaming is not supported by AppEngine
-    # v1.
+    """Returns the output of the task corresponding to a task ID.
+
+    'offset' and 'length' select a range of the output, in bytes. Only the
+    relevant part of the output is read, so tailing a large output is cheap.
+
+    When 'wait_secs' is set and there is no output past 'offset' yet, the call
+    waits up to wait_secs, capped to 45 seconds, for more output or for the task
+    to stop running. Following a running task is done by calling it in a loop
+    with the returned 'next_offset' until 'state' is not RUNNING or PENDING
+    anymore.
+    """
     # TODO(maruel): Send as raw content instead of encoded. This is not
     # supported by cloud endpoints.
     logging.info('%s', request)
+    if request.offset < 0 or request.length < 0:
+      raise endpoints.BadRequestException('offset and length must be positive')
     _, result = get_request_and_result(request.task_id)
-    output = result.get_output()
+    if request.wait_secs:
+      result, output = task_result.wait_for_output(
+          result.key, request.offset, request.length,
+          _get_wait_timeout(request.wait_secs))
+      if not result:
+        raise endpoints.NotFoundException('%s not found.' % request.task_id)
+    else:
+      output = result.get_output(request.offset, request.length)
+    next_offset = request.offset + len(output or '')
     if output:
       output = output.decode('utf-8', 'replace')
-    return swarming_rpcs.TaskOutput(output=output)
+    return swarming_rpcs.TaskOutput(
+        output=output,
+        next_offset=next_offset,
+        state=swarming_rpcs.StateField(result.state))
 
 
 @swarming_api.api_class(resource_name='tasks', path='tasks')
@@ -338,26 +484,123 @@ class SwarmingTasksService(remote.Service):
     in the task request.
     """
     logging.info('%s', request)
+    request = _new_task_request_from_rpc(request, utils.utcnow())
+    result_summary = task_scheduler.schedule_request(request)
+    return _task_request_metadata(request, result_summary)
 
-    try:
-      request = message_conversion.new_task_request_from_rpc(
-          request, utils.utcnow())
-      apply_property_defaults(request.properties)
-      task_request.init_new_request(request, acl.is_bot_or_admin())
-    except (datastore_errors.BadValueError, TypeError, ValueError) as e:
-      raise endpoints.BadRequestException(e.message)
+  @gae_ts_mon.instrument_endpoint()
+  @auth.endpoints_method(
+      swarming_rpcs.NewTaskRequests, swarming_rpcs.TaskRequestMetadataList)
+  @auth.require(acl.is_bot_or_user)
+  def new_batch(self, request):
+    """Creates multiple new tasks at once.
 
-    result_summary = task_scheduler.schedule_request(request)
+    All the tasks are validated before any is created. It is much faster than
+    calling new for each task, e.g. for each shard of a sharded task.
+    """
+    logging.info('%d tasks', len(request.items))
+    if not request.items:
+      raise endpoints.BadRequestException('items is required')
+    if len(request.items) > MAX_NEW_BATCH_SIZE:
+      raise endpoints.BadRequestException(
+          'At most %d tasks can be created at once' % MAX_NEW_BATCH_SIZE)
+    now = utils.utcnow()
+    requests = [_new_task_request_from_rpc(i, now) for i in request.items]
+    result_summaries = task_scheduler.schedule_requests(requests)
+    return swarming_rpcs.TaskRequestMetadataList(
+        items=[
+          _task_request_metadata(r, s)
+          for r, s in zip(requests, result_summaries)
+        ])
+
+  @gae_ts_mon.instrument_endpoint()
+  @auth.endpoints_method(
+      swarming_rpcs.TasksResultsRequest, swarming_rpcs.TaskList)
+  @auth.require(acl.is_bot_or_user)
+  def results(self, request):
+    """Reports the results of multiple tasks at once.
 
-    previous_result = None
-    if result_summary.deduped_from:
-      previous_result = message_conversion.task_result_to_rpc(
-          result_summary, False)
+    The results are in the same order as task_ids. The output of the tasks is
+    only sent when include_output is set, in which case at most 100 tasks can
+    be requested. It is much cheaper than calling task.result and task.stdout
+    for each task, e.g. to collect the shards of a sharded task.
 
-    return swarming_rpcs.TaskRequestMetadata(
-        request=message_conversion.task_request_to_rpc(request),
-        task_id=task_pack.pack_result_summary_key(result_summary.key),
-        task_result=previous_result)
+    The outputs sent are capped to MAX_RESULTS_OUTPUT_SIZE bytes in total. The
+    other ones have output_omitted set and must be fetched with task.stdout.
+    """
+    logging.info(
+        '%d tasks, include_output=%s', len(request.task_ids),
+        request.include_output)
+    if not request.task_ids:
+      raise endpoints.BadRequestException('task_ids is required')
+    limit = (
+        MAX_RESULTS_OUTPUT_BATCH_SIZE if request.include_output
+        else MAX_RESULTS_BATCH_SIZE)
+    if len(request.task_ids) > limit:
+      raise endpoints.BadRequestException(
+          'At most %d tasks can be fetched at once' % limit)
+    results = [r for _, r in get_requests_and_results(request.task_ids)]
+    items = [
+      message_conversion.task_result_to_rpc(
+          r, request.include_performance_stats)
+      for r in results
+    ]
+    if request.include_output:
+      # Only fetch the outputs that surely fit, based on their number of chunks.
+      budget = MAX_RESULTS_OUTPUT_SIZE
+      futures = []
+      for item, r in zip(items, results):
+        size = min(
+            (r.stdout_chunks or 0) * task_result.TaskOutput.CHUNK_SIZE,
+            task_result.TaskOutput.FETCH_MAX_CONTENT)
+        if size > budget:
+          item.output_omitted = True
+          futures.append(None)
+          continue
+        budget -= size
+        futures.append(r.get_output_async())
+      # The outputs are fetched concurrently.
+      for item, future in zip(items, futures):
+        output = future.get_result() if future else None
+        if output:
+          item.output = output.decode('utf-8', 'replace')
+    return swarming_rpcs.TaskList(items=items, now=utils.utcnow())
+
+  @gae_ts_mon.instrument_endpoint()
+  @auth.endpoints_method(
+      swarming_rpcs.TasksWaitRequest, swarming_rpcs.TaskList)
+  @auth.require(acl.is_bot_or_user)
+  def wait(self, request):
+    """Waits for at least one of multiple tasks to stop running.
+
+    The call returns the results of the tasks that are not pending nor running
+    anymore as soon as there is at least one, or after timeout_secs, which is
+    capped to 45 seconds. The results of the tasks still running are not
+    returned. It is much cheaper than calling task.wait for each task, e.g. to
+    collect the shards of a sharded task.
+    """
+    logging.info(
+        '%d tasks, timeout_secs=%s', len(request.task_ids),
+        request.timeout_secs)
+    if not request.task_ids:
+      raise endpoints.BadRequestException('task_ids is required')
+    if len(request.task_ids) > MAX_WAIT_BATCH_SIZE:
+      raise endpoints.BadRequestException(
+          'At most %d tasks can be waited for at once' % MAX_WAIT_BATCH_SIZE)
+    timeout = _get_wait_timeout(request.timeout_secs)
+    keys = [r.key for _, r in get_requests_and_results(request.task_ids)]
+    results = task_result.wait_for_change(keys, [None] * len(keys), timeout)
+    for task_id, result in zip(request.task_ids, results):
+      if not result:
+        raise endpoints.NotFoundException('%s not found.' % task_id)
+    return swarming_rpcs.TaskList(
+        items=[
+          message_conversion.task_result_to_rpc(
+              r, request.include_performance_stats)
+          for r in results
+          if r.state not in task_result.State.STATES_RUNNING
+        ],
+        now=utils.utcnow())
 
   @gae_ts_mon.instrument_endpoint()
   @auth.endpoints_method(
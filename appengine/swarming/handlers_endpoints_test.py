@@ -565,6 +565,115 @@ class TasksApiTest(BaseTest):
         expected,
         self.call_api('requests', body=message_to_dict(request)).json)
 
+  def test_new_batch_ok(self):
+    """Asserts that new_batch creates all the tasks."""
+    def gen_request(name, os_name):
+      return swarming_rpcs.NewTaskRequest(
+          expiration_secs=30,
+          name=name,
+          priority=200,
+          properties=swarming_rpcs.TaskProperties(
+              command=['python', 'run_test.py'],
+              dimensions=[
+                swarming_rpcs.StringPair(key='os', value=os_name),
+                swarming_rpcs.StringPair(key='pool', value='default'),
+              ],
+              execution_timeout_secs=30,
+              io_timeout_secs=30),
+          user='joe@localhost')
+    request = swarming_rpcs.NewTaskRequests(
+        items=[gen_request('job1', 'Amiga'), gen_request('job2', 'Atari')])
+    response = self.call_api('new_batch', body=message_to_dict(request))
+    items = response.json['items']
+    self.assertEqual(
+        [u'job1', u'job2'], [i['request']['name'] for i in items])
+    task_ids = [i['task_id'] for i in items]
+    self.assertEqual(2, len(set(task_ids)))
+    for task_id in task_ids:
+      self.assertEqual(
+          u'PENDING', self.client_get_results(task_id)['state'])
+
+  def test_new_batch_empty(self):
+    request = swarming_rpcs.NewTaskRequests(items=[])
+    self.call_api(
+        'new_batch', body=message_to_dict(request), status=400)
+
+  def test_results_ok(self):
+    """Asserts that results returns the results in order."""
+    self.client_create_task_raw()
+    self.set_as_bot()
+    run_id = self.bot_run_task()
+    self.set_as_user()
+    _, pending_id = self.client_create_task_raw()
+    task_id = run_id[:-1] + '0'
+    request = swarming_rpcs.TasksResultsRequest(
+        task_ids=[pending_id, task_id, run_id])
+    items = self.call_api('results', body=message_to_dict(request)).json[
+        'items']
+    self.assertEqual(
+        [pending_id, task_id, run_id], [i['task_id'] for i in items])
+    self.assertEqual(
+        [u'PENDING', u'COMPLETED', u'COMPLETED'], [i['state'] for i in items])
+    self.assertEqual([None] * 3, [i.get('output') for i in items])
+
+    request.include_output = True
+    items = self.call_api('results', body=message_to_dict(request)).json[
+        'items']
+    self.assertEqual(
+        [None, u'rÉsult string', u'rÉsult string'],
+        [i.get('output') for i in items])
+
+  def test_results_output_omitted(self):
+    """Asserts that the outputs over the size limit are not sent."""
+    self.mock(
+        handlers_endpoints, 'MAX_RESULTS_OUTPUT_SIZE',
+        task_result.TaskOutput.CHUNK_SIZE)
+    self.client_create_task_raw()
+    self.set_as_bot()
+    run_id = self.bot_run_task()
+    self.set_as_user()
+    task_id = run_id[:-1] + '0'
+    request = swarming_rpcs.TasksResultsRequest(
+        task_ids=[task_id, run_id], include_output=True)
+    items = self.call_api('results', body=message_to_dict(request)).json[
+        'items']
+    self.assertEqual(
+        [u'rÉsult string', None], [i.get('output') for i in items])
+    self.assertEqual(
+        [None, True], [i.get('output_omitted') for i in items])
+
+  def test_results_too_many_outputs(self):
+    count = handlers_endpoints.MAX_RESULTS_OUTPUT_BATCH_SIZE + 1
+    request = swarming_rpcs.TasksResultsRequest(
+        task_ids=['12300'] * count, include_output=True)
+    self.call_api('results', body=message_to_dict(request), status=400)
+
+  def test_wait_ok(self):
+    """Asserts that wait only returns the tasks that stopped running."""
+    self.mock(
+        task_result.time, 'sleep', lambda _: self.fail('Unexpected sleep'))
+    self.client_create_task_raw()
+    self.set_as_bot()
+    run_id = self.bot_run_task()
+    self.set_as_user()
+    _, pending_id = self.client_create_task_raw()
+    _, other_id = self.client_create_task_raw()
+    request = swarming_rpcs.TasksWaitRequest(
+        task_ids=[pending_id, other_id], timeout_secs=0)
+    response = self.call_api('wait', body=message_to_dict(request))
+    self.assertEqual([], response.json.get('items', []))
+
+    request = swarming_rpcs.TasksWaitRequest(
+        task_ids=[pending_id, other_id, run_id])
+    response = self.call_api('wait', body=message_to_dict(request))
+    items = response.json['items']
+    self.assertEqual([run_id], [i['task_id'] for i in items])
+    self.assertEqual(u'COMPLETED', items[0]['state'])
+
+  def test_wait_empty(self):
+    request = swarming_rpcs.TasksWaitRequest(task_ids=[])
+    self.call_api('wait', body=message_to_dict(request), status=400)
+
   def test_new_ok_isolated(self):
     """Asserts that new generates appropriate metadata."""
     self.mock(random, 'getrandbits', lambda _: 0x88)
@@ -1321,6 +1430,26 @@ class TaskApiTest(BaseTest):
     }
     self.assertEqual(expected, response.json)
 
+  def test_wait_ok(self):
+    """Asserts that wait returns as soon as the state changed."""
+    self.mock(
+        task_result.time, 'sleep', lambda _: self.fail('Unexpected sleep'))
+    _, task_id = self.client_create_task_raw()
+    response = self.call_api(
+        'wait', body={'task_id': task_id, 'timeout_secs': 0})
+    self.assertEqual(u'PENDING', response.json['state'])
+
+    self.set_as_bot()
+    self.bot_poll('bot1')
+    self.set_as_user()
+    response = self.call_api(
+        'wait', body={'task_id': task_id, 'state': 'PENDING'})
+    self.assertEqual(u'RUNNING', response.json['state'])
+
+  def test_wait_unknown(self):
+    """Asserts that wait raises 404 for unknown task IDs."""
+    self.call_api('wait', body={'task_id': '12300'}, status=404)
+
   def test_result_completed_task(self):
     """Tests that completed tasks are correctly reported."""
     now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
@@ -1391,16 +1520,47 @@ class TaskApiTest(BaseTest):
 
     self.set_as_privileged_user()
     run_id = task_id[:-1] + '1'
-    expected = {u'output': u'rÉsult string'}
+    expected = {
+      u'next_offset': u'14',
+      u'output': u'rÉsult string',
+      u'state': u'COMPLETED',
+    }
     for i in (task_id, run_id):
       response = self.call_api('stdout', body={'task_id': i})
       self.assertEqual(expected, response.json)
 
+  def test_stdout_range(self):
+    """Asserts that stdout only returns the requested range."""
+    self.client_create_task_raw()
+    self.set_as_bot()
+    task_id = self.bot_run_task()
+
+    self.set_as_privileged_user()
+    # 'É' is 2 bytes long in UTF-8.
+    response = self.call_api(
+        'stdout', body={'task_id': task_id, 'offset': 3, 'length': 6})
+    expected = {
+      u'next_offset': u'9',
+      u'output': u'sult s',
+      u'state': u'COMPLETED',
+    }
+    self.assertEqual(expected, response.json)
+    # Waiting returns right away since the task completed.
+    self.mock(
+        task_result.time, 'sleep', lambda _: self.fail('Unexpected sleep'))
+    response = self.call_api(
+        'stdout', body={'task_id': task_id, 'offset': 14, 'wait_secs': 10})
+    self.assertEqual(
+        {u'next_offset': u'14', u'state': u'COMPLETED'}, response.json)
+    self.call_api(
+        'stdout', body={'task_id': task_id, 'offset': -1}, status=400)
+
   def test_stdout_empty(self):
     """Asserts that incipient tasks produce no output."""
     _, task_id = self.client_create_task_raw()
     response = self.call_api('stdout', body={'task_id': task_id})
-    self.assertEqual({}, response.json)
+    self.assertEqual(
+        {u'next_offset': u'0', u'state': u'PENDING'}, response.json)
 
     run_id = task_id[:-1] + '1'
     self.call_api('stdout', body={'task_id': run_id}, status=404)
@@ -1433,7 +1593,12 @@ class TaskApiTest(BaseTest):
 
     # results shouldn't change, even if the second task wasn't executed
     response = self.call_api('stdout', body={'task_id': task_id_2})
-    self.assertEqual({'output': u'rÉsult string'}, response.json)
+    expected = {
+      u'next_offset': u'14',
+      u'output': u'rÉsult string',
+      u'state': u'COMPLETED',
+    }
+    self.assertEqual(expected, response.json)
 
   def test_request_unknown(self):
     """Asserts that 404 is raised for unknown tasks."""
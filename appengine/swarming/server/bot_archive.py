@@ -52,6 +52,7 @@ FILES = (
     'client/cipd.py',
     'client/isolated_format.py',
     'client/isolateserver.py',
+    'client/named_cache.py',
     'client/run_isolated.py',
     'config/__init__.py',
     'libs/__init__.py',
@@ -183,6 +184,7 @@ FILES = (
     'utils/auth_server.py',
     'utils/authenticators.py',
     'utils/cacert.pem',
+    'utils/dir_watcher.py',
     'utils/file_path.py',
     'utils/fs.py',
     'utils/large.py',
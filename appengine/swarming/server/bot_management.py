@@ -22,7 +22,7 @@
 - BotInfo is a 'dump-only' entity used for UI, it permits quickly show the
   state of every bots in an single query. It is basically a cache of the last
   BotEvent and additionally updated on poll. It doesn't need to be updated in a
-  transaction.
+  transaction. Updates on poll are buffered in memcache, see bot_event().
 - BotSettings contains bot-specific settings. It must be updated in a
   transaction and contains admin-provided settings, contrary to the other
   entities which are generated from data provided by the bot itself.
@@ -31,6 +31,7 @@
 import datetime
 import hashlib
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from components import datastore_utils
@@ -44,6 +45,12 @@ from server import task_pack
 BOT_REBOOT_PERIOD_RANDOMIZATION_MARGIN = 0.2
 
 
+# Maximum number of seconds BotInfo.last_seen_ts and BotInfo.state can lag
+# behind the last poll of a bot, see bot_event(). It must be well below
+# bot_death_timeout_secs.
+BOT_INFO_WRITE_PERIOD_SECS = 60
+
+
 ### Models.
 
 # There is one BotRoot entity per bot id. Multiple bots could run on a single
@@ -171,6 +178,11 @@ class BotInfo(_BotCommon):
     if not self.task_id:
       self.task_name = None
 
+  @classmethod
+  def _post_delete_hook(cls, key, _future):
+    # Do not let the buffered updates resurrect a deleted bot.
+    memcache.delete(key.parent().string_id(), namespace='bot_info')
+
 
 class BotEvent(_BotCommon):
   """This entity is immutable.
@@ -236,6 +248,14 @@ class DimensionAggregation(ndb.Model):
 ### Private APIs.
 
 
+def _bot_info_to_compare(bot_info):
+  """Returns the BotInfo values that must be stored as soon as they change.
+
+  last_seen_ts and state change on every poll so they are excluded.
+  """
+  return bot_info.to_dict(exclude=['last_seen_ts', 'state'])
+
+
 ### Public APIs.
 
 
@@ -325,10 +345,20 @@ def bot_event(
   if not bot_id:
     return
 
-  # Retrieve the previous BotInfo and update it.
-  info_key = get_info_key(bot_id)
-  bot_info = info_key.get() or BotInfo(key=info_key)
-  bot_info.last_seen_ts = utils.utcnow()
+  # Retrieve the previous BotInfo and update it. On poll, memcache has the
+  # BotInfo as of the last poll, along the time it was last stored.
+  now = utils.utcnow()
+  is_poll = event_type in ('request_sleep', 'task_update')
+  cached = None
+  if is_poll:
+    cached = memcache.get(bot_id, namespace='bot_info')
+  if cached:
+    bot_info = cached[1]
+  else:
+    info_key = get_info_key(bot_id)
+    bot_info = info_key.get() or BotInfo(key=info_key)
+  previous = _bot_info_to_compare(bot_info)
+  bot_info.last_seen_ts = now
   bot_info.external_ip = external_ip
   bot_info.authenticated_as = authenticated_as
   if dimensions:
@@ -348,12 +378,22 @@ def bot_event(
   if kwargs.get('lease_expiration_ts') is not None:
     bot_info.lease_expiration_ts = kwargs['lease_expiration_ts']
 
-  if event_type in ('request_sleep', 'task_update'):
+  if is_poll:
     # Handle this specifically. It's not much of an even worth saving a BotEvent
     # for but it's worth updating BotInfo. The only reason BotInfo is GET is to
     # keep first_seen_ts. It's not necessary to use a transaction here since no
     # BotEvent is being added, only last_seen_ts is really updated.
+    #
+    # When only last_seen_ts and state changed, the update is buffered in
+    # memcache for up to BOT_INFO_WRITE_PERIOD_SECS.
+    # cron_update_bot_info() stores the updates of the bots that stopped
+    # polling.
+    if (cached and previous == _bot_info_to_compare(bot_info) and
+        (now - cached[0]).total_seconds() < BOT_INFO_WRITE_PERIOD_SECS):
+      memcache.set(bot_id, (cached[0], bot_info), namespace='bot_info')
+      return
     bot_info.put()
+    memcache.set(bot_id, (now, bot_info), namespace='bot_info')
     return
 
   event = BotEvent(
@@ -373,6 +413,7 @@ def bot_event(
     bot_info.task_id = ''
 
   datastore_utils.store_new_version(event, BotRoot, [bot_info])
+  memcache.set(bot_id, (now, bot_info), namespace='bot_info')
 
 
 def get_bot_reboot_period(bot_id, state):
@@ -413,3 +454,31 @@ def should_restart_bot(bot_id, state):
   if period and running_time > period:
     return True, 'Periodic reboot: running longer than %ds' % period
   return False, ''
+
+
+def cron_update_bot_info():
+  """Stores the BotInfo updates buffered in memcache by bot_event().
+
+  A polling bot stores its BotInfo at least every BOT_INFO_WRITE_PERIOD_SECS,
+  so only the bots that stopped polling recently can have updates left in
+  memcache.
+
+  Returns:
+    Number of BotInfo stored.
+  """
+  now = utils.utcnow()
+  period = datetime.timedelta(seconds=BOT_INFO_WRITE_PERIOD_SECS)
+  # Look a few periods back in case a cron job execution was skipped.
+  q = BotInfo.query(
+      BotInfo.last_seen_ts < now - period,
+      BotInfo.last_seen_ts > now - 5 * period)
+  bots = q.fetch(batch_size=500)
+  if not bots:
+    return 0
+  cached = memcache.get_multi([b.id for b in bots], namespace='bot_info')
+  to_put = [
+    cached[b.id][1] for b in bots
+    if b.id in cached and cached[b.id][1].last_seen_ts > b.last_seen_ts
+  ]
+  ndb.put_multi(to_put)
+  return len(to_put)
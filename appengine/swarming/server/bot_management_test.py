@@ -29,6 +29,35 @@ class BotManagementTest(test_case.TestCase):
     missing = expected - actual
     self.assertFalse(missing)
 
+  def test_cron_update_bot_info(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+    self.mock_now(now)
+    for bot_id in ('id1', 'id2'):
+      bot_management.bot_event(
+          event_type='request_sleep', bot_id=bot_id,
+          external_ip='8.8.4.4', authenticated_as='bot:%s.domain' % bot_id,
+          dimensions={'id': [bot_id]}, state={'ram': 65},
+          version=hashlib.sha1().hexdigest(), quarantined=False, task_id=None,
+          task_name=None)
+    # id1 polls once more then stops, the update is buffered.
+    now_30 = self.mock_now(now, 30)
+    bot_management.bot_event(
+        event_type='request_sleep', bot_id='id1',
+        external_ip='8.8.4.4', authenticated_as='bot:id1.domain',
+        dimensions={'id': ['id1']}, state={'ram': 66},
+        version=hashlib.sha1().hexdigest(), quarantined=False, task_id=None,
+        task_name=None)
+    self.assertEqual(0, bot_management.cron_update_bot_info())
+
+    self.mock_now(now, bot_management.BOT_INFO_WRITE_PERIOD_SECS + 1)
+    self.assertEqual(1, bot_management.cron_update_bot_info())
+    bot_info = bot_management.get_info_key('id1').get()
+    self.assertEqual(now_30, bot_info.last_seen_ts)
+    self.assertEqual({'ram': 66}, bot_info.state)
+    self.assertEqual(now, bot_management.get_info_key('id2').get().last_seen_ts)
+    # Nothing left to store.
+    self.assertEqual(0, bot_management.cron_update_bot_info())
+
   def test_dimensions_to_flat(self):
     self.assertEqual(
         ['a:b', 'c:d'], bot_management.dimensions_to_flat({'a': 'b', 'c': 'd'}))
@@ -124,6 +153,40 @@ class BotManagementTest(test_case.TestCase):
     # No BotEvent is registered for 'poll'.
     self.assertEqual([], bot_management.get_events_query('id1', True).fetch())
 
+  def test_bot_event_poll_sleep_buffered(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+    self.mock_now(now)
+    def poll(state, quarantined=False):
+      bot_management.bot_event(
+          event_type='request_sleep', bot_id='id1',
+          external_ip='8.8.4.4', authenticated_as='bot:id1.domain',
+          dimensions={'id': ['id1'], 'foo': ['bar']}, state=state,
+          version=hashlib.sha1().hexdigest(), quarantined=quarantined,
+          task_id=None, task_name=None)
+    poll({'ram': 65})
+
+    # Only last_seen_ts and state changed, the update is buffered.
+    self.mock_now(now, 10)
+    poll({'ram': 66})
+    bot_info = bot_management.get_info_key('id1').get()
+    self.assertEqual(now, bot_info.last_seen_ts)
+    self.assertEqual({'ram': 65}, bot_info.state)
+
+    # A meaningful change is stored right away.
+    now_20 = self.mock_now(now, 20)
+    poll({'ram': 67}, quarantined=True)
+    bot_info = bot_management.get_info_key('id1').get()
+    self.assertEqual(now_20, bot_info.last_seen_ts)
+    self.assertEqual({'ram': 67}, bot_info.state)
+    self.assertEqual(True, bot_info.quarantined)
+
+    # So is an update after BOT_INFO_WRITE_PERIOD_SECS.
+    now_80 = self.mock_now(now, 80)
+    poll({'ram': 68}, quarantined=True)
+    bot_info = bot_management.get_info_key('id1').get()
+    self.assertEqual(now_80, bot_info.last_seen_ts)
+    self.assertEqual({'ram': 68}, bot_info.state)
+
   def test_bot_event_busy(self):
     now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
     self.mock_now(now)
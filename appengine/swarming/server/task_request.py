@@ -73,6 +73,10 @@ MAXIMUM_PRIORITY = 255
 DIMENSION_KEY_RE = ur'^[a-zA-Z\-\_\.]+$'
 
 
+# Enforced on both task request and bots. Keep synced with named_cache.py.
+CACHE_NAME_RE = re.compile(ur'^[a-z0-9_]{1,4096}$')
+
+
 # One day in seconds. Add 10s to account for small jitter.
 _ONE_DAY_SECS = 24*60*60 + 10
 
@@ -237,6 +241,28 @@ def _validate_package_path(_prop, path):
         'CIPD package path cannot start with "/".')
 
 
+def _validate_cache_name(prop, value):
+  """Validates a named cache name."""
+  if not CACHE_NAME_RE.match(value):
+    raise datastore_errors.BadValueError(
+        '%s %r does not match %s' % (prop._name, value, CACHE_NAME_RE.pattern))
+
+
+def _validate_cache_path(_prop, path):
+  """Validates a named cache path, relative to the run dir."""
+  if not path:
+    raise datastore_errors.BadValueError('cache path is required')
+  if '\\' in path:
+    raise datastore_errors.BadValueError(
+        'cache path cannot contain \\. On Windows forward-slashes will be '
+        'replaced with back-slashes.')
+  if '..' in path.split('/'):
+    raise datastore_errors.BadValueError('cache path cannot contain "..".')
+  if path.startswith('/'):
+    raise datastore_errors.BadValueError(
+        'cache path cannot start with "/".')
+
+
 def _validate_service_account(prop, value):
   """Validates that 'service_account' field is 'bot', 'none' or email."""
   if not value:
@@ -344,6 +370,27 @@ class CipdInput(ndb.Model):
     self.packages.sort(key=lambda p: p.package_name)
 
 
+class CacheEntry(ndb.Model):
+  """Describes a named cache that should be present on the bot.
+
+  A named cache is a directory kept on the bot between tasks. It is mapped at
+  |path| in the run dir while the task runs.
+
+  A part of TaskProperties.
+  """
+  # Name of the cache, shared by all the tasks using it.
+  name = ndb.StringProperty(indexed=False, validator=_validate_cache_name)
+  # Path to the directory, relative to the run dir, where to map the cache.
+  path = ndb.StringProperty(indexed=False, validator=_validate_cache_path)
+
+  def _pre_put_hook(self):
+    super(CacheEntry, self)._pre_put_hook()
+    if not self.name:
+      raise datastore_errors.BadValueError('cache name is required')
+    if not self.path:
+      raise datastore_errors.BadValueError('cache path is required')
+
+
 class TaskProperties(ndb.Model):
   """Defines all the properties of a task to be run on the Swarming
   infrastructure.
@@ -388,6 +435,9 @@ class TaskProperties(ndb.Model):
   # CIPD packages to install.
   cipd_input = ndb.LocalStructuredProperty(CipdInput)
 
+  # Named caches to map in the run dir. They are kept on the bot between tasks.
+  caches = ndb.LocalStructuredProperty(CacheEntry, repeated=True)
+
   # Filter to use to determine the required properties on the bot to run on. For
   # example, Windows or hostname. Encoded as json. Either 'pool' or 'id'
   # dimension are required (see _validate_dimensions).
@@ -436,7 +486,8 @@ class TaskProperties(ndb.Model):
         not self.extra_args and
         not self.grace_period_secs and
         not self.io_timeout_secs and
-        not self.idempotent)
+        not self.idempotent and
+        not self.caches)
 
   @property
   def properties_hash(self):
@@ -453,7 +504,11 @@ class TaskProperties(ndb.Model):
     return self.HASHING_ALGO(utils.encode_to_json(self)).digest()
 
   def to_dict(self):
-    out = super(TaskProperties, self).to_dict(exclude=['commands'])
+    exclude = ['commands']
+    if not self.caches:
+      # Keeps properties_hash stable for the tasks not using named caches.
+      exclude.append('caches')
+    out = super(TaskProperties, self).to_dict(exclude=exclude)
     out['command'] = self.commands[0] if self.commands else self.command
     return out
 
@@ -483,6 +538,20 @@ class TaskProperties(ndb.Model):
                 'an idempotent task cannot have unpinned packages; '
                 'use tags or instance IDs as package versions')
 
+      names = set()
+      paths = set()
+      for c in self.caches:
+        c._pre_put_hook()
+        if c.name in names:
+          raise datastore_errors.BadValueError(
+              'cache %s is specified more than once' % c.name)
+        if c.path in paths:
+          raise datastore_errors.BadValueError(
+              'cache path %s is specified more than once' % c.path)
+        names.add(c.name)
+        paths.add(c.path)
+      self.caches.sort(key=lambda c: c.name)
+
 
 class TaskRequest(ndb.Model):
   """Contains a user request.
@@ -469,6 +469,28 @@ class TaskRequestApiTest(TestCase):
         server='https://chrome-infra-packages.appspot.com',
     )
 
+    def mkcachereq(*caches):
+      mkreq(_gen_request(properties=dict(caches=list(caches))))
+
+    with self.assertRaises(datastore_errors.BadValueError):
+      mkcachereq(dict(name='', path='git'))
+    with self.assertRaises(datastore_errors.BadValueError):
+      mkcachereq(dict(name='Git', path='git'))
+    with self.assertRaises(datastore_errors.BadValueError):
+      mkcachereq(dict(name='git', path=''))
+    with self.assertRaises(datastore_errors.BadValueError):
+      mkcachereq(dict(name='git', path='../git'))
+    with self.assertRaises(datastore_errors.BadValueError):
+      mkcachereq(dict(name='git', path='/git'))
+    with self.assertRaises(datastore_errors.BadValueError):
+      mkcachereq(dict(name='git', path='a\\git'))
+    with self.assertRaises(datastore_errors.BadValueError):
+      mkcachereq(dict(name='git', path='a'), dict(name='git', path='b'))
+    with self.assertRaises(datastore_errors.BadValueError):
+      mkcachereq(dict(name='a', path='git'), dict(name='b', path='git'))
+    mkcachereq()
+    mkcachereq(dict(name='git_chromium', path='git'), dict(name='a', path='b'))
+
     with self.assertRaises(TypeError):
       mkreq(_gen_request(properties=dict(dimensions=[])))
     with self.assertRaises(datastore_errors.BadValueError):
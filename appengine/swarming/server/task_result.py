@@ -13,6 +13,8 @@ store tasks results.
   be multiple tries for one job, for example if a bot dies.
 - The stdout of the task is saved under TaskOutput, chunked in TaskOutputChunk
   entities to fit the entity size limit.
+- TaskDedup maps the properties of idempotent tasks to their last successful
+  TaskResultSummary. It is a root entity.
 
 Graph of schema:
 
@@ -48,7 +50,7 @@ Graph of schema:
                 |           |
        +-----------------+ +----------------+
        |TaskOutput       | |PerformanceStats|
-       |id=1 (not stored)| |id=1            |
+       |id=1             | |id=1            |
        +-----------------+ +----------------+
                  ^      ^
                  |      |
@@ -63,6 +65,7 @@ import datetime
 import logging
 import random
 import re
+import time
 
 from google.appengine.api import datastore_errors
 from google.appengine.datastore import datastore_query
@@ -81,6 +84,11 @@ import cipd
 BOT_PING_TOLERANCE = datetime.timedelta(seconds=5*60)
 
 
+# Delay between each read of the task results done by wait_for_change() and
+# wait_for_output().
+WAIT_POLL_INTERVAL_SECS = 1.
+
+
 class State(object):
   """States in which a task can be.
 
@@ -160,24 +168,29 @@ def _calculate_failure(result_common):
 
 
 class TaskOutput(ndb.Model):
-  """Phantom entity to represent the task output stored as small chunks.
+  """Header of the task output stored as small chunks.
 
   Parent is TaskRunResult. Key id is 1.
 
-  Child entities TaskOutputChunk are aggregated for the whole output.
+  Child entities TaskOutputChunk are aggregated for the whole output. This
+  entity describes them, so that readers know exactly which TaskOutputChunk to
+  fetch and writers don't have to fetch the chunks that were never written.
 
-  This entity doesn't actually exist in the DB. It only exists to make
-  categories.
+  Outputs stored before this entity was introduced don't have it; then the
+  chunk size is LEGACY_CHUNK_SIZE and TaskRunResult.stdout_chunks is the only
+  information available.
   """
-  # The maximum size for each TaskOutputChunk.chunk. The rationale is that
-  # appending data to an entity requires reading it first, so it must not be too
-  # big. On the other hand, having thousands of small entities is pure overhead.
+  # The maximum size for each TaskOutputChunk.chunk of new outputs. The
+  # rationale is that appending data to an entity requires reading it first, so
+  # it must not be too big. On the other hand, having thousands of small
+  # entities is pure overhead.
   # TODO(maruel): This value was selected from guts feeling. Do proper load
   # testing to find the best value.
-  # TODO(maruel): This value should be stored in the entity for future-proofing.
-  # It can't be changed until then.
   CHUNK_SIZE = 100*1024
 
+  # Chunk size of the outputs stored without a TaskOutput entity. Never change.
+  LEGACY_CHUNK_SIZE = 100*1024
+
   # Maximum content saved in a TaskOutput.
   # It is a safe-guard for tasks that sends way too much data. 100Mb should be
   # enough stdout.
@@ -187,8 +200,7 @@ class TaskOutput(ndb.Model):
   PUT_MAX_CHUNKS = PUT_MAX_CONTENT / CHUNK_SIZE
 
   # Hard limit on the amount of data returned by get_output_async() at once.
-  # Eventually, we'll want to add support for chunked fetch, if desired. Because
-  # CHUNK_SIZE is hardcoded, it's not exactly 16Mb.
+  # Because CHUNK_SIZE is not a power of 10, it's not exactly 16Mb.
   FETCH_MAX_CONTENT = 16*1000*1024
 
   # Maximum number of chunks to fetch at once.
@@ -198,25 +210,70 @@ class TaskOutput(ndb.Model):
   assert (PUT_MAX_CONTENT % CHUNK_SIZE) == 0
   assert (FETCH_MAX_CONTENT % CHUNK_SIZE) == 0
 
+  # Size of each TaskOutputChunk.chunk except the last one, set when the output
+  # is created.
+  chunk_size = ndb.IntegerProperty(indexed=False)
+  # Number of TaskOutputChunk, including the missing ones.
+  number_chunks = ndb.IntegerProperty(default=0, indexed=False)
+  # len(TaskOutputChunk.chunk) of each chunk, 0 if the chunk was never written.
+  chunk_lengths = ndb.IntegerProperty(repeated=True, indexed=False)
+  # Number of bytes that were not saved because the output went over
+  # PUT_MAX_CONTENT.
+  dropped_bytes = ndb.IntegerProperty(default=0, indexed=False)
+
+  @property
+  def size(self):
+    """Size of the output in bytes, including the missing parts."""
+    if not self.number_chunks:
+      return 0
+    return (
+        (self.number_chunks - 1) * self.chunk_size + self.chunk_lengths[-1])
+
   @classmethod
   @ndb.tasklet
-  def get_output_async(cls, output_key, number_chunks):
-    """Returns the stdout for the task as a ndb.Future."""
-    # TODO(maruel): Save number_chunks locally in this entity.
+  def get_output_async(cls, output_key, number_chunks, offset=0, length=None):
+    """Returns the stdout for the task as a ndb.Future.
+
+    Only the TaskOutputChunk entities overlapping the requested range that were
+    written to are fetched, so the cost is proportional to length, not to the
+    output size.
+
+    Arguments:
+      output_key: ndb.Key to the TaskOutput.
+      number_chunks: number of TaskOutputChunk as known by the TaskRunResult.
+      offset: offset in bytes of the first byte to return.
+      length: maximum number of bytes to return. It is capped to
+          FETCH_MAX_CONTENT.
+    """
     if not number_chunks:
       raise ndb.Return(None)
 
-    number_chunks = min(number_chunks, cls.FETCH_MAX_CHUNKS)
-
-    # TODO(maruel): Always get one more than necessary, in case number_chunks
-    # is invalid. If there's an unexpected TaskOutputChunk entity present,
-    # continue fetching for more incrementally.
-    parts = []
-    for f in ndb.get_multi_async(
+    header = yield output_key.get_async()
+    if header:
+      chunk_size = header.chunk_size
+      number_chunks = header.number_chunks
+      chunk_lengths = header.chunk_lengths
+    else:
+      chunk_size = cls.LEGACY_CHUNK_SIZE
+      chunk_lengths = None
+
+    length = min(length or cls.FETCH_MAX_CONTENT, cls.FETCH_MAX_CONTENT)
+    first_chunk = offset / chunk_size
+    end_chunk = min(
+        number_chunks, (offset + length + chunk_size - 1) / chunk_size)
+
+    # Without a header, always get the chunks in case some were not written.
+    chunk_numbers = [
+      i for i in xrange(first_chunk, end_chunk)
+      if chunk_lengths is None or chunk_lengths[i]
+    ]
+    chunks = {}
+    for i, f in zip(chunk_numbers, ndb.get_multi_async(
         _output_key_to_output_chunk_key(output_key, i)
-        for i in xrange(number_chunks)):
+        for i in chunk_numbers)):
       chunk = yield f
-      parts.append(chunk.chunk if chunk else None)
+      chunks[i] = chunk.chunk if chunk else None
+    parts = [chunks.get(i) for i in xrange(first_chunk, end_chunk)]
 
     # Trim ending empty chunks.
     while parts and not parts[-1]:
@@ -226,8 +283,9 @@ class TaskOutput(ndb.Model):
     # Replace any missing chunk.
     for i in xrange(len(parts)):
       if not parts[i]:
-        parts[i] = '\x00' * cls.CHUNK_SIZE
-    raise ndb.Return(''.join(parts))
+        parts[i] = '\x00' * chunk_size
+    start = offset - first_chunk * chunk_size
+    raise ndb.Return(''.join(parts)[start:start+length])
 
 
 class TaskOutputChunk(ndb.Model):
@@ -567,12 +625,18 @@ class _TaskResultCommon(ndb.Model):
     if not self.server_versions or self.server_versions[-1] != server_version:
       self.server_versions.append(server_version)
 
-  def get_output(self):
-    """Returns the output, either as str or None if no output is present."""
-    return self.get_output_async().get_result()
+  def get_output(self, offset=0, length=None):
+    """Returns the output, either as str or None if no output is present.
+
+    Arguments:
+      offset: offset in bytes of the first byte to return.
+      length: maximum number of bytes to return. All the output is returned by
+          default, up to TaskOutput.FETCH_MAX_CONTENT.
+    """
+    return self.get_output_async(offset, length).get_result()
 
   @ndb.tasklet
-  def get_output_async(self):
+  def get_output_async(self, offset=0, length=None):
     """Returns the stdout as a ndb.Future.
 
     Use out.get_result() to get the data as a str or None if no output is
@@ -583,7 +647,8 @@ class _TaskResultCommon(ndb.Model):
       raise ndb.Return(None)
 
     output_key = _run_result_key_to_output_key(self.run_result_key)
-    out = yield TaskOutput.get_output_async(output_key, self.stdout_chunks)
+    out = yield TaskOutput.get_output_async(
+        output_key, self.stdout_chunks, offset, length)
     raise ndb.Return(out)
 
   def validate(self, request):
@@ -891,6 +956,24 @@ class TaskResultSummary(_TaskResultCommon):
     return out
 
 
+class TaskDedup(ndb.Model):
+  """Points to the last TaskResultSummary that can be reused by tasks with the
+  same properties.
+
+  Key id is TaskRequest.properties.properties_hash encoded in hex. It has no
+  parent. It is stored once the task is COMPLETED without failure, see
+  TaskResultSummary.properties_hash.
+
+  It is not transactionally updated with the TaskResultSummary, the
+  TaskResultSummary must be verified when fetched.
+  """
+  # TaskResultSummary with the results to reuse.
+  result_summary_key = ndb.KeyProperty(kind='TaskResultSummary', indexed=False)
+  # Copy of TaskResultSummary.created_ts, to enforce reusable_task_age_secs
+  # without fetching it.
+  created_ts = ndb.DateTimeProperty(indexed=False)
+
+
 class TagValues(ndb.Model):
   tag = ndb.StringProperty()
   values = ndb.StringProperty(repeated=True)
@@ -925,6 +1008,26 @@ def _output_key_to_output_chunk_key(output_key, chunk_number):
   return ndb.Key(TaskOutputChunk, chunk_number+1, parent=output_key)
 
 
+def _output_split(output, output_chunk_start, chunk_size):
+  """Splits output to be written at output_chunk_start in chunks.
+
+  Returns:
+    tuple(list of tuple(chunk_number, start, data), dropped bytes).
+  """
+  chunks = []
+  while output:
+    chunk_number = output_chunk_start / chunk_size
+    if chunk_number * chunk_size >= TaskOutput.PUT_MAX_CONTENT:
+      logging.error('Dropping output\n%d bytes were lost', len(output))
+      return chunks, len(output)
+    start = output_chunk_start % chunk_size
+    next_start = chunk_size - start
+    chunks.append((chunk_number, start, output[:next_start]))
+    output = output[next_start:]
+    output_chunk_start = (chunk_number+1)*chunk_size
+  return chunks, 0
+
+
 def _output_append(output_key, number_chunks, output, output_chunk_start):
   """Appends output to a TaskOutput in TaskOutputChunk entities.
 
@@ -933,14 +1036,18 @@ def _output_append(output_key, number_chunks, output, output_chunk_start):
 
   It silently drops saving the output if it goes over ~16Mb. The hard limit is
   32Mb but HTML escaping can expand the raw data a bit, so just store half of
-  the limit to be on the safe side.
+  the limit to be on the safe side. The number of dropped bytes is recorded in
+  TaskOutput.dropped_bytes.
 
   TODO(maruel): This is because AppEngine can't do response over 32Mb and at
   this point, it's probably just a ton of junk. Figure out a way to better
   implement this if necessary.
 
-  Does one DB read by key and no puts. It's the responsibility of the caller to
-  save the entities.
+  Does at most one DB read by key and no puts. The TaskOutput is fetched along
+  the TaskOutputChunk that may already hold data; the ones past number_chunks
+  can't exist so they are not fetched. Nothing is fetched for a new output. It's
+  the responsibility of the caller to save the entities, including the
+  TaskOutput.
 
   Arguments:
     output_key: ndb.Key to TaskOutput that is the parent of TaskOutputChunk.
@@ -956,40 +1063,53 @@ def _output_append(output_key, number_chunks, output, output_chunk_start):
   assert output and isinstance(output, str), output
   assert output_key.kind() == 'TaskOutput', output_key
 
-  # Split everything in small bits.
-  chunks = []
-  while output:
-    chunk_number = output_chunk_start / TaskOutput.CHUNK_SIZE
-    if chunk_number >= TaskOutput.PUT_MAX_CHUNKS:
-      # TODO(maruel): Log into TaskOutput that data was dropped.
-      logging.error('Dropping output\n%d bytes were lost', len(output))
-      break
-    key = _output_key_to_output_chunk_key(output_key, chunk_number)
-    start = output_chunk_start % TaskOutput.CHUNK_SIZE
-    next_start = TaskOutput.CHUNK_SIZE - start
-    chunks.append((key, start, output[:next_start]))
-    output = output[next_start:]
-    number_chunks = max(number_chunks, chunk_number + 1)
-    output_chunk_start = (chunk_number+1)*TaskOutput.CHUNK_SIZE
-
+  chunk_size = TaskOutput.CHUNK_SIZE
+  chunks, dropped = _output_split(output, output_chunk_start, chunk_size)
+  if not number_chunks:
+    # A new output, there is nothing to fetch.
+    header = TaskOutput(key=output_key, chunk_size=chunk_size)
+    entities = []
+  else:
+    # Chunks past number_chunks can't exist yet. Since chunks is sorted, the
+    # ones to fetch are a prefix.
+    keys = [
+      _output_key_to_output_chunk_key(output_key, i)
+      for i, _, _ in chunks if i < number_chunks
+    ]
+    fetched = ndb.get_multi([output_key] + keys)
+    header = fetched[0]
+    entities = fetched[1:]
+    if not header:
+      # The output was stored before TaskOutput was saved. Assume all the chunks
+      # were written to.
+      header = TaskOutput(
+          key=output_key, chunk_size=TaskOutput.LEGACY_CHUNK_SIZE,
+          number_chunks=number_chunks,
+          chunk_lengths=[TaskOutput.LEGACY_CHUNK_SIZE] * number_chunks)
+    if header.chunk_size != chunk_size:
+      # The output was created with a different chunk size, split again.
+      chunks, dropped = _output_split(
+          output, output_chunk_start, header.chunk_size)
+      entities = ndb.get_multi(
+          _output_key_to_output_chunk_key(output_key, i)
+          for i, _, _ in chunks if i < number_chunks)
+
+  header.dropped_bytes += dropped
   if not chunks:
-    return [], number_chunks
+    return ([header] if dropped else []), number_chunks
 
-  # Get the TaskOutputChunk from the DB. Normally it would be only one entity
-  # (the last incomplete one) but this code supports arbitrary overwrite.
-  #
-  # number_chunks should normally be used to skip entities that are assumed to
-  # not be present but we don't assume the number_chunks is valid for safety.
-  #
-  # This means an unneeded get() is done on the missing chunk.
-  entities = ndb.get_multi(i[0] for i in chunks)
+  entities.extend([None] * (len(chunks) - len(entities)))
+  header.number_chunks = max(header.number_chunks, chunks[-1][0] + 1)
+  header.chunk_lengths.extend(
+      [0] * (header.number_chunks - len(header.chunk_lengths)))
 
   # Update the entities.
   for i in xrange(len(chunks)):
-    key, start, output = chunks[i]
+    chunk_number, start, output = chunks[i]
     if not entities[i]:
       # Fill up for missing entities.
-      entities[i] = TaskOutputChunk(key=key)
+      entities[i] = TaskOutputChunk(
+          key=_output_key_to_output_chunk_key(output_key, chunk_number))
     chunk = entities[i]
     # Magically combine everything.
     end = start + len(output)
@@ -1031,7 +1151,8 @@ def _output_append(output_key, number_chunks, output, output_chunk_start):
 
     chunk.gaps = new_gaps
     chunk.chunk = chunk.chunk[:start] + output + chunk.chunk[end:]
-  return entities, number_chunks
+    header.chunk_lengths[chunk_number] = len(chunk.chunk)
+  return entities + [header], header.number_chunks
 
 
 def _sort_property(sort):
@@ -1129,6 +1250,12 @@ def state_to_string(state_obj):
   return out
 
 
+def properties_hash_to_dedup_key(properties_hash):
+  """Returns the TaskDedup ndb.Key for a TaskProperties hash."""
+  assert properties_hash
+  return ndb.Key(TaskDedup, properties_hash.encode('hex'))
+
+
 def new_result_summary(request):
   """Returns the new and only TaskResultSummary for a TaskRequest.
 
@@ -1210,3 +1337,73 @@ def get_result_summaries_query(start, end, sort, state, tags):
       tags_filter = ndb.AND(tags_filter, TaskResultSummary.tags == tag)
     query = query.filter(tags_filter)
   return _filter_query(TaskResultSummary, query, start, end, sort, state)
+
+
+def wait_for_change(result_keys, last_states, timeout):
+  """Waits until at least one of the task results changes state.
+
+  The entities are fetched while bypassing the in-context cache, so each read
+  is served by memcache, which ndb invalidates on put(), and falls back to the
+  datastore only on a cache miss.
+
+  Arguments:
+    result_keys: list of TaskResultSummary or TaskRunResult ndb.Key.
+    last_states: list of the State last known by the caller for each key. None
+        means any state in State.STATES_RUNNING, e.g. wait for the task to stop
+        running.
+    timeout: maximum duration to wait for, in seconds.
+
+  Returns:
+    list of the entities as of the last read, in the same order as result_keys.
+    An item is None if the entity doesn't exist.
+  """
+  assert len(result_keys) == len(last_states), (result_keys, last_states)
+  deadline = utils.time_time() + timeout
+  while True:
+    results = ndb.get_multi(result_keys, use_cache=False)
+    for result, last_state in zip(results, last_states):
+      if not result:
+        return results
+      if last_state is None:
+        if result.state not in State.STATES_RUNNING:
+          return results
+      elif result.state != last_state:
+        return results
+    remaining = deadline - utils.time_time()
+    if remaining <= 0:
+      return results
+    time.sleep(min(WAIT_POLL_INTERVAL_SECS, remaining))
+
+
+def wait_for_output(result_key, offset, length, timeout):
+  """Waits for output past offset to be available or the task to stop running.
+
+  It is meant to follow the output of a running task. The TaskOutputChunk
+  entities are only fetched again once the task result was modified.
+
+  Arguments:
+    result_key: TaskResultSummary or TaskRunResult ndb.Key.
+    offset: offset in bytes of the first byte to return.
+    length: maximum number of bytes to return, see get_output().
+    timeout: maximum duration to wait for, in seconds.
+
+  Returns:
+    tuple(entity, output) as of the last read. The entity is None if it doesn't
+    exist. output is None if there is no output yet.
+  """
+  deadline = utils.time_time() + timeout
+  modified_ts = None
+  output = None
+  while True:
+    result = result_key.get(use_cache=False)
+    if not result:
+      return None, None
+    if result.modified_ts != modified_ts:
+      modified_ts = result.modified_ts
+      output = result.get_output(offset, length)
+    if output or result.state not in State.STATES_RUNNING:
+      return result, output
+    remaining = deadline - utils.time_time()
+    if remaining <= 0:
+      return result, output
+    time.sleep(min(WAIT_POLL_INTERVAL_SECS, remaining))
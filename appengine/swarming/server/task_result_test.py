@@ -142,6 +142,10 @@ class TaskResultApiTest(TestCase):
     f.deduped_from = '123'
     self.assertEqual('Deduped', task_result.state_to_string(f))
 
+  def test_properties_hash_to_dedup_key(self):
+    actual = task_result.properties_hash_to_dedup_key('\x01\xab')
+    self.assertEqual(ndb.Key('TaskDedup', '01ab'), actual)
+
   def test_new_result_summary(self):
     request = mkreq(_gen_request())
     actual = task_result.new_result_summary(request)
@@ -439,6 +443,72 @@ class TaskResultApiTest(TestCase):
         [run_result.key],
         list(task_result.yield_run_result_keys_with_dead_bot()))
 
+  def test_wait_for_change(self):
+    request = mkreq(_gen_request())
+    result_summary = task_result.new_result_summary(request)
+    result_summary.modified_ts = utils.utcnow()
+    ndb.transaction(result_summary.put)
+    sleeps = []
+    def sleep(duration):
+      sleeps.append(duration)
+      self.mock_now(self.now, sum(sleeps))
+      if len(sleeps) == 2:
+        # Another request updates the entity while this one waits.
+        result_summary.state = task_result.State.RUNNING
+        result_summary.put()
+    self.mock(task_result.time, 'sleep', sleep)
+
+    # Returns on the first change.
+    actual = task_result.wait_for_change(
+        [result_summary.key], [task_result.State.PENDING], 10.)
+    self.assertEqual([task_result.State.RUNNING], [i.state for i in actual])
+    self.assertEqual([1., 1.], sleeps)
+
+    # Times out, RUNNING is not done.
+    actual = task_result.wait_for_change([result_summary.key], [None], 2.5)
+    self.assertEqual([task_result.State.RUNNING], [i.state for i in actual])
+    self.assertEqual([1., 1., 1., 1., .5], sleeps)
+
+    # A missing entity returns right away.
+    missing = task_pack.request_key_to_result_summary_key(
+        task_request.new_request_key())
+    actual = task_result.wait_for_change(
+        [result_summary.key, missing], [task_result.State.RUNNING, None], 10.)
+    self.assertEqual(None, actual[1])
+    self.assertEqual(5, len(sleeps))
+
+  def test_wait_for_output(self):
+    request = mkreq(_gen_request())
+    result_summary = task_result.new_result_summary(request)
+    result_summary.modified_ts = utils.utcnow()
+    ndb.transaction(result_summary.put)
+    run_result = task_result.new_run_result(request, 1, 'localhost', 'abc', {})
+    run_result.modified_ts = utils.utcnow()
+    ndb.put_multi(run_result.append_output('Part1\n', 0) + [run_result])
+    sleeps = []
+    def sleep(duration):
+      sleeps.append(duration)
+      self.mock_now(self.now, sum(sleeps))
+      if len(sleeps) == 2:
+        # The bot sends more output while this request waits.
+        run_result.modified_ts = utils.utcnow()
+        ndb.put_multi(run_result.append_output('Part2\n', 6) + [run_result])
+    self.mock(task_result.time, 'sleep', sleep)
+
+    # Available output is returned right away.
+    actual = task_result.wait_for_output(run_result.key, 0, None, 10.)
+    self.assertEqual('Part1\n', actual[1])
+    self.assertEqual([], sleeps)
+
+    # Waits for output past the offset.
+    actual = task_result.wait_for_output(run_result.key, 6, None, 10.)
+    self.assertEqual('Part2\n', actual[1])
+    self.assertEqual([1., 1.], sleeps)
+
+    # Times out.
+    actual = task_result.wait_for_output(run_result.key, 12, None, 1.5)
+    self.assertEqual(('', [1., 1., 1., .5]), (actual[1], sleeps))
+
   def test_set_from_run_result(self):
     request = mkreq(_gen_request())
     result_summary = task_result.new_result_summary(request)
@@ -575,13 +645,41 @@ class TestOutput(TestCase):
     # Test that one can stream output and it is returned fine.
     def run(*args):
       entities = self.run_result.append_output(*args)
-      self.assertEqual(1, len(entities))
+      # The TaskOutputChunk and the TaskOutput.
+      self.assertEqual(2, len(entities))
       ndb.put_multi(entities)
     run('Part1\n', 0)
     run('Part2\n', len('Part1\n'))
     run('Part3\n', len('Part1P\n'))
     self.assertEqual('Part1\nPPart3\n', self.run_result.get_output())
 
+  def test_get_output_range(self):
+    size = task_result.TaskOutput.CHUNK_SIZE
+    data = ''.join(chr(ord('a') + i % 26) for i in xrange(size * 5 / 2))
+    ndb.put_multi(self.run_result.append_output(data, 0))
+    self.run_result.put()
+    fetched = []
+    old_get_multi_async = ndb.get_multi_async
+    def get_multi_async(keys, **kwargs):
+      keys = list(keys)
+      fetched.extend(k.integer_id() for k in keys)
+      return old_get_multi_async(keys, **kwargs)
+    self.mock(ndb, 'get_multi_async', get_multi_async)
+
+    self.assertEqual(data, self.run_result.get_output())
+    self.assertEqual([1, 2, 3], fetched)
+    del fetched[:]
+    self.assertEqual(data[10:20], self.run_result.get_output(10, 10))
+    self.assertEqual([1], fetched)
+    del fetched[:]
+    self.assertEqual(
+        data[size-5:size+5], self.run_result.get_output(size-5, 10))
+    self.assertEqual([1, 2], fetched)
+    del fetched[:]
+    self.assertEqual(data[2*size+1:], self.run_result.get_output(2*size+1))
+    self.assertEqual([3], fetched)
+    self.assertEqual('', self.run_result.get_output(len(data)))
+
   def test_append_output_large(self):
     self.mock(logging, 'error', lambda *_: None)
     one_mb = '<3Google' * (1024*1024/8)
@@ -616,17 +714,21 @@ class TestOutput(TestCase):
     self.mock(logging, 'error', lambda *args: calls.append(args))
     max_chunk = 'x' * task_result.TaskOutput.PUT_MAX_CONTENT
     entities = self.run_result.append_output(max_chunk, 0)
-    self.assertEqual(task_result.TaskOutput.PUT_MAX_CHUNKS, len(entities))
+    self.assertEqual(task_result.TaskOutput.PUT_MAX_CHUNKS + 1, len(entities))
     ndb.put_multi(entities)
     self.assertEqual([], calls)
 
     # Try with PUT_MAX_CONTENT + 1 bytes, so the last byte is discarded.
     entities = self.run_result.append_output(max_chunk + 'x', 0)
-    self.assertEqual(task_result.TaskOutput.PUT_MAX_CHUNKS, len(entities))
+    self.assertEqual(task_result.TaskOutput.PUT_MAX_CHUNKS + 1, len(entities))
     ndb.put_multi(entities)
     self.assertEqual(1, len(calls))
     self.assertTrue(calls[0][0].startswith('Dropping '), calls[0][0])
     self.assertEqual(1, calls[0][1])
+    header = task_result._run_result_key_to_output_key(
+        self.run_result.key).get()
+    self.assertEqual(1, header.dropped_bytes)
+    self.assertEqual(task_result.TaskOutput.PUT_MAX_CONTENT, header.size)
 
   def test_append_output_partial(self):
     ndb.put_multi(self.run_result.append_output('Foo', 10))
@@ -652,6 +754,52 @@ class TestOutput(TestCase):
     ]
     self.assertTaskOutputChunk(expected)
 
+  def test_append_output_header(self):
+    size = task_result.TaskOutput.CHUNK_SIZE
+    fetched = []
+    old_get_multi = ndb.get_multi
+    def get_multi(keys, **kwargs):
+      keys = list(keys)
+      fetched.append([k.kind() for k in keys])
+      return old_get_multi(keys, **kwargs)
+    self.mock(ndb, 'get_multi', get_multi)
+
+    # Nothing is fetched for a new output.
+    ndb.put_multi(self.run_result.append_output('Foo', size - 3))
+    self.assertEqual([], fetched)
+    # Only the TaskOutput is fetched when writing to a new chunk.
+    ndb.put_multi(self.run_result.append_output('BarBaz', size))
+    self.assertEqual([['TaskOutput']], fetched)
+    # The chunk is fetched along when appending to it.
+    ndb.put_multi(self.run_result.append_output('!', size + 6))
+    self.assertEqual(
+        [['TaskOutput'], ['TaskOutput', 'TaskOutputChunk']], fetched)
+
+    header = task_result._run_result_key_to_output_key(
+        self.run_result.key).get()
+    expected = {
+      'chunk_lengths': [size, 7],
+      'chunk_size': size,
+      'dropped_bytes': 0,
+      'number_chunks': 2,
+    }
+    self.assertEqual(expected, header.to_dict())
+    self.assertEqual(size + 7, header.size)
+    self.assertEqual(2, self.run_result.stdout_chunks)
+    self.assertEqual('FooBarBaz!', self.run_result.get_output(size - 3))
+
+  def test_append_output_legacy(self):
+    # Output stored without a TaskOutput entity.
+    ndb.put_multi(self.run_result.append_output('Foo', 0))
+    task_result._run_result_key_to_output_key(self.run_result.key).delete()
+    self.assertEqual('Foo', self.run_result.get_output())
+
+    ndb.put_multi(self.run_result.append_output('Bar', 3))
+    self.assertEqual('FooBar', self.run_result.get_output())
+    header = task_result._run_result_key_to_output_key(
+        self.run_result.key).get()
+    self.assertEqual([6], header.chunk_lengths)
+
   def test_append_output_partial_far_split(self):
     # Missing, writing happens on two different TaskOutputChunk entities.
     ndb.put_multi(self.run_result.append_output(
@@ -7,11 +7,13 @@
 This is the interface closest to the HTTP handlers.
 """
 
+import collections
 import datetime
 import logging
 import math
 import random
 
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 
 from components import auth
@@ -35,6 +37,15 @@ from server import task_to_run
 
 _PROBABILITY_OF_QUICK_COMEBACK = 0.05
 
+# When TaskDedup was rolled out. Tasks completed before have no TaskDedup, so
+# they are looked up with a query until they are older than
+# reusable_task_age_secs. See _find_dupe_tasks().
+_TASK_DEDUP_ROLLOUT_TS = datetime.datetime(2026, 10, 19)
+
+# For how long a task using named caches is left to the bots that already have
+# all of them, before any bot can reap it.
+_COLD_CACHES_DELAY = datetime.timedelta(seconds=10)
+
 
 def _secs_to_ms(value):
   """Converts a seconds value in float to the number of ms as an integer."""
@@ -408,40 +419,101 @@ def _can_use_dimension(dim_acls, ident, k, v):
   return True
 
 
-def _find_dupe_task(now, h):
-  """Finds a previously run task that is also idempotent and completed.
+def _find_dupe_tasks_by_query(oldest, properties_hashes):
+  """Finds previously run tasks that are also idempotent and completed with a
+  query on TaskResultSummary.properties_hash.
 
-  Fetch items that can be used to dedupe the task. See the comment for this
-  property for more details.
+  It is the fallback for the tasks completed before TaskDedup was added, so
+  they can be reused until they are older than reusable_task_age_secs. The
+  TaskDedup is stored for the tasks found, so the next lookups are a get.
 
   Do not use "task_result.TaskResultSummary.created_ts > oldest" here because
   this would require a composite index. It's unnecessary because TaskRequest.key
   is equivalent to decreasing TaskRequest.created_ts, ordering by key works as
   well and doesn't require a composite index.
+
+  Returns:
+    dict(properties_hash: TaskResultSummary) of the tasks that can be reused.
   """
-  # TODO(maruel): Make a reverse map on successful task completion so this
-  # becomes a simple ndb.get().
   cls = task_result.TaskResultSummary
-  q = cls.query(cls.properties_hash==h).order(cls.key)
-  for i, dupe_summary in enumerate(q.iter(batch_size=1)):
-    # It is possible for the query to return stale items.
-    if (dupe_summary.state != task_result.State.COMPLETED or
-        dupe_summary.failure):
-      if i == 2:
-        # Indexes are very inconsistent, give up.
-        return None
+  # The query can return stale items, so give up after 3 of them.
+  futures = [
+    cls.query(cls.properties_hash==h).order(cls.key).fetch_async(3)
+    for h in properties_hashes
+  ]
+  out = {}
+  for h, future in zip(properties_hashes, futures):
+    for dupe_summary in future.get_result():
+      if (dupe_summary.state != task_result.State.COMPLETED or
+          dupe_summary.failure):
+        continue
+      if dupe_summary.created_ts > oldest:
+        _store_dedup(dupe_summary)
+        out[h] = dupe_summary
+      break
+  return out
+
+
+def _find_dupe_tasks(now, properties_hashes):
+  """Finds previously run tasks that are also idempotent and completed.
+
+  Uses the TaskDedup reverse map stored on successful completion of an
+  idempotent task, see _store_dedup(). The TaskResultSummary are fetched and
+  verified, since TaskDedup is not updated in the same transaction. Falls back
+  to _find_dupe_tasks_by_query() when there's no TaskDedup, only as long as
+  tasks completed before _TASK_DEDUP_ROLLOUT_TS can still be reused.
+
+  Returns:
+    dict(properties_hash: TaskResultSummary) of the tasks that can be reused.
+  """
+  properties_hashes = sorted(set(properties_hashes))
+  if not properties_hashes:
+    return {}
+  dedups = ndb.get_multi(
+      task_result.properties_hash_to_dedup_key(h) for h in properties_hashes)
+
+  # Refuse tasks older than X days. This is due to the isolate server
+  # dropping files.
+  # TODO(maruel): The value should be calculated from the isolate server
+  # setting and be unbounded when no isolated input was used.
+  oldest = now - datetime.timedelta(
+      seconds=config.settings().reusable_task_age_secs)
+  out = {}
+  if oldest < _TASK_DEDUP_ROLLOUT_TS:
+    # Some reusable tasks may have completed before TaskDedup was added.
+    out = _find_dupe_tasks_by_query(
+        oldest, [h for h, d in zip(properties_hashes, dedups) if not d])
+  dedups = [
+    (h, d) for h, d in zip(properties_hashes, dedups)
+    if d and d.created_ts > oldest
+  ]
+  summaries = ndb.get_multi(d.result_summary_key for _, d in dedups)
+  for (h, dedup), dupe_summary in zip(dedups, summaries):
+    # properties_hash is only set when the task COMPLETED without failure.
+    if not dupe_summary or dupe_summary.properties_hash != h:
+      logging.warning('Stale TaskDedup %s', dedup.key.id())
       continue
+    out[h] = dupe_summary
+  return out
 
-    # Refuse tasks older than X days. This is due to the isolate server
-    # dropping files.
-    # TODO(maruel): The value should be calculated from the isolate server
-    # setting and be unbounded when no isolated input was used.
-    oldest = now - datetime.timedelta(
-        seconds=config.settings().reusable_task_age_secs)
-    if dupe_summary.created_ts <= oldest:
-      return None
-    return dupe_summary
-  return None
+
+def _store_dedup(result_summary):
+  """Stores the TaskDedup pointing to a TaskResultSummary whose results can be
+  reused.
+
+  Ignores failures, in which case the next task with the same properties will
+  run instead of being deduped.
+  """
+  assert result_summary.properties_hash
+  dedup = task_result.TaskDedup(
+      key=task_result.properties_hash_to_dedup_key(
+          result_summary.properties_hash),
+      result_summary_key=result_summary.key,
+      created_ts=result_summary.created_ts)
+  try:
+    dedup.put()
+  except datastore_errors.Error as e:
+    logging.warning('Failed to store TaskDedup: %s', e)
 
 
 ### Public API.
@@ -459,6 +531,74 @@ def exponential_backoff(attempt_num):
   return min(max_wait, math.pow(1.5, min(attempt_num, 10) + 1))
 
 
+@ndb.tasklet
+def _schedule_request_async(request, dupe_summary, now):
+  """Stores all the entities to schedule a new task request.
+
+  Arguments:
+  - request: TaskRequest entity to be saved in the DB.
+  - dupe_summary: TaskResultSummary of a previous task to reuse the results of,
+        or None.
+  - now: time of the scheduling.
+
+  Returns:
+    TaskResultSummary.
+  """
+  request.key = task_request.new_request_key()
+  task = task_to_run.new_task_to_run(request)
+  result_summary = task_result.new_result_summary(request)
+  result_summary.modified_ts = now
+
+  def get_new_keys():
+    # Warning: this assumes knowledge about the hierarchy of each entity.
+    key = task_request.new_request_key()
+    task.key.parent = key
+    old = result_summary.task_id
+    result_summary.parent = key
+    logging.info('%s conflicted, using %s', old, result_summary.task_id)
+    return key
+
+  if dupe_summary:
+    # Setting task.queue_number to None removes it from the scheduling.
+    task.queue_number = None
+    _copy_summary(
+        dupe_summary, result_summary,
+        ('created_ts', 'modified_ts', 'name', 'user', 'tags'))
+    # Zap irrelevant properties. PerformanceStats is also not copied over,
+    # since it's not relevant.
+    result_summary.properties_hash = None
+    result_summary.try_number = 0
+    result_summary.cost_saved_usd = result_summary.cost_usd
+    # Only zap after.
+    result_summary.costs_usd = []
+    result_summary.deduped_from = task_pack.pack_run_result_key(
+        dupe_summary.run_result_key)
+    # In this code path, there's not much to do as the task will not be run,
+    # previous results are returned. We still need to store all the entities
+    # correctly.
+    yield datastore_utils.insert_async(
+        request, get_new_keys, extra=[task, result_summary])
+    logging.debug(
+        'New request %s reusing %s', result_summary.task_id,
+        dupe_summary.task_id)
+  else:
+    # Storing these entities makes this task live. It is important at this point
+    # that the HTTP handler returns as fast as possible, otherwise the task will
+    # be run but the client will not know about it.
+    yield datastore_utils.insert_async(
+        request, get_new_keys, extra=[task, result_summary])
+    logging.debug('New request %s', result_summary.task_id)
+    yield task_to_run.add_prefetch_hint_async(request)
+
+  stats.add_task_entry(
+      'task_enqueued', result_summary.key,
+      dimensions=request.properties.dimensions,
+      user=request.user)
+  ts_mon_metrics.update_jobs_requested_metrics(
+      result_summary, bool(dupe_summary))
+  raise ndb.Return(result_summary)
+
+
 def schedule_request(request, check_acls=True):
   """Creates and stores all the entities to schedule a new task request.
 
@@ -479,67 +619,56 @@ def schedule_request(request, check_acls=True):
   Returns:
     TaskResultSummary. TaskToRun is not returned.
   """
-  assert isinstance(request, task_request.TaskRequest), request
-  assert not request.key, request.key
+  return schedule_requests([request], check_acls=check_acls)[0]
 
-  # Raises AuthorizationError with helpful message if the request.authorized
-  # can't use some of the requested dimensions.
-  if check_acls:
-    _check_dimension_acls(request)
 
-  now = utils.utcnow()
-  request.key = task_request.new_request_key()
-  task = task_to_run.new_task_to_run(request)
-  result_summary = task_result.new_result_summary(request)
-  result_summary.modified_ts = now
+def schedule_requests(requests, check_acls=True):
+  """Creates and stores all the entities to schedule multiple task requests.
 
-  def get_new_keys():
-    # Warning: this assumes knowledge about the hierarchy of each entity.
-    key = task_request.new_request_key()
-    task.key.parent = key
-    old = result_summary.task_id
-    result_summary.parent = key
-    logging.info('%s conflicted, using %s', old, result_summary.task_id)
-    return key
+  Same as schedule_request() but the ACLs of all the requests are checked
+  before any is stored, the dedup lookups are done in bulk and the requests are
+  stored in parallel transactions, one per request.
 
-  deduped = False
-  if request.properties.idempotent:
-    dupe_summary = _find_dupe_task(now, request.properties.properties_hash)
-    if dupe_summary:
-      # Setting task.queue_number to None removes it from the scheduling.
-      task.queue_number = None
-      _copy_summary(
-          dupe_summary, result_summary,
-          ('created_ts', 'modified_ts', 'name', 'user', 'tags'))
-      # Zap irrelevant properties. PerformanceStats is also not copied over,
-      # since it's not relevant.
-      result_summary.properties_hash = None
-      result_summary.try_number = 0
-      result_summary.cost_saved_usd = result_summary.cost_usd
-      # Only zap after.
-      result_summary.costs_usd = []
-      result_summary.deduped_from = task_pack.pack_run_result_key(
-          dupe_summary.run_result_key)
-      # In this code path, there's not much to do as the task will not be run,
-      # previous results are returned. We still need to store all the entities
-      # correctly.
-      datastore_utils.insert(
-          request, get_new_keys, extra=[task, result_summary])
-      logging.debug(
-          'New request %s reusing %s', result_summary.task_id,
-          dupe_summary.task_id)
-      deduped = True
-
-  if not deduped:
-    # Storing these entities makes this task live. It is important at this point
-    # that the HTTP handler returns as fast as possible, otherwise the task will
-    # be run but the client will not know about it.
-    datastore_utils.insert(request, get_new_keys, extra=[task, result_summary])
-    logging.debug('New request %s', result_summary.task_id)
+  Arguments:
+  - requests: list of TaskRequest entities to be saved in the DB. Their key
+              must not be set and the entities must not be saved in the DB yet.
+  - check_acls: Whether the requests should check ACLs.
 
-  # Get parent task details if applicable.
-  if request.parent_task_id:
-    parent_run_key = task_pack.unpack_run_result_key(request.parent_task_id)
+  Returns:
+    list of TaskResultSummary, in the same order as |requests|.
+  """
+  for request in requests:
+    assert isinstance(request, task_request.TaskRequest), request
+    assert not request.key, request.key
+    # Raises AuthorizationError with helpful message if the request.authorized
+    # can't use some of the requested dimensions.
+    if check_acls:
+      _check_dimension_acls(request)
+
+  now = utils.utcnow()
+  dupes = _find_dupe_tasks(
+      now,
+      (r.properties.properties_hash for r in requests
+        if r.properties.idempotent))
+  futures = [
+    _schedule_request_async(
+        r,
+        dupes.get(r.properties.properties_hash)
+          if r.properties.idempotent else None,
+        now)
+    for r in requests
+  ]
+  result_summaries = [f.get_result() for f in futures]
+
+  # Get parent task details if applicable. Update each parent task once, since
+  # the shards of a task usually have the same parent.
+  children = collections.OrderedDict()
+  for request, result_summary in zip(requests, result_summaries):
+    if request.parent_task_id:
+      children.setdefault(request.parent_task_id, []).append(
+          result_summary.task_id)
+  for parent_task_id, task_ids in children.iteritems():
+    parent_run_key = task_pack.unpack_run_result_key(parent_task_id)
     parent_task_keys = [
       parent_run_key,
       task_pack.run_result_key_to_result_summary_key(parent_run_key),
@@ -548,9 +677,8 @@ def schedule_request(request, check_acls=True):
     def run_parent():
       # This one is slower.
       items = ndb.get_multi(parent_task_keys)
-      k = result_summary.task_id
       for item in items:
-        item.children_task_ids.append(k)
+        item.children_task_ids.extend(task_ids)
         item.modified_ts = now
       ndb.put_multi(items)
 
@@ -560,20 +688,22 @@ def schedule_request(request, check_acls=True):
     # job, which would remove this code from the critical path.
     datastore_utils.transaction(run_parent)
 
-  stats.add_task_entry(
-      'task_enqueued', result_summary.key,
-      dimensions=request.properties.dimensions,
-      user=request.user)
-  ts_mon_metrics.update_jobs_requested_metrics(result_summary, deduped)
-  return result_summary
+  return result_summaries
 
 
-def bot_reap_task(dimensions, bot_id, bot_version, deadline):
+def bot_reap_task(dimensions, bot_id, bot_version, deadline, named_caches=None):
   """Reaps a TaskToRun if one is available.
 
   The process is to find a TaskToRun where its .queue_number is set, then
   create a TaskRunResult for it.
 
+  A task using named caches that the bot doesn't have is skipped during its
+  first _COLD_CACHES_DELAY, so a bot that has them can reap it first.
+
+  Arguments:
+  - named_caches: names of the named caches present on the bot, as reported
+        in the bot state.
+
   Returns:
     tuple of (TaskRequest, TaskRunResult) for the task that was reaped.
     The TaskToRun involved is not returned.
@@ -587,7 +717,12 @@ def bot_reap_task(dimensions, bot_id, bot_version, deadline):
   failures = 0
   to_skip = 0
   total_skipped = 0
+  cold_cutoff = utils.utcnow() - _COLD_CACHES_DELAY
+  named_caches = frozenset(named_caches or ())
   for request, to_run in q:
+    if (request.created_ts > cold_cutoff and
+        any(c.name not in named_caches for c in request.properties.caches)):
+      continue
     if to_skip:
       to_skip -= 1
       total_skipped += 1
@@ -790,6 +925,8 @@ def bot_update_task(
     return None
   _update_stats(run_result, bot_id, request, task_completed)
   if task_completed:
+    if smry.properties_hash:
+      _store_dedup(smry)
     ts_mon_metrics.update_jobs_completed_metrics(smry)
   return run_result.state
 
@@ -199,6 +199,52 @@ class TaskSchedulerApiTest(test_case.TestCase):
     self.assertEqual('localhost', run_result.bot_id)
     self.failIf(task_to_run.TaskToRun.query().get().queue_number)
 
+  def test_bot_reap_task_named_caches(self):
+    request = _gen_request(
+        properties={
+          'caches': [task_request.CacheEntry(name=u'git', path=u'git')],
+          'dimensions': {u'OS': u'Windows-3.1.1', u'pool': u'default'},
+        })
+    task_request.init_new_request(request, True)
+    task_scheduler.schedule_request(request)
+    bot_dimensions = {
+      u'OS': [u'Windows', u'Windows-3.1.1'],
+      u'id': [u'localhost'],
+      u'pool': [u'default'],
+    }
+    # A bot without the cache leaves the task to the bots that have it.
+    self.mock_now(self.now, 1)
+    actual_request, run_result = task_scheduler.bot_reap_task(
+        bot_dimensions, 'localhost', 'abc', None, [u'other'])
+    self.assertEqual(None, actual_request)
+    self.assertEqual(None, run_result)
+
+    # Until it waited for long enough.
+    self.mock_now(
+        self.now, task_scheduler._COLD_CACHES_DELAY.total_seconds() + 1)
+    actual_request, run_result = task_scheduler.bot_reap_task(
+        bot_dimensions, 'localhost', 'abc', None)
+    self.assertEqual(request, actual_request)
+
+  def test_bot_reap_task_named_caches_warm(self):
+    request = _gen_request(
+        properties={
+          'caches': [task_request.CacheEntry(name=u'git', path=u'git')],
+          'dimensions': {u'OS': u'Windows-3.1.1', u'pool': u'default'},
+        })
+    task_request.init_new_request(request, True)
+    task_scheduler.schedule_request(request)
+    bot_dimensions = {
+      u'OS': [u'Windows', u'Windows-3.1.1'],
+      u'id': [u'localhost'],
+      u'pool': [u'default'],
+    }
+    self.mock_now(self.now, 1)
+    actual_request, run_result = task_scheduler.bot_reap_task(
+        bot_dimensions, 'localhost', 'abc', None, [u'git', u'other'])
+    self.assertEqual(request, actual_request)
+    self.assertEqual('localhost', run_result.bot_id)
+
   def test_exponential_backoff(self):
     self.mock(
         task_scheduler.random, 'random',
@@ -356,6 +402,66 @@ class TaskSchedulerApiTest(test_case.TestCase):
     new_ts = self.mock_now(self.now, config.settings().reusable_task_age_secs-1)
     self._task_deduped(new_ts, task_id)
 
+  def test_task_idempotent_no_dedup(self):
+    self.mock(random, 'getrandbits', lambda _: 0x88)
+    # First task is idempotent, it completed before TaskDedup was added.
+    task_id = self._task_ran_successfully()
+    task_result.TaskDedup.query().get().key.delete()
+
+    # Second task is deduped against first task with the query fallback, which
+    # stores the TaskDedup.
+    new_ts = self.mock_now(self.now, config.settings().reusable_task_age_secs-1)
+    self._task_deduped(new_ts, task_id)
+    self.assertEqual(1, task_result.TaskDedup.query().count())
+
+  def test_task_idempotent_no_dedup_after_rollout(self):
+    self.mock(random, 'getrandbits', lambda _: 0x88)
+    self._task_ran_successfully()
+    task_result.TaskDedup.query().get().key.delete()
+
+    # Once all the reusable tasks have a TaskDedup, a miss doesn't query.
+    new_ts = self.mock_now(self.now, config.settings().reusable_task_age_secs-1)
+    self.mock(
+        task_scheduler, '_TASK_DEDUP_ROLLOUT_TS',
+        new_ts - datetime.timedelta(
+            seconds=config.settings().reusable_task_age_secs))
+    def _find_dupe_tasks_by_query(*_):
+      self.fail('Unexpected query')
+    self.mock(
+        task_scheduler, '_find_dupe_tasks_by_query', _find_dupe_tasks_by_query)
+    request = _gen_request(
+        properties={
+          'dimensions': {u'OS': u'Windows-3.1.1', u'pool': u'default'},
+          'idempotent': True,
+        })
+    task_request.init_new_request(request, True)
+    result_summary = task_scheduler.schedule_request(request)
+    self.assertEqual(None, result_summary.deduped_from)
+
+  def test_task_idempotent_stale_dedup(self):
+    self.mock(random, 'getrandbits', lambda _: 0x88)
+    # First task is idempotent.
+    task_id = self._task_ran_successfully()
+    dedup = task_result.TaskDedup.query().get()
+    summary_key = task_pack.run_result_key_to_result_summary_key(
+        task_pack.unpack_run_result_key(task_id))
+    self.assertEqual(summary_key, dedup.result_summary_key)
+
+    # The TaskResultSummary is not reusable anymore, so the TaskDedup is
+    # ignored.
+    result_summary = summary_key.get()
+    result_summary.properties_hash = None
+    result_summary.put()
+    self.mock_now(self.now, 1)
+    request = _gen_request(
+        properties={
+          'dimensions': {u'OS': u'Windows-3.1.1', u'pool': u'default'},
+          'idempotent': True,
+        })
+    task_request.init_new_request(request, True)
+    result_summary = task_scheduler.schedule_request(request)
+    self.assertEqual(None, result_summary.deduped_from)
+
   def test_task_idempotent_old(self):
     self.mock(random, 'getrandbits', lambda _: 0x88)
     # First task is idempotent.
@@ -840,6 +946,50 @@ class TaskSchedulerApiTest(test_case.TestCase):
     self.assertTrue(
         _quick_schedule({u'OS': u'Windows-3.1.1', u'pool': u'default'}))
 
+  def test_schedule_requests(self):
+    parent_id = self._task_ran_successfully()
+    # The idempotent task is deduped, the other ones are children of the
+    # first task.
+    requests = [
+      _gen_request(
+          properties={
+            'dimensions': {u'OS': u'Windows-3.1.1', u'pool': u'default'},
+            'idempotent': True,
+          }),
+      _gen_request(
+          parent_task_id=parent_id,
+          properties={'dimensions': {u'OS': u'Linux', u'pool': u'default'}}),
+      _gen_request(
+          parent_task_id=parent_id,
+          properties={'dimensions': {u'OS': u'Mac', u'pool': u'default'}}),
+    ]
+    for request in requests:
+      task_request.init_new_request(request, True)
+    actual = task_scheduler.schedule_requests(requests)
+    self.assertEqual(3, len(actual))
+    self.assertEqual([r.key for r in requests], [r.request_key for r in actual])
+    self.assertEqual(parent_id, actual[0].deduped_from)
+    self.assertEqual([None, None], [r.deduped_from for r in actual[1:]])
+    self.assertEqual(
+        2, task_to_run.TaskToRun.query(
+            task_to_run.TaskToRun.queue_number > 0).count())
+    parent_run_result_key = task_pack.unpack_run_result_key(parent_id)
+    expected = [r.task_id for r in actual[1:]]
+    self.assertEqual(expected, parent_run_result_key.get().children_task_ids)
+
+  def test_schedule_requests_forbidden_dim(self):
+    self.mock_dim_acls({u'pool:bad': u'noone'})
+    requests = [
+      _gen_request(properties={'dimensions': {u'pool': u'good'}}),
+      _gen_request(properties={'dimensions': {u'pool': u'bad'}}),
+    ]
+    for request in requests:
+      task_request.init_new_request(request, True)
+    with self.assertRaises(auth.AuthorizationError):
+      task_scheduler.schedule_requests(requests)
+    # None was scheduled.
+    self.assertEqual(0, task_request.TaskRequest.query().count())
+
   def mock_dim_acls(self, mapping):
     self.mock(config, 'settings', lambda: config_pb2.SettingsCfg(
       dimension_acls=config_pb2.DimensionACLs(entry=[
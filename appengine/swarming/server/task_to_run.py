@@ -27,21 +27,63 @@ Graph of the schema:
 
 import datetime
 import hashlib
+import heapq
 import itertools
 import logging
 import struct
+import time
 
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+from components import datastore_utils
 from components import utils
 from server import task_request
+import ts_mon_metrics
 
 
 # Maximum product search space for dimensions for a bot.
 MAX_DIMENSIONS = 16384
 
 
+# Number of seconds between the rebuilds of the set of dimensions_hash with
+# TaskToRun ready to be reaped from a scan of all of them by a cron job, see
+# refresh_ready_hashes().
+READY_HASHES_REFRESH = 60
+
+
+# Number of seconds the rebuilt set of dimensions_hash is kept in memcache. If
+# the cron job stops refreshing it, the bots fall back to scanning all the
+# TaskToRun.
+READY_HASHES_EXPIRATION = 5*READY_HASHES_REFRESH
+
+
+# Maximum number of inputs_ref kept per ready queue as prefetch hints, see
+# get_prefetch_hints().
+PREFETCH_HINTS_PER_QUEUE = 5
+
+
+# Number of seconds a prefetch hint is kept after the last task with these
+# inputs was enqueued.
+PREFETCH_HINTS_EXPIRATION = 10*60
+
+
+# Maximum number of bots for which the accepted dimensions_hash are kept in the
+# instance memory, see _get_accepted_dimensions_hash().
+_ACCEPTED_CACHE_SIZE = 1000
+
+
+# Instance cache of bot id -> (dimensions digest, frozenset of
+# dimensions_hash, seconds it took to compute them).
+_accepted_cache = {}
+
+
+# Memcache keys, in namespace 'task_to_run', of the ready queues index. See
+# _get_ready_hashes().
+_READY_HASHES_KEY = 'ready_hashes'
+_NEW_READY_HASHES_KEY = 'new_ready_hashes'
+
+
 class TaskToRun(ndb.Model):
   """Defines a TaskRequest ready to be scheduled on a bot.
 
@@ -57,11 +99,19 @@ class TaskToRun(ndb.Model):
 
   The key id is the value of 'dimensions_hash' that is generated with
   _hash_dimensions(), parent is TaskRequest.
+
+  The TaskToRun with the same dimensions_hash form a ready queue, ordered by
+  queue_number. A bot only looks at the ready queues of the dimensions it can
+  serve, see yield_next_available_task_to_dispatch().
   """
   # Moment by which the task has to be requested by a bot. Copy of TaskRequest's
   # TaskRequest.expiration_ts to enable queries when cleaning up stale jobs.
   expiration_ts = ndb.DateTimeProperty(required=True)
 
+  # Copy of the key id, to enable queries on a single ready queue.
+  dimensions_hash = ndb.ComputedProperty(
+      lambda self: self.key.integer_id() if self.key else None)
+
   # Everything above is immutable, everything below is mutable.
 
   # priority and request creation timestamp are mixed together to allow queries
@@ -82,10 +132,15 @@ class TaskToRun(ndb.Model):
     """Returns the TaskRequest ndb.Key that is parent to the task to run."""
     return task_to_run_key_to_request_key(self.key)
 
-  def to_dict(self):
-    out = super(TaskToRun, self).to_dict()
-    out['dimensions_hash'] = self.key.integer_id()
-    return out
+  def _post_put_hook(self, _future):
+    """Adds the ready queue of a reapable task to the ready queues index.
+
+    Tasks that are not reapable anymore are dropped from their ready queue by
+    the datastore index. Empty ready queues are dropped from the index when it
+    is refreshed.
+    """
+    if self.is_reapable:
+      _add_ready_hash(self.dimensions_hash)
 
 
 def _gen_queue_number(
@@ -174,6 +229,62 @@ def _hash_dimensions(dimensions_json):
   return int(struct.unpack('<L', digest[:4])[0]) or 1
 
 
+def _digest_dimensions(dimensions):
+  """Returns a digest of the bot dimensions, independent of the order of the
+  values.
+  """
+  normalized = {
+    k: sorted(v) if isinstance(v, list) else v
+    for k, v in dimensions.iteritems()
+  }
+  return hashlib.sha1(utils.encode_to_json(normalized)).hexdigest()
+
+
+def _get_accepted_dimensions_hash(bot_dimensions):
+  """Returns the frozenset of dimensions_hash of the tasks the bot can run.
+
+  Computing the powerset of the dimensions of a bot with many list values is
+  expensive, and they rarely change. The result is cached in the instance,
+  keyed by bot id, and in memcache, keyed by the digest of the dimensions, so
+  it is recomputed only when the dimensions of the bot change.
+
+  The time saved by the cache is recorded in
+  ts_mon_metrics.bot_powerset_cache_saved.
+  """
+  start = time.time()
+  digest = _digest_dimensions(bot_dimensions)
+  bot_id = bot_dimensions.get(u'id')
+  if isinstance(bot_id, list):
+    bot_id = bot_id[0] if bot_id else None
+  cached = _accepted_cache.get(bot_id)
+  if cached and cached[0] == digest:
+    accepted, cost = cached[1:]
+  else:
+    cached = memcache.get(digest, namespace='task_to_run_accepted')
+    if cached:
+      accepted, cost = cached
+    else:
+      accepted = frozenset(
+          _hash_dimensions(utils.encode_to_json(i))
+          for i in _powerset(bot_dimensions))
+      cost = time.time() - start
+      try:
+        memcache.set(
+            digest, (accepted, cost), namespace='task_to_run_accepted')
+      except ValueError:
+        # Too large for memcache, only the instance cache will have it.
+        pass
+      cached = None
+    if bot_id:
+      if len(_accepted_cache) >= _ACCEPTED_CACHE_SIZE:
+        _accepted_cache.clear()
+      _accepted_cache[bot_id] = (digest, accepted, cost)
+  if cached:
+    saved = cost - (time.time() - start)
+    ts_mon_metrics.bot_powerset_cache_saved.add(max(saved, 0.) * 1000.)
+  return accepted
+
+
 def _memcache_to_run_key(task_key):
   """Functional equivalent of task_result.pack_result_summary_key()."""
   request_key = task_to_run_key_to_request_key(task_key)
@@ -187,6 +298,163 @@ def _lookup_cache_is_taken(task_key):
   return bool(memcache.get(key, namespace='task_to_run'))
 
 
+def _lookup_cache_is_taken_async(task_keys):
+  """Queries the quick lookup cache for all of |task_keys| at once.
+
+  The ndb context batches the lookups into a single memcache RPC.
+
+  Returns:
+    list of ndb.Future, one per key, returning the cached value.
+  """
+  assert not ndb.in_transaction()
+  ctx = ndb.get_context()
+  return [
+    ctx.memcache_get(_memcache_to_run_key(k), namespace='task_to_run')
+    for k in task_keys
+  ]
+
+
+def _yield_pages(items, size, max_size):
+  """Yields lists of |items|, doubling in size up to |max_size| items.
+
+  The first pages are small so the first items are returned quickly.
+  """
+  page = []
+  for i in items:
+    page.append(i)
+    if len(page) == size:
+      yield page
+      page = []
+      size = min(size * 2, max_size)
+  if page:
+    yield page
+
+
+def _yield_entities(task_keys, sizes):
+  """Yields the (TaskToRun, TaskRequest) of |task_keys|.
+
+  They are fetched in chunks, the size of each chunk taken from the iterator
+  |sizes|, so few entities are fetched in vain when the caller stops early.
+  """
+  while task_keys:
+    size = next(sizes)
+    chunk, task_keys = task_keys[:size], task_keys[size:]
+    # The reason use_cache=False is otherwise it'll create a buffer bloat.
+    entities = ndb.get_multi(
+        chunk + [task_to_run_key_to_request_key(k) for k in chunk],
+        use_cache=False)
+    for pair in zip(entities[:len(chunk)], entities[len(chunk):]):
+      yield pair
+
+
+def _add_ready_hash(dimensions_hash):
+  """Adds |dimensions_hash| to the ready queues index, if not already there."""
+  client = memcache.Client()
+  for _ in xrange(10):
+    cached = client.get_multi(
+        [_READY_HASHES_KEY, _NEW_READY_HASHES_KEY], namespace='task_to_run',
+        for_cas=True)
+    ready = cached.get(_READY_HASHES_KEY)
+    new = cached.get(_NEW_READY_HASHES_KEY)
+    if ((ready and dimensions_hash in ready[1]) or
+        (new and dimensions_hash in new)):
+      return
+    now = utils.utcnow()
+    if new is None:
+      if client.add(
+          _NEW_READY_HASHES_KEY, {dimensions_hash: now},
+          namespace='task_to_run'):
+        return
+    else:
+      new = new.copy()
+      new[dimensions_hash] = now
+      if client.cas(_NEW_READY_HASHES_KEY, new, namespace='task_to_run'):
+        return
+  # A refresh of the index will add it.
+  logging.warning('Failed to add %d to the ready queues index', dimensions_hash)
+
+
+def _backfill_dimensions_hash(task_key):
+  """Stores again a reapable TaskToRun so its dimensions_hash is indexed.
+
+  The TaskToRun stored before dimensions_hash was added are not in any ready
+  queue until then.
+
+  Returns:
+    True on success.
+  """
+  def run():
+    task = task_key.get()
+    if task and task.is_reapable:
+      task.put()
+
+  try:
+    datastore_utils.transaction(run)
+    return True
+  except datastore_utils.CommitError as e:
+    logging.warning('Failed to backfill %s: %s', task_key, e)
+    return False
+
+
+def _get_ready_hashes():
+  """Returns the set of dimensions_hash with TaskToRun ready to be reaped.
+
+  The index is kept in memcache as two entries:
+  - the set of dimensions_hash found in a scan of all the reapable TaskToRun,
+    rebuilt every READY_HASHES_REFRESH seconds by refresh_ready_hashes().
+  - the dimensions_hash added since, see TaskToRun._post_put_hook().
+
+  It is a superset of the ready queues, since the queues emptied since the last
+  refresh are still listed.
+
+  Returns:
+    frozenset of dimensions_hash, or None if the index is not in memcache.
+  """
+  cached = memcache.get_multi(
+      [_READY_HASHES_KEY, _NEW_READY_HASHES_KEY], namespace='task_to_run')
+  ready = cached.get(_READY_HASHES_KEY)
+  if not ready:
+    return None
+  return ready[1].union(cached.get(_NEW_READY_HASHES_KEY) or ())
+
+
+def _yield_ready_keys(accepted_dimensions_hash, opts):
+  """Yields the keys of the TaskToRun in the ready queues of
+  |accepted_dimensions_hash|, merged by queue_number.
+
+  Falls back to scanning all the ready TaskToRun when the ready queues index is
+  not available, e.g. while some TaskToRun don't have dimensions_hash indexed
+  yet.
+  """
+  ready = _get_ready_hashes()
+  if ready is None:
+    # Interestingly, the filter on .queue_number>0 is required otherwise all the
+    # None items are returned first.
+    q = TaskToRun.query(default_options=opts).order(
+        TaskToRun.queue_number).filter(TaskToRun.queue_number > 0)
+    for task_key in q:
+      yield task_key
+    return
+
+  # Start all the queries before waiting for any of them.
+  iterators = [
+    TaskToRun.query(
+        TaskToRun.dimensions_hash == h, TaskToRun.queue_number > 0).order(
+            TaskToRun.queue_number).iter(
+                projection=[TaskToRun.queue_number],
+                batch_size=opts.batch_size)
+    for h in ready.intersection(accepted_dimensions_hash)
+  ]
+  def sort_key(n, iterator):
+    # |n| breaks ties on queue_number.
+    for t in iterator:
+      yield t.queue_number, n, t.key
+  merged = heapq.merge(
+      *[sort_key(n, i) for n, i in enumerate(iterators)])
+  for _, _, task_key in merged:
+    yield task_key
+
+
 ### Public API.
 
 
@@ -222,6 +490,73 @@ def new_task_to_run(request):
       expiration_ts=request.expiration_ts)
 
 
+@ndb.tasklet
+def add_prefetch_hint_async(request):
+  """Records the inputs_ref of a newly enqueued task as a prefetch hint.
+
+  The hints are kept in memcache per ready queue, the most recent first. See
+  get_prefetch_hints().
+
+  It uses the ndb context memcache API so it doesn't block the other tasklets
+  of a batch of task_scheduler.schedule_requests().
+  """
+  inputs_ref = request.properties.inputs_ref
+  if not inputs_ref or not inputs_ref.isolated:
+    return
+  hint = (
+      inputs_ref.isolated, inputs_ref.namespace, inputs_ref.isolatedserver)
+  key = str(request_to_task_to_run_key(request).integer_id())
+  ctx = ndb.get_context()
+  for _ in xrange(10):
+    hints = yield ctx.memcache_gets(key, namespace='task_to_run_prefetch')
+    if hints is None:
+      added = yield ctx.memcache_add(
+          key, [hint], time=PREFETCH_HINTS_EXPIRATION,
+          namespace='task_to_run_prefetch')
+      if added:
+        return
+      continue
+    if hints and hints[0] == hint:
+      return
+    hints = ([hint] + [h for h in hints if h != hint])[
+        :PREFETCH_HINTS_PER_QUEUE]
+    stored = yield ctx.memcache_cas(
+        key, hints, time=PREFETCH_HINTS_EXPIRATION,
+        namespace='task_to_run_prefetch')
+    if stored:
+      return
+  # It is only a hint.
+  logging.info('Failed to add prefetch hint %s', hint)
+
+
+def get_prefetch_hints(bot_dimensions, limit):
+  """Returns the inputs_ref of the tasks likely to be assigned to a bot soon.
+
+  These are the inputs_ref of the tasks recently enqueued in the ready queues
+  the bot can serve, so the bot can fetch them in its cache while idle. The
+  queues are interleaved so a busy one doesn't hide the other ones.
+
+  Returns:
+    list of up to |limit| (isolated, namespace, isolatedserver) tuples.
+  """
+  ready = _get_ready_hashes()
+  if not ready:
+    return []
+  hashes = ready.intersection(_get_accepted_dimensions_hash(bot_dimensions))
+  if not hashes:
+    return []
+  cached = memcache.get_multi(
+      [str(h) for h in sorted(hashes)], namespace='task_to_run_prefetch')
+  out = []
+  for hints in itertools.izip_longest(*(cached[k] for k in sorted(cached))):
+    for hint in hints:
+      if hint and hint not in out:
+        out.append(hint)
+        if len(out) == limit:
+          return out
+  return out
+
+
 def validate_to_run_key(task_key):
   """Validates a ndb.Key to a TaskToRun entity. Raises ValueError if invalid."""
   # This also validates the key kind.
@@ -305,9 +640,7 @@ def yield_next_available_task_to_dispatch(bot_dimensions, deadline):
       complete the task by. None if there is no such deadline.
   """
   # List of all the valid dimensions hashed.
-  accepted_dimensions_hash = frozenset(
-      _hash_dimensions(utils.encode_to_json(i))
-      for i in _powerset(bot_dimensions))
+  accepted_dimensions_hash = _get_accepted_dimensions_hash(bot_dimensions)
   now = utils.utcnow()
   broken = 0
   cache_lookup = 0
@@ -331,18 +664,23 @@ def yield_next_available_task_to_dispatch(bot_dimensions, deadline):
   # - Abusing batching will slow down this query.
   #
   # TODO(maruel): Measure query performance with stats_framework!!
-  # TODO(maruel): Use fetch_page_async() + ndb.get_multi_async() +
-  # memcache.get_multi_async() to do pipelined processing. Should greatly reduce
-  # the effect of latency on the total duration of this function. I also suspect
-  # using ndb.get_multi() will return fresher objects than what is returned by
-  # the query.
+  #
+  # The candidates are evaluated by pages: the quick lookup cache of the next
+  # page is queried while the current one is evaluated, then the TaskToRun and
+  # TaskRequest of the candidates left in a page are fetched with get_multi, in
+  # chunks growing from 1 item. The quick lookup cache is checked again for each
+  # candidate right before it is yielded.
   opts = ndb.QueryOptions(batch_size=50, prefetch_size=500, keys_only=True)
   try:
-    # Interestingly, the filter on .queue_number>0 is required otherwise all the
-    # None items are returned first.
-    q = TaskToRun.query(default_options=opts).order(
-        TaskToRun.queue_number).filter(TaskToRun.queue_number > 0)
-    for task_key in q:
+    pages = _yield_pages(
+        _yield_ready_keys(accepted_dimensions_hash, opts), 10, opts.batch_size)
+    # The entities are fetched by chunks of 1 doubling up to a page.
+    fetch_sizes = itertools.chain(
+        (2**i for i in xrange(opts.batch_size.bit_length() - 1)),
+        itertools.repeat(opts.batch_size))
+    pending = None
+    # The last empty page flushes the pending one.
+    for page in itertools.chain(pages, [[]]):
       duration = (utils.utcnow() - now).total_seconds()
       if duration > 40.:
         # Stop searching after too long, since the odds of the request blowing
@@ -353,86 +691,99 @@ def yield_next_available_task_to_dispatch(bot_dimensions, deadline):
         # request.
         return
 
-      total += 1
-      # Verify TaskToRun is what is expected. Play defensive here.
-      try:
-        validate_to_run_key(task_key)
-      except ValueError as e:
-        logging.error(str(e))
-        broken += 1
-        continue
-
-      # integer_id() == dimensions_hash.
-      if task_key.integer_id() not in accepted_dimensions_hash:
-        hash_mismatch += 1
-        continue
-
-      # Do this after the basic weeding out but before fetching TaskRequest.
-      if _lookup_cache_is_taken(task_key):
-        cache_lookup += 1
-        continue
-
-      # Ok, it's now worth taking a real look at the entity.
-      task = task_key.get(use_cache=False)
+      task_keys = []
+      for task_key in page:
+        total += 1
+        # Verify TaskToRun is what is expected. Play defensive here.
+        try:
+          validate_to_run_key(task_key)
+        except ValueError as e:
+          logging.error(str(e))
+          broken += 1
+          continue
 
-      # DB operations are slow, double check memcache again.
-      if _lookup_cache_is_taken(task_key):
-        cache_lookup += 1
+        # integer_id() == dimensions_hash.
+        if task_key.integer_id() not in accepted_dimensions_hash:
+          hash_mismatch += 1
+          continue
+        task_keys.append(task_key)
+
+      # Do this after the basic weeding out but before fetching the entities.
+      # Start the lookup of this page before evaluating the previous one.
+      current = None
+      if task_keys:
+        current = (task_keys, _lookup_cache_is_taken_async(task_keys))
+      if not pending:
+        pending = current
         continue
+      task_keys, taken = pending
+      pending = current
 
-      # It is possible for the index to be inconsistent since it is not executed
-      # in a transaction, no problem.
-      if not task.queue_number:
-        no_queue += 1
+      task_keys = [k for k, f in zip(task_keys, taken) if not f.get_result()]
+      cache_lookup += len(taken) - len(task_keys)
+      if not task_keys:
         continue
 
-      # It expired. A cron job will cancel it eventually. Since 'now' is saved
-      # before the query, an expired task may still be reaped even if
-      # technically expired if the query is very slow. This is on purpose so
-      # slow queries do not cause exagerate expirations.
-      if task.expiration_ts < now:
-        expired += 1
-        continue
+      # Ok, it's now worth taking a real look at the entities.
+      for task, request in _yield_entities(task_keys, fetch_sizes):
+        # It is possible for the index to be inconsistent since it is not
+        # executed in a transaction, no problem.
+        if not task or not task.queue_number:
+          no_queue += 1
+          continue
 
-      # The hash may have conflicts. Ensure the dimensions actually match by
-      # verifying the TaskRequest. There's a probability of 2**-31 of conflicts,
-      # which is low enough for our purpose. The reason use_cache=False is
-      # otherwise it'll create a buffer bloat.
-      request = task.request_key.get(use_cache=False)
-      if not match_dimensions(request.properties.dimensions, bot_dimensions):
-        real_mismatch += 1
-        continue
+        # It expired. A cron job will cancel it eventually. Since 'now' is saved
+        # before the query, an expired task may still be reaped even if
+        # technically expired if the query is very slow. This is on purpose so
+        # slow queries do not cause exagerate expirations.
+        if task.expiration_ts < now:
+          expired += 1
+          continue
 
-      # If the bot has a deadline, don't allow it to reap the task unless it can
-      # be completed before the deadline. We have to assume the task takes the
-      # theoretical maximum amount of time possible, which is governed by
-      # execution_timeout_secs. An isolated task's download phase is not subject
-      # to this limit, so we need to add io_timeout_secs. When a task is
-      # signalled that it's about to be killed, it receives a grace period as
-      # well. grace_period_secs is given by run_isolated to the task execution
-      # process, by task_runner to run_isolated, and by bot_main to the
-      # task_runner. Lastly, add a few seconds to account for any overhead.
-      #
-      # Give an exemption to the special terminate task because it doesn't
-      # actually run anything.
-      if deadline is not None and not request.properties.is_terminate:
-        if not request.properties.execution_timeout_secs:
-          # Task never times out, so it cannot be accepted.
-          too_long += 1
+        # The hash may have conflicts. Ensure the dimensions actually match by
+        # verifying the TaskRequest. There's a probability of 2**-31 of
+        # conflicts, which is low enough for our purpose.
+        if not match_dimensions(request.properties.dimensions, bot_dimensions):
+          real_mismatch += 1
           continue
-        max_task_time = (utils.time_time() +
-                         request.properties.execution_timeout_secs +
-                         (request.properties.io_timeout_secs or 600) +
-                         3 * (request.properties.grace_period_secs or 30) +
-                         10)
-        if deadline <= max_task_time:
-          too_long += 1
+
+        # If the bot has a deadline, don't allow it to reap the task unless it
+        # can be completed before the deadline. We have to assume the task takes
+        # the theoretical maximum amount of time possible, which is governed by
+        # execution_timeout_secs. An isolated task's download phase is not
+        # subject to this limit, so we need to add io_timeout_secs. When a task
+        # is signalled that it's about to be killed, it receives a grace period
+        # as well. grace_period_secs is given by run_isolated to the task
+        # execution process, by task_runner to run_isolated, and by bot_main to
+        # the task_runner. Lastly, add a few seconds to account for any
+        # overhead.
+        #
+        # Give an exemption to the special terminate task because it doesn't
+        # actually run anything.
+        if deadline is not None and not request.properties.is_terminate:
+          if not request.properties.execution_timeout_secs:
+            # Task never times out, so it cannot be accepted.
+            too_long += 1
+            continue
+          max_task_time = (utils.time_time() +
+                           request.properties.execution_timeout_secs +
+                           (request.properties.io_timeout_secs or 600) +
+                           3 * (request.properties.grace_period_secs or 30) +
+                           10)
+          if deadline <= max_task_time:
+            too_long += 1
+            continue
+
+        # DB operations are slow, double check memcache again just before
+        # yielding it.
+        if _lookup_cache_is_taken(task.key):
+          cache_lookup += 1
           continue
 
-      # It's a valid task! Note that in the meantime, another bot may have
-      # reaped it.
-      yield request, task
-      ignored += 1
+        # It's a valid task! Note that in the meantime, another bot may have
+        # reaped it.
+        yield request, task
+        ignored += 1
   finally:
     duration = (utils.utcnow() - now).total_seconds()
     logging.info(
@@ -454,6 +805,53 @@ def yield_next_available_task_to_dispatch(bot_dimensions, deadline):
         deadline)
 
 
+def refresh_ready_hashes():
+  """Rebuilds the set of ready dimensions_hash from a scan of all the TaskToRun.
+
+  Meant to be called by a cron job every READY_HASHES_REFRESH seconds, so the
+  scan is not done in the bots' requests.
+
+  The TaskToRun without dimensions_hash indexed are stored again so they are
+  in their ready queue. The index is not stored as long as some of them are
+  left, so the bots keep scanning all the TaskToRun meanwhile.
+
+  The dimensions_hash added more than one refresh period ago are dropped from
+  the new ones, since the scan includes them.
+
+  Returns:
+    Number of ready queues.
+  """
+  now = utils.utcnow()
+  q = TaskToRun.query(TaskToRun.queue_number > 0)
+  # The projection only returns the TaskToRun with dimensions_hash indexed.
+  indexed = frozenset(
+      t.key for t in q.iter(
+          projection=[TaskToRun.dimensions_hash], batch_size=500))
+  keys = q.fetch(keys_only=True, batch_size=500)
+  failed = sum(
+      not _backfill_dimensions_hash(k) for k in keys if k not in indexed)
+  if failed:
+    logging.warning('%d TaskToRun without dimensions_hash are left', failed)
+    memcache.delete(_READY_HASHES_KEY, namespace='task_to_run')
+    return 0
+
+  ready = frozenset(k.integer_id() for k in keys)
+  memcache.set(
+      _READY_HASHES_KEY, (now, ready), time=READY_HASHES_EXPIRATION,
+      namespace='task_to_run')
+
+  cutoff = now - datetime.timedelta(seconds=READY_HASHES_REFRESH)
+  client = memcache.Client()
+  for _ in xrange(10):
+    new = client.gets(_NEW_READY_HASHES_KEY, namespace='task_to_run') or {}
+    if all(v >= cutoff for v in new.itervalues()):
+      break
+    new = {k: v for k, v in new.iteritems() if v >= cutoff}
+    if client.cas(_NEW_READY_HASHES_KEY, new, namespace='task_to_run'):
+      break
+  return len(ready)
+
+
 def yield_expired_task_to_run():
   """Yields all the expired TaskToRun still marked as available."""
   now = utils.utcnow()
@@ -14,6 +14,8 @@ import unittest
 import test_env
 test_env.setup_test_env()
 
+from google.appengine.api import datastore
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from components import auth_testing
@@ -94,6 +96,7 @@ class TestCase(test_case.TestCase):
   def setUp(self):
     super(TestCase, self).setUp()
     auth_testing.mock_get_current_identity(self)
+    self.mock(task_to_run, '_accepted_cache', {})
 
 
 class TaskToRunPrivateTest(TestCase):
@@ -223,6 +226,43 @@ class TaskToRunPrivateTest(TestCase):
     self.assertEqual('711d0bf1', as_hex)
     self.assertEqual(0xf10b1d71, actual)
 
+  def test_yield_pages(self):
+    actual = list(task_to_run._yield_pages(xrange(20), 2, 8))
+    expected = [[0, 1], [2, 3, 4, 5], range(6, 14), range(14, 20)]
+    self.assertEqual(expected, actual)
+    self.assertEqual([], list(task_to_run._yield_pages([], 2, 8)))
+
+  def test_get_accepted_dimensions_hash(self):
+    calls = []
+    def powerset(dimensions):
+      calls.append(dimensions)
+      return old_powerset(dimensions)
+    old_powerset = self.mock(task_to_run, '_powerset', powerset)
+    bot_dimensions = {u'OS': [u'Windows', u'Windows-3.1.1'], u'id': [u'bot1']}
+    expected = frozenset(
+        _hash_dimensions(i) for i in old_powerset(bot_dimensions))
+    self.assertEqual(
+        expected, task_to_run._get_accepted_dimensions_hash(bot_dimensions))
+    self.assertEqual(1, len(calls))
+
+    # Cached in the instance, even if the values are in a different order.
+    bot_dimensions[u'OS'].reverse()
+    self.assertEqual(
+        expected, task_to_run._get_accepted_dimensions_hash(bot_dimensions))
+    # Cached in memcache.
+    task_to_run._accepted_cache.clear()
+    self.assertEqual(
+        expected, task_to_run._get_accepted_dimensions_hash(bot_dimensions))
+    self.assertEqual(1, len(calls))
+
+    # Recomputed when the dimensions change.
+    bot_dimensions[u'OS'] = [u'Linux']
+    expected = frozenset(
+        _hash_dimensions(i) for i in old_powerset(bot_dimensions))
+    self.assertEqual(
+        expected, task_to_run._get_accepted_dimensions_hash(bot_dimensions))
+    self.assertEqual(2, len(calls))
+
   def test_dimensions_search_sizing_10_1(self):
     dimensions = {str(k): '01234567890123456789' for k in xrange(10)}
     items = tuple(sorted(
@@ -716,6 +756,114 @@ class TaskToRunApiTest(TestCase):
     to_run.put()
     self.assertEqual(False, to_run.is_reapable)
 
+  def test_get_ready_hashes(self):
+    dims_1 = {u'OS': u'Windows-3.1.1', u'pool': u'default'}
+    dims_2 = {u'OS': u'Linux', u'pool': u'default'}
+    hash_1 = _hash_dimensions(dims_1)
+    hash_2 = _hash_dimensions(dims_2)
+    to_run_1 = _gen_new_task_to_run(properties=dict(dimensions=dims_1))
+    # The index is only built by the cron job.
+    self.assertEqual(None, task_to_run._get_ready_hashes())
+    self.assertEqual(1, task_to_run.refresh_ready_hashes())
+    self.assertEqual(frozenset([hash_1]), task_to_run._get_ready_hashes())
+
+    # A new ready queue is added when the TaskToRun is stored.
+    _gen_new_task_to_run(properties=dict(dimensions=dims_2))
+    self.assertEqual(
+        frozenset([hash_1, hash_2]), task_to_run._get_ready_hashes())
+
+    # An emptied ready queue is only dropped at the next refresh.
+    to_run_1.queue_number = None
+    to_run_1.put()
+    self.assertEqual(
+        frozenset([hash_1, hash_2]), task_to_run._get_ready_hashes())
+    self.mock_now(self.now, task_to_run.READY_HASHES_REFRESH + 1)
+    self.assertEqual(1, task_to_run.refresh_ready_hashes())
+    self.assertEqual(frozenset([hash_2]), task_to_run._get_ready_hashes())
+
+  def test_get_ready_hashes_missing(self):
+    dims = {u'OS': u'Windows-3.1.1', u'pool': u'default'}
+    _gen_new_task_to_run(properties=dict(dimensions=dims))
+    task_to_run.refresh_ready_hashes()
+    # The index was evicted from memcache.
+    memcache.flush_all()
+    self.assertEqual(None, task_to_run._get_ready_hashes())
+    # The bot falls back to scanning all the TaskToRun.
+    self.assertEqual(1, len(_yield_next_available_task_to_dispatch(dims, None)))
+
+  def test_refresh_ready_hashes_backfill(self):
+    dims = {u'OS': u'Windows-3.1.1', u'pool': u'default'}
+    to_run = _gen_new_task_to_run(properties=dict(dimensions=dims))
+    # Stores it again like it was before dimensions_hash was added.
+    entity = datastore.Entity(
+        'TaskToRun', parent=to_run.key.parent().to_old_key(),
+        id=to_run.key.integer_id())
+    entity['expiration_ts'] = to_run.expiration_ts
+    entity['queue_number'] = to_run.queue_number
+    datastore.Put(entity)
+    q = task_to_run.TaskToRun.query(
+        task_to_run.TaskToRun.dimensions_hash == to_run.key.integer_id())
+    self.assertEqual(0, q.count())
+
+    self.assertEqual(1, task_to_run.refresh_ready_hashes())
+    self.assertEqual([to_run.key], q.fetch(keys_only=True))
+    self.assertEqual(
+        frozenset([to_run.key.integer_id()]), task_to_run._get_ready_hashes())
+
+  def test_yield_ready_keys(self):
+    dims_1 = {u'OS': u'Windows-3.1.1', u'pool': u'default'}
+    dims_2 = {u'pool': u'default'}
+    dims_3 = {u'OS': u'Linux', u'pool': u'default'}
+    to_run_1 = _gen_new_task_to_run(
+        properties=dict(dimensions=dims_1), priority=20)
+    to_run_2 = _gen_new_task_to_run(
+        properties=dict(dimensions=dims_2), priority=10)
+    self.mock_now(self.now, 1)
+    to_run_3 = _gen_new_task_to_run(
+        properties=dict(dimensions=dims_1), priority=10)
+    _gen_new_task_to_run(properties=dict(dimensions=dims_3), priority=0)
+    accepted = frozenset(
+        task_to_run._hash_dimensions(utils.encode_to_json(d))
+        for d in task_to_run._powerset(dims_1))
+    opts = ndb.QueryOptions(batch_size=50)
+    task_to_run.refresh_ready_hashes()
+    # The two ready queues are merged by queue_number, the queue of the Linux
+    # task is not looked at.
+    actual = list(task_to_run._yield_ready_keys(accepted, opts))
+    self.assertEqual([to_run_2.key, to_run_3.key, to_run_1.key], actual)
+
+  def test_yield_next_available_task_to_dispatch_lookup_cache(self):
+    # Spans multiple pages, with taken tasks in each.
+    request_dimensions = {u'OS': u'Windows-3.1.1', u'pool': u'default'}
+    to_runs = []
+    for i in xrange(25):
+      self.mock_now(self.now, i)
+      to_runs.append(
+          _gen_new_task_to_run(properties=dict(dimensions=request_dimensions)))
+    for to_run in to_runs[::2]:
+      task_to_run.set_lookup_cache(to_run.key, False)
+    actual = [
+      to_run.key
+      for _, to_run in task_to_run.yield_next_available_task_to_dispatch(
+          request_dimensions, None)
+    ]
+    self.assertEqual([t.key for t in to_runs[1::2]], actual)
+
+  def test_yield_next_available_task_to_dispatch_taken_after_fetch(self):
+    request_dimensions = {u'OS': u'Windows-3.1.1', u'pool': u'default'}
+    to_runs = []
+    for i in xrange(3):
+      self.mock_now(self.now, i)
+      to_runs.append(
+          _gen_new_task_to_run(properties=dict(dimensions=request_dimensions)))
+    # Another bot reaps the last task while the first one is evaluated.
+    actual = []
+    for _, to_run in task_to_run.yield_next_available_task_to_dispatch(
+        request_dimensions, None):
+      actual.append(to_run.key)
+      task_to_run.set_lookup_cache(to_runs[2].key, False)
+    self.assertEqual([to_runs[0].key, to_runs[1].key], actual)
+
   def test_set_lookup_cache(self):
     to_run = _gen_new_task_to_run(
         properties={
@@ -729,6 +877,67 @@ class TaskToRunApiTest(TestCase):
     task_to_run.set_lookup_cache(to_run.key, True)
     self.assertEqual(False, task_to_run._lookup_cache_is_taken(to_run.key))
 
+  def test_get_prefetch_hints(self):
+    def gen(isolated, dimensions):
+      request = mkreq(_gen_request(properties={
+        'command': [],
+        'dimensions': dimensions,
+        'inputs_ref': task_request.FilesRef(
+            isolated=isolated, isolatedserver=u'http://localhost:1',
+            namespace=u'default-gzip'),
+      }))
+      task_to_run.new_task_to_run(request).put()
+      task_to_run.add_prefetch_hint_async(request).get_result()
+      return (isolated, u'default-gzip', u'http://localhost:1')
+    win = {u'OS': u'Windows-3.1.1', u'pool': u'default'}
+    linux = {u'OS': u'Linux', u'pool': u'default'}
+    hint_1 = gen(u'1' * 40, win)
+    hint_2 = gen(u'2' * 40, win)
+    hint_3 = gen(u'3' * 40, linux)
+    # A task with the same inputs becomes the most recent hint again.
+    gen(u'1' * 40, win)
+    task_to_run.refresh_ready_hashes()
+
+    bot_dimensions = {
+      u'OS': [u'Windows-3.1.1'], u'id': [u'bot1'], u'pool': [u'default'],
+    }
+    self.assertEqual(
+        [hint_1, hint_2], task_to_run.get_prefetch_hints(bot_dimensions, 5))
+    self.assertEqual(
+        [hint_1], task_to_run.get_prefetch_hints(bot_dimensions, 1))
+
+    # The queues are interleaved.
+    bot_dimensions[u'OS'].append(u'Linux')
+    bot_dimensions[u'id'] = [u'bot2']
+    actual = task_to_run.get_prefetch_hints(bot_dimensions, 2)
+    self.assertEqual(set([hint_1, hint_3]), set(actual))
+    self.assertEqual(
+        [], task_to_run.get_prefetch_hints({u'OS': [u'Amiga']}, 5))
+
+  def test_add_prefetch_hint_max(self):
+    self.mock(task_to_run, 'PREFETCH_HINTS_PER_QUEUE', 2)
+    for i in xrange(3):
+      request = _gen_request(properties={
+        'command': [],
+        'inputs_ref': task_request.FilesRef(
+            isolated=unicode(i) * 40, isolatedserver=u'http://localhost:1',
+            namespace=u'default-gzip'),
+      })
+      request.key = task_request.new_request_key()
+      task_to_run.add_prefetch_hint_async(request).get_result()
+    # Raw commands are ignored.
+    request = _gen_request()
+    request.key = task_request.new_request_key()
+    task_to_run.add_prefetch_hint_async(request).get_result()
+
+    key = str(task_to_run.request_to_task_to_run_key(request).integer_id())
+    expected = [
+      (u'2' * 40, u'default-gzip', u'http://localhost:1'),
+      (u'1' * 40, u'default-gzip', u'http://localhost:1'),
+    ]
+    self.assertEqual(
+        expected, memcache.get(key, namespace='task_to_run_prefetch'))
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
@@ -42,6 +42,7 @@ from api import bot
 from api import os_utilities
 from api import platforms
 from utils import file_path
+from utils import lru
 from utils import net
 from utils import on_error
 from utils import subprocess42
@@ -71,6 +72,7 @@ SINGLETON = singleton.Singleton(os.path.dirname(THIS_FILE))
 # for more details.
 PASSLIST = (
   '*-cacert.pem',
+  'c',
   'cipd_cache',
   'isolated_cache',
   'logs',
@@ -81,6 +83,40 @@ PASSLIST = (
   'swarming_bot.zip',
 )
 
+# Maximum time spent by the background run_isolated --clean hashing the
+# isolated cache items to detect corruption, in seconds.
+CLEAN_ISOLATED_CACHE_VERIFY_SECS = 600
+
+
+# Time given to a background run_isolated to save its state and exit once the
+# bot needs the cache for a task, in seconds.
+CLEAN_ISOLATED_CACHE_GRACE_SECS = 30
+
+
+# Maximum number of bytes downloaded by the background run_isolated --prefetch.
+# run_isolated also keeps --min-free-space bytes free on the disk.
+PREFETCH_MAX_SIZE = 1024*1024*1024
+
+
+# Maximum number of .isolated hashes remembered in _PREFETCHED.
+_PREFETCHED_MAX_ITEMS = 100
+
+
+# The background run_isolated --clean as (proc, thread), if any. See
+# clean_isolated_cache().
+_CACHE_CLEANER = None
+
+
+# The background run_isolated --prefetch as (proc, thread), if any. See
+# prefetch_isolated_inputs().
+_PREFETCHER = None
+
+
+# The .isolated hashes already prefetched, so they are not fetched again on
+# each poll.
+_PREFETCHED = set()
+
+
 ### bot_config handler part.
 
 
@@ -171,6 +207,12 @@ def get_state(botobj, sleep_streak):
     # Use super hammer in case of dangerous environment.
     state['quarantined'] = 'Can\'t run from blacklisted directory'
 
+  # The named caches are reported in the state and not as a dimension, since
+  # each dimension value multiplies the number of dimensions combinations the
+  # server matches the bot against.
+  caches = get_named_caches(botobj)
+  if caches:
+    state['named_caches'] = caches
   state['sleep_streak'] = sleep_streak
   return state
 
@@ -252,6 +294,20 @@ def is_base_dir_ok(botobj):
   return botobj.base_dir != os.path.expanduser('~')
 
 
+def get_named_caches(botobj):
+  """Returns the names of the named caches present on the bot."""
+  base_dir = botobj.base_dir if botobj else os.path.dirname(THIS_FILE)
+  # The state file is managed by run_isolated's named_cache.CacheManager.
+  state_file = os.path.join(base_dir, 'c', 'state.json')
+  if not os.path.isfile(state_file):
+    return []
+  try:
+    return sorted(lru.LRUDict.load(state_file))
+  except ValueError as e:
+    logging.warning('Failed to read the named caches: %s', e)
+    return []
+
+
 def get_min_free_space(botobj):
   """Returns free disk space needed.
 
@@ -383,26 +439,107 @@ def cleanup_bot_directory(botobj):
 
 
 def clean_isolated_cache(botobj):
-  """Asks run_isolated to clean its cache.
+  """Starts run_isolated --clean in the background to clean its cache.
 
-  This may take a while but it ensures that in the case of a run_isolated run
-  failed and it temporarily used more space than min_free_disk, it can cleans up
-  the mess properly.
+  It ensures that in the case of a run_isolated run failed and it temporarily
+  used more space than min_free_disk, it can cleans up the mess properly.
 
   It will remove unexpected files, remove corrupted files, trim the cache size
   based on the policies and update state.json.
+
+  It doesn't block the bot from polling for the next task. It is stopped by
+  stop_clean_isolated_cache() before a task is run, the items it didn't get to
+  hash are verified by the next cleanup. run_isolated holds a lock file on the
+  cache, so a task waits for the cleanup to have saved its state.
   """
+  global _CACHE_CLEANER
+  stop_clean_isolated_cache()
   cmd = [
     sys.executable, THIS_FILE, 'run_isolated',
     '--clean',
     '--log-file', os.path.join(botobj.base_dir, 'logs', 'run_isolated.log'),
     '--cache', os.path.join(botobj.base_dir, 'isolated_cache'),
+    '--named-cache-root', os.path.join(botobj.base_dir, 'c'),
     '--min-free-space', str(get_min_free_space(botobj)),
+    '--max-verify-time', str(CLEAN_ISOLATED_CACHE_VERIFY_SECS),
   ]
+  _CACHE_CLEANER = _start_run_isolated(botobj, cmd, '--clean')
+
+
+def stop_clean_isolated_cache():
+  """Stops the background run_isolated --clean, if still running.
+
+  run_isolated saves its progress and exits when terminated. It is killed if it
+  doesn't within CLEAN_ISOLATED_CACHE_GRACE_SECS.
+  """
+  global _CACHE_CLEANER
+  cleaner, _CACHE_CLEANER = _CACHE_CLEANER, None
+  _stop_run_isolated(cleaner, '--clean')
+
+
+def prefetch_isolated_inputs(botobj, hints):
+  """Starts run_isolated --prefetch in the background to warm the isolated
+  cache while the bot is idle.
+
+  |hints| are the inputs of the tasks the server expects to assign to this bot
+  soon, as sent in the 'prefetch' list of the sleep command. Each is a dict with
+  the keys 'input', 'namespace' and 'server'.
+
+  The inputs already prefetched are skipped. Only the inputs of one isolate
+  server and namespace are fetched at a time, the other ones are fetched on a
+  following poll. Nothing is done while the cache is being cleaned up or
+  prefetched. It is stopped by stop_prefetch_isolated_inputs() before a task is
+  run.
+  """
+  global _PREFETCHER
+  for background in (_CACHE_CLEANER, _PREFETCHER):
+    if background and background[1].is_alive():
+      return
+  hints = [h for h in hints if h.get('input') not in _PREFETCHED]
+  if not hints:
+    return
+  server = hints[0]['server']
+  namespace = hints[0]['namespace']
+  inputs = [
+    h['input'] for h in hints
+    if h['server'] == server and h['namespace'] == namespace
+  ]
+  cmd = [
+    sys.executable, THIS_FILE, 'run_isolated',
+    '--log-file', os.path.join(botobj.base_dir, 'logs', 'run_isolated.log'),
+    '--cache', os.path.join(botobj.base_dir, 'isolated_cache'),
+    '--min-free-space', str(get_min_free_space(botobj)),
+    '-I', server.encode('utf-8'),
+    '--namespace', namespace.encode('utf-8'),
+    '--max-prefetch-size', str(PREFETCH_MAX_SIZE),
+  ]
+  for i in inputs:
+    cmd.extend(('--prefetch', i.encode('utf-8')))
+  if len(_PREFETCHED) + len(inputs) > _PREFETCHED_MAX_ITEMS:
+    _PREFETCHED.clear()
+  _PREFETCHED.update(inputs)
+  _PREFETCHER = _start_run_isolated(botobj, cmd, '--prefetch')
+
+
+def stop_prefetch_isolated_inputs():
+  """Stops the background run_isolated --prefetch, if still running.
+
+  The files fetched so far are kept in the cache.
+  """
+  global _PREFETCHER
+  prefetcher, _PREFETCHER = _PREFETCHER, None
+  _stop_run_isolated(prefetcher, '--prefetch')
+
+
+def _start_run_isolated(botobj, cmd, name):
+  """Starts run_isolated |cmd| in the background.
+
+  Returns:
+    (proc, thread) where thread waits for proc and reports its failure, or None
+    if it couldn't be started.
+  """
   logging.info('Running: %s', cmd)
   try:
-    # Intentionally do not use a timeout, it can take a while to hash 50gb but
-    # better be safe than sorry.
     proc = subprocess42.Popen(
         cmd,
         stdin=subprocess42.PIPE,
@@ -410,14 +547,45 @@ def clean_isolated_cache(botobj):
         cwd=botobj.base_dir,
         detached=True,
         close_fds=sys.platform != 'win32')
-    output, _ = proc.communicate(None)
-    logging.info('Result:\n%s', output)
-    if proc.returncode:
-      botobj.post_error(
-          'swarming_bot.zip failure during run_isolated --clean:\n%s' % output)
   except OSError:
     botobj.post_error(
-        'swarming_bot.zip internal failure during run_isolated --clean')
+        'swarming_bot.zip internal failure during run_isolated %s' % name)
+    return None
+  thread = threading.Thread(
+      target=_wait_run_isolated, args=(botobj, proc, name),
+      name='run_isolated %s' % name)
+  thread.daemon = True
+  thread.start()
+  return proc, thread
+
+
+def _wait_run_isolated(botobj, proc, name):
+  """Waits for a background run_isolated and reports failures."""
+  output, _ = proc.communicate(None)
+  logging.info('Result:\n%s', output)
+  if proc.returncode:
+    botobj.post_error(
+        'swarming_bot.zip failure during run_isolated %s:\n%s' %
+        (name, output))
+
+
+def _stop_run_isolated(background, name):
+  """Stops a background run_isolated started by _start_run_isolated().
+
+  run_isolated saves its progress and exits when terminated. It is killed if it
+  doesn't within CLEAN_ISOLATED_CACHE_GRACE_SECS.
+  """
+  if not background:
+    return
+  proc, thread = background
+  if proc.poll() is None:
+    logging.info('Stopping run_isolated %s', name)
+    proc.terminate()
+  thread.join(CLEAN_ISOLATED_CACHE_GRACE_SECS)
+  if thread.is_alive():
+    logging.error('Killing run_isolated %s', name)
+    proc.kill()
+    thread.join()
 
 
 def run_bot(arg_error):
@@ -551,6 +719,8 @@ def run_bot(arg_error):
         botobj.post_error(msg)
         consecutive_sleeps = 0
     logging.info('Quitting')
+    stop_prefetch_isolated_inputs()
+    stop_clean_isolated_cache()
 
   # Tell the server we are going away.
   botobj.post_event('bot_shutdown', 'Signal was received')
@@ -572,9 +742,12 @@ def poll_server(botobj, quit_bit, last_action):
   logging.debug('Server response:\n%s: %s', cmd, value)
 
   if cmd == 'sleep':
-    # Value is duration
+    # Value is the duration and the inputs to prefetch.
+    duration, prefetch = value
     call_hook(botobj, 'on_bot_idle', max(0, time.time() - last_action))
-    quit_bit.wait(value)
+    if prefetch:
+      prefetch_isolated_inputs(botobj, prefetch)
+    quit_bit.wait(duration)
     return False
 
   if cmd == 'terminate':
@@ -592,22 +765,28 @@ def poll_server(botobj, quit_bit, last_action):
 
   if cmd == 'run':
     # Value is the manifest
+    stop_prefetch_isolated_inputs()
+    stop_clean_isolated_cache()
     if run_manifest(botobj, value, start):
       # Completed a task successfully so update swarming_bot.zip if necessary.
       update_lkgbc(botobj)
-    # Clean up cache after a task
+    # Clean up cache after a task, in the background.
     clean_isolated_cache(botobj)
     # TODO(maruel): Handle the case where quit_bit.is_set() happens here. This
     # is concerning as this means a signal (often SIGTERM) was received while
     # running the task. Make sure the host is properly restarting.
   elif cmd == 'update':
     # Value is the version
+    stop_prefetch_isolated_inputs()
+    stop_clean_isolated_cache()
     update_bot(botobj, value)
   elif cmd == 'restart':
     # Value is the message to display while restarting
     if _in_load_test_mode():
       logging.warning('Would have restarted: %s' % value)
     else:
+      stop_prefetch_isolated_inputs()
+      stop_clean_isolated_cache()
       botobj.restart(value)
   else:
     raise ValueError('Unexpected command: %s\n%s' % (cmd, value))
@@ -27,6 +27,7 @@ from api.platforms import gce
 from depot_tools import fix_encoding
 from utils import file_path
 from utils import logging_utils
+from utils import lru
 from utils import net
 from utils import subprocess42
 from utils import zip_package
@@ -119,6 +120,18 @@ class TestBotMain(net_utils.TestCase):
     os.environ['SWARMING_LOAD_TEST'] = '1'
     self.assertEqual(['id', 'load_test'], sorted(bot_main.get_dimensions(None)))
 
+  def test_get_named_caches(self):
+    botobj = self.make_bot()
+    self.assertEqual([], bot_main.get_named_caches(botobj))
+    lru_dict = lru.LRUDict()
+    lru_dict.add(u'pip', u'aa')
+    lru_dict.add(u'git', u'ab')
+    os.mkdir(os.path.join(self.root_dir, 'c'))
+    lru_dict.save(os.path.join(self.root_dir, 'c', 'state.json'))
+    self.assertEqual([u'git', u'pip'], bot_main.get_named_caches(botobj))
+    self.assertEqual(
+        [u'git', u'pip'], bot_main.get_state(botobj, 0)['named_caches'])
+
   def test_generate_version(self):
     self.assertEqual('123', bot_main.generate_version())
 
@@ -362,6 +375,45 @@ class TestBotMain(net_utils.TestCase):
     self.assertFalse(bot_main.poll_server(self.bot, bit, 0))
     self.assertEqual([1.24], slept)
 
+  def test_poll_server_sleep_prefetch(self):
+    slept = []
+    prefetched = []
+    bit = threading.Event()
+    self.mock(bit, 'wait', slept.append)
+    self.mock(bot_main, 'run_manifest', self.fail)
+    self.mock(bot_main, 'update_bot', self.fail)
+    self.mock(
+        bot_main, 'prefetch_isolated_inputs',
+        lambda *args: prefetched.append(args))
+    hints = [
+      {
+        'input': '123',
+        'namespace': 'default-gzip',
+        'server': 'https://isolateserver.appspot.com',
+      },
+    ]
+
+    self.expected_requests(
+        [
+          (
+            'https://localhost:1/swarming/api/v1/bot/poll',
+            {
+              'data': self.attributes,
+              'follow_redirects': False,
+              'headers': {},
+              'timeout': remote_client.NET_CONNECTION_TIMEOUT_SEC,
+            },
+            {
+              'cmd': 'sleep',
+              'duration': 1.24,
+              'prefetch': hints,
+            },
+          ),
+        ])
+    self.assertFalse(bot_main.poll_server(self.bot, bit, 0))
+    self.assertEqual([1.24], slept)
+    self.assertEqual([(self.bot, hints)], prefetched)
+
   def test_poll_server_run(self):
     manifest = []
     clean = []
@@ -394,6 +446,108 @@ class TestBotMain(net_utils.TestCase):
     expected = [(self.bot,)]
     self.assertEqual(expected, clean)
 
+  def test_clean_isolated_cache(self):
+    calls = []
+    class Popen(object):
+      def __init__(self2, cmd, **kwargs):
+        calls.append(cmd)
+        self.assertEqual(True, kwargs['detached'])
+        self2.returncode = None
+        self2._done = threading.Event()
+
+      def communicate(self2, _input):
+        self2._done.wait()
+        return 'output', None
+
+      def poll(self2):
+        return self2.returncode
+
+      def terminate(self2):
+        calls.append('terminate')
+        self2.returncode = 0
+        self2._done.set()
+
+      def kill(_self2):
+        self.fail()
+    self.mock(subprocess42, 'Popen', Popen)
+
+    # It returns right away and runs in the background.
+    bot_main.clean_isolated_cache(self.bot)
+    self.assertEqual(1, len(calls))
+    self.assertEqual('--clean', calls[0][3])
+    self.assertEqual(
+        ['--max-verify-time', str(bot_main.CLEAN_ISOLATED_CACHE_VERIFY_SECS)],
+        calls[0][-2:])
+    proc, thread = bot_main._CACHE_CLEANER
+    self.assertTrue(thread.is_alive())
+
+    # A task stops it.
+    bot_main.stop_clean_isolated_cache()
+    self.assertEqual('terminate', calls[1])
+    self.assertFalse(thread.is_alive())
+    self.assertEqual(None, bot_main._CACHE_CLEANER)
+    self.assertEqual(0, proc.returncode)
+    bot_main.stop_clean_isolated_cache()
+    self.assertEqual(2, len(calls))
+
+  def test_prefetch_isolated_inputs(self):
+    calls = []
+    class Popen(object):
+      def __init__(self2, cmd, **kwargs):
+        calls.append(cmd)
+        self.assertEqual(True, kwargs['detached'])
+        self2.returncode = None
+        self2._done = threading.Event()
+
+      def communicate(self2, _input):
+        self2._done.wait()
+        return 'output', None
+
+      def poll(self2):
+        return self2.returncode
+
+      def terminate(self2):
+        calls.append('terminate')
+        self2.returncode = 0
+        self2._done.set()
+
+      def kill(_self2):
+        self.fail()
+    self.mock(subprocess42, 'Popen', Popen)
+    self.mock(bot_main, '_CACHE_CLEANER', None)
+    self.mock(bot_main, '_PREFETCHED', set())
+    hints = [
+      {'input': '1', 'namespace': 'default-gzip', 'server': 'https://a'},
+      {'input': '2', 'namespace': 'default-gzip', 'server': 'https://b'},
+      {'input': '3', 'namespace': 'default-gzip', 'server': 'https://a'},
+    ]
+
+    # Only the inputs of the first isolate server are prefetched.
+    bot_main.prefetch_isolated_inputs(self.bot, hints)
+    self.assertEqual(1, len(calls))
+    self.assertEqual(
+        ['-I', 'https://a', '--namespace', 'default-gzip',
+         '--max-prefetch-size', str(bot_main.PREFETCH_MAX_SIZE),
+         '--prefetch', '1', '--prefetch', '3'],
+        calls[0][-10:])
+    # Nothing is started while it runs.
+    bot_main.prefetch_isolated_inputs(self.bot, hints)
+    self.assertEqual(1, len(calls))
+
+    # A task stops it.
+    bot_main.stop_prefetch_isolated_inputs()
+    self.assertEqual('terminate', calls[1])
+    self.assertEqual(None, bot_main._PREFETCHER)
+
+    # The inputs already prefetched are skipped.
+    bot_main.prefetch_isolated_inputs(self.bot, hints)
+    self.assertEqual(3, len(calls))
+    self.assertEqual(['-I', 'https://b'], calls[2][-8:-6])
+    self.assertEqual(['--prefetch', '2'], calls[2][-2:])
+    bot_main.stop_prefetch_isolated_inputs()
+    bot_main.prefetch_isolated_inputs(self.bot, hints)
+    self.assertEqual(4, len(calls))
+
   def test_poll_server_update(self):
     update = []
     bit = threading.Event()
@@ -2,12 +2,14 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
-import base64
+import json
 import logging
+import struct
 import threading
 import time
 import traceback
 import urllib
+import zlib
 
 from utils import net
 
@@ -23,6 +25,13 @@ AUTH_HEADERS_EXPIRATION_SEC = 6*60
 NET_CONNECTION_TIMEOUT_SEC = 5*60
 
 
+# Content type of the task_update requests. The body is the length of the JSON
+# encoded parameters as a 4 bytes big endian integer, the JSON encoded
+# parameters, then the zlib compressed output, if any. This saves the base64
+# encoding of the output and most of its size. Keep synced with handlers_bot.py.
+TASK_UPDATE_CONTENT_TYPE = 'application/x-swarming-task-update'
+
+
 class InitializationError(Exception):
   """Raised by RemoteClient.initialize on fatal errors."""
   def __init__(self, last_error):
@@ -125,14 +134,19 @@ class RemoteClientNative(object):
               self._exp_ts - time.time())
       return self._headers or {}
 
-  def _url_read_json(self, url_path, data=None):
-    """Does POST (if data is not None) or GET request to a JSON endpoint."""
+  def _url_read_json(self, url_path, data=None, content_type=None):
+    """Does POST (if data is not None) or GET request to a JSON endpoint.
+
+    If |content_type| is set, |data| is an already encoded str sent as-is.
+    """
+    kwargs = {'content_type': content_type} if content_type else {}
     return net.url_read_json(
         self._server + url_path,
         data=data,
         headers=self.get_authentication_headers(),
         timeout=NET_CONNECTION_TIMEOUT_SEC,
-        follow_redirects=False)
+        follow_redirects=False,
+        **kwargs)
 
   def _url_retrieve(self, filepath, url_path):
     """Fetches the file from the given URL path on the server."""
@@ -171,15 +185,17 @@ class RemoteClientNative(object):
         'task_id': task_id,
     }
     data.update(params)
+    output = ''
     # Preserving prior behaviour: empty stdout is not transmitted
     if stdout_and_chunk and stdout_and_chunk[0]:
-      data['output'] = base64.b64encode(stdout_and_chunk[0])
+      output = stdout_and_chunk[0]
       data['output_chunk_start'] = stdout_and_chunk[1]
     if exit_code != None:
       data['exit_code'] = exit_code
 
     resp = self._url_read_json(
-        '/swarming/api/v1/bot/task_update/%s' % task_id, data)
+        '/swarming/api/v1/bot/task_update/%s' % task_id,
+        encode_task_update(data, output), TASK_UPDATE_CONTENT_TYPE)
     logging.debug('post_task_update() = %s', resp)
     if not resp or resp.get('error'):
       raise InternalError(
@@ -217,7 +233,7 @@ class RemoteClientNative(object):
 
     cmd = resp['cmd']
     if cmd == 'sleep':
-      return (cmd, resp['duration'])
+      return (cmd, (resp['duration'], resp.get('prefetch') or []))
     if cmd == 'terminate':
       return (cmd, resp['task_id'])
     if cmd == 'run':
@@ -243,3 +259,12 @@ class RemoteClientNative(object):
     resp = net.url_read(self._server + '/swarming/api/v1/bot/server_ping')
     if resp is None:
       logging.error('No response from server_ping')
+
+
+def encode_task_update(params, output):
+  """Returns the body of a task_update request in TASK_UPDATE_CONTENT_TYPE."""
+  header = json.dumps(params, sort_keys=True, separators=(',', ':'))
+  body = struct.pack('>I', len(header)) + header
+  if output:
+    body += zlib.compress(output)
+  return body
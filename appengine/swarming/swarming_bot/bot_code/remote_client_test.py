@@ -3,16 +3,20 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import json
 import logging
+import struct
 import sys
 import threading
 import time
 import unittest
+import zlib
 
 import test_env_bot_code
 test_env_bot_code.setup_test_env()
 
 from depot_tools import auto_stub
+from utils import net
 
 import remote_client
 
@@ -77,6 +81,37 @@ class TestRemoteClient(auto_stub.TestCase):
     self.mock(time, 'time', lambda: 103500)
     self.assertEqual({'Now': '103500'}, c.get_authentication_headers())
 
+  def test_post_task_update(self):
+    calls = []
+    def url_read_json(url, **kwargs):
+      calls.append((url, kwargs))
+      return {'must_stop': False, 'ok': True}
+    self.mock(net, 'url_read_json', url_read_json)
+    c = remote_client.RemoteClientNative('http://localhost:1', None)
+    output = 'hi\n' * 1000
+    self.assertTrue(
+        c.post_task_update('23', 'bot1', {'cost_usd': 1.}, (output, 10), 0))
+
+    self.assertEqual(1, len(calls))
+    url, kwargs = calls[0]
+    self.assertEqual(
+        'http://localhost:1/swarming/api/v1/bot/task_update/23', url)
+    self.assertEqual(
+        remote_client.TASK_UPDATE_CONTENT_TYPE, kwargs['content_type'])
+    body = kwargs['data']
+    length = struct.unpack_from('>I', body)[0]
+    expected = {
+      u'cost_usd': 1.,
+      u'exit_code': 0,
+      u'id': u'bot1',
+      u'output_chunk_start': 10,
+      u'task_id': u'23',
+    }
+    self.assertEqual(expected, json.loads(body[4:4+length]))
+    # The output is sent compressed.
+    self.assertEqual(output, zlib.decompress(body[4+length:]))
+    self.assertLess(len(body), len(output) / 10)
+
 
 if __name__ == '__main__':
   logging.basicConfig(
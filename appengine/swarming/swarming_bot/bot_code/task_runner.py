@@ -40,16 +40,19 @@ import remote_client
 THIS_FILE = os.path.abspath(zip_package.get_main_script_path())
 
 
-# Sends a maximum of 100kb of stdout per task_update packet.
-MAX_CHUNK_SIZE = 102400
+# Bounds of the amount of stdout sent per task_update packet. See PacketPolicy.
+MIN_CHUNK_SIZE = 100*1024
+MAX_CHUNK_SIZE = 1600*1024
 
 
 # Maximum wait between task_update packet when there's no output.
 MAX_PACKET_INTERVAL = 30
 
 
-# Minimum wait between task_update packet when there's output.
-MIN_PACKET_INTERNAL = 10
+# Bounds of the wait between task_update packets when there's output. See
+# PacketPolicy.
+MIN_OUTPUT_PACKET_INTERVAL = 1
+MAX_OUTPUT_PACKET_INTERVAL = 10
 
 
 # Current task_runner_out version.
@@ -122,6 +125,11 @@ def get_isolated_cmd(
           '--cipd-server', task_details.cipd_input.get('server'),
         ])
 
+  if task_details.caches:
+    for cache in task_details.caches:
+      cmd.extend(('--named-cache', cache['name'], cache['path']))
+    cmd.extend(('--named-cache-root', os.path.join(bot_dir, 'c')))
+
   cmd.extend(
       [
         # Cleanup has been run at bot startup in bot_main.py.
@@ -170,6 +178,9 @@ class TaskDetails(object):
 
     self.cipd_input = data.get('cipd_input')
 
+    # List of dict with 'name' and 'path' keys of the named caches to map.
+    self.caches = data.get('caches') or []
+
     self.env = {
       k.encode('utf-8'): v.encode('utf-8') for k, v in data['env'].iteritems()
     }
@@ -295,20 +306,61 @@ def load_and_run(
       json.dump(task_result, f)
 
 
-def should_post_update(stdout, now, last_packet):
-  """Returns True if it's time to send a task_update packet via post_update().
+class PacketPolicy(object):
+  """Decides when to send the buffered stdout in a task_update packet.
+
+  Each packet costs a server side write of the output, so a packet is sent when
+  one of these conditions is met:
+  - |chunk_size| of stdout is buffered.
+  - there is stdout and the last packet was sent more than |interval| seconds
+    ago.
+  - the last packet was sent more than MAX_PACKET_INTERVAL seconds ago.
 
-  Sends a packet when one of this condition is met:
-  - more than MAX_CHUNK_SIZE of stdout is buffered.
-  - last packet was sent more than MIN_PACKET_INTERNAL seconds ago and there was
-    stdout.
-  - last packet was sent more than MAX_PACKET_INTERVAL seconds ago.
+  Both adapt to the output rate. While the output keeps coming, |interval|
+  doubles up to MAX_OUTPUT_PACKET_INTERVAL and |chunk_size| doubles up to
+  MAX_CHUNK_SIZE each time it is filled before |interval| elapsed, so a chatty
+  or a heavy output is sent in few large packets. Once the output resumes after
+  a pause of MAX_OUTPUT_PACKET_INTERVAL seconds, both are reset to their
+  minimum, so interactive output is shown quickly.
   """
-  packet_interval = MIN_PACKET_INTERNAL if stdout else MAX_PACKET_INTERVAL
-  return len(stdout) >= MAX_CHUNK_SIZE or (now - last_packet) > packet_interval
+
+  def __init__(self, now):
+    self.chunk_size = MIN_CHUNK_SIZE
+    self.interval = MIN_OUTPUT_PACKET_INTERVAL
+    self.last_packet = now
+    # When the output buffered since the last packet started.
+    self._first_output = None
+
+  def on_output(self, now):
+    """Signals that stdout was buffered."""
+    if self._first_output is None:
+      self._first_output = now
+
+  def should_post(self, stdout, now):
+    """Returns True if it's time to send a task_update packet."""
+    return len(stdout) >= self.chunk_size or self.wait(stdout, now) < 0
+
+  def wait(self, stdout, now):
+    """Returns the number of seconds before the next packet is due."""
+    interval = self.interval if stdout else MAX_PACKET_INTERVAL
+    return self.last_packet + interval - now
+
+  def on_post(self, stdout, now):
+    """Adapts to the output rate once a packet was sent."""
+    if stdout:
+      if self._first_output - self.last_packet >= MAX_OUTPUT_PACKET_INTERVAL:
+        # The output resumed after a pause.
+        self.chunk_size = MIN_CHUNK_SIZE
+        self.interval = MIN_OUTPUT_PACKET_INTERVAL
+      else:
+        if len(stdout) >= self.chunk_size:
+          self.chunk_size = min(self.chunk_size * 2, MAX_CHUNK_SIZE)
+        self.interval = min(self.interval * 2, MAX_OUTPUT_PACKET_INTERVAL)
+    self.last_packet = now
+    self._first_output = None
 
 
-def calc_yield_wait(task_details, start, last_io, timed_out, stdout):
+def calc_yield_wait(task_details, start, last_io, timed_out, policy, stdout):
   """Calculates the maximum number of seconds to wait in yield_any()."""
   now = monotonic_time()
   if timed_out:
@@ -317,7 +369,7 @@ def calc_yield_wait(task_details, start, last_io, timed_out, stdout):
       return max(now - timed_out - task_details.grace_period, 0.)
     return 0.
 
-  out = MIN_PACKET_INTERNAL if stdout else MAX_PACKET_INTERVAL
+  out = policy.wait(stdout, now)
   if task_details.hard_timeout:
     out = min(out, start + task_details.hard_timeout - now)
   if task_details.io_timeout:
@@ -357,7 +409,8 @@ def run_command(remote, task_details, work_dir, cost_usd_hour,
   # TODO(maruel): This function is incomprehensible, split and refactor.
 
   # Signal the command is about to be started.
-  last_packet = start = now = monotonic_time()
+  start = now = monotonic_time()
+  policy = PacketPolicy(now)
   task_id = task_details.task_id
   bot_id = task_details.bot_id
   params = {
@@ -431,17 +484,18 @@ def run_command(remote, task_details, work_dir, cost_usd_hour,
     timed_out = None
     try:
       calc = lambda: calc_yield_wait(
-          task_details, start, last_io, timed_out, stdout)
-      maxsize = lambda: MAX_CHUNK_SIZE - len(stdout)
+          task_details, start, last_io, timed_out, policy, stdout)
+      maxsize = lambda: policy.chunk_size - len(stdout)
       last_io = monotonic_time()
       for _, new_data in proc.yield_any(maxsize=maxsize, timeout=calc):
         now = monotonic_time()
         if new_data:
           stdout += new_data
           last_io = now
+          policy.on_output(now)
 
         # Post update if necessary.
-        if should_post_update(stdout, now, last_packet):
+        if policy.should_post(stdout, now):
           last_packet = monotonic_time()
           params['cost_usd'] = (
               cost_usd_hour * (last_packet - task_start) / 60. / 60.)
@@ -454,6 +508,7 @@ def run_command(remote, task_details, work_dir, cost_usd_hour,
               proc.kill()
               kill_sent = True
 
+          policy.on_post(stdout, last_packet)
           output_chunk_start += len(stdout)
           stdout = ''
 
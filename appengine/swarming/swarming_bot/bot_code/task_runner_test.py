@@ -10,10 +10,12 @@ import logging
 import os
 import re
 import signal
+import struct
 import sys
 import tempfile
 import time
 import unittest
+import zlib
 
 import test_env_bot_code
 test_env_bot_code.setup_test_env()
@@ -57,6 +59,15 @@ def get_manifest(script=None, isolated=None, **kwargs):
   return out
 
 
+def decode_task_update(body):
+  """Decodes a task_update body, putting back the output in 'output'."""
+  length = struct.unpack_from('>I', body)[0]
+  out = json.loads(body[4:4+length])
+  if body[4+length:]:
+    out['output'] = zlib.decompress(body[4+length:])
+  return out
+
+
 class FakeAuthSystem(object):
   local_auth_context = None
 
@@ -112,6 +123,14 @@ class TestTaskRunnerBase(net_utils.TestCase):
     finally:
       super(TestTaskRunnerBase, self).tearDown()
 
+  def _url_read_json(self, url, **kwargs):
+    """Decodes the task_update requests to ease checking them."""
+    if 'content_type' in kwargs:
+      self.assertEqual(
+          remote_client.TASK_UPDATE_CONTENT_TYPE, kwargs.pop('content_type'))
+      kwargs['data'] = decode_task_update(kwargs['data'])
+    return super(TestTaskRunnerBase, self)._url_read_json(url, **kwargs)
+
   @classmethod
   def get_task_details(cls, *args, **kwargs):
     return task_runner.TaskDetails(get_manifest(*args, **kwargs))
@@ -166,7 +185,7 @@ class TestTaskRunner(TestTaskRunnerBase):
 
       output = ''
       if 'output' in kwargs['data']:
-        output = base64.b64decode(kwargs['data'].pop('output'))
+        output = kwargs['data'].pop('output')
       self.assertTrue(re.match(output_re, output))
 
       expected = {
@@ -385,6 +404,66 @@ class TestTaskRunner(TestTaskRunnerBase):
     }
     self.assertEqual(expected, self._run_command(task_details))
 
+  def test_get_isolated_cmd_named_caches(self):
+    task_details = self.get_task_details(
+        'print(\'hi\')',
+        caches=[
+          {'name': 'git_chromium', 'path': 'git'},
+          {'name': 'pip', 'path': 'cache/pip'},
+        ])
+    cmd = task_runner.get_isolated_cmd(
+        self.work_dir, task_details, os.path.join(self.root_dir, 'out.json'),
+        None, None)
+    expected = [
+      '--named-cache', 'git_chromium', 'git',
+      '--named-cache', 'pip', 'cache/pip',
+      '--named-cache-root', os.path.join(self.root_dir, 'c'),
+    ]
+    start = cmd.index('--named-cache')
+    self.assertEqual(expected, cmd[start:start+len(expected)])
+
+  def test_packet_policy(self):
+    policy = task_runner.PacketPolicy(100.)
+    # No output, only a keep alive is sent.
+    self.assertFalse(policy.should_post('', 129.))
+    self.assertTrue(policy.should_post('', 131.))
+    policy.on_post('', 131.)
+    self.assertEqual(30., policy.wait('', 131.))
+
+    # Interactive output is sent quickly.
+    policy.on_output(131.5)
+    self.assertFalse(policy.should_post('a', 131.5))
+    self.assertEqual(0.5, policy.wait('a', 131.5))
+    self.assertTrue(policy.should_post('a', 132.5))
+    policy.on_post('a', 132.5)
+
+    # Continuous output grows the interval up to 10s.
+    now = 132.5
+    for interval in (2, 4, 8, 10, 10):
+      self.assertEqual(interval, policy.interval)
+      policy.on_output(now + 0.1)
+      self.assertFalse(policy.should_post('a', now + interval))
+      now += interval + 0.5
+      self.assertTrue(policy.should_post('a', now))
+      policy.on_post('a', now)
+
+    # Heavy output grows the chunk size.
+    for chunk_size in (100, 200, 400, 800, 1600, 1600):
+      self.assertEqual(chunk_size*1024, policy.chunk_size)
+      policy.on_output(now + 0.1)
+      now += 1
+      self.assertFalse(policy.should_post('a' * (chunk_size*1024 - 1), now))
+      self.assertTrue(policy.should_post('a' * chunk_size*1024, now))
+      policy.on_post('a' * chunk_size*1024, now)
+
+    # Once the output resumes after a pause, both are reset.
+    now += 30
+    policy.on_output(now)
+    self.assertTrue(policy.should_post('a', now))
+    policy.on_post('a', now)
+    self.assertEqual(task_runner.MIN_CHUNK_SIZE, policy.chunk_size)
+    self.assertEqual(task_runner.MIN_OUTPUT_PACKET_INTERVAL, policy.interval)
+
   def test_run_command_fail(self):
     # This runs the command for real.
     self.requests(cost_usd=10., exit_code=1)
@@ -480,7 +559,7 @@ class TestTaskRunner(TestTaskRunnerBase):
               'hard_timeout': False,
               'id': 'localhost',
               'io_timeout': False,
-              'output': base64.b64encode('hi!\n'),
+              'output': 'hi!\n',
               'output_chunk_start': 100002*4,
               'task_id': 23,
             },
@@ -511,7 +590,7 @@ class TestTaskRunner(TestTaskRunnerBase):
           'data': {
             'cost_usd': 10.,
             'id': 'localhost',
-            'output': base64.b64encode('hi!\n' * 100002),
+            'output': 'hi!\n' * 100002,
             'output_chunk_start': 0,
             'task_id': 23,
           },
@@ -605,6 +684,12 @@ class TestTaskRunnerNoTimeMock(TestTaskRunnerBase):
   # really bad and prone to flakiness.
   SHORT_TIME_OUT = 1.
 
+  def setUp(self):
+    super(TestTaskRunnerNoTimeMock, self).setUp()
+    # Keep the output in the final packet, these tests check the timeouts.
+    self.mock(task_runner, 'MIN_OUTPUT_PACKET_INTERVAL', 60)
+    self.mock(task_runner, 'MAX_OUTPUT_PACKET_INTERVAL', 60)
+
   # Here's a simple script that handles signals properly. Sadly SIGBREAK is not
   # defined on posix.
   SCRIPT_SIGNAL = (
@@ -662,7 +747,7 @@ class TestTaskRunnerNoTimeMock(TestTaskRunnerBase):
 
       output = ''
       if 'output' in kwargs['data']:
-        output = base64.b64decode(kwargs['data'].pop('output'))
+        output = kwargs['data'].pop('output')
       self.assertTrue(re.match(output_re, output), (kwargs, output))
 
       self.assertEqual(
@@ -855,12 +940,14 @@ class TestTaskRunnerNoTimeMock(TestTaskRunnerBase):
       self.assertLess(0, kwargs['data'].pop('duration'))
       self.assertLess(
           0., kwargs['data']['isolated_stats']['download'].pop('duration'))
+      download = kwargs['data']['isolated_stats']['download']
+      self.assertLessEqual(
+          download.pop('time_to_first_byte'), download.pop('time_to_last_byte'))
       # duration==0 can happen on Windows when the clock is in the default
       # resolution, 15.6ms.
       self.assertLessEqual(
           0., kwargs['data']['isolated_stats']['upload'].pop('duration'))
       # Makes the diffing easier.
-      kwargs['data']['output'] = base64.b64decode(kwargs['data']['output'])
       for k in ('download', 'upload'):
         for j in ('items_cold', 'items_hot'):
           kwargs['data']['isolated_stats'][k][j] = large.unpack(
@@ -878,6 +965,7 @@ class TestTaskRunnerNoTimeMock(TestTaskRunnerBase):
                   u'initial_size': 0,
                   u'items_cold': [10, 86, 94, 276],
                   u'items_hot': [],
+                  u'link_strategies': {u'hardlink': 3},
                 },
                 u'upload': {
                   u'items_cold': [],
@@ -973,6 +1061,9 @@ class TestTaskRunnerNoTimeMock(TestTaskRunnerBase):
       self.assertLess(0., kwargs['data'].pop('bot_overhead'))
       self.assertLess(
           0., kwargs['data']['isolated_stats']['download'].pop('duration'))
+      download = kwargs['data']['isolated_stats']['download']
+      self.assertLessEqual(
+          download.pop('time_to_first_byte'), download.pop('time_to_last_byte'))
       self.assertLess(
           0., kwargs['data']['isolated_stats']['upload'].pop('duration'))
       # Makes the diffing easier.
@@ -982,7 +1073,7 @@ class TestTaskRunnerNoTimeMock(TestTaskRunnerBase):
               base64.b64decode(kwargs['data']['isolated_stats'][k][j]))
       # The command print the pid of this child and grand-child processes, each
       # on its line.
-      output = base64.b64decode(kwargs['data'].pop('output', ''))
+      output = kwargs['data'].pop('output', '')
       for line in output.splitlines():
         try:
           to_kill.append(int(line))
@@ -1001,6 +1092,7 @@ class TestTaskRunnerNoTimeMock(TestTaskRunnerBase):
                   u'initial_size': 0,
                   u'items_cold': [144, 150, 285, 307],
                   u'items_hot': [],
+                  u'link_strategies': {u'hardlink': 3},
                 },
                 u'upload': {
                   u'items_cold': [],
@@ -7,8 +7,10 @@ import json
 import logging
 import os
 import SocketServer
+import struct
 import sys
 import threading
+import zlib
 
 BOT_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -36,7 +38,15 @@ class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
 
   def do_POST(self):
     length = int(self.headers['Content-Length'])
-    data = json.loads(self.rfile.read(length))
+    body = self.rfile.read(length)
+    if self.headers['Content-Type'] == 'application/x-swarming-task-update':
+      # See remote_client.encode_task_update().
+      length = struct.unpack_from('>I', body)[0]
+      data = json.loads(body[4:4+length])
+      if body[4+length:]:
+        data['output'] = zlib.decompress(body[4+length:])
+    else:
+      data = json.loads(body)
 
     if self.path == '/auth/api/v1/accounts/self/xsrf_token':
       return self._send_json({'xsrf_token': 'a'})
@@ -162,8 +162,25 @@ class CipdPins(messages.Message):
   packages = messages.MessageField(CipdPackage, 2, repeated=True)
 
 
+class CacheEntry(messages.Message):
+  """Describes a named cache that should be present on the bot.
+
+  The cache directory is moved to <run_dir>/|path| while the task runs. It is
+  empty the first time the cache is used on a bot. The changes done by the task
+  are kept on the bot and seen by the next task requesting the same named cache,
+  even if mapped to a different path.
+  """
+
+  # Name of the cache, must match [a-z0-9_]{1,4096}. Required.
+  name = messages.StringField(1)
+  # Path to the directory, relative to the run dir, where to map the cache.
+  # Required. The task fails if a file or directory already exists there.
+  path = messages.StringField(2)
+
+
 class TaskProperties(messages.Message):
   """Important metadata about a particular task."""
+  caches = messages.MessageField(CacheEntry, 11, repeated=True)
   cipd_input = messages.MessageField(CipdInput, 10)
   command = messages.StringField(1, repeated=True)
   dimensions = messages.MessageField(StringPair, 2, repeated=True)
@@ -213,6 +230,11 @@ class NewTaskRequest(messages.Message):
   pubsub_userdata = messages.StringField(11)
 
 
+class NewTaskRequests(messages.Message):
+  """Wraps a list of NewTaskRequest, to create them at once."""
+  items = messages.MessageField(NewTaskRequest, 1, repeated=True)
+
+
 class TaskRequest(messages.Message):
   """Description of a task request as registered by the server."""
   expiration_secs = messages.IntegerField(1)
@@ -256,6 +278,22 @@ class TasksRequest(messages.Message):
   include_performance_stats = messages.BooleanField(8, default=False)
 
 
+class TasksResultsRequest(messages.Message):
+  """Request to get the results of multiple tasks at once."""
+  task_ids = messages.StringField(1, repeated=True)
+  # Also returns the output of each task. This is a bit slower.
+  include_output = messages.BooleanField(2, default=False)
+  include_performance_stats = messages.BooleanField(3, default=False)
+
+
+class TasksWaitRequest(messages.Message):
+  """Request to wait for any of multiple tasks to stop running."""
+  task_ids = messages.StringField(1, repeated=True)
+  # Maximum duration to wait for, in seconds. It is capped server side.
+  timeout_secs = messages.IntegerField(2, default=45)
+  include_performance_stats = messages.BooleanField(3, default=False)
+
+
 class TasksCountRequest(messages.Message):
   """Request to count some subset of tasks."""
   # These should be DateTimeField but endpoints + protorpc have trouble encoding
@@ -298,6 +336,11 @@ class CancelResponse(messages.Message):
 class TaskOutput(messages.Message):
   """A task's output as a string."""
   output = messages.StringField(1)
+  # Offset in bytes right after the returned output, to read the next part of
+  # the output.
+  next_offset = messages.IntegerField(2)
+  # Current state of the task.
+  state = messages.EnumField(StateField, 3)
 
 
 class TaskResult(messages.Message):
@@ -340,6 +383,12 @@ class TaskResult(messages.Message):
   # (e.g. a ref like "latest").
   cipd_pins = messages.MessageField(CipdPins, 27)
 
+  # The task's output. Only sent by tasks.results when requested.
+  output = messages.StringField(28)
+  # Set by tasks.results when the output was not sent to keep the response
+  # small. It must then be fetched with task.stdout.
+  output_omitted = messages.BooleanField(29)
+
 
 class TaskList(messages.Message):
   """Wraps a list of TaskResult."""
@@ -377,6 +426,11 @@ class TaskRequestMetadata(messages.Message):
   task_result = messages.MessageField(TaskResult, 3)
 
 
+class TaskRequestMetadataList(messages.Message):
+  """Wraps a list of TaskRequestMetadata."""
+  items = messages.MessageField(TaskRequestMetadata, 1, repeated=True)
+
+
 ### Bots
 
 
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# Copyright 2016 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Measures the latency of task_scheduler.bot_reap_task() against the number
+of pending tasks, using the local datastore and memcache stubs.
+
+The tasks are spread over --dimensions different dimension sets, only one of
+which is served by the reaping bot, to expose the cost of walking the ready
+queues of the other dimension sets.
+"""
+
+import datetime
+import optparse
+import os
+import sys
+import time
+
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.dirname(APP_DIR)), 'client')
+sys.path.insert(0, APP_DIR)
+
+sys.path.insert(0, CLIENT_DIR)
+from third_party.depot_tools import fix_encoding
+sys.path.pop(0)
+
+import test_env
+test_env.setup_test_env()
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import testbed
+
+from components import utils
+from server import task_request
+from server import task_scheduler
+
+
+def init_testbed():
+  """Returns an activated testbed with the stubs needed to schedule tasks."""
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.setup_env(app_id='reap-load-test', overwrite=True)
+  bed.init_app_identity_stub()
+  bed.init_datastore_v3_stub(
+      consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+          probability=1))
+  bed.init_memcache_stub()
+  bed.init_taskqueue_stub()
+  bed.init_user_stub()
+  return bed
+
+
+def gen_dimensions(index):
+  return {u'os': u'os-%d' % index, u'pool': u'default'}
+
+
+def schedule(count, dimensions_count):
+  """Schedules |count| tasks round robin over |dimensions_count| dimension
+  sets.
+  """
+  now = utils.utcnow()
+  for i in xrange(count):
+    request = task_request.TaskRequest(
+        created_ts=now,
+        expiration_ts=now + datetime.timedelta(days=1),
+        name=u'load test %d' % i,
+        priority=50,
+        properties=task_request.TaskProperties(
+            command=[u'command1'],
+            dimensions=gen_dimensions(i % dimensions_count),
+            execution_timeout_secs=3600),
+        user=u'load-test')
+    task_request.init_new_request(request, True)
+    task_scheduler.schedule_request(request, check_acls=False)
+
+
+def reap(count):
+  """Reaps up to |count| tasks with the bot serving dimension set 0.
+
+  Returns:
+    list of the latency of each reap, in seconds.
+  """
+  bot_dimensions = gen_dimensions(0)
+  bot_dimensions[u'id'] = u'bot1'
+  durations = []
+  for _ in xrange(count):
+    start = time.time()
+    request, _ = task_scheduler.bot_reap_task(
+        bot_dimensions, 'bot1', 'abc', None)
+    durations.append(time.time() - start)
+    if not request:
+      break
+  return durations
+
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+  parser = optparse.OptionParser(description=sys.modules[__name__].__doc__)
+  parser.add_option(
+      '--depths', default='100,1000,5000',
+      help='Comma separated list of number of pending tasks to measure at; '
+           'default: %default')
+  parser.add_option(
+      '--dimensions', type='int', default=20,
+      help='Number of different dimension sets; default: %default')
+  parser.add_option(
+      '--reaps', type='int', default=20,
+      help='Number of reaps to measure at each depth; default: %default')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unsupported arguments: %s' % args)
+  depths = sorted(int(i) for i in options.depths.split(','))
+
+  print('%8s %10s %10s' % ('depth', 'median', 'p90'))
+  for depth in depths:
+    bed = init_testbed()
+    try:
+      schedule(depth, options.dimensions)
+      durations = reap(options.reaps)
+    finally:
+      bed.deactivate()
+    print('%8d %9.1fms %9.1fms' % (
+        depth, percentile(durations, 0.5) * 1000.,
+        percentile(durations, 0.9) * 1000.))
+  return 0
+
+
+if __name__ == '__main__':
+  fix_encoding.fix_encoding()
+  sys.exit(main())
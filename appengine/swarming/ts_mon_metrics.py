@@ -70,6 +70,12 @@ tasks_expired = gae_ts_mon.CounterMetric(
     'swarming/tasks/expired',
     description='Number of expired tasks')
 
+# Swarming-specific metric. Instance-local, no metric field.
+bot_powerset_cache_saved = gae_ts_mon.CumulativeDistributionMetric(
+    'swarming/bots/powerset_cache_saved', bucketer=_bucketer,
+    description=(
+        'Time saved on a bot poll by the cached dimensions powerset, in ms.'))
+
 # Global metric. Metric fields:
 # - project_id: e.g. 'chromium'
 # - subproject_id: e.g. 'blink'. Set to empty string if not used.
@@ -373,15 +373,20 @@ class SavedState(Flattenable):
     """
     def strip(data):
       """Returns a 'files' entry with only the whitelisted keys."""
-      return dict((k, data[k]) for k in ('h', 'l', 'm', 's') if k in data)
-
+      out = dict((k, data[k]) for k in ('c', 'h', 'l', 'm', 's') if k in data)
+      # 't' is the timestamp in the saved state and the file type in .isolated.
+      if 'c' in out:
+        out['t'] = 'chunked'
+      return out
+
+    files = dict(
+        (filepath, strip(data)) for filepath, data in self.files.iteritems())
     out = {
       'algo': isolated_format.SUPPORTED_ALGOS_REVERSE[self.algo],
-      'files': dict(
-          (filepath, strip(data)) for filepath, data in self.files.iteritems()),
+      'files': files,
       # The version of the .state file is different than the one of the
       # .isolated file.
-      'version': isolated_format.ISOLATED_FILE_VERSION,
+      'version': isolated_format.get_isolated_file_version(files),
     }
     if self.command:
       out['command'] = self.command
@@ -565,24 +570,37 @@ class CompleteState(object):
     self.saved_state.update_isolated(command, infiles, read_only, relative_cwd)
     logging.debug(self)
 
-  def files_to_metadata(self, subdir):
+  def filter_subdir(self, subdir):
+    """Filters self.saved_state.files to a subdirectory, if specified.
+
+    The resulting .isolated file is tainted.
+    """
+    if subdir:
+      for infile in self.saved_state.files.keys():
+        if not infile.startswith(subdir):
+          self.saved_state.files.pop(infile)
+
+  def files_to_metadata(self, subdir, digest_index=None, chunked_file_size=0):
     """Updates self.saved_state.files with the files' mode and hash.
 
     If |subdir| is specified, filters to a subdirectory. The resulting .isolated
-    file is tainted.
+    file is tainted. |digest_index| is an optional isolated_format.DigestIndex.
+    Files at least |chunked_file_size| bytes large are chunked if it is set.
 
     See isolated_format.file_to_metadata() for more information.
     """
-    for infile in sorted(self.saved_state.files):
-      if subdir and not infile.startswith(subdir):
-        self.saved_state.files.pop(infile)
-      else:
-        filepath = os.path.join(self.root_dir, infile)
-        self.saved_state.files[infile] = isolated_format.file_to_metadata(
-            filepath,
-            self.saved_state.files[infile],
-            self.saved_state.read_only,
-            self.saved_state.algo)
+    self.filter_subdir(subdir)
+    infiles = sorted(self.saved_state.files)
+    metadata = isolated_format.files_to_metadata(
+        [
+          (os.path.join(self.root_dir, i), self.saved_state.files[i])
+          for i in infiles
+        ],
+        self.saved_state.read_only,
+        self.saved_state.algo,
+        digest_index,
+        chunked_file_size)
+    self.saved_state.files.update(zip(infiles, metadata))
 
   def save_files(self):
     """Saves self.saved_state and creates a .isolated file."""
@@ -617,7 +635,7 @@ class CompleteState(object):
     return out
 
 
-def load_complete_state(options, cwd, subdir, skip_update):
+def load_complete_state(options, cwd, subdir, skip_update, skip_hash=False):
   """Loads a CompleteState.
 
   This includes data from .isolate and .isolated.state files. Never reads the
@@ -632,6 +650,8 @@ def load_complete_state(options, cwd, subdir, skip_update):
             to CompleteState.root_dir.
     skip_update: Skip trying to load the .isolate file and processing the
                  dependencies. It is useful when not needed, like when tracing.
+    skip_hash: Only list the dependencies, the caller is responsible to call
+               CompleteState.files_to_metadata() or equivalent.
   """
   assert not options.isolate or os.path.isabs(options.isolate)
   assert not options.isolated or os.path.isabs(options.isolated)
@@ -691,7 +711,12 @@ def load_complete_state(options, cwd, subdir, skip_update):
     subdir = subdir.replace('/', os.path.sep)
 
   if not skip_update:
-    complete_state.files_to_metadata(subdir)
+    if skip_hash:
+      complete_state.filter_subdir(subdir)
+    else:
+      with isolated_format.DigestIndex(options.digest_index) as digest_index:
+        complete_state.files_to_metadata(
+            subdir, digest_index, options.chunked_file_size)
   return complete_state
 
 
@@ -731,6 +756,15 @@ def prepare_for_archival(options, cwd):
   """Loads the isolated file and create 'infiles' for archival."""
   complete_state = load_complete_state(
       options, cwd, options.subdir, False)
+  return save_for_archival(options, complete_state)
+
+
+def save_for_archival(options, complete_state):
+  """Creates the .isolated file(s) and returns 'infiles' for archival.
+
+  Returns:
+    tuple(CompleteState, dict of infiles, list of .isolated files hashes).
+  """
   # Make sure that complete_state isn't modified until save_files() is
   # called, because any changes made to it here will propagate to the files
   # created (which is probably not intended).
@@ -760,14 +794,63 @@ def prepare_for_archival(options, cwd):
   return complete_state, infiles, isolated_hash
 
 
-def isolate_and_archive(trees, isolate_server, namespace):
+def files_to_metadata_batch(
+    complete_states, digest_index=None, chunked_file_size=0):
+  """Updates the files' mode and hash of multiple CompleteState at once.
+
+  Files are deduplicated across the states by absolute path, so a file shared
+  by multiple trees is only stat'ed and hashed once, and all the files are
+  hashed by a single thread pool. The subdirectory filtering must have been
+  done beforehand. See CompleteState.files_to_metadata() for the arguments.
+
+  Raises isolated_format.MappingError if any file is missing.
+  """
+  # (read_only, algo) -> {absolute path: prevdict}. The file mode depends on
+  # read_only, so there is one batch per distinct pair; in practice, all the
+  # trees use the same.
+  batches = {}
+  for complete_state in complete_states:
+    saved_state = complete_state.saved_state
+    files = batches.setdefault((saved_state.read_only, saved_state.algo), {})
+    for infile, prevdict in saved_state.files.iteritems():
+      files.setdefault(os.path.join(complete_state.root_dir, infile), prevdict)
+
+  # A file in multiple batches reuses the hash from the previous batch.
+  hashed = {}
+  metadata = {}
+  for key, files in batches.iteritems():
+    read_only, algo = key
+    paths = sorted(files)
+    out = isolated_format.files_to_metadata(
+        [(p, hashed.get((algo, p), files[p])) for p in paths],
+        read_only, algo, digest_index, chunked_file_size)
+    for path, meta in zip(paths, out):
+      hashed[(algo, path)] = meta
+      metadata[(key, path)] = meta
+
+  for complete_state in complete_states:
+    saved_state = complete_state.saved_state
+    key = (saved_state.read_only, saved_state.algo)
+    for infile in saved_state.files:
+      saved_state.files[infile] = metadata[
+          (key, os.path.join(complete_state.root_dir, infile))].copy()
+
+
+def isolate_and_archive(
+    trees, isolate_server, namespace, digest_index_path=None,
+    chunked_file_size=0):
   """Isolates and uploads a bunch of isolated trees.
 
+  The files of all the trees are hashed at once, the .isolated files are then
+  created and all the items are uploaded at once, deduplicated by digest.
+
   Args:
     trees: list of pairs (Options, working directory) that describe what tree
         to isolate. Options are processed by 'process_isolate_options'.
     isolate_server: URL of Isolate Server to upload to.
     namespace: namespace to upload to.
+    digest_index_path: optional path to an isolated_format.DigestIndex file.
+    chunked_file_size: if set, files at least this large are chunked.
 
   Returns a dict {target name -> isolate hash or None}, where target name is
   a name of *.isolated file without an extension (e.g. 'base_unittests').
@@ -794,10 +877,39 @@ def isolate_and_archive(trees, isolate_server, namespace):
   files_generators = []
   isolated_hashes = {}
   with tools.Profiler('Isolate'):
+    # List of (Options, target name, CompleteState) of the trees loaded
+    # successfully.
+    loaded = []
     for opts, cwd in trees:
       target_name = os.path.splitext(os.path.basename(opts.isolated))[0]
       try:
-        complete_state, files, isolated_hash = prepare_for_archival(opts, cwd)
+        loaded.append(
+            (opts, target_name,
+             load_complete_state(opts, cwd, opts.subdir, False, True)))
+      except Exception:
+        logging.exception('Exception when isolating %s', target_name)
+        isolated_hashes[target_name] = None
+
+    with isolated_format.DigestIndex(digest_index_path) as digest_index:
+      try:
+        files_to_metadata_batch(
+            [i[2] for i in loaded], digest_index, chunked_file_size)
+      except Exception:
+        # Find out which trees are broken by hashing them one by one.
+        logging.exception('Exception when hashing, retrying one tree at a time')
+        for opts, target_name, complete_state in loaded[:]:
+          try:
+            complete_state.files_to_metadata(
+                None, digest_index, chunked_file_size)
+          except Exception:
+            logging.exception('Exception when isolating %s', target_name)
+            isolated_hashes[target_name] = None
+            loaded.remove((opts, target_name, complete_state))
+
+    for opts, target_name, complete_state in loaded:
+      try:
+        complete_state, files, isolated_hash = save_for_archival(
+            opts, complete_state)
         files_generators.append(emit_files(complete_state.root_dir, files))
         isolated_hashes[target_name] = isolated_hash[0]
         print('%s  %s' % (isolated_hash[0], target_name))
@@ -860,7 +972,9 @@ def CMDarchive(parser, args):
   result = isolate_and_archive(
       [(options, unicode(os.getcwd()))],
       options.isolate_server,
-      options.namespace)
+      options.namespace,
+      options.digest_index,
+      options.chunked_file_size)
   if result is None:
     return EXIT_CODE_UPLOAD_ERROR
   assert len(result) == 1, result
@@ -920,7 +1034,8 @@ def CMDbatcharchive(parser, args):
 
   # Perform the archival, all at once.
   isolated_hashes = isolate_and_archive(
-      work_units, options.isolate_server, options.namespace)
+      work_units, options.isolate_server, options.namespace,
+      options.digest_index, options.chunked_file_size)
 
   # TODO(vadimsh): isolate_and_archive returns None on upload failure, there's
   # no way currently to figure out what *.isolated file from a batch were
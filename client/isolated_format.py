@@ -11,9 +11,13 @@ import os
 import re
 import stat
 import sys
+import threading
+import time
+import zlib
 
 from utils import file_path
 from utils import fs
+from utils import threading_utils
 from utils import tools
 
 
@@ -21,10 +25,36 @@ from utils import tools
 ISOLATED_FILE_VERSION = '1.5'
 
 
+# Version stored in .isolated files containing 'chunked' files, so the hash of
+# the .isolated files without any is unchanged.
+CHUNKED_ISOLATED_FILE_VERSION = '1.6'
+
+
 # Chunk size to use when doing disk I/O.
 DISK_FILE_CHUNK = 1024 * 1024
 
 
+# Number of files stat'ed by a single thread pool task in files_to_metadata().
+# Hashing is done one file per task since it is much more expensive.
+STAT_BATCH_SIZE = 256
+
+
+# Default maximum number of entries kept in a DigestIndex file.
+DIGEST_INDEX_MAX_ITEMS = 100000
+
+
+# Parameters of the content defined chunking of large files, see
+# iter_file_chunks(). A chunk ends after a CHUNK_ANCHOR byte when the CRC-32 of
+# the CHUNK_WINDOW bytes ending with it has all the CHUNK_MASK bits set. On
+# random data, 1 byte in 256 is an anchor and 1 anchor in 4096 is a boundary,
+# so chunks are around 1.25mb on average.
+CHUNK_ANCHOR = 'Z'
+CHUNK_WINDOW = 48
+CHUNK_MASK = 0xfff
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+
+
 # Sadly, hashlib uses 'sha1' instead of the standard 'sha-1' so explicitly
 # specify the names here.
 SUPPORTED_ALGOS = {
@@ -37,7 +67,9 @@ SUPPORTED_ALGOS = {
 # Used for serialization.
 SUPPORTED_ALGOS_REVERSE = dict((v, k) for k, v in SUPPORTED_ALGOS.iteritems())
 
-SUPPORTED_FILE_TYPES = ['basic', 'ar']
+# 'chunked' was added in version 1.6, the file is the concatenation of the
+# items listed in 'c'.
+SUPPORTED_FILE_TYPES = ['basic', 'ar', 'chunked']
 
 
 class IsolatedError(ValueError):
@@ -82,6 +114,189 @@ def hash_file(filepath, algo):
   return digest.hexdigest()
 
 
+def iter_file_chunks(f):
+  """Splits the content of a file object in content defined chunks.
+
+  Boundaries only depend on the content around them, so inserting or removing
+  data in a file only modifies the chunks around the modification. Chunks are
+  between CHUNK_MIN_SIZE and CHUNK_MAX_SIZE bytes, except the last one.
+
+  The anchor byte is searched with str.find() so the content is not processed
+  one byte at a time in python.
+
+  Yields:
+    str of each chunk.
+  """
+  buf = ''
+  eof = False
+  while True:
+    if not eof and len(buf) < CHUNK_MAX_SIZE:
+      data = [buf]
+      size = len(buf)
+      while size < CHUNK_MAX_SIZE:
+        d = f.read(DISK_FILE_CHUNK)
+        if not d:
+          eof = True
+          break
+        data.append(d)
+        size += len(d)
+      buf = ''.join(data)
+    if not buf:
+      break
+    end = min(len(buf), CHUNK_MAX_SIZE)
+    i = buf.find(CHUNK_ANCHOR, CHUNK_MIN_SIZE - 1, end)
+    while i != -1:
+      window = buf[i + 1 - CHUNK_WINDOW:i + 1]
+      if zlib.crc32(window) & CHUNK_MASK == CHUNK_MASK:
+        end = i + 1
+        break
+      i = buf.find(CHUNK_ANCHOR, i + 1, end)
+    yield buf[:end]
+    buf = buf[end:]
+
+
+def hash_file_chunks(filepath, algo):
+  """Hashes a file and each of its content defined chunks.
+
+  Returns:
+    tuple(digest of the file, list of [digest, size] of each chunk).
+  """
+  digest = algo()
+  chunks = []
+  with fs.open(filepath, 'rb') as f:
+    for chunk in iter_file_chunks(f):
+      digest.update(chunk)
+      chunks.append([algo(chunk).hexdigest(), len(chunk)])
+  return digest.hexdigest(), chunks
+
+
+class DigestIndex(object):
+  """Maps the identity of a file on disk to the digest of its content.
+
+  A file is identified by (st_dev, st_ino, st_size, st_mtime in ns), so a file
+  shared by multiple trees, or archived again by a later run, is only hashed
+  once.
+
+  When |path| is set, the index is loaded from and saved to this file, so it
+  can be shared machine wide. The file is always replaced atomically and is
+  merged with its current content on save, so parallel processes can safely use
+  the same file; an entry added concurrently by another process may be lost,
+  which only costs hashing this file again. The least recently used entries are
+  evicted to keep at most |max_items| entries.
+
+  Use as a context manager to load and save the index. It is thread safe.
+  """
+  # Files modified more recently than this number of seconds are not indexed.
+  # On file systems with coarse timestamps, such a file could be modified again
+  # without its mtime changing.
+  RACY_DELAY = 2.
+
+  def __init__(self, path=None, max_items=DIGEST_INDEX_MAX_ITEMS):
+    self.path = unicode(os.path.abspath(path)) if path else None
+    self.max_items = max_items
+    self._lock = threading.Lock()
+    # key -> [digest, timestamp of last use].
+    self._items = {}
+    self._dirty = False
+
+  def __enter__(self):
+    self.load()
+    return self
+
+  def __exit__(self, _exc_type, _exec_value, _traceback):
+    self.save()
+    return False
+
+  def __len__(self):
+    return len(self._items)
+
+  def load(self):
+    """Loads the index from |path|, if any. A broken file is ignored."""
+    items = self._read()
+    with self._lock:
+      items.update(self._items)
+      self._items = items
+
+  def save(self):
+    """Merges the index with the content of |path| and replaces it."""
+    if not self.path or not self._dirty:
+      return
+    with self._lock:
+      items = self._read()
+      for key, value in self._items.iteritems():
+        if key not in items or items[key][1] < value[1]:
+          items[key] = value
+      if len(items) > self.max_items:
+        newest = sorted(items, key=lambda k: items[k][1])[-self.max_items:]
+        items = {k: items[k] for k in newest}
+      self._items = items
+      self._dirty = False
+      try:
+        file_path.ensure_tree(os.path.dirname(self.path))
+        file_path.atomic_replace(
+            self.path,
+            json.dumps({'items': items, 'version': 1}, separators=(',', ':')))
+      except (IOError, OSError) as e:
+        logging.warning('Failed to save digest index %s: %s', self.path, e)
+
+  def get(self, filestats, algo):
+    """Returns the digest of the file described by |filestats| or None."""
+    key = self._key(filestats, algo)
+    if not key:
+      return None
+    with self._lock:
+      value = self._items.get(key)
+      if not value:
+        return None
+      value[1] = time.time()
+      self._dirty = True
+      return value[0]
+
+  def add(self, filestats, algo, digest):
+    """Records the digest of the file described by |filestats|."""
+    key = self._key(filestats, algo)
+    now = time.time()
+    if not key or filestats.st_mtime > now - self.RACY_DELAY:
+      return
+    with self._lock:
+      self._items[key] = [digest, now]
+      self._dirty = True
+
+  def hash_file(self, filepath, filestats, algo):
+    """Returns the digest of a file, only hashing it if it isn't indexed."""
+    digest = self.get(filestats, algo)
+    if not digest:
+      digest = hash_file(filepath, algo)
+      self.add(filestats, algo, digest)
+    return digest
+
+  @staticmethod
+  def _key(filestats, algo):
+    if not filestats.st_ino:
+      # Files can't be identified, e.g. on Windows.
+      return None
+    return '%s:%d:%d:%d:%d' % (
+        algo().name, filestats.st_dev, filestats.st_ino, filestats.st_size,
+        int(round(filestats.st_mtime * 1e9)))
+
+  def _read(self):
+    if not self.path or not fs.isfile(self.path):
+      return {}
+    try:
+      with fs.open(self.path, 'rb') as f:
+        state = json.load(f)
+      if not isinstance(state, dict) or state.get('version') != 1:
+        raise ValueError('unsupported format')
+      items = state['items']
+      if not isinstance(items, dict) or not all(
+          isinstance(v, list) and len(v) == 2 for v in items.itervalues()):
+        raise ValueError('invalid items')
+      return items
+    except (IOError, KeyError, ValueError) as e:
+      logging.warning('Ignoring broken digest index %s: %s', self.path, e)
+      return {}
+
+
 class IsolatedFile(object):
   """Represents a single parsed .isolated file."""
 
@@ -309,7 +524,9 @@ def expand_directories_and_symlinks(
 
 
 @tools.profile
-def file_to_metadata(filepath, prevdict, read_only, algo):
+def file_to_metadata(
+    filepath, prevdict, read_only, algo, digest_index=None,
+    chunked_file_size=0):
   """Processes an input file, a dependency, and return meta data about it.
 
   Behaviors:
@@ -326,11 +543,111 @@ def file_to_metadata(filepath, prevdict, read_only, algo):
                windows, mode is not set since all files are 'executable' by
                default.
     algo:      Hashing algorithm used.
+    digest_index: optional DigestIndex to look up and record the file's hash.
+    chunked_file_size: if set, files at least this large are split in content
+                       defined chunks, listed in 'c' as [digest, size] pairs.
+                       'h' is still the digest of the whole file.
 
   Returns:
     The necessary dict to create a entry in the 'files' section of an .isolated
     file.
   """
+  out, filestats = _stat_to_metadata(
+      filepath, prevdict, read_only, chunked_file_size)
+  if 's' in out:
+    _hash_to_metadata(
+        out, filepath, filestats, algo, digest_index, chunked_file_size)
+  return out
+
+
+def files_to_metadata(
+    files, read_only, algo, digest_index=None, chunked_file_size=0):
+  """Processes multiple files concurrently, see file_to_metadata().
+
+  Files are stat'ed in batches of STAT_BATCH_SIZE, then the files whose hash
+  couldn't be reused from their previous dictionary are hashed in parallel.
+  Each file is still hashed sequentially, so the largest files are started
+  first to not have a single large file hashed last while all the other
+  threads are idle.
+
+  Arguments:
+    files: list of (filepath, prevdict) tuples.
+    read_only: see file_to_metadata().
+    algo: Hashing algorithm used.
+    digest_index: see file_to_metadata().
+    chunked_file_size: see file_to_metadata().
+
+  Returns:
+    list of dict, in the same order as |files|.
+  """
+  files = list(files)
+  out = [None] * len(files)
+  stats = [None] * len(files)
+
+  def stat_batch(start):
+    for i in xrange(start, min(start + STAT_BATCH_SIZE, len(files))):
+      out[i], stats[i] = _stat_to_metadata(
+          files[i][0], files[i][1], read_only, chunked_file_size)
+      if (digest_index is not None and 's' in out[i] and
+          not _is_chunked(out[i]['s'], chunked_file_size)):
+        if out[i].get('h'):
+          digest_index.add(stats[i], algo, out[i]['h'])
+        else:
+          out[i]['h'] = digest_index.get(stats[i], algo)
+
+  def hash_one(i):
+    _hash_to_metadata(
+        out[i], files[i][0], stats[i], algo, digest_index, chunked_file_size)
+
+  with threading_utils.ThreadPool(
+      1, threading_utils.num_processors(), 0, 'hash') as pool:
+    try:
+      for start in xrange(0, len(files), STAT_BATCH_SIZE):
+        pool.add_task(0, stat_batch, start)
+      pool.join()
+      # Tasks of the same priority are run in FIFO order.
+      to_hash = sorted(
+          (i for i, m in enumerate(out) if 's' in m and not m.get('h')),
+          key=lambda i: out[i]['s'], reverse=True)
+      for i in to_hash:
+        pool.add_task(0, hash_one, i)
+      pool.join()
+    except:
+      pool.abort()
+      raise
+  return out
+
+
+def _is_chunked(size, chunked_file_size):
+  """Returns True if a file of |size| bytes must be split in chunks."""
+  return bool(chunked_file_size) and size >= chunked_file_size
+
+
+def _hash_to_metadata(
+    out, filepath, filestats, algo, digest_index, chunked_file_size):
+  """Sets 'h', and 'c' for a chunked file, unless they were already set.
+
+  The digest index is not used for chunked files, since it doesn't store the
+  chunks.
+  """
+  if _is_chunked(out['s'], chunked_file_size):
+    if not out.get('h'):
+      out['h'], out['c'] = hash_file_chunks(filepath, algo)
+  elif digest_index is None:
+    if not out.get('h'):
+      out['h'] = hash_file(filepath, algo)
+  elif out.get('h'):
+    digest_index.add(filestats, algo, out['h'])
+  else:
+    out['h'] = digest_index.hash_file(filepath, filestats, algo)
+
+
+def _stat_to_metadata(filepath, prevdict, read_only, chunked_file_size):
+  """Returns the metadata of a file without hashing it and its os.lstat().
+
+  'h' is only set when the hash could be reused from |prevdict|, along with 'c'
+  if the file must be chunked.
+  """
   # TODO(maruel): None is not a valid value.
   assert read_only in (None, 0, 1, 2), read_only
   out = {}
@@ -371,10 +688,13 @@ def file_to_metadata(filepath, prevdict, read_only, algo):
     # on the sha-1.
     if (prevdict.get('t') == out['t'] and
         prevdict.get('s') == out['s']):
-      # Reuse the previous hash if available.
-      out['h'] = prevdict.get('h')
-    if not out.get('h'):
-      out['h'] = hash_file(filepath, algo)
+      # Reuse the previous hash if available. 'h' is the digest of the whole
+      # file in both cases but the chunks must be reused too when needed.
+      if not _is_chunked(out['s'], chunked_file_size):
+        out['h'] = prevdict.get('h')
+      elif prevdict.get('c'):
+        out['h'] = prevdict.get('h')
+        out['c'] = prevdict['c']
   else:
     # If the timestamp wasn't updated, carry on the link destination.
     if prevdict.get('t') == out['t']:
@@ -390,7 +710,7 @@ def file_to_metadata(filepath, prevdict, read_only, algo):
       filedir = file_path.get_native_path_case(os.path.dirname(filepath))
       native_dest = file_path.fix_native_path_case(filedir, symlink_value)
       out['l'] = os.path.relpath(native_dest, filedir)
-  return out
+  return out, filestats
 
 
 def save_isolated(isolated, data):
@@ -418,6 +738,16 @@ def split_path(path):
   return out
 
 
+def get_isolated_file_version(files):
+  """Returns the version to store in an .isolated file listing |files|.
+
+  CHUNKED_ISOLATED_FILE_VERSION is only used when there's a 'chunked' file.
+  """
+  if any('c' in props for props in files.itervalues()):
+    return CHUNKED_ISOLATED_FILE_VERSION
+  return ISOLATED_FILE_VERSION
+
+
 def load_isolated(content, algo):
   """Verifies the .isolated file is valid and loads this object with the json
   data.
@@ -512,6 +842,16 @@ def load_isolated(content, algo):
             if subsubvalue not in SUPPORTED_FILE_TYPES:
               raise IsolatedError('Expected one of \'%s\', got %r' % (
                   ', '.join(sorted(SUPPORTED_FILE_TYPES)), subsubvalue))
+          elif subsubkey == 'c':
+            if not isinstance(subsubvalue, list) or not subsubvalue:
+              raise IsolatedError(
+                  'Expected non-empty list, got %r' % subsubvalue)
+            for chunk in subsubvalue:
+              if (not isinstance(chunk, list) or len(chunk) != 2 or
+                  not is_valid_hash(chunk[0], algo) or
+                  not isinstance(chunk[1], (int, long))):
+                raise IsolatedError(
+                    'Expected [sha-1, size] chunk, got %r' % chunk)
           else:
             raise IsolatedError('Unknown subsubkey %s' % subsubkey)
         if bool('h' in subvalue) == bool('l' in subvalue):
@@ -530,6 +870,14 @@ def load_isolated(content, algo):
           raise IsolatedError(
               'Cannot use \'m\' (mode) and \'l\' (link), got: %r' %
               subvalue)
+        if bool('c' in subvalue) != (subvalue.get('t') == 'chunked'):
+          raise IsolatedError(
+              '\'c\' (chunks) must be used with type \'chunked\', got: %r' %
+              subvalue)
+        if ('c' in subvalue and
+            sum(c[1] for c in subvalue['c']) != subvalue.get('s')):
+          raise IsolatedError(
+              'Chunks size must add up to \'s\' (size), got: %r' % subvalue)
 
     elif key == 'includes':
       if not isinstance(value, list):
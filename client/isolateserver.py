@@ -10,10 +10,13 @@ __version__ = '0.6.0'
 import base64
 import errno
 import functools
+import heapq
 import io
+import itertools
 import logging
 import optparse
 import os
+import Queue
 import re
 import signal
 import stat
@@ -21,7 +24,6 @@ import sys
 import tempfile
 import threading
 import time
-import types
 import zlib
 
 from third_party import colorama
@@ -59,7 +61,8 @@ DEADLOCK_TIMEOUT = 5 * 60
 
 
 # The number of files to check the isolate server per /pre-upload query.
-# All files are sorted by likelihood of a change in the file content
+# Files are sorted by likelihood of a change in the file content, by windows of
+# CONTAINS_SORT_WINDOW files
 # (currently file size is used to estimate this: larger the file -> larger the
 # possibility it has changed). Then first ITEMS_PER_CONTAINS_QUERIES[0] files
 # are taken and send to '/pre-upload', then next ITEMS_PER_CONTAINS_QUERIES[1],
@@ -72,6 +75,35 @@ DEADLOCK_TIMEOUT = 5 * 60
 ITEMS_PER_CONTAINS_QUERIES = (20, 20, 50, 50, 50, 100)
 
 
+# Number of files sorted at once before being split into /pre-upload queries.
+# Sorting all the files would delay the first query until every file is hashed.
+CONTAINS_SORT_WINDOW = 1000
+
+
+# Maximum number of /pre-upload queries in flight and of items being hashed at
+# once in Storage.get_missing_items(). Items are only consumed from the input as
+# fast as they are processed, so the memory use stays bounded when the items are
+# streamed.
+MAX_PENDING_CONTAINS_QUERIES = 16
+MAX_PENDING_PREPARE = 64
+
+
+# Maximum number of items fetched at once by a Storage, i.e. from its server.
+# Fetches waiting for a slot are started largest first, so the largest items
+# don't end up dominating the wall time by starting last.
+MAX_CONCURRENT_FETCHES_PER_HOST = 12
+
+
+# Items at least this large only get up to half of the fetch slots while smaller
+# items are waiting, so the small items are fetched alongside the large ones.
+LARGE_FETCH_SIZE = 8 * 1024 * 1024
+
+
+# Maximum number of files fetched at once by prefetch_isolated(). It is kept
+# low so the fetches in flight complete quickly once it is asked to stop.
+PREFETCH_IN_FLIGHT = 16
+
+
 # A list of already compressed extension types that should not receive any
 # compression before being uploaded.
 ALREADY_COMPRESSED_TYPES = [
@@ -84,6 +116,12 @@ ALREADY_COMPRESSED_TYPES = [
 NET_IO_FILE_CHUNK = 16 * 1024
 
 
+# Maximum number of compressed chunks buffered between the thread zipping an
+# item and the thread uploading it. Caps the memory used by each in-flight
+# upload independently of the item size.
+ZIP_STREAM_BUFFERED_CHUNKS = 4
+
+
 # Read timeout in seconds for downloads from isolate storage. If there's no
 # response from the server within this timeout whole download will be aborted.
 DOWNLOAD_READ_TIMEOUT = 60
@@ -122,15 +160,21 @@ class AlreadyExists(Error):
   """File already exists."""
 
 
-def file_read(path, chunk_size=isolated_format.DISK_FILE_CHUNK, offset=0):
-  """Yields file content in chunks of |chunk_size| starting from |offset|."""
+def file_read(
+    path, chunk_size=isolated_format.DISK_FILE_CHUNK, offset=0, size=-1):
+  """Yields file content in chunks of |chunk_size| starting from |offset|.
+
+  If |size| is not -1, stops after |size| bytes.
+  """
   with fs.open(path, 'rb') as f:
     if offset:
       f.seek(offset)
-    while True:
-      data = f.read(chunk_size)
+    while size:
+      data = f.read(chunk_size if size == -1 else min(chunk_size, size))
       if not data:
         break
+      if size != -1:
+        size -= len(data)
       yield data
 
 
@@ -237,10 +281,13 @@ def putfile(srcfileobj, dstpath, file_mode=None, size=-1, use_symlink=False):
     - SeCreateSymbolicLinkPrivilege is *stripped off* by UAC when a restricted
       RID is present in the token;
       https://msdn.microsoft.com/en-us/library/bb530410.aspx
+
+  Returns:
+    The strategy used to create the file, as returned by file_path.link_file().
   """
   srcpath = fileobj_path(srcfileobj)
   if srcpath and size == -1:
-    readonly = file_mode is None or (
+    readonly = file_mode is None or not (
         file_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
 
     if readonly:
@@ -253,17 +300,19 @@ def putfile(srcfileobj, dstpath, file_mode=None, size=-1, use_symlink=False):
       # If not read only, we must copy the file
       link_mode = file_path.COPY
 
-    file_path.link_file(dstpath, srcpath, link_mode)
+    strategy = file_path.link_file(dstpath, srcpath, link_mode)
   else:
     # Need to write out the file
     with fs.open(dstpath, 'wb') as dstfileobj:
       fileobj_copy(dstfileobj, srcfileobj, size)
+    strategy = file_path.COPY_PYTHON
 
   assert fs.exists(dstpath)
 
   # file_mode of 0 is actually valid, so need explicit check.
   if file_mode is not None:
     fs.chmod(dstpath, file_mode)
+  return strategy
 
 
 def zip_compress(content_generator, level=7):
@@ -425,6 +474,46 @@ class FileItem(Item):
     return file_read(self.path)
 
 
+class FileChunkItem(Item):
+  """A chunk of a 'chunked' file to push to Storage.
+
+  See isolated_format.iter_file_chunks().
+  """
+
+  def __init__(self, path, offset, digest, size, high_priority=False):
+    super(FileChunkItem, self).__init__(digest, size, high_priority)
+    self.path = path
+    self.offset = offset
+    self.compression_level = get_zip_compression_level(path)
+
+  def content(self):
+    return file_read(self.path, offset=self.offset, size=self.size)
+
+
+def metadata_to_items(path, metadata, high_priority=False):
+  """Returns the list of Item to push to Storage for a file.
+
+  Arguments:
+    path: absolute path of the file.
+    metadata: the file's dict as returned by isolated_format.file_to_metadata().
+    high_priority: see Item.
+  """
+  if 'c' not in metadata:
+    return [
+      FileItem(
+          path=path,
+          digest=metadata['h'],
+          size=metadata['s'],
+          high_priority=high_priority),
+    ]
+  items = []
+  offset = 0
+  for digest, size in metadata['c']:
+    items.append(FileChunkItem(path, offset, digest, size, high_priority))
+    offset += size
+  return items
+
+
 class BufferItem(Item):
   """A byte buffer to push to Storage."""
 
@@ -436,6 +525,26 @@ class BufferItem(Item):
     return [self.buffer]
 
 
+class _CallbackChannel(object):
+  """Forwards the outcome of a task to a TaskChannel, then calls |callback|.
+
+  Used with AutoRetryThreadPool, it calls |callback| only once the task
+  succeeded or failed for good, not when it is retried.
+  """
+
+  def __init__(self, channel, callback):
+    self._channel = channel
+    self._callback = callback
+
+  def send_result(self, result):
+    self._channel.send_result(result)
+    self._callback()
+
+  def send_exception(self, exc_info=None):
+    self._channel.send_exception(exc_info or sys.exc_info())
+    self._callback()
+
+
 class Storage(object):
   """Efficiently downloads or uploads large set of files via StorageApi.
 
@@ -458,6 +567,15 @@ class Storage(object):
     self._net_thread_pool = None
     self._aborted = False
     self._prev_sig_handlers = {}
+    # Lock that protects the fetch scheduling state below.
+    self._fetch_lock = threading.Lock()
+    # Heaps of fetches waiting for a slot, see async_fetch().
+    self._small_fetches = []
+    self._large_fetches = []
+    self._fetch_count = 0
+    # Number of fetches running, and how many of them are large.
+    self._running_fetches = 0
+    self._running_large_fetches = 0
 
   @property
   def hash_algo(self):
@@ -540,38 +658,40 @@ class Storage(object):
     """Uploads a bunch of items to the isolate server.
 
     It figures out what items are missing from the server and uploads only them.
+    Hashing, lookups and uploads are pipelined: items are looked up as soon as
+    they are hashed and uploaded as soon as they are known to be missing.
 
     Arguments:
-      items: list of Item instances that represents data to upload.
+      items: iterable of Item instances that represents data to upload. It can
+             be a generator.
 
     Returns:
       List of items that were uploaded. All other items are already there.
     """
-    logging.info('upload_items(items=%d)', len(items))
-
-    # Ensure all digests are calculated.
-    for item in items:
-      item.prepare(self._hash_algo)
+    logging.info('upload_items()')
 
     # For each digest keep only first Item that matches it. All other items
     # are just indistinguishable copies from the point of view of isolate
     # server (it doesn't care about paths at all, only content and digests).
     seen = {}
-    duplicates = 0
-    for item in items:
-      if seen.setdefault(item.digest, item) is not item:
-        duplicates += 1
-    items = seen.values()
-    if duplicates:
-      logging.info('Skipped %d files with duplicated content', duplicates)
+    duplicates = []
+    def iter_unique():
+      for item in self._iter_prepared(items):
+        if seen.setdefault(item.digest, item) is item:
+          yield item
+        else:
+          duplicates.append(item)
 
     # Enqueue all upload tasks.
     missing = set()
     uploaded = []
     channel = threading_utils.TaskChannel()
-    for missing_item, push_state in self.get_missing_items(items):
+    for missing_item, push_state in self.get_missing_items(iter_unique()):
       missing.add(missing_item)
       self.async_push(channel, missing_item, push_state)
+    items = seen.values()
+    if duplicates:
+      logging.info('Skipped %d files with duplicated content', len(duplicates))
 
     # No need to spawn deadlock detector thread if there's nothing to upload.
     if missing:
@@ -632,36 +752,78 @@ class Storage(object):
         threading_utils.PRIORITY_HIGH if item.high_priority
         else threading_utils.PRIORITY_MED)
 
-    def push(content):
+    def push(content_factory):
       """Pushes an Item and returns it to |channel|."""
       if self._aborted:
         raise Aborted()
       item.prepare(self._hash_algo)
-      self._storage_api.push(item, push_state, content)
+      # The factory is passed along so the content is regenerated on each
+      # attempt, both by the StorageApi and by |net_thread_pool|, instead of
+      # reading from an exhausted stream.
+      self._storage_api.push(item, push_state, content_factory)
       return item
 
     # If zipping is not required, just start a push task.
     if not self._use_zip:
       self.net_thread_pool.add_task_with_channel(
-          channel, priority, push, item.content())
+          channel, priority, push, item.content)
       return
 
-    # If zipping is enabled, zip in a separate thread.
-    def zip_and_push():
-      # TODO(vadimsh): Implement streaming uploads. Before it's done, assemble
-      # content right here. It will block until all file is zipped.
+    # If zipping is enabled, zip in a separate thread and stream compressed
+    # chunks to the push as soon as they are produced.
+    self.net_thread_pool.add_task_with_channel(
+        channel, priority, push,
+        functools.partial(self._zip_stream, item, priority))
+
+  def _zip_stream(self, item, priority):
+    """Yields the compressed content of |item|, zipped in |cpu_thread_pool|.
+
+    At most ZIP_STREAM_BUFFERED_CHUNKS compressed chunks are kept in memory;
+    the zipping thread blocks until the consumer catches up. Zipping only starts
+    once the generator is first iterated, that is once the upload started, so
+    zipping threads never wait on an upload that is not running.
+
+    Exceptions raised while zipping are reraised in the consumer thread.
+    """
+    buf = Queue.Queue(maxsize=ZIP_STREAM_BUFFERED_CHUNKS)
+    done = threading.Event()
+
+    def put(entry):
+      # Gives up if the consumer went away, otherwise the thread would be stuck.
+      while not done.is_set():
+        try:
+          buf.put(entry, timeout=0.1)
+          return True
+        except Queue.Full:
+          pass
+      return False
+
+    def zip_content():
       try:
         if self._aborted:
           raise Aborted()
-        stream = zip_compress(item.content(), item.compression_level)
-        data = ''.join(stream)
+        for chunk in zip_compress(item.content(), item.compression_level):
+          if self._aborted:
+            raise Aborted()
+          if not put((chunk, None)):
+            return
       except Exception as exc:
         logging.error('Failed to zip \'%s\': %s', item, exc)
-        channel.send_exception()
+        put((None, sys.exc_info()))
         return
-      self.net_thread_pool.add_task_with_channel(
-          channel, priority, push, [data])
-    self.cpu_thread_pool.add_task(priority, zip_and_push)
+      put((None, None))
+
+    self.cpu_thread_pool.add_task(priority, zip_content)
+    try:
+      while True:
+        chunk, exc_info = buf.get()
+        if chunk is None:
+          if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+          return
+        yield chunk
+    finally:
+      done.set()
 
   def push(self, item, push_state):
     """Synchronously pushes a single item to the server.
@@ -686,6 +848,11 @@ class Storage(object):
   def async_fetch(self, channel, priority, digest, size, sink):
     """Starts asynchronous fetch from the server in a parallel thread.
 
+    At most MAX_CONCURRENT_FETCHES_PER_HOST items are fetched at once. The other
+    fetches are started by order of priority, then largest first. Items at
+    least LARGE_FETCH_SIZE large are limited to half of the slots while smaller
+    items are waiting.
+
     Arguments:
       channel: TaskChannel that receives back |digest| when download ends.
       priority: thread pool task priority for the fetch.
@@ -693,32 +860,72 @@ class Storage(object):
       size: expected size of the item (after decompression).
       sink: function that will be called as sink(generator).
     """
-    def fetch():
-      try:
-        # Prepare reading pipeline.
-        stream = self._storage_api.fetch(digest)
-        if self._use_zip:
-          stream = zip_decompress(stream, isolated_format.DISK_FILE_CHUNK)
-        # Run |stream| through verifier that will assert its size.
-        verifier = FetchStreamVerifier(stream, size)
-        # Verified stream goes to |sink|.
-        sink(verifier.run())
-      except Exception as err:
-        logging.error('Failed to fetch %s: %s', digest, err)
-        raise
-      return digest
-
+    large = size is not UNKNOWN_FILE_SIZE and size >= LARGE_FETCH_SIZE
+    with self._fetch_lock:
+      self._fetch_count += 1
+      heapq.heappush(
+          self._large_fetches if large else self._small_fetches,
+          (priority, -(size or 0), self._fetch_count, large, channel, digest,
+            size, sink))
+    self._start_fetches()
+
+  def _start_fetches(self):
+    """Starts the fetches waiting for a slot, if any slot is available."""
+    while True:
+      with self._fetch_lock:
+        if self._running_fetches >= MAX_CONCURRENT_FETCHES_PER_HOST:
+          return
+        fetches = self._small_fetches
+        if self._large_fetches and (
+            not self._small_fetches or
+            (self._running_large_fetches <
+                MAX_CONCURRENT_FETCHES_PER_HOST / 2 and
+              self._large_fetches[0][0] <= self._small_fetches[0][0])):
+          fetches = self._large_fetches
+        if not fetches:
+          return
+        priority, _, _, large, channel, digest, size, sink = heapq.heappop(
+            fetches)
+        self._running_fetches += 1
+        self._running_large_fetches += large
+      self.net_thread_pool.add_task_with_channel(
+          _CallbackChannel(
+              channel, functools.partial(self._on_fetch_done, large)),
+          priority, self._fetch, digest, size, sink)
+
+  def _on_fetch_done(self, large):
+    """Frees the slot of a fetch, including all of its retries."""
+    with self._fetch_lock:
+      self._running_fetches -= 1
+      self._running_large_fetches -= large
+    self._start_fetches()
+
+  def _fetch(self, digest, size, sink):
+    """Fetches |digest| into |sink| and returns |digest|. See async_fetch()."""
     # Don't bother with zip_thread_pool for decompression. Decompression is
     # really fast and most probably IO bound anyway.
-    self.net_thread_pool.add_task_with_channel(channel, priority, fetch)
+    try:
+      # Prepare reading pipeline.
+      stream = self._storage_api.fetch(digest)
+      if self._use_zip:
+        stream = zip_decompress(stream, isolated_format.DISK_FILE_CHUNK)
+      # Run |stream| through verifier that will assert its size.
+      verifier = FetchStreamVerifier(stream, size)
+      # Verified stream goes to |sink|.
+      sink(verifier.run())
+    except Exception as err:
+      logging.error('Failed to fetch %s: %s', digest, err)
+      raise
+    return digest
 
   def get_missing_items(self, items):
     """Yields items that are missing from the server.
 
-    Issues multiple parallel queries via StorageApi's 'contains' method.
+    Issues multiple parallel queries via StorageApi's 'contains' method, as
+    soon as enough items are hashed to fill a query.
 
     Arguments:
-      items: a list of Item objects to check.
+      items: an iterable of Item objects to check.
 
     Yields:
       For each missing item it yields a pair (item, push_state), where:
@@ -731,26 +938,66 @@ class Storage(object):
     channel = threading_utils.TaskChannel()
     pending = 0
 
-    # Ensure all digests are calculated.
-    for item in items:
-      item.prepare(self._hash_algo)
-
     def contains(batch):
       if self._aborted:
         raise Aborted()
       return self._storage_api.contains(batch)
 
-    # Enqueue all requests.
-    for batch in batch_items_for_check(items):
+    for batch in batch_items_for_check(self._iter_prepared(items)):
       self.net_thread_pool.add_task_with_channel(
           channel, threading_utils.PRIORITY_HIGH, contains, batch)
       pending += 1
-
-    # Yield results as they come in.
+      # Yield the results already available. Wait for one when too many
+      # queries are in flight.
+      while pending:
+        try:
+          result = channel.pull(
+              None if pending >= MAX_PENDING_CONTAINS_QUERIES else 0)
+        except threading_utils.TaskChannel.Timeout:
+          break
+        pending -= 1
+        for missing_item, push_state in result.iteritems():
+          yield missing_item, push_state
+
+    # Yield the remaining results as they come in.
     for _ in xrange(pending):
       for missing_item, push_state in channel.pull().iteritems():
         yield missing_item, push_state
 
+  def _iter_prepared(self, items):
+    """Yields |items| once their digest and size are known.
+
+    Items missing them are hashed on cpu_thread_pool, so they may be yielded
+    out of order. At most MAX_PENDING_PREPARE items are hashed at once.
+    """
+    channel = threading_utils.TaskChannel()
+    pending = 0
+
+    def prepare(item):
+      if self._aborted:
+        raise Aborted()
+      item.prepare(self._hash_algo)
+      return item
+
+    for item in items:
+      if item.digest is not None and item.size is not None:
+        yield item
+        continue
+      self.cpu_thread_pool.add_task(
+          threading_utils.PRIORITY_HIGH, channel.wrap_task(prepare), item)
+      pending += 1
+      while pending:
+        try:
+          prepared = channel.pull(
+              None if pending >= MAX_PENDING_PREPARE else 0)
+        except threading_utils.TaskChannel.Timeout:
+          break
+        pending -= 1
+        yield prepared
+
+    for _ in xrange(pending):
+      yield channel.pull()
+
 
 def batch_items_for_check(items):
   """Splits list of items to check for existence on the server into batches.
@@ -759,7 +1006,9 @@ def batch_items_for_check(items):
   to StorageApi's 'contains' method.
 
   Arguments:
-    items: a list of Item objects.
+    items: an iterable of Item objects. Items are sorted by size by windows of
+           CONTAINS_SORT_WINDOW items, so the first batch is yielded without
+           consuming all of |items|.
 
   Yields:
     Batches of items to query for existence in a single operation,
@@ -768,18 +1017,29 @@ def batch_items_for_check(items):
   batch_count = 0
   batch_size_limit = ITEMS_PER_CONTAINS_QUERIES[0]
   next_queries = []
-  for item in sorted(items, key=lambda x: x.size, reverse=True):
-    next_queries.append(item)
-    if len(next_queries) == batch_size_limit:
-      yield next_queries
-      next_queries = []
-      batch_count += 1
-      batch_size_limit = ITEMS_PER_CONTAINS_QUERIES[
-          min(batch_count, len(ITEMS_PER_CONTAINS_QUERIES) - 1)]
+  for window in iter_windows(items, CONTAINS_SORT_WINDOW):
+    for item in sorted(window, key=lambda x: x.size, reverse=True):
+      next_queries.append(item)
+      if len(next_queries) == batch_size_limit:
+        yield next_queries
+        next_queries = []
+        batch_count += 1
+        batch_size_limit = ITEMS_PER_CONTAINS_QUERIES[
+            min(batch_count, len(ITEMS_PER_CONTAINS_QUERIES) - 1)]
   if next_queries:
     yield next_queries
 
 
+def iter_windows(iterable, size):
+  """Yields lists of up to |size| consecutive elements of |iterable|."""
+  iterator = iter(iterable)
+  while True:
+    window = list(itertools.islice(iterator, size))
+    if not window:
+      return
+    yield window
+
+
 class FetchQueue(object):
   """Fetches items from Storage and places them into LocalCache.
 
@@ -795,6 +1055,20 @@ class FetchQueue(object):
     self._pending = set()
     self._accessed = set()
     self._fetched = cache.cached_set()
+    # Digest of a 'chunked' item being fetched -> list of its [digest, size]
+    # chunks.
+    self._chunked = {}
+    # Digest of a 'chunked' item being fetched -> number of its distinct chunks
+    # still being fetched.
+    self._chunks_left = {}
+    # Digest of a chunk being fetched -> set of the 'chunked' items using it.
+    self._chunk_users = {}
+    # Seconds between the creation of the queue and the first and last bytes
+    # fetched.
+    self._start = time.time()
+    self._timing_lock = threading.Lock()
+    self.time_to_first_byte = None
+    self.time_to_last_byte = None
 
   def add(
       self,
@@ -802,22 +1076,55 @@ class FetchQueue(object):
       size=UNKNOWN_FILE_SIZE,
       priority=threading_utils.PRIORITY_MED):
     """Starts asynchronous fetch of item |digest|."""
-    # Fetching it now?
-    if digest in self._pending:
-      return
-
     # Mark this file as in use, verify_all_cached will later ensure it is still
     # in cache.
     self._accessed.add(digest)
+    self._fetch(digest, size, priority)
+
+  def add_chunked(
+      self, digest, size, chunks, priority=threading_utils.PRIORITY_MED):
+    """Starts asynchronous fetch of the chunks of 'chunked' item |digest|.
+
+    The item itself is never fetched. It is assembled from its chunks into the
+    cache by wait() once they are all fetched, unless it is already in the
+    cache.
+    """
+    if digest in self._pending:
+      return
+    self._accessed.add(digest)
+    if not self._needs_fetch(digest, size):
+      return
 
+    self._pending.add(digest)
+    self._chunked[digest] = chunks
+    self._chunks_left[digest] = 0
+    for chunk_digest, chunk_size in dict(chunks).iteritems():
+      self._fetch(chunk_digest, chunk_size, priority)
+      if chunk_digest in self._pending:
+        self._chunk_users.setdefault(chunk_digest, set()).add(digest)
+        self._chunks_left[digest] += 1
+    if not self._chunks_left[digest]:
+      self._assemble(digest)
+
+  def _needs_fetch(self, digest, size):
+    """Returns False if |digest| is already in the cache and not corrupted."""
     # Already fetched? Notify cache to update item's LRU position.
     if digest in self._fetched:
       # 'touch' returns True if item is in cache and not corrupted.
       if self.cache.touch(digest, size):
-        return
+        return False
       # Item is corrupted, remove it from cache and fetch it again.
       self._fetched.remove(digest)
       self.cache.evict(digest)
+    return True
+
+  def _fetch(self, digest, size, priority):
+    """Starts asynchronous fetch of |digest| unless it is not needed."""
+    # Fetching it now?
+    if digest in self._pending:
+      return
+    if not self._needs_fetch(digest, size):
+      return
 
     # TODO(maruel): It should look at the free disk space, the current cache
     # size and the size of the new item on every new item:
@@ -831,7 +1138,19 @@ class FetchQueue(object):
     self._pending.add(digest)
     self.storage.async_fetch(
         self._channel, priority, digest, size,
-        functools.partial(self.cache.write, digest))
+        lambda content: self.cache.write(digest, self._timed(content)))
+
+  def _timed(self, content):
+    """Yields |content| while updating time_to_first/last_byte."""
+    for data in content:
+      if self.time_to_first_byte is None:
+        with self._timing_lock:
+          if self.time_to_first_byte is None:
+            self.time_to_first_byte = time.time() - self._start
+      yield data
+    with self._timing_lock:
+      self.time_to_last_byte = max(
+          self.time_to_last_byte, time.time() - self._start)
 
   def wait(self, digests):
     """Starts a loop that waits for at least one of |digests| to be retrieved.
@@ -852,12 +1171,42 @@ class FetchQueue(object):
       digest = self._channel.pull()
       self._pending.remove(digest)
       self._fetched.add(digest)
-      if digest in digests:
-        return digest
+      # Assemble the 'chunked' items that were waiting only for this chunk.
+      assembled = []
+      for chunked_digest in self._chunk_users.pop(digest, ()):
+        self._chunks_left[chunked_digest] -= 1
+        if not self._chunks_left[chunked_digest]:
+          self._assemble(chunked_digest)
+          assembled.append(chunked_digest)
+      for d in [digest] + assembled:
+        if d in digests:
+          return d
 
     # Should never reach this point due to assert above.
     raise RuntimeError('Impossible state')
 
+  def _assemble(self, digest):
+    """Writes 'chunked' item |digest| into the cache out of its chunks."""
+    del self._chunks_left[digest]
+    chunks = self._chunked.pop(digest)
+    hasher = self.storage.hash_algo()
+    def content():
+      for chunk_digest, _ in chunks:
+        with self.cache.getfileobj(chunk_digest) as f:
+          while True:
+            data = f.read(isolated_format.DISK_FILE_CHUNK)
+            if not data:
+              break
+            hasher.update(data)
+            yield data
+    self.cache.write(digest, content())
+    if hasher.hexdigest() != digest:
+      self.cache.evict(digest)
+      raise isolated_format.MappingError(
+          'Chunks of %s assemble into %s' % (digest, hasher.hexdigest()))
+    self._pending.remove(digest)
+    self._fetched.add(digest)
+
   def inject_local_file(self, path, algo):
     """Adds local file to the cache as if it was fetched from storage."""
     with fs.open(path, 'rb') as f:
@@ -981,7 +1330,9 @@ class StorageApi(object):
     Arguments:
       item: Item object that holds information about an item being pushed.
       push_state: push state object as returned by 'contains' call.
-      content: a generator that yields chunks to push, item.content() if None.
+      content: a generator that yields chunks to push, or a callable returning
+          a new such generator on each call so the push can be retried.
+          item.content if None.
 
     Returns:
       None.
@@ -1041,7 +1392,6 @@ class IsolateServer(StorageApi):
     }
     self._lock = threading.Lock()
     self._server_caps = None
-    self._memory_use = 0
 
   @property
   def _server_capabilities(self):
@@ -1132,81 +1482,39 @@ class IsolateServer(StorageApi):
     assert isinstance(push_state, _IsolateServerPushState)
     assert not push_state.finalized
 
-    # Default to item.content().
-    content = item.content() if content is None else content
+    # Default to item.content, which can be called again to retry.
+    content = item.content if content is None else content
     logging.info('Push state size: %d', push_state.size)
-    if isinstance(content, (basestring, list)):
-      # Memory is already used, too late.
-      with self._lock:
-        self._memory_use += push_state.size
+    # This push operation may be a retry after failed finalization call below,
+    # no need to reupload contents in that case.
+    if not push_state.uploaded:
+      # PUT file to |upload_url|.
+      success = self.do_push(push_state, content)
+      if not success:
+        raise IOError('Failed to upload file with hash %s to URL %s' % (
+            item.digest, push_state.upload_url))
+      push_state.uploaded = True
     else:
-      # TODO(vadimsh): Do not read from |content| generator when retrying push.
-      # If |content| is indeed a generator, it can not be re-winded back to the
-      # beginning of the stream. A retry will find it exhausted. A possible
-      # solution is to wrap |content| generator with some sort of caching
-      # restartable generator. It should be done alongside streaming support
-      # implementation.
-      #
-      # In theory, we should keep the generator, so that it is not serialized in
-      # memory. Sadly net.HttpService.request() requires the body to be
-      # serialized.
-      assert isinstance(content, types.GeneratorType), repr(content)
-      slept = False
-      # HACK HACK HACK. Please forgive me for my sins but OMG, it works!
-      # One byte less than 512mb. This is to cope with incompressible content.
-      max_size = int(sys.maxsize * 0.25)
-      while True:
-        with self._lock:
-          # This is due to 32 bits python when uploading very large files. The
-          # problem is that it's comparing uncompressed sizes, while we care
-          # about compressed sizes since it's what is serialized in memory.
-          # The first check assumes large files are compressible and that by
-          # throttling one upload at once, we can survive. Otherwise, kaboom.
-          memory_use = self._memory_use
-          if ((push_state.size >= max_size and not memory_use) or
-              (memory_use + push_state.size <= max_size)):
-            self._memory_use += push_state.size
-            memory_use = self._memory_use
-            break
-        time.sleep(0.1)
-        slept = True
-      if slept:
-        logging.info('Unblocked: %d %d', memory_use, push_state.size)
-
-    try:
-      # This push operation may be a retry after failed finalization call below,
-      # no need to reupload contents in that case.
-      if not push_state.uploaded:
-        # PUT file to |upload_url|.
-        success = self.do_push(push_state, content)
-        if not success:
-          raise IOError('Failed to upload file with hash %s to URL %s' % (
-              item.digest, push_state.upload_url))
-        push_state.uploaded = True
-      else:
-        logging.info(
-            'A file %s already uploaded, retrying finalization only',
-            item.digest)
-
-      # Optionally notify the server that it's done.
-      if push_state.finalize_url:
-        # TODO(vadimsh): Calculate MD5 or CRC32C sum while uploading a file and
-        # send it to isolated server. That way isolate server can verify that
-        # the data safely reached Google Storage (GS provides MD5 and CRC32C of
-        # stored files).
-        # TODO(maruel): Fix the server to accept properly data={} so
-        # url_read_json() can be used.
-        response = net.url_read_json(
-            url='%s/%s' % (self._base_url, push_state.finalize_url),
-            data={
-                'upload_ticket': push_state.preupload_status['upload_ticket'],
-            })
-        if not response or not response['ok']:
-          raise IOError('Failed to finalize file with hash %s.' % item.digest)
-      push_state.finalized = True
-    finally:
-      with self._lock:
-        self._memory_use -= push_state.size
+      logging.info(
+          'A file %s already uploaded, retrying finalization only',
+          item.digest)
+
+    # Optionally notify the server that it's done.
+    if push_state.finalize_url:
+      # TODO(vadimsh): Calculate MD5 or CRC32C sum while uploading a file and
+      # send it to isolated server. That way isolate server can verify that
+      # the data safely reached Google Storage (GS provides MD5 and CRC32C of
+      # stored files).
+      # TODO(maruel): Fix the server to accept properly data={} so
+      # url_read_json() can be used.
+      response = net.url_read_json(
+          url='%s/%s' % (self._base_url, push_state.finalize_url),
+          data={
+              'upload_ticket': push_state.preupload_status['upload_ticket'],
+          })
+      if not response or not response['ok']:
+        raise IOError('Failed to finalize file with hash %s.' % item.digest)
+    push_state.finalized = True
 
   def contains(self, items):
     # Ensure all items were initialized with 'prepare' call. Storage does that.
@@ -1282,22 +1590,20 @@ class IsolateServer(StorageApi):
     subclasses.
 
     Args:
-      url: URL to upload the data to.
       push_state: an _IsolateServicePushState instance
-      item: the original Item to be uploaded
-      content: an iterable that yields 'str' chunks.
+      content: an iterable that yields 'str' chunks, or a callable returning a
+          new such iterable on each call. A callable is streamed and called
+          again for each retry. Another iterable that is not a list is streamed
+          and consumed only once, so the caller is responsible for retrying
+          with a new iterable.
     """
-    # A cheezy way to avoid memcpy of (possibly huge) file, until streaming
-    # upload support is implemented.
-    if isinstance(content, list) and len(content) == 1:
-      content = content[0]
-    else:
-      content = ''.join(content)
-
-    # DB upload
+    # DB upload. The content is sent base64 encoded in a JSON body, so it has
+    # to be assembled in memory. The server only directs small items here.
     if not push_state.finalize_url:
+      if callable(content):
+        content = content()
       url = '%s/%s' % (self._base_url, push_state.upload_url)
-      content = base64.b64encode(content)
+      content = base64.b64encode(''.join(content))
       data = {
           'upload_ticket': push_state.preupload_status['upload_ticket'],
           'content': content,
@@ -1306,13 +1612,42 @@ class IsolateServer(StorageApi):
       return response is not None and response['ok']
 
     # upload to GS
+    kwargs = {}
+    generated = []
+    if callable(content):
+      # Stream the content with chunked transfer encoding as it is generated.
+      # net calls the factory again for each retry.
+      factory = content
+      def content():
+        if generated:
+          # Unblocks the zipping thread of the previous attempt.
+          generated[-1].close()
+        body = factory()
+        if not hasattr(body, 'close'):
+          body = (chunk for chunk in body)
+        generated.append(body)
+        return body
+    elif isinstance(content, list):
+      # A cheezy way to avoid memcpy of (possibly huge) file.
+      content = content[0] if len(content) == 1 else ''.join(content)
+    else:
+      # Stream the content with chunked transfer encoding as it is generated.
+      # It can't be rewound, so only a single attempt is done here.
+      content = (chunk for chunk in content)
+      kwargs['max_attempts'] = 1
     url = push_state.upload_url
-    response = net.url_read(
-        content_type='application/octet-stream',
-        data=content,
-        method='PUT',
-        headers={'Cache-Control': 'public, max-age=31536000'},
-        url=url)
+    try:
+      response = net.url_read(
+          content_type='application/octet-stream',
+          data=content,
+          method='PUT',
+          headers={'Cache-Control': 'public, max-age=31536000'},
+          url=url,
+          **kwargs)
+    finally:
+      if generated:
+        # Unblocks the zipping thread if the upload stopped midway.
+        generated[-1].close()
     return response is not None
 
 
@@ -1339,6 +1674,7 @@ class LocalCache(object):
     self._added = []
     self._initial_number_items = 0
     self._initial_size = 0
+    self._corrupted = []
     self._evicted = []
     self._used = []
 
@@ -1357,6 +1693,10 @@ class LocalCache(object):
   def added(self):
     return self._added[:]
 
+  @property
+  def corrupted(self):
+    return self._corrupted[:]
+
   @property
   def evicted(self):
     return self._evicted[:]
@@ -1377,8 +1717,14 @@ class LocalCache(object):
     """Returns a set of all cached digests (always a new object)."""
     raise NotImplementedError()
 
-  def cleanup(self):
-    """Deletes any corrupted item from the cache and trims it if necessary."""
+  def cleanup(self, verify_time_budget=0, stop_event=None):
+    """Deletes any corrupted item from the cache and trims it if necessary.
+
+    Arguments:
+      verify_time_budget: maximum time in seconds spent hashing items to detect
+          corruption.
+      stop_event: optional threading.Event. Hashing stops as soon as it is set.
+    """
     raise NotImplementedError()
 
   def touch(self, digest, size):
@@ -1433,7 +1779,7 @@ class MemoryCache(LocalCache):
     with self._lock:
       return set(self._contents)
 
-  def cleanup(self):
+  def cleanup(self, verify_time_budget=0, stop_event=None):
     pass
 
   def touch(self, digest, size):
@@ -1483,16 +1829,27 @@ class CachePolicies(object):
 class DiskCache(LocalCache):
   """Stateful LRU cache in a flat hash table in a directory.
 
-  Saves its state as json file.
+  Saves its state as json file. Modifications done in between are appended to a
+  journal file, so the state file is only rewritten once in a while.
+
+  The inode and mtime of each item are recorded when its content is verified,
+  in a separate LRU state ordered by verification time.
   """
   STATE_FILE = u'state.json'
+  JOURNAL_FILE = u'state.journal'
+  VERIFIED_FILE = u'verified.json'
+  VERIFIED_JOURNAL_FILE = u'verified.journal'
+  LOCK_FILE = u'lock'
 
-  def __init__(self, cache_dir, policies, hash_algo):
+  def __init__(self, cache_dir, policies, hash_algo, lock=False):
     """
     Arguments:
       cache_dir: directory where to place the cache.
       policies: cache retention policies.
       algo: hashing algorithm used.
+      lock: if True, waits for and holds the lock file of cache_dir until this
+          object is deleted or the process exits, so the processes sharing the
+          cache directory do not modify it concurrently.
     """
     # All protected methods (starting with '_') except _path should be called
     # with self._lock held.
@@ -1501,8 +1858,14 @@ class DiskCache(LocalCache):
     self.policies = policies
     self.hash_algo = hash_algo
     self.state_file = os.path.join(cache_dir, self.STATE_FILE)
+    self.journal_file = os.path.join(cache_dir, self.JOURNAL_FILE)
+    self.verified_file = os.path.join(cache_dir, self.VERIFIED_FILE)
+    self.verified_journal_file = os.path.join(
+        cache_dir, self.VERIFIED_JOURNAL_FILE)
     # Items in a LRU lookup dict(digest: size).
     self._lru = lru.LRUDict()
+    # Sum of the sizes of all the items in self._lru.
+    self._total_size = 0
     # Current cached free disk space. It is updated by self._trim().
     self._free_disk = 0
     # The first item in the LRU cache that must not be evicted during this run
@@ -1512,6 +1875,13 @@ class DiskCache(LocalCache):
     self._protected = None
     # Cleanup operations done by self._load(), if any.
     self._operations = []
+    # File object holding the lock on cache_dir, if any.
+    self._lock_file = None
+    if lock:
+      file_path.ensure_tree(cache_dir)
+      with tools.Profiler('Lock'):
+        self._lock_file = file_path.lock_file(
+            os.path.join(cache_dir, self.LOCK_FILE))
     with tools.Profiler('Setup'):
       with self._lock:
         # self._load() calls self._trim() which initializes self._free_disk.
@@ -1535,10 +1905,14 @@ class DiskCache(LocalCache):
         logging.info(
             '%5d (%8dkb) current',
             len(self._lru),
-            sum(self._lru.itervalues()) / 1024)
+            self._total_size / 1024)
         logging.info(
             '%5d (%8dkb) evicted',
             len(self._evicted), sum(self._evicted) / 1024)
+        if self._corrupted:
+          logging.info(
+              '%5d (%8dkb) corrupted',
+              len(self._corrupted), sum(self._corrupted) / 1024)
         logging.info(
             '       %8dkb free',
             self._free_disk / 1024)
@@ -1548,21 +1922,28 @@ class DiskCache(LocalCache):
     with self._lock:
       return self._lru.keys_set()
 
-  def cleanup(self):
+  def cleanup(self, verify_time_budget=0, stop_event=None):
     """Cleans up the cache directory.
 
     Ensures there is no unknown files in cache_dir.
     Ensures the read-only bits are set correctly.
+    Hashes the items that are new or were modified since they were last
+    verified, for up to |verify_time_budget| seconds or until |stop_event| is
+    set, and evicts the corrupted ones. Items not verified in this run are
+    verified by the next calls.
 
     At that point, the cache was already loaded, trimmed to respect cache
     policies.
     """
     fs.chmod(self.cache_dir, 0700)
+    state_files = (
+        self.STATE_FILE, self.JOURNAL_FILE,
+        self.VERIFIED_FILE, self.VERIFIED_JOURNAL_FILE, self.LOCK_FILE)
     # Ensure that all files listed in the state still exist and add new ones.
     previous = self._lru.keys_set()
     # It'd be faster if there were a readdir() function.
     for filename in fs.listdir(self.cache_dir):
-      if filename == self.STATE_FILE:
+      if filename in state_files:
         fs.chmod(os.path.join(self.cache_dir, filename), 0600)
         continue
       if filename in previous:
@@ -1586,21 +1967,13 @@ class DiskCache(LocalCache):
       # Filter out entries that were not found.
       logging.warning('Removed %d lost files', len(previous))
       for filename in previous:
-        self._lru.pop(filename)
-
-    # What remains to be done is to hash every single item to
-    # detect corruption, then save to ensure state.json is up to date.
-    # Sadly, on a 50Gb cache with 100mib/s I/O, this is still over 8 minutes.
-    # TODO(maruel): Let's revisit once directory metadata is stored in
-    # state.json so only the files that had been mapped since the last cleanup()
-    # call are manually verified.
-    #
-    #with self._lock:
-    #  for digest in self._lru:
-    #    if not isolated_format.is_valid_hash(
-    #        self._path(digest), self.hash_algo):
-    #      self.evict(digest)
-    #      logging.info('Deleted corrupted item: %s', digest)
+        self._total_size -= self._lru.pop(filename)
+
+    # What remains to be done is to hash items to detect corruption. On a 50Gb
+    # cache with 100mib/s I/O, hashing everything is over 8 minutes so only the
+    # items that changed since they were last verified are hashed.
+    if verify_time_budget:
+      self._verify(verify_time_budget, stop_event)
 
   def touch(self, digest, size):
     """Verifies an actual file is valid.
@@ -1626,7 +1999,7 @@ class DiskCache(LocalCache):
     with self._lock:
       # Do not check for 'digest == self._protected' since it could be because
       # the object is corrupted.
-      self._lru.pop(digest)
+      self._total_size -= self._lru.pop(digest)
       self._delete_file(digest, UNKNOWN_FILE_SIZE)
 
   def getfileobj(self, digest):
@@ -1675,19 +2048,23 @@ class DiskCache(LocalCache):
     if not fs.isfile(self.state_file):
       if not os.path.isdir(self.cache_dir):
         fs.makedirs(self.cache_dir)
+      # A journal without its state is useless.
+      file_path.try_remove(self.journal_file)
     else:
       # Load state of the cache.
       try:
-        self._lru = lru.LRUDict.load(self.state_file)
+        self._lru = lru.LRUDict.load(self.state_file, self.journal_file)
       except ValueError as err:
         logging.error('Failed to load cache state: %s' % (err,))
         # Don't want to keep broken state file.
         file_path.try_remove(self.state_file)
+        file_path.try_remove(self.journal_file)
+    self._total_size = sum(self._lru.itervalues())
     self._trim()
     # We want the initial cache size after trimming, i.e. what is readily
     # avaiable.
     self._initial_number_items = len(self._lru)
-    self._initial_size = sum(self._lru.itervalues())
+    self._initial_size = self._total_size
     if self._evicted:
       logging.info(
           'Trimming evicted items with the following sizes: %s',
@@ -1701,9 +2078,10 @@ class DiskCache(LocalCache):
       if fs.isdir(d):
         # Necessary otherwise the file can't be created.
         file_path.set_read_only(d, False)
-    if fs.isfile(self.state_file):
-      file_path.set_read_only(self.state_file, False)
-    self._lru.save(self.state_file)
+    for f in (self.state_file, self.journal_file):
+      if fs.isfile(f):
+        file_path.set_read_only(f, False)
+    self._lru.save(self.state_file, self.journal_file)
 
   def _trim(self):
     """Trims anything we don't know, make sure enough free space exists."""
@@ -1711,9 +2089,8 @@ class DiskCache(LocalCache):
 
     # Ensure maximum cache size.
     if self.policies.max_cache_size:
-      total_size = sum(self._lru.itervalues())
-      while total_size > self.policies.max_cache_size:
-        total_size -= self._remove_lru_file(True)
+      while self._total_size > self.policies.max_cache_size:
+        self._remove_lru_file(True)
 
     # Ensure maximum number of items in the cache.
     if self.policies.max_items and len(self._lru) > self.policies.max_items:
@@ -1731,7 +2108,7 @@ class DiskCache(LocalCache):
       self._remove_lru_file(True)
 
     if trimmed_due_to_space:
-      total_usage = sum(self._lru.itervalues())
+      total_usage = self._total_size
       usage_percent = 0.
       if total_usage:
         usage_percent = 100. * float(total_usage) / self.policies.max_cache_size
@@ -1746,6 +2123,64 @@ class DiskCache(LocalCache):
           self.policies.max_cache_size / 1024.)
     self._save()
 
+  def _verify(self, time_budget, stop_event):
+    """Hashes the items that are new or modified since they were last verified.
+
+    The most recently used items are verified first. Stops hashing once
+    |time_budget| seconds elapsed or |stop_event| is set. Corrupted items are
+    evicted.
+    """
+    verified = lru.LRUDict()
+    if fs.isfile(self.verified_file):
+      try:
+        verified = lru.LRUDict.load(
+            self.verified_file, self.verified_journal_file)
+      except ValueError as err:
+        logging.error('Failed to load verification state: %s' % (err,))
+    # Forget about the items that are not in the cache anymore.
+    for digest in verified.keys_set() - self.cached_set():
+      verified.pop(digest)
+
+    start = time.time()
+    hashed = 0
+    pending = 0
+    with self._lock:
+      digests = list(self._lru)
+    for digest in reversed(digests):
+      try:
+        st = fs.stat(self._path(digest))
+      except OSError:
+        continue
+      signature = [st.st_ino, st.st_mtime]
+      if verified.get(digest) == signature:
+        continue
+      if (time.time() - start >= time_budget or
+          (stop_event and stop_event.is_set())):
+        pending += 1
+        continue
+      hashed += 1
+      actual = isolated_format.hash_file(self._path(digest), self.hash_algo)
+      if actual == digest:
+        verified.add(digest, signature)
+        continue
+      logging.warning('Deleted corrupted item: %s', digest)
+      with self._lock:
+        self._corrupted.append(self._lru[digest])
+      self.evict(digest)
+      if digest in verified:
+        verified.pop(digest)
+    if self._corrupted:
+      with self._lock:
+        self._save()
+
+    for f in (self.verified_file, self.verified_journal_file):
+      if fs.isfile(f):
+        file_path.set_read_only(f, False)
+    verified.save(self.verified_file, self.verified_journal_file)
+    logging.info(
+        'Verified %d items in %.1fs, %d corrupted, %d left to verify',
+        hashed, time.time() - start, len(self._corrupted), pending)
+
   def _path(self, digest):
     """Returns the path to one item."""
     return os.path.join(self.cache_dir, digest)
@@ -1760,6 +2195,7 @@ class DiskCache(LocalCache):
     except KeyError:
       raise Error('Nothing to remove')
     digest, (size, _) = self._lru.pop_oldest()
+    self._total_size -= size
     logging.debug("Removing LRU file %s", digest)
     self._delete_file(digest, size)
     return size
@@ -1770,6 +2206,7 @@ class DiskCache(LocalCache):
     if size == UNKNOWN_FILE_SIZE:
       size = fs.stat(self._path(digest)).st_size
     self._added.append(size)
+    self._total_size += size - self._lru.get(digest, 0)
     self._lru.add(digest, size)
     self._free_disk -= size
     # Do a quicker version of self._trim(). It only enforces free disk space,
@@ -1807,8 +2244,15 @@ class IsolatedBundle(object):
     self.relative_cwd = None
     # The main .isolated file, a IsolatedFile instance.
     self.root = None
-
-  def fetch(self, fetch_queue, root_isolated_hash, algo):
+    # Number of files mapped by fetch_isolated() per strategy returned by
+    # putfile().
+    self.link_strategies = {}
+    # Seconds from the start of fetch_isolated() until the first and the last
+    # bytes were fetched, None if nothing was fetched.
+    self.time_to_first_byte = None
+    self.time_to_last_byte = None
+
+  def fetch(self, fetch_queue, root_isolated_hash, algo, fetch_files=True):
     """Fetches the .isolated and all the included .isolated.
 
     It enables support for "included" .isolated files. They are processed in
@@ -1827,8 +2271,8 @@ class IsolatedBundle(object):
     in 'includes' is important.
 
     As a side effect this method starts asynchronous fetch of all data files
-    by adding them to |fetch_queue|. It doesn't wait for data files to finish
-    fetching though.
+    by adding them to |fetch_queue|, unless |fetch_files| is False. It doesn't
+    wait for data files to finish fetching though.
     """
     self.root = isolated_format.IsolatedFile(root_isolated_hash, algo)
 
@@ -1872,7 +2316,7 @@ class IsolatedBundle(object):
           if not node.is_loaded:
             break
           # Not visited and loaded -> process it and continue the traversal.
-          self._start_fetching_files(node, fetch_queue)
+          self._start_fetching_files(node, fetch_queue, fetch_files)
           processed.add(node)
 
     # All *.isolated files should be processed by now and only them.
@@ -1884,10 +2328,10 @@ class IsolatedBundle(object):
       self._update_self(node)
     self.relative_cwd = self.relative_cwd or ''
 
-  def _start_fetching_files(self, isolated, fetch_queue):
+  def _start_fetching_files(self, isolated, fetch_queue, fetch_files):
     """Starts fetching files from |isolated| that are not yet being fetched.
 
-    Modifies self.files.
+    Modifies self.files. Only lists the files if |fetch_files| is False.
     """
     logging.debug('fetch_files(%s)', isolated.obj_hash)
     for filepath, properties in isolated.data.get('files', {}).iteritems():
@@ -1902,7 +2346,14 @@ class IsolatedBundle(object):
           properties['m'] &= ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
 
         # Preemptively request hashed files.
-        if 'h' in properties:
+        if not fetch_files:
+          continue
+        if 'c' in properties:
+          logging.debug('fetching chunks of %s', filepath)
+          fetch_queue.add_chunked(
+              properties['h'], properties['s'], properties['c'],
+              threading_utils.PRIORITY_MED)
+        elif 'h' in properties:
           logging.debug('fetching %s', filepath)
           fetch_queue.add(
               properties['h'], properties['s'], threading_utils.PRIORITY_MED)
@@ -1978,28 +2429,25 @@ def upload_tree(base_url, infiles, namespace):
     infiles:   iterable of pairs (absolute path, metadata dict) of files.
     namespace: The namespace to use on the server.
   """
-  # Convert |infiles| into a list of FileItem objects, skip duplicates.
-  # Filter out symlinks, since they are not represented by items on isolate
-  # server side.
-  items = []
-  seen = set()
-  skipped = 0
-  for filepath, metadata in infiles:
-    assert isinstance(filepath, unicode), filepath
-    if 'l' not in metadata and filepath not in seen:
-      seen.add(filepath)
-      item = FileItem(
-          path=filepath,
-          digest=metadata['h'],
-          size=metadata['s'],
-          high_priority=metadata.get('priority') == '0')
-      items.append(item)
-    else:
-      skipped += 1
+  # Convert |infiles| into FileItem objects as they are consumed, skip
+  # duplicates. Filter out symlinks, since they are not represented by items on
+  # isolate server side.
+  def iter_items():
+    seen = set()
+    skipped = 0
+    for filepath, metadata in infiles:
+      assert isinstance(filepath, unicode), filepath
+      if 'l' not in metadata and filepath not in seen:
+        seen.add(filepath)
+        for item in metadata_to_items(
+            filepath, metadata, metadata.get('priority') == '0'):
+          yield item
+      else:
+        skipped += 1
+    logging.info('Skipped %d duplicated entries', skipped)
 
-  logging.info('Skipped %d duplicated entries', skipped)
   with get_storage(base_url, namespace) as storage:
-    return storage.upload_items(items)
+    return storage.upload_items(iter_items())
 
 
 def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks):
@@ -2074,14 +2522,17 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks):
             with cache.getfileobj(digest) as srcfileobj:
               filetype = props.get('t', 'basic')
 
-              if filetype == 'basic':
+              # 'chunked' files were assembled into the cache by fetch_queue.
+              if filetype in ('basic', 'chunked'):
                 file_mode = props.get('m')
                 if file_mode:
                   # Ignore all bits apart from the user
                   file_mode &= 0700
-                putfile(
+                strategy = putfile(
                     srcfileobj, fullpath, file_mode,
                     use_symlink=use_symlinks)
+                bundle.link_strategies[strategy] = (
+                    bundle.link_strategies.get(strategy, 0) + 1)
 
               elif filetype == 'ar':
                 basedir = os.path.dirname(fullpath)
@@ -2107,33 +2558,83 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks):
   if not fetch_queue.verify_all_cached():
     raise isolated_format.MappingError(
         'Cache is too small to hold all requested files')
+  bundle.time_to_first_byte = fetch_queue.time_to_first_byte
+  bundle.time_to_last_byte = fetch_queue.time_to_last_byte
   return bundle
 
 
-def directory_to_metadata(root, algo, blacklist):
-  """Returns the FileItem list and .isolated metadata for a directory."""
+def prefetch_isolated(isolated_hash, storage, cache, max_size, stop_event=None):
+  """Downloads the files of an isolated tree into |cache| without mapping it.
+
+  The files are fetched in path order until the ones missing from the cache
+  would exceed |max_size| bytes; the files that don't fit are skipped. The
+  .isolated files are always fetched and not accounted for.
+
+  Stops early when |stop_event| is set. At most PREFETCH_IN_FLIGHT files are
+  fetched concurrently, so it doesn't take long to complete the pending ones.
+
+  Returns:
+    Number of bytes of the files fetched.
+  """
+  logging.debug('prefetch_isolated(%s, %d)', isolated_hash, max_size)
+  with cache:
+    fetch_queue = FetchQueue(storage, cache)
+    bundle = IsolatedBundle()
+    bundle.fetch(fetch_queue, isolated_hash, storage.hash_algo, False)
+
+    fetched = 0
+    pending = set()
+    for _, props in sorted(bundle.files.iteritems()):
+      if stop_event and stop_event.is_set():
+        break
+      digest = props.get('h')
+      if not digest or digest in pending or digest in cache:
+        continue
+      if fetched + props['s'] > max_size:
+        continue
+      fetched += props['s']
+      if 'c' in props:
+        fetch_queue.add_chunked(digest, props['s'], props['c'])
+      else:
+        fetch_queue.add(digest, props['s'])
+      pending.add(digest)
+      if len(pending) >= PREFETCH_IN_FLIGHT:
+        pending.remove(fetch_queue.wait(pending))
+    while pending:
+      pending.remove(fetch_queue.wait(pending))
+  logging.info('Prefetched %d bytes of %s', fetched, isolated_hash)
+  return fetched
+
+
+def directory_to_metadata(
+    root, algo, blacklist, digest_index=None, chunked_file_size=0):
+  """Returns the Item list and .isolated metadata for a directory.
+
+  |digest_index| is an optional isolated_format.DigestIndex. Files at least
+  |chunked_file_size| bytes large are 'chunked' files if it is set.
+  """
   root = file_path.get_native_path_case(root)
   paths = isolated_format.expand_directory_and_symlink(
       root, '.' + os.path.sep, blacklist, sys.platform != 'win32')
-  metadata = {
-    relpath: isolated_format.file_to_metadata(
-        os.path.join(root, relpath), {}, 0, algo)
-    for relpath in paths
-  }
+  metadata = dict(zip(paths, isolated_format.files_to_metadata(
+      [(os.path.join(root, relpath), {}) for relpath in paths], 0, algo,
+      digest_index, chunked_file_size)))
   for v in metadata.itervalues():
+    # 't' is the timestamp in the metadata and the file type in .isolated.
     v.pop('t')
-  items = [
-      FileItem(
-          path=os.path.join(root, relpath),
-          digest=meta['h'],
-          size=meta['s'],
-          high_priority=relpath.endswith('.isolated'))
-      for relpath, meta in metadata.iteritems() if 'h' in meta
-  ]
+    if 'c' in v:
+      v['t'] = 'chunked'
+  items = []
+  for relpath, meta in metadata.iteritems():
+    if 'h' in meta:
+      items.extend(
+          metadata_to_items(
+              os.path.join(root, relpath), meta, relpath.endswith('.isolated')))
   return items, metadata
 
 
-def archive_files_to_storage(storage, files, blacklist):
+def archive_files_to_storage(
+    storage, files, blacklist, digest_index=None, chunked_file_size=0):
   """Stores every entries and returns the relevant data.
 
   Arguments:
@@ -2141,6 +2642,10 @@ def archive_files_to_storage(storage, files, blacklist):
     files: list of file paths to upload. If a directory is specified, a
            .isolated file is created and its hash is returned.
     blacklist: function that returns True if a file should be omitted.
+    digest_index: optional isolated_format.DigestIndex to skip hashing files
+                  already hashed.
+    chunked_file_size: if set, files at least this large in directories are
+                       uploaded as 'chunked' files.
 
   Returns:
     tuple(list(tuple(hash, path)), list(FileItem cold), list(FileItem hot)).
@@ -2163,7 +2668,8 @@ def archive_files_to_storage(storage, files, blacklist):
         if fs.isdir(filepath):
           # Uploading a whole directory.
           items, metadata = directory_to_metadata(
-              filepath, storage.hash_algo, blacklist)
+              filepath, storage.hash_algo, blacklist, digest_index,
+              chunked_file_size)
 
           # Create the .isolated file.
           if not tempdir:
@@ -2174,7 +2680,7 @@ def archive_files_to_storage(storage, files, blacklist):
               'algo':
                   isolated_format.SUPPORTED_ALGOS_REVERSE[storage.hash_algo],
               'files': metadata,
-              'version': isolated_format.ISOLATED_FILE_VERSION,
+              'version': isolated_format.get_isolated_file_version(metadata),
           }
           isolated_format.save_isolated(isolated, data)
           h = isolated_format.hash_file(isolated, storage.hash_algo)
@@ -2188,12 +2694,16 @@ def archive_files_to_storage(storage, files, blacklist):
           results.append((h, f))
 
         elif fs.isfile(filepath):
-          h = isolated_format.hash_file(filepath, storage.hash_algo)
+          filestats = fs.stat(filepath)
+          if digest_index is not None:
+            h = digest_index.hash_file(filepath, filestats, storage.hash_algo)
+          else:
+            h = isolated_format.hash_file(filepath, storage.hash_algo)
           items_to_upload.append(
             FileItem(
                 path=filepath,
                 digest=h,
-                size=fs.stat(filepath).st_size,
+                size=filestats.st_size,
                 high_priority=f.endswith('.isolated')))
           results.append((h, f))
         else:
@@ -2209,7 +2719,9 @@ def archive_files_to_storage(storage, files, blacklist):
       file_path.rmtree(tempdir)
 
 
-def archive(out, namespace, files, blacklist):
+def archive(
+    out, namespace, files, blacklist, digest_index_path=None,
+    chunked_file_size=0):
   if files == ['-']:
     files = sys.stdin.readlines()
 
@@ -2219,8 +2731,10 @@ def archive(out, namespace, files, blacklist):
   files = [f.decode('utf-8') for f in files]
   blacklist = tools.gen_blacklist(blacklist)
   with get_storage(out, namespace) as storage:
-    # Ignore stats.
-    results = archive_files_to_storage(storage, files, blacklist)[0]
+    with isolated_format.DigestIndex(digest_index_path) as digest_index:
+      # Ignore stats.
+      results = archive_files_to_storage(
+          storage, files, blacklist, digest_index, chunked_file_size)[0]
   print('\n'.join('%s %s' % (r[0], r[1]) for r in results))
 
 
@@ -2241,7 +2755,9 @@ def CMDarchive(parser, args):
   options, files = parser.parse_args(args)
   process_isolate_server_options(parser, options, True, True)
   try:
-    archive(options.isolate_server, options.namespace, files, options.blacklist)
+    archive(
+        options.isolate_server, options.namespace, files, options.blacklist,
+        options.digest_index, options.chunked_file_size)
   except Error as e:
     parser.error(e.args[0])
   return 0
@@ -2329,6 +2845,21 @@ def add_archive_options(parser):
       action='append', default=list(DEFAULT_BLACKLIST),
       help='List of regexp to use as blacklist filter when uploading '
            'directories')
+  parser.add_option(
+      '--digest-index',
+      metavar='FILE', default=os.environ.get('ISOLATE_DIGEST_INDEX'),
+      help='File used to remember the hash of files across runs, keyed by '
+           'their inode, size and timestamp. Can be shared by concurrent '
+           'processes. Defaults to the environment variable '
+           'ISOLATE_DIGEST_INDEX if set.')
+  parser.add_option(
+      '--chunked-file-size',
+      type='int', metavar='NNN', default=0,
+      help='Files at least this large are split in content defined chunks '
+           'stored separately, so only the modified chunks of a large file are '
+           'uploaded and downloaded again. The resulting .isolated files '
+           'require clients supporting version %s of the format. Disabled by '
+           'default.' % isolated_format.CHUNKED_ISOLATED_FILE_VERSION)
 
 
 def add_isolate_server_options(parser):
@@ -2405,7 +2936,8 @@ def process_cache_options(options):
     return DiskCache(
         unicode(os.path.abspath(options.cache)),
         policies,
-        isolated_format.get_hash_algo(options.namespace))
+        isolated_format.get_hash_algo(options.namespace),
+        lock=True)
   else:
     return MemoryCache()
 
@@ -0,0 +1,271 @@
+# Copyright 2016 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Manages named caches, directories persisted between tasks on a bot."""
+
+import logging
+import optparse
+import os
+import random
+import re
+import string
+
+from utils import file_path
+from utils import fs
+from utils import lru
+from utils import threading_utils
+
+
+# Keep synced with task_request.py
+CACHE_NAME_RE = re.compile(ur'^[a-z0-9_]{1,4096}$')
+
+
+class Error(Exception):
+  """Named cache specific error."""
+
+
+class CacheManager(object):
+  """Manages cache directories exposed to a task.
+
+  A task can specify that caches should be present on a bot. A cache is a
+  tuple (name, path), where
+    name is a short identifier that describes the contents of the cache, e.g.
+      "git_v8" could be all git repositories required by v8 builds, or
+      "build_chromium" could be build artefacts of the Chromium.
+    path is a directory path relative to the task run dir. The cache directory
+      is moved there before the task runs and moved back once it completes.
+
+  The caches are stored in |root_dir| under short random directory names, which
+  keeps the mapped paths short on Windows. Their order of use is kept in a
+  state.json file, so the least recently used caches are deleted first when the
+  disk runs low on free space.
+
+  Must be used as a context manager.
+  """
+
+  # Characters used to name the cache directories in |root_dir|.
+  _DIR_ALPHABET = string.ascii_letters + string.digits
+
+  def __init__(self, root_dir):
+    """Initializes CacheManager.
+
+    |root_dir| is a directory for persistent cache storage.
+    """
+    assert isinstance(root_dir, unicode), root_dir
+    assert file_path.isabs(root_dir), root_dir
+    self.root_dir = root_dir
+    self._lock = threading_utils.LockWithAssert()
+    # LRU {cache_name -> cache_location}
+    # It is saved to |root_dir|/state.json.
+    self._lru = None
+
+  @property
+  def state_file(self):
+    return os.path.join(self.root_dir, u'state.json')
+
+  def __enter__(self):
+    """Loads the state of the caches from the state file."""
+    self._lock.__enter__()
+    try:
+      file_path.ensure_tree(self.root_dir)
+      self._lru = lru.LRUDict()
+      if fs.isfile(self.state_file):
+        try:
+          self._lru = lru.LRUDict.load(self.state_file)
+        except ValueError as err:
+          logging.error('Failed to load named cache state: %s', err)
+          # The directories are deleted as unknown by the next trim().
+          file_path.try_remove(self.state_file)
+    except:
+      self._lock.__exit__(None, None, None)
+      raise
+    return self
+
+  def __exit__(self, _exc_type, _exc_value, _traceback):
+    """Saves the state of the caches."""
+    try:
+      self._lru.save(self.state_file)
+    finally:
+      self._lru = None
+      self._lock.__exit__(None, None, None)
+    return False
+
+  def __len__(self):
+    """Returns number of items in the cache."""
+    self._lock.assert_locked()
+    return len(self._lru)
+
+  def get_names(self):
+    """Returns the names of the caches present on the bot, sorted."""
+    self._lock.assert_locked()
+    return sorted(self._lru)
+
+  def install(self, path, name):
+    """Moves the directory of cache |name| to |path|.
+
+    |path| must not exist. If the cache does not exist yet, an empty directory
+    is created. The cache is not tracked until it is uninstalled, so it cannot
+    be trimmed while a task is using it.
+
+    Raises Error if the cache cannot be installed.
+    """
+    self._lock.assert_locked()
+    assert isinstance(path, unicode), path
+    if fs.exists(path):
+      raise Error('%s already exists' % path)
+    try:
+      _ensure_parent_writeable(path)
+      if name in self._lru:
+        rel_cache = self._lru.pop(name)
+        abs_cache = os.path.join(self.root_dir, rel_cache)
+        if fs.isdir(abs_cache):
+          logging.info('Moving named cache %r from %r to %r', name, abs_cache,
+                       path)
+          fs.rename(abs_cache, path)
+          return
+        logging.warning('Named cache %r was lost at %r', name, abs_cache)
+      logging.info('Creating empty named cache %r at %r', name, path)
+      fs.mkdir(path)
+    except (OSError, IOError) as ex:
+      raise Error(
+          'cannot install cache named %r at %r: %s' % (name, path, ex))
+
+  def uninstall(self, path, name):
+    """Moves |path| back to the cache directory as cache |name|.
+
+    The cache becomes the most recently used one. Replaces an existing cache of
+    the same name, if any.
+
+    Raises Error if the cache cannot be uninstalled.
+    """
+    self._lock.assert_locked()
+    assert isinstance(path, unicode), path
+    if not fs.isdir(path):
+      logging.warning('Named cache %r at %r is gone', name, path)
+      return
+    try:
+      if name in self._lru:
+        file_path.rmtree(os.path.join(self.root_dir, self._lru.pop(name)))
+      rel_cache = self._allocate_dir()
+      abs_cache = os.path.join(self.root_dir, rel_cache)
+      logging.info('Moving named cache %r from %r to %r', name, path, abs_cache)
+      _ensure_parent_writeable(path)
+      fs.rename(path, abs_cache)
+      self._lru.add(name, rel_cache)
+    except (OSError, IOError) as ex:
+      raise Error(
+          'cannot uninstall cache named %r at %r: %s' % (name, path, ex))
+
+  def trim(self, min_free_space):
+    """Purges unknown directories and least recently used caches.
+
+    Deletes caches until the free disk space is at least |min_free_space|. If 0,
+    the caches can fill the disk.
+
+    Returns:
+      Number of caches deleted.
+    """
+    self._lock.assert_locked()
+    known = set(self._lru.itervalues())
+    known.add(os.path.basename(self.state_file))
+    for i in fs.listdir(self.root_dir):
+      if i not in known:
+        logging.warning('Deleting unknown item %r in named cache', i)
+        self._remove(i)
+
+    trimmed = 0
+    while (
+        min_free_space and
+        self._lru and
+        file_path.get_free_space(self.root_dir) < min_free_space):
+      name, (rel_cache, _) = self._lru.pop_oldest()
+      logging.info('Deleting named cache %r to free disk space', name)
+      self._remove(rel_cache)
+      trimmed += 1
+    return trimmed
+
+  def _allocate_dir(self):
+    """Returns a new unused short directory name in |root_dir|."""
+    abc_len = len(self._DIR_ALPHABET)
+    tried = set()
+    while len(tried) < 1000:
+      i = random.randint(0, abc_len * abc_len - 1)
+      rel_path = (
+        self._DIR_ALPHABET[i / abc_len] +
+        self._DIR_ALPHABET[i % abc_len])
+      if rel_path in tried:
+        continue
+      tried.add(rel_path)
+      if not fs.exists(os.path.join(self.root_dir, rel_path)):
+        return rel_path
+    raise Error('could not allocate a new cache dir, too many cache dirs')
+
+  def _remove(self, rel_path):
+    """Deletes an item in |root_dir|, logging instead of raising on failure."""
+    path = os.path.join(self.root_dir, rel_path)
+    try:
+      if fs.isdir(path):
+        file_path.rmtree(path)
+      else:
+        file_path.try_remove(path)
+    except OSError as ex:
+      logging.error('Failed to delete %r: %s', path, ex)
+
+
+def _ensure_parent_writeable(path):
+  """Makes the parent directory of |path| writeable so it can be renamed.
+
+  The parent directory is created if necessary.
+  """
+  parent = os.path.dirname(path)
+  if fs.isdir(parent):
+    file_path.set_read_only(parent, False)
+  else:
+    file_path.ensure_tree(parent)
+
+
+def add_named_cache_options(parser):
+  group = optparse.OptionGroup(parser, 'Named caches')
+  group.add_option(
+      '--named-cache',
+      dest='named_caches',
+      action='append',
+      nargs=2,
+      default=[],
+      help='A named cache to request. Accepts two arguments, name and path. '
+           'name identifies the cache, must match regex [a-z0-9_]{1,4096}. '
+           'path is a path relative to the run dir where the cache directory '
+           'must be put to. '
+           'This option can be specified more than once.')
+  group.add_option(
+      '--named-cache-root',
+      help='Cache root directory. Default=%default')
+  parser.add_option_group(group)
+
+
+def process_named_cache_options(parser, options):
+  """Validates named cache options and returns a CacheManager."""
+  if options.named_caches and not options.named_cache_root:
+    parser.error('--named-cache is specified, but --named-cache-root is empty')
+  names = set()
+  paths = set()
+  for name, path in options.named_caches:
+    if not CACHE_NAME_RE.match(name):
+      parser.error(
+          'cache name %r does not match %r' % (name, CACHE_NAME_RE.pattern))
+    if not path:
+      parser.error('cache path cannot be empty')
+    normpath = os.path.normpath(path)
+    if (os.path.isabs(path) or normpath == os.pardir or
+        normpath.startswith(os.pardir + os.sep)):
+      parser.error('cache path %r must be relative to the run dir' % path)
+    if name in names:
+      parser.error('cache %r is specified more than once' % name)
+    if normpath in paths:
+      parser.error('cache path %r is specified more than once' % path)
+    names.add(name)
+    paths.add(normpath)
+  if options.named_cache_root:
+    return CacheManager(unicode(os.path.abspath(options.named_cache_root)))
+  return None
@@ -20,26 +20,39 @@ Any ${ISOLATED_OUTDIR} on the command line will be replaced by the location of a
 temporary directory upon execution of the command specified in the .isolated
 file. All content written to this directory will be uploaded upon termination
 and the .isolated file describing this directory will be printed to stdout.
+With --upload-while-running, the files are uploaded as soon as they are
+written, so only the files modified last remain to be uploaded upon termination.
 
 Any ${SWARMING_BOT_FILE} on the command line will be replaced by the value of
 the --bot-file parameter. This file is used by a swarming bot to communicate
 state of the host to tasks. It is written to by the swarming bot's
 on_before_task() hook in the swarming server's custom bot_config.py.
+
+Named caches requested with --named-cache are moved from --named-cache-root into
+the run directory for the duration of the command, and moved back afterward so
+their content is kept for the next task.
+
+With --prefetch, the files of the given isolated trees are only downloaded into
+the cache, so a bot can warm its cache while idle.
 """
 
-__version__ = '0.8.5'
+__version__ = '0.11'
 
 import base64
 import collections
+import contextlib
 import logging
 import optparse
 import os
+import stat
 import sys
 import tempfile
+import threading
 import time
 
 from third_party.depot_tools import fix_encoding
 
+from utils import dir_watcher
 from utils import file_path
 from utils import fs
 from utils import large
@@ -51,7 +64,9 @@ from utils import zip_package
 
 import auth
 import cipd
+import isolated_format
 import isolateserver
+import named_cache
 
 
 # Absolute path to this file (can be None if running from zip on Mac).
@@ -118,6 +133,7 @@ def get_as_zip_package(executable=True):
   package.add_python_file(os.path.join(BASE_DIR, 'isolateserver.py'))
   package.add_python_file(os.path.join(BASE_DIR, 'auth.py'))
   package.add_python_file(os.path.join(BASE_DIR, 'cipd.py'))
+  package.add_python_file(os.path.join(BASE_DIR, 'named_cache.py'))
   package.add_directory(os.path.join(BASE_DIR, 'libs'))
   package.add_directory(os.path.join(BASE_DIR, 'third_party'))
   package.add_directory(os.path.join(BASE_DIR, 'utils'))
@@ -284,12 +300,135 @@ def fetch_and_map(isolated_hash, storage, cache, outdir, use_symlinks):
     'items_cold': base64.b64encode(large.pack(sorted(cache.added))),
     'items_hot': base64.b64encode(
         large.pack(sorted(set(cache.used) - set(cache.added)))),
+    'link_strategies': bundle.link_strategies,
+    'time_to_first_byte': bundle.time_to_first_byte,
+    'time_to_last_byte': bundle.time_to_last_byte,
   }
 
 
-def delete_and_upload(storage, out_dir, leak_temp_dir):
+def prefetch(isolated_hashes, storage, cache, max_size, stop_event):
+  """Downloads the files of isolated trees into |cache| without mapping them.
+
+  Used by the bot to warm its cache with the inputs of the tasks it is likely to
+  run soon. Up to |max_size| bytes are fetched, limited to the free disk space
+  above the min_free_space policy of |cache|. Stops early when |stop_event| is
+  set.
+
+  Failures are logged and ignored, the task fetches what is missing anyway.
+
+  Returns:
+    Number of bytes fetched.
+  """
+  min_free_space = cache.policies.min_free_space
+  max_size = min(
+      max_size, file_path.get_free_space(cache.cache_dir) - min_free_space)
+  fetched = 0
+  for isolated_hash in isolated_hashes:
+    if fetched >= max_size or stop_event.is_set():
+      break
+    try:
+      fetched += isolateserver.prefetch_isolated(
+          isolated_hash, storage, cache, max_size - fetched, stop_event)
+    except (IOError, OSError, isolated_format.IsolatedError) as e:
+      logging.warning('Failed to prefetch %s: %s', isolated_hash, e)
+  return fetched
+
+
+class OutputUploader(object):
+  """Uploads the files written to out_dir while the command is running.
+
+  A background thread hashes and uploads the files once they are closed and
+  were not modified for DigestIndex.RACY_DELAY seconds, so files that are
+  rewritten or deleted shortly after being written are skipped. The digests are
+  kept in |digest_index|, so delete_and_upload() only hashes and uploads the
+  files written or modified after they were uploaded, and the .isolated.
+
+  Uploading is best effort, delete_and_upload() archives the whole out_dir
+  anyway. On Windows, files can't be identified in the DigestIndex, so they are
+  hashed again but not uploaded again.
+  """
+
+  # Maximum time waiting for new files before checking the files not yet old
+  # enough, in seconds.
+  WAIT_INTERVAL = 1.
+
+  def __init__(self, storage, out_dir):
+    self.digest_index = isolated_format.DigestIndex()
+    # FileItem uploaded in the background.
+    self.uploaded = []
+    self._storage = storage
+    self._out_dir = out_dir
+    self._done = threading.Event()
+    self._thread = None
+    # Files reported as written but not yet processed.
+    self._pending = set()
+    # path -> (st_size, st_mtime) of the files processed.
+    self._processed = {}
+
+  def start(self):
+    """Starts watching out_dir in the background."""
+    assert not self._thread
+    self._thread = threading.Thread(
+        target=self._run, name='OutputUploader')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    """Stops watching out_dir and waits for the uploads in progress."""
+    self._done.set()
+    if self._thread:
+      self._thread.join()
+      self._thread = None
+    logging.info(
+        'Uploaded %d files while running', len(self.uploaded))
+
+  def _run(self):
+    try:
+      with dir_watcher.DirWatcher(self._out_dir) as watcher:
+        while not self._done.is_set():
+          self._pending.update(watcher.get_closed_files(self.WAIT_INTERVAL))
+          self._upload_pending()
+    except Exception as e:
+      # The outputs are archived when the command completes anyway.
+      logging.exception('Failed to upload %s while running: %s',
+                        self._out_dir, e)
+
+  def _upload_pending(self):
+    """Hashes and uploads the pending files that are old enough."""
+    items = []
+    now = time.time()
+    for path in sorted(self._pending):
+      if self._done.is_set():
+        break
+      try:
+        st = fs.lstat(path)
+      except OSError:
+        # Deleted.
+        self._pending.discard(path)
+        continue
+      if not stat.S_ISREG(st.st_mode):
+        self._pending.discard(path)
+        continue
+      if st.st_mtime > now - isolated_format.DigestIndex.RACY_DELAY:
+        # Still likely to be modified.
+        continue
+      self._pending.discard(path)
+      key = (st.st_size, st.st_mtime)
+      if self._processed.get(path) == key:
+        continue
+      self._processed[path] = key
+      digest = self.digest_index.hash_file(path, st, self._storage.hash_algo)
+      items.append(
+          isolateserver.FileItem(path=path, digest=digest, size=st.st_size))
+    if items:
+      self.uploaded.extend(self._storage.upload_items(items))
+
+
+def delete_and_upload(storage, out_dir, leak_temp_dir, output_uploader):
   """Deletes the temporary run directory and uploads results back.
 
+  |output_uploader| is the OutputUploader that ran along the command, if any.
+
   Returns:
     tuple(outputs_ref, success, stats)
     - outputs_ref: a dict referring to the results archived back to the isolated
@@ -310,8 +449,16 @@ def delete_and_upload(storage, out_dir, leak_temp_dir):
   if fs.isdir(out_dir) and fs.listdir(out_dir):
     with tools.Profiler('ArchiveOutput'):
       try:
+        digest_index = None
+        if output_uploader:
+          digest_index = output_uploader.digest_index
         results, f_cold, f_hot = isolateserver.archive_files_to_storage(
-            storage, [out_dir], None)
+            storage, [out_dir], None, digest_index)
+        if output_uploader:
+          # The files uploaded while running are found on the server.
+          early = set(i.digest for i in output_uploader.uploaded)
+          f_cold = f_cold + output_uploader.uploaded
+          f_hot = [i for i in f_hot if i.digest not in early]
         outputs_ref = {
           'isolated': results[0][0],
           'isolatedserver': storage.location,
@@ -351,7 +498,7 @@ def delete_and_upload(storage, out_dir, leak_temp_dir):
 def map_and_run(
     command, isolated_hash, storage, isolate_cache, leak_temp_dir, root_dir,
     hard_timeout, grace_period, bot_file, extra_args, install_packages_fn,
-    use_symlinks):
+    use_symlinks, install_named_caches, upload_while_running):
   """Runs a command with optional isolated input/output.
 
   See run_tha_test for argument documentation.
@@ -377,6 +524,9 @@ def map_and_run(
     #      'initial_size': 0,
     #      'items_cold': '<large.pack()>',
     #      'items_hot': '<large.pack()>',
+    #      'link_strategies': {'hardlink': 0, 'reflink': 0},
+    #      'time_to_first_byte': 0.,
+    #      'time_to_last_byte': 0.,
     #    },
     #    'upload': {
     #      'duration': 0.,
@@ -407,6 +557,9 @@ def map_and_run(
   out_dir = make_temp_dir(ISOLATED_OUT_DIR, root_dir) if storage else None
   tmp_dir = make_temp_dir(ISOLATED_TMP_DIR, root_dir)
   cwd = run_dir
+  output_uploader = None
+  if out_dir and upload_while_running:
+    output_uploader = OutputUploader(storage, out_dir)
 
   try:
     cipd_info = install_packages_fn(run_dir)
@@ -441,13 +594,19 @@ def map_and_run(
     command = process_command(command, out_dir, bot_file)
     file_path.ensure_command_has_abs_path(command, cwd)
 
-    sys.stdout.flush()
-    start = time.time()
-    try:
-      result['exit_code'], result['had_hard_timeout'] = run_command(
-          command, cwd, tmp_dir, hard_timeout, grace_period)
-    finally:
-      result['duration'] = max(time.time() - start, 0)
+    # The named caches are moved back before run_dir is deleted below.
+    with install_named_caches(run_dir):
+      sys.stdout.flush()
+      start = time.time()
+      try:
+        if output_uploader:
+          output_uploader.start()
+        result['exit_code'], result['had_hard_timeout'] = run_command(
+            command, cwd, tmp_dir, hard_timeout, grace_period)
+      finally:
+        result['duration'] = max(time.time() - start, 0)
+        if output_uploader:
+          output_uploader.stop()
   except Exception as e:
     # An internal error occurred. Report accordingly so the swarming task will
     # be retried automatically.
@@ -498,7 +657,8 @@ def map_and_run(
       if out_dir:
         isolated_stats = result['stats'].setdefault('isolated', {})
         result['outputs_ref'], success, isolated_stats['upload'] = (
-            delete_and_upload(storage, out_dir, leak_temp_dir))
+            delete_and_upload(
+                storage, out_dir, leak_temp_dir, output_uploader))
       if not success and result['exit_code'] == 0:
         result['exit_code'] = 1
     except Exception as e:
@@ -512,7 +672,8 @@ def map_and_run(
 def run_tha_test(
     command, isolated_hash, storage, isolate_cache, leak_temp_dir, result_json,
     root_dir, hard_timeout, grace_period, bot_file, extra_args,
-    install_packages_fn, use_symlinks):
+    install_packages_fn, use_symlinks, install_named_caches,
+    upload_while_running):
   """Runs an executable and records execution metadata.
 
   Either command or isolated_hash must be specified.
@@ -552,6 +713,10 @@ def run_tha_test(
     install_packages_fn: function (dir) => {"stats": cipd_stats, "pins":
                          cipd_pins}. Installs packages.
     use_symlinks: create tree with symlinks instead of hardlinks.
+    install_named_caches: function (dir) => context manager. Maps the named
+                          caches in the run dir while the command runs.
+    upload_while_running: if true, the files written to the output directory
+                          are uploaded while the command runs.
 
   Returns:
     Process exit code that should be used.
@@ -577,7 +742,7 @@ def run_tha_test(
   result = map_and_run(
       command, isolated_hash, storage, isolate_cache, leak_temp_dir, root_dir,
       hard_timeout, grace_period, bot_file, extra_args, install_packages_fn,
-      use_symlinks)
+      use_symlinks, install_named_caches, upload_while_running)
   logging.info('Result:\n%s', tools.format_json(result, dense=True))
 
   if result_json:
@@ -700,6 +865,39 @@ def install_packages(
   }
 
 
+@contextlib.contextmanager
+def noop_install_named_caches(_run_dir):
+  yield
+
+
+@contextlib.contextmanager
+def install_named_caches(run_dir, cache_manager, caches, min_free_space):
+  """Maps the named caches in |run_dir| for the duration of the context.
+
+  Once the caches are moved back, the least recently used ones are deleted
+  until there is at least |min_free_space| bytes free on the disk.
+
+  Arguments:
+    run_dir: the task run directory.
+    cache_manager: a named_cache.CacheManager.
+    caches: list of (name, path) tuples, with path relative to |run_dir|.
+    min_free_space: free disk space to keep, in bytes.
+  """
+  installed = []
+  try:
+    with cache_manager:
+      for name, path in caches:
+        path = os.path.join(run_dir, unicode(path))
+        cache_manager.install(path, name)
+        installed.append((name, path))
+    yield
+  finally:
+    with cache_manager:
+      for name, path in installed:
+        cache_manager.uninstall(path, name)
+      cache_manager.trim(min_free_space)
+
+
 def create_option_parser():
   parser = logging_utils.OptionParserWithLogging(
       usage='%prog <options> [command to run or extra args]',
@@ -710,6 +908,22 @@ def create_option_parser():
       help='Cleans the cache, trimming it necessary and remove corrupted items '
            'and returns without executing anything; use with -v to know what '
            'was done')
+  parser.add_option(
+      '--max-verify-time', type='float', default=60., metavar='SECS',
+      help='With --clean, maximum time spent hashing cache items to detect '
+           'corruption. Only items that are new or modified since they were '
+           'last verified are hashed, the remaining ones are verified by the '
+           'next --clean. Default: %default')
+  parser.add_option(
+      '--prefetch', action='append', default=[], metavar='HASH',
+      help='Downloads the files of this .isolated into the cache and returns '
+           'without executing anything. Used by the bot to warm its cache '
+           'while idle. Can be specified multiple times')
+  parser.add_option(
+      '--max-prefetch-size', type='int', default=1024*1024*1024,
+      metavar='NNN',
+      help='With --prefetch, maximum number of bytes downloaded. The disk '
+           'space above --min-free-space is never used. Default: %default')
   parser.add_option(
       '--no-clean', action='store_true',
       help='Do not clean the cache automatically on startup. This is meant for '
@@ -731,6 +945,11 @@ def create_option_parser():
       '--bot-file',
       help='Path to a file describing the state of the host. The content is '
            'defined by on_before_task() in bot_config.')
+  parser.add_option(
+      '--upload-while-running', action='store_true',
+      help='Upload the files written to ${ISOLATED_OUTDIR} while the command '
+           'is running instead of only once it completed. Useful for tasks '
+           'producing large outputs')
   data_group = optparse.OptionGroup(parser, 'Data source')
   data_group.add_option(
       '-s', '--isolated',
@@ -742,6 +961,8 @@ def create_option_parser():
 
   cipd.add_cipd_options(parser)
 
+  named_cache.add_named_cache_options(parser)
+
   debug_group = optparse.OptionGroup(parser, 'Debugging')
   debug_group.add_option(
       '--leak-temp-dir',
@@ -763,6 +984,7 @@ def main(args):
   options, args = parser.parse_args(args)
 
   isolated_cache = isolateserver.process_cache_options(options)
+  named_cache_manager = named_cache.process_named_cache_options(parser, options)
   if options.clean:
     if options.isolated:
       parser.error('Can\'t use --isolated with --clean.')
@@ -770,7 +992,36 @@ def main(args):
       parser.error('Can\'t use --isolate-server with --clean.')
     if options.json:
       parser.error('Can\'t use --json with --clean.')
-    isolated_cache.cleanup()
+    if options.named_caches:
+      parser.error('Can\'t use --named-cache with --clean.')
+    # The swarming bot runs the cleanup in the background and terminates it
+    # when a task needs the cache. Save the progress and exit quickly then.
+    stop_event = threading.Event()
+    with subprocess42.set_signal_handler(
+        subprocess42.STOP_SIGNALS, lambda *_: stop_event.set()):
+      isolated_cache.cleanup(options.max_verify_time, stop_event)
+    if named_cache_manager is not None and not stop_event.is_set():
+      with named_cache_manager:
+        named_cache_manager.trim(options.min_free_space)
+    return 0
+  if options.prefetch:
+    if options.isolated or args:
+      parser.error('Can\'t use --isolated or a command with --prefetch.')
+    if not options.cache:
+      parser.error('--prefetch requires --cache.')
+    auth.process_auth_options(parser, options)
+    isolateserver.process_isolate_server_options(parser, options, True, True)
+    storage = isolateserver.get_storage(
+        options.isolate_server, options.namespace)
+    # The swarming bot runs it in the background and terminates it when a task
+    # needs the cache. Complete the pending fetches and exit quickly then.
+    stop_event = threading.Event()
+    with storage:
+      with subprocess42.set_signal_handler(
+          subprocess42.STOP_SIGNALS, lambda *_: stop_event.set()):
+        prefetch(
+            options.prefetch, storage, isolated_cache,
+            options.max_prefetch_size, stop_event)
     return 0
   if not options.no_clean:
     isolated_cache.cleanup()
@@ -801,6 +1052,13 @@ def main(args):
       options.cipd_server, options.cipd_client_package,
       options.cipd_client_version, cache_dir=options.cipd_cache)
 
+  if named_cache_manager is not None:
+    install_named_caches_fn = lambda run_dir: install_named_caches(
+        run_dir, named_cache_manager, options.named_caches,
+        options.min_free_space)
+  else:
+    install_named_caches_fn = noop_install_named_caches
+
   try:
     command = [] if options.isolated else args
     if options.isolate_server:
@@ -813,12 +1071,14 @@ def main(args):
             command, options.isolated, storage, isolated_cache,
             options.leak_temp_dir, options.json, options.root_dir,
             options.hard_timeout, options.grace_period, options.bot_file, args,
-            install_packages_fn, options.use_symlinks)
+            install_packages_fn, options.use_symlinks, install_named_caches_fn,
+            options.upload_while_running)
     return run_tha_test(
         command, options.isolated, None, isolated_cache, options.leak_temp_dir,
         options.json, options.root_dir, options.hard_timeout,
         options.grace_period, options.bot_file, args, install_packages_fn,
-        options.use_symlinks)
+        options.use_symlinks, install_named_caches_fn,
+        options.upload_while_running)
   except cipd.Error as ex:
     print >> sys.stderr, ex.message
     return 1
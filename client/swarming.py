@@ -11,6 +11,7 @@ import collections
 import datetime
 import json
 import logging
+import math
 import optparse
 import os
 import subprocess
@@ -237,6 +238,23 @@ def task_request_to_raw_request(task_request, hide_token):
   return out
 
 
+def _report_trigger_error(msg, result):
+  """Reports a failure to trigger tasks, with the details returned by the
+  server if any.
+  """
+  if result and result.get('error'):
+    # The reply is an error.
+    if result['error'].get('errors'):
+      for err in result['error']['errors']:
+        if err.get('message'):
+          msg += '\nMessage: %s' % err['message']
+        if err.get('debugInfo'):
+          msg += '\nDebug info:\n%s' % err['debugInfo']
+    elif result['error'].get('message'):
+      msg += '\nMessage: %s' % result['error']['message']
+  on_error.report(msg)
+
+
 def swarming_trigger(swarming, raw_request):
   """Triggers a request on the Swarming server and returns the json data.
 
@@ -255,24 +273,40 @@ def swarming_trigger(swarming, raw_request):
 
   result = net.url_read_json(
       swarming + '/api/swarming/v1/tasks/new', data=raw_request)
-  if not result:
-    on_error.report('Failed to trigger task %s' % raw_request['name'])
+  if not result or result.get('error'):
+    _report_trigger_error(
+        'Failed to trigger task %s' % raw_request['name'], result)
     return None
-  if result.get('error'):
-    # The reply is an error.
-    msg = 'Failed to trigger task %s' % raw_request['name']
-    if result['error'].get('errors'):
-      for err in result['error']['errors']:
-        if err.get('message'):
-          msg += '\nMessage: %s' % err['message']
-        if err.get('debugInfo'):
-          msg += '\nDebug info:\n%s' % err['debugInfo']
-    elif result['error'].get('message'):
-      msg += '\nMessage: %s' % result['error']['message']
+  return result
+
+
+def swarming_trigger_batch(swarming, raw_requests):
+  """Triggers multiple requests on the Swarming server at once.
+
+  It's the low-level function.
+
+  Returns:
+    list of the json data as returned by swarming_trigger(), in the same order
+    as |raw_requests|. None on failure, in which case some of the tasks may
+    have been triggered.
 
-    on_error.report(msg)
+  Raises:
+    net.HttpError if the server doesn't support tasks/new_batch. No task was
+    triggered then.
+  """
+  logging.info('Triggering %d tasks', len(raw_requests))
+
+  result = net.url_read_json(
+      swarming + '/api/swarming/v1/tasks/new_batch',
+      data={'items': raw_requests}, raise_404=True)
+  if (not result or result.get('error') or
+      len(result.get('items', [])) != len(raw_requests)):
+    _report_trigger_error(
+        'Failed to trigger tasks %s to %s' % (
+            raw_requests[0]['name'], raw_requests[-1]['name']),
+        result)
     return None
-  return result
+  return result['items']
 
 
 def setup_googletest(env, shards, index):
@@ -286,6 +320,10 @@ def setup_googletest(env, shards, index):
   return env
 
 
+# Maximum number of shards to trigger with a single tasks/new_batch request.
+TRIGGER_BATCH_SIZE = 500
+
+
 def trigger_task_shards(swarming, task_request, shards):
   """Triggers one or many subtasks of a sharded task.
 
@@ -301,13 +339,36 @@ def trigger_task_shards(swarming, task_request, shards):
       req['name'] += ':%s:%s' % (index, shards)
     return req
 
+  def trigger():
+    # Yields the triggered tasks, stops at the first failure.
+    if len(requests) == 1:
+      task = swarming_trigger(swarming, requests[0])
+      if task:
+        yield task
+      return
+    for i in xrange(0, len(requests), TRIGGER_BATCH_SIZE):
+      try:
+        batch = swarming_trigger_batch(
+            swarming, requests[i:i+TRIGGER_BATCH_SIZE])
+      except net.HttpError:
+        # The server doesn't support tasks/new_batch, trigger the shards one by
+        # one.
+        logging.warning('Falling back to triggering the shards one by one')
+        for request in requests[i:]:
+          task = swarming_trigger(swarming, request)
+          if not task:
+            return
+          yield task
+        return
+      if not batch:
+        return
+      for task in batch:
+        yield task
+
   requests = [convert(index) for index in xrange(shards)]
   tasks = {}
   priority_warning = False
-  for index, request in enumerate(requests):
-    task = swarming_trigger(swarming, request)
-    if not task:
-      break
+  for index, (request, task) in enumerate(zip(requests, trigger())):
     logging.info('Request result: %s', task)
     if (not priority_warning and
         task['request']['priority'] != task_request.priority):
@@ -350,6 +411,19 @@ def mint_service_account_token(service_account):
 STATUS_UPDATE_INTERVAL = 15 * 60.
 
 
+# Maximum duration the server holds a 'wait' request for, in seconds.
+MAX_WAIT_SECS = 45
+
+
+# Maximum number of tasks to wait for with a single tasks/wait request.
+COLLECT_BATCH_SIZE = 1000
+
+
+# Maximum number of tasks to fetch the results and output of with a single
+# tasks/results request.
+COLLECT_OUTPUT_BATCH_SIZE = 100
+
+
 class State(object):
   """States in which a task can be.
 
@@ -417,7 +491,9 @@ class TaskOutputCollector(object):
   --task-output-dir is passed).
 
   This object is shared among multiple threads running 'retrieve_results'
-  function, in particular they call 'process_shard_result' method in parallel.
+  function or downloading the outputs of the tasks collected by
+  _yield_results_batched(), in particular they call 'process_shard_result'
+  method in parallel.
   """
 
   def __init__(self, task_output_dir, shard_count):
@@ -555,12 +631,15 @@ def retrieve_results(
   """
   assert timeout is None or isinstance(timeout, float), timeout
   result_url = '%s/api/swarming/v1/task/%s/result' % (base_url, task_id)
+  wait_url = '%s/api/swarming/v1/task/%s/wait' % (base_url, task_id)
   if include_perf:
     result_url += '?include_performance_stats=true'
   output_url = '%s/api/swarming/v1/task/%s/stdout' % (base_url, task_id)
   started = now()
   deadline = started + timeout if timeout else None
   attempt = 0
+  waited = True
+  wait_supported = True
 
   while not should_stop.is_set():
     attempt += 1
@@ -572,10 +651,11 @@ def retrieve_results(
           base_url, attempt)
       return None
 
-    # Do not spin too fast. Spin faster at the beginning though.
-    # Start with 1 sec delay and for each 30 sec of waiting add another second
-    # of delay, until hitting 15 sec ceiling.
-    if attempt > 1:
+    # Do not spin too fast when the server didn't hold the previous request.
+    # Spin faster at the beginning though. Start with 1 sec delay and for each
+    # 30 sec of waiting add another second of delay, until hitting 15 sec
+    # ceiling.
+    if not waited:
       max_delay = min(15, 1 + (current_time - started) / 30.0)
       delay = min(max_delay, deadline - current_time) if deadline else max_delay
       if delay > 0:
@@ -584,14 +664,31 @@ def retrieve_results(
         if should_stop.is_set():
           return None
 
-    # Disable internal retries in net.url_read_json, since we are doing retries
-    # ourselves.
-    # TODO(maruel): We'd need to know if it's a 404 and not retry at all.
-    # TODO(maruel): Sadly, we currently have to poll here. Use hanging HTTP
-    # request on GAE v2.
-    result = net.url_read_json(result_url, retry_50x=False)
+    result = None
+    if wait_supported:
+      # The server holds the request until the task stops running, up to
+      # MAX_WAIT_SECS.
+      wait_secs = MAX_WAIT_SECS
+      if deadline:
+        wait_secs = max(
+            1, min(wait_secs, int(math.ceil(deadline - current_time))))
+      url = '%s?timeout_secs=%d' % (wait_url, wait_secs)
+      if include_perf:
+        url += '&include_performance_stats=true'
+      # Disable internal retries in net.url_read_json, since we are doing
+      # retries ourselves.
+      try:
+        result = net.url_read_json(url, retry_50x=False, raise_404=True)
+      except net.HttpError:
+        # The server doesn't support 'wait', don't try again.
+        logging.info('Falling back to polling %s', result_url)
+        wait_supported = False
+    waited = bool(result)
     if not result:
-      continue
+      # Fall back to a plain read.
+      result = net.url_read_json(result_url, retry_50x=False)
+      if not result:
+        continue
 
     if result.get('error'):
       # An error occurred.
@@ -620,6 +717,171 @@ def retrieve_results(
       return result
 
 
+def _wait_for_tasks(base_url, task_ids, wait_secs):
+  """Waits for any of the tasks to stop running.
+
+  Only the first COLLECT_BATCH_SIZE tasks are waited for, the other ones are
+  only checked.
+
+  Returns:
+    list of the IDs of the tasks that are not running anymore. None on failure.
+
+  Raises:
+    net.HttpError if the server doesn't support tasks/wait.
+  """
+  done = []
+  for i in xrange(0, len(task_ids), COLLECT_BATCH_SIZE):
+    result = net.url_read_json(
+        base_url + '/api/swarming/v1/tasks/wait',
+        data={
+          'task_ids': task_ids[i:i+COLLECT_BATCH_SIZE],
+          'timeout_secs': 0 if i else wait_secs,
+        },
+        retry_50x=False,
+        raise_404=True)
+    if not result or result.get('error'):
+      logging.warning('Failed to wait for tasks: %s', result)
+      return None
+    done.extend(r['task_id'] for r in result.get('items', []))
+  return done
+
+
+def _get_results(base_url, task_ids, include_perf):
+  """Returns the results of the tasks, including their output, in the same order
+  as task_ids. None on failure.
+
+  Raises net.HttpError if the server doesn't support tasks/results.
+  """
+  out = []
+  for i in xrange(0, len(task_ids), COLLECT_OUTPUT_BATCH_SIZE):
+    result = net.url_read_json(
+        base_url + '/api/swarming/v1/tasks/results',
+        data={
+          'include_output': True,
+          'include_performance_stats': include_perf,
+          'task_ids': task_ids[i:i+COLLECT_OUTPUT_BATCH_SIZE],
+        },
+        retry_50x=False,
+        raise_404=True)
+    if not result or result.get('error'):
+      logging.warning('Failed to get the tasks results: %s', result)
+      return None
+    out.extend(result.get('items', []))
+  return out
+
+
+def _yield_results_batched(
+    base_url, task_ids, timeout, max_threads, print_status_updates,
+    output_collector, include_perf):
+  """Implements yield_results() for multiple tasks with a single poller.
+
+  It tracks the set of tasks still running, waits for any of them to stop with
+  tasks/wait then fetches the results and output of the ones that stopped with
+  tasks/results. The outputs too large to be sent by tasks/results and the
+  output files of the tasks are fetched in parallel by up to |max_threads|
+  threads.
+
+  Raises:
+    net.HttpError if the server doesn't support tasks/wait or tasks/results.
+  """
+  number_threads = (
+      min(max_threads, len(task_ids)) if max_threads else len(task_ids))
+  with threading_utils.ThreadPool(0, number_threads, 0) as pool:
+    for shard_index, result in _yield_results_batched_with_pool(
+        base_url, task_ids, timeout, print_status_updates, output_collector,
+        include_perf, pool):
+      yield shard_index, result
+
+
+def _process_results(pool, base_url, output_collector, items):
+  """Completes the (shard_index, result) in |items| in parallel on |pool|.
+
+  The outputs omitted by tasks/results are fetched, then the results are passed
+  to output_collector.process_shard_result(), which fetches the output files.
+
+  Yields:
+    (shard_index, result) as soon as they are processed.
+  """
+  channel = threading_utils.TaskChannel()
+  def process(shard_index, result):
+    if result.pop('output_omitted', False):
+      out = net.url_read_json(
+          '%s/api/swarming/v1/task/%s/stdout' % (base_url, result['task_id']))
+      result['output'] = out.get('output') if out else out
+    if output_collector:
+      output_collector.process_shard_result(shard_index, result)
+    return shard_index, result
+  for shard_index, result in items:
+    pool.add_task(0, channel.wrap_task(process), shard_index, result)
+  for _ in items:
+    yield channel.pull()
+
+
+def _yield_results_batched_with_pool(
+    base_url, task_ids, timeout, print_status_updates, output_collector,
+    include_perf, pool):
+  """Implements _yield_results_batched() with the thread pool |pool|."""
+  # Maps the task ID of each task still running to its shard index.
+  pending = collections.OrderedDict()
+  for shard_index, task_id in enumerate(task_ids):
+    pending.setdefault(task_id, shard_index)
+  started = now()
+  deadline = started + timeout if timeout else None
+  last_update = started
+  backoff = False
+  while pending:
+    # Waiting for too long -> give up.
+    current_time = now()
+    if deadline and current_time >= deadline:
+      logging.error('yield_results(%s) timed out', base_url)
+      return
+
+    if print_status_updates and (
+        current_time - last_update >= STATUS_UPDATE_INTERVAL):
+      print(
+          'Waiting for results from the following shards: %s' %
+          ', '.join(str(i) for i in pending.itervalues()))
+      sys.stdout.flush()
+      last_update = current_time
+
+    # Do not spin too fast when the server didn't hold the previous request,
+    # same as in retrieve_results().
+    if backoff:
+      max_delay = min(15, 1 + (current_time - started) / 30.0)
+      delay = min(max_delay, deadline - current_time) if deadline else max_delay
+      if delay > 0:
+        logging.debug('Waiting %.1f sec before retrying', delay)
+        time.sleep(delay)
+
+    wait_secs = MAX_WAIT_SECS
+    if deadline:
+      wait_secs = max(
+          1, min(wait_secs, int(math.ceil(deadline - current_time))))
+    done = _wait_for_tasks(base_url, pending.keys(), wait_secs)
+    results = None
+    if done:
+      results = _get_results(base_url, done, include_perf)
+      backoff = results is None
+    else:
+      # The server held the request, unless it failed or the tasks were only
+      # checked.
+      backoff = done is None or len(pending) > COLLECT_BATCH_SIZE
+    items = []
+    for task_id, result in zip(done or [], results or []):
+      result.setdefault('output', None)
+      items.append((pending.pop(task_id), result))
+    if output_collector or any(r.get('output_omitted') for _, r in items):
+      # Fetches the outputs and output files of the tasks in parallel.
+      items = _process_results(pool, base_url, output_collector, items)
+    for shard_index, result in items:
+      if result.get('internal_failure'):
+        logging.error('Internal error!')
+      elif result['state'] == 'BOT_DIED':
+        logging.error('Bot died!')
+      last_update = current_time
+      yield shard_index, result
+
+
 def convert_to_old_format(result):
   """Converts the task result data from Endpoints API format to old API format
   for compatibility.
@@ -676,9 +938,10 @@ def yield_results(
   Timed out shards are NOT yielded at all. Caller can compare number of yielded
   shards with len(task_keys) to verify all shards completed.
 
-  max_threads is optional and is used to limit the number of parallel fetches
-  done. Since in general the number of task_keys is in the range <=10, it's not
-  worth normally to limit the number threads. Mostly used for testing purposes.
+  Multiple tasks are collected by a single poller, see
+  _yield_results_batched(), unless the server doesn't support it. max_threads
+  is optional and is used to limit the number of parallel fetches. Mostly used
+  for testing purposes.
 
   output_collector is an optional instance of TaskOutputCollector that will be
   used to fetch files produced by a task from isolate server to the local disk.
@@ -687,8 +950,27 @@ def yield_results(
     (index, result). In particular, 'result' is defined as the
     GetRunnerResults() function in services/swarming/server/test_runner.py.
   """
+  # Shards to retrieve one by one.
+  shards = range(len(task_ids))
+  if len(task_ids) > 1:
+    started = now()
+    try:
+      for shard_index, result in _yield_results_batched(
+          swarm_base_url, task_ids, timeout, max_threads, print_status_updates,
+          output_collector, include_perf):
+        shards.remove(shard_index)
+        yield shard_index, result
+      return
+    except net.HttpError:
+      # The server doesn't support collecting tasks at once.
+      logging.warning('Falling back to collecting the shards one by one')
+    if timeout:
+      timeout -= now() - started
+      if timeout <= 0:
+        return
+
   number_threads = (
-      min(max_threads, len(task_ids)) if max_threads else len(task_ids))
+      min(max_threads, len(shards)) if max_threads else len(shards))
   should_stop = threading.Event()
   results_channel = threading_utils.TaskChannel()
 
@@ -703,12 +985,12 @@ def yield_results(
             task_id, timeout, should_stop, output_collector, include_perf)
 
       # Enqueue 'retrieve_results' calls for each shard key to run in parallel.
-      for shard_index, task_id in enumerate(task_ids):
-        enqueue_retrieve_results(shard_index, task_id)
+      for shard_index in shards:
+        enqueue_retrieve_results(shard_index, task_ids[shard_index])
 
       # Wait for all of them to finish.
-      shards_remaining = range(len(task_ids))
-      active_task_count = len(task_ids)
+      shards_remaining = shards[:]
+      active_task_count = len(shards)
       while active_task_count:
         shard_index, result = None, None
         try:
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Copyright 2016 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import logging
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'third_party'))
+
+from depot_tools import auto_stub
+from depot_tools import fix_encoding
+from utils import dir_watcher
+from utils import file_path
+
+
+def write_file(path, content):
+  with open(path, 'wb') as f:
+    f.write(content)
+
+
+class DirWatcherTest(auto_stub.TestCase):
+  def setUp(self):
+    super(DirWatcherTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'dir_watcher_test')
+
+  def tearDown(self):
+    try:
+      file_path.rmtree(self.tempdir)
+    finally:
+      super(DirWatcherTest, self).tearDown()
+
+  def get_all(self, watcher, count):
+    """Returns the files reported until |count| of them are found."""
+    found = set()
+    for _ in xrange(50):
+      found.update(watcher.get_closed_files(0.1))
+      if len(found) >= count:
+        break
+    return sorted(found)
+
+  def check_watcher(self, watcher, uses_inotify):
+    existing = os.path.join(self.tempdir, u'existing')
+    with watcher:
+      self.assertEqual(uses_inotify, watcher.uses_inotify)
+      self.assertEqual([existing], self.get_all(watcher, 1))
+      self.assertEqual([], watcher.get_closed_files(0))
+
+      # A new file and a file in a new subdirectory.
+      sub = os.path.join(self.tempdir, u'sub')
+      os.mkdir(sub)
+      if sys.platform != 'win32':
+        # Symlinks are not reported.
+        os.symlink(existing, os.path.join(sub, u'link'))
+      write_file(os.path.join(sub, u'b'), 'b')
+      write_file(os.path.join(self.tempdir, u'a'), 'a')
+      self.assertEqual(
+          [os.path.join(self.tempdir, u'a'), os.path.join(sub, u'b')],
+          self.get_all(watcher, 2))
+
+  def test_inotify(self):
+    if not sys.platform.startswith('linux'):
+      self.skipTest('inotify is only supported on linux')
+    write_file(os.path.join(self.tempdir, u'existing'), 'foo')
+    self.check_watcher(dir_watcher.DirWatcher(self.tempdir), True)
+
+  def test_inotify_open_file(self):
+    if not sys.platform.startswith('linux'):
+      self.skipTest('inotify is only supported on linux')
+    with dir_watcher.DirWatcher(self.tempdir) as watcher:
+      self.assertTrue(watcher.uses_inotify)
+      path = os.path.join(self.tempdir, u'a')
+      with open(path, 'wb') as f:
+        f.write('a')
+        f.flush()
+        # The file is reported only once closed.
+        self.assertEqual([], watcher.get_closed_files(0.1))
+      self.assertEqual([path], watcher.get_closed_files(1))
+
+  def test_poll(self):
+    self.mock(dir_watcher, '_load_inotify', lambda: None)
+    write_file(os.path.join(self.tempdir, u'existing'), 'foo')
+    self.check_watcher(
+        dir_watcher.DirWatcher(self.tempdir, poll_interval=0), False)
+
+  def test_poll_modified(self):
+    self.mock(dir_watcher, '_load_inotify', lambda: None)
+    path = os.path.join(self.tempdir, u'a')
+    write_file(path, 'a')
+    with dir_watcher.DirWatcher(self.tempdir, poll_interval=0) as watcher:
+      self.assertEqual([], watcher.get_closed_files(0))
+      self.assertEqual([path], watcher.get_closed_files(0))
+      self.assertEqual([], watcher.get_closed_files(0))
+      # A modification is reported once it is stable.
+      write_file(path, 'bb')
+      self.assertEqual([], watcher.get_closed_files(0))
+      self.assertEqual([path], watcher.get_closed_files(0))
+
+
+if __name__ == '__main__':
+  fix_encoding.fix_encoding()
+  VERBOSE = '-v' in sys.argv
+  logging.basicConfig(level=logging.DEBUG if VERBOSE else logging.ERROR)
+  unittest.main()
@@ -4,6 +4,7 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import errno
 import getpass
 import logging
 import os
@@ -180,6 +181,62 @@ class FilePathTest(auto_stub.TestCase):
     # must be reset to be read-only after deleting one of the hard link
     # directory entry.
 
+  def test_copy_file(self):
+    src = os.path.join(self.tempdir, u'src')
+    content = os.urandom(3 * 1024 * 1024 + 1)
+    write_content(src, content)
+    functions = file_path._COPY_FUNCTIONS
+    strategies = [file_path.COPY_PYTHON]
+    if sys.platform.startswith('linux'):
+      strategies.extend(s for s, _ in functions)
+    used = set()
+    for strategy in strategies:
+      # Only keep |strategy| and the python fallback.
+      self.mock(
+          file_path, '_COPY_FUNCTIONS',
+          [f for f in functions if f[0] == strategy])
+      dst = os.path.join(self.tempdir, strategy)
+      used.add(file_path.copy_file(dst, src))
+      with fs.open(dst, 'rb') as f:
+        self.assertEqual(content, f.read())
+    # The file system of tempdir may not support reflinks.
+    used.discard(file_path.COPY_REFLINK)
+    self.assertEqual(set(strategies) - set([file_path.COPY_REFLINK]), used)
+
+  def test_copy_file_fallback(self):
+    if not sys.platform.startswith('linux'):
+      return
+    def broken(_libc, dst_fd, _src_fd, _size):
+      os.write(dst_fd, 'partial')
+      raise OSError(errno.EXDEV, 'Cross-device link')
+    self.mock(file_path, '_COPY_FUNCTIONS', [('broken', broken)])
+    src = os.path.join(self.tempdir, u'src')
+    dst = os.path.join(self.tempdir, u'dst')
+    write_content(src, 'content')
+    os.chmod(src, 0500)
+    self.assertEqual(
+        file_path.COPY_PYTHON, file_path.link_file(dst, src, file_path.COPY))
+    with fs.open(dst, 'rb') as f:
+      self.assertEqual('content', f.read())
+    self.assertFileMode(dst, 0100544, umask=0)
+
+  def test_lock_file(self):
+    path = os.path.join(self.tempdir, u'lock')
+    f = file_path.lock_file(path)
+    # Another process waits for the lock to be released.
+    proc = subprocess.Popen(
+        [
+          sys.executable, '-c',
+          'import sys; sys.path.insert(0, %r); from utils import file_path; '
+          'file_path.lock_file(%r); print(\'locked\')' % (ROOT_DIR, path),
+        ],
+        stdout=subprocess.PIPE)
+    time.sleep(0.5)
+    self.assertEqual(None, proc.poll())
+    f.close()
+    self.assertEqual('locked', proc.communicate()[0].strip())
+    self.assertEqual(0, proc.returncode)
+
   def test_rmtree_unicode(self):
     subdir = os.path.join(self.tempdir, 'hi')
     fs.mkdir(subdir)
@@ -26,15 +26,30 @@ class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
   def _read_body(self):
     """Reads the request body."""
-    return self.rfile.read(int(self.headers['Content-Length']))
+    return ''.join(self._iter_body())
 
   def _drop_body(self):
     """Reads the request body."""
+    for _ in self._iter_body():
+      pass
+
+  def _iter_body(self):
+    """Yields the request body in chunks, supports chunked transfer encoding."""
+    if self.headers.get('Transfer-Encoding') == 'chunked':
+      while True:
+        size = int(self.rfile.readline().split(';', 1)[0], 16)
+        if not size:
+          # Skip the trailer.
+          while self.rfile.readline() not in ('\r\n', '\n', ''):
+            pass
+          return
+        yield self.rfile.read(size)
+        self.rfile.readline()
     size = int(self.headers['Content-Length'])
     while size:
-      chunk = min(4096, size)
-      self.rfile.read(chunk)
-      size -= chunk
+      chunk = self.rfile.read(min(4096, size))
+      yield chunk
+      size -= len(chunk)
 
   def log_message(self, fmt, *args):
     logging.info(
@@ -282,6 +282,8 @@ class IsolateLoad(IsolateBase):
       outdir = os.path.join(self.directory, 'outdir')
       isolate = isolate_file
       blacklist = list(isolateserver.DEFAULT_BLACKLIST)
+      chunked_file_size = 0
+      digest_index = None
       path_variables = {}
       config_variables = {
         'OS': 'linux',
@@ -1425,6 +1427,55 @@ class IsolateCommand(IsolateBase):
     }
     self.assertEqual(expected_json, tools.read_json('json_output.json'))
 
+  def test_CMDbatcharchive_shared_files(self):
+    # A file shared by multiple trees is only hashed once and a broken tree
+    # doesn't affect the others.
+    uploaded = []
+    def mocked_upload_tree(base_url, infiles, namespace):
+      uploaded.append(sorted(p for p, m in infiles if 'priority' not in m))
+    self.mock(isolateserver, 'upload_tree', mocked_upload_tree)
+    hashed = []
+    hash_file = isolated_format.hash_file
+    def mocked_hash_file(filepath, algo):
+      hashed.append(filepath)
+      return hash_file(filepath, algo)
+    self.mock(isolated_format, 'hash_file', mocked_hash_file)
+
+    def join(*path):
+      return os.path.join(self.cwd, *path)
+
+    for name in ('foo', 'bar'):
+      with open(join(name), 'wb') as f:
+        f.write(name)
+    targets = {'x': ['foo', 'bar'], 'y': ['foo'], 'z': ['missing']}
+    for target, files in sorted(targets.iteritems()):
+      with open(join('%s.isolate' % target), 'wb') as f:
+        f.write(str({'variables': {'files': files}}))
+      with open(join('%s.isolated.gen.json' % target), 'wb') as f:
+        json.dump({
+          'args': [
+            '-i', join('%s.isolate' % target),
+            '-s', join('%s.isolated' % target),
+          ],
+          'dir': self.cwd,
+          'version': 1,
+        }, f)
+
+    self.mock(sys, 'stdout', cStringIO.StringIO())
+    cmd = [
+      '--isolate-server', 'http://localhost:1',
+      '--dump-json', 'json_output.json',
+    ] + [join('%s.isolated.gen.json' % t) for t in sorted(targets)]
+    self.mock(logging, 'exception', lambda *_: None)
+    self.assertEqual(
+        isolate.EXIT_CODE_ISOLATE_ERROR,
+        isolate.CMDbatcharchive(logging_utils.OptionParserWithLogging(), cmd))
+    self.assertEqual([join('bar'), join('foo')], sorted(hashed))
+    self.assertEqual([[join('bar'), join('foo'), join('foo')]], uploaded)
+    actual = tools.read_json('json_output.json')
+    self.assertEqual(['x', 'y', 'z'], sorted(actual))
+    self.assertEqual(None, actual['z'])
+
   def test_CMDcheck_empty(self):
     isolate_file = os.path.join(self.cwd, 'x.isolate')
     isolated_file = os.path.join(self.cwd, 'x.isolated')
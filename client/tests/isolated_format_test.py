@@ -7,8 +7,10 @@ import hashlib
 import json
 import logging
 import os
+import StringIO
 import sys
 import tempfile
+import time
 import unittest
 
 # net_utils adjusts sys.path.
@@ -144,6 +146,180 @@ class SymlinkTest(unittest.TestCase):
       actual = isolated_format.expand_symlinks(src, u'out/foo/bar.txt')
       self.assertEqual((u'out/foo/bar.txt', []), actual)
 
+    def test_files_to_metadata(self):
+      files = []
+      for i in xrange(5):
+        path = os.path.join(self.cwd, u'file%d' % i)
+        with open(path, 'wb') as f:
+          f.write('a' * i)
+        os.chmod(path, 0644)
+        files.append(path)
+      os.symlink('file0', os.path.join(self.cwd, u'link'))
+      # Reuse the hash of file1 since its size and timestamp didn't change.
+      t = int(round(os.stat(files[1]).st_mtime))
+      prevdicts = [{}, {'h': 'cached', 's': 1, 't': t}, {}, {}, {}]
+      old_batch_size = isolated_format.STAT_BATCH_SIZE
+      isolated_format.STAT_BATCH_SIZE = 2
+      try:
+        actual = isolated_format.files_to_metadata(
+            zip(files, prevdicts) + [(os.path.join(self.cwd, u'link'), {})],
+            1, ALGO)
+      finally:
+        isolated_format.STAT_BATCH_SIZE = old_batch_size
+      for i in actual:
+        i.pop('t')
+      expected = [
+        {'h': ALGO('a' * i).hexdigest(), 'm': 0440, 's': i} for i in xrange(5)
+      ]
+      expected[1]['h'] = 'cached'
+      expected.append({'l': u'file0'})
+      self.assertEqual(expected, actual)
+
+
+class DigestIndexTest(auto_stub.TestCase):
+  def setUp(self):
+    super(DigestIndexTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'isolated_format')
+    self.index_path = os.path.join(self.tempdir, u'index', u'digests.json')
+    self.hashed = []
+    hash_file = isolated_format.hash_file
+    def hash_file_mock(filepath, algo):
+      self.hashed.append(os.path.basename(filepath))
+      return hash_file(filepath, algo)
+    self.mock(isolated_format, 'hash_file', hash_file_mock)
+
+  def tearDown(self):
+    try:
+      file_path.rmtree(self.tempdir)
+    finally:
+      super(DigestIndexTest, self).tearDown()
+
+  def _write(self, name, content, age=60):
+    path = os.path.join(self.tempdir, name)
+    with open(path, 'wb') as f:
+      f.write(content)
+    t = time.time() - age
+    os.utime(path, (t, t))
+    return path
+
+  def test_files_to_metadata(self):
+    files = [(self._write(u'a', 'a'), {}), (self._write(u'b', 'bb'), {})]
+    with isolated_format.DigestIndex(self.index_path) as index:
+      first = isolated_format.files_to_metadata(files, 0, ALGO, index)
+    self.assertEqual([u'b', u'a'], self.hashed)
+    # A new run only hashes the modified file.
+    files.append((self._write(u'a', 'A'), {}))
+    with isolated_format.DigestIndex(self.index_path) as index:
+      second = isolated_format.files_to_metadata(files[1:], 0, ALGO, index)
+      self.assertEqual(
+          second[0]['h'],
+          index.hash_file(files[1][0], os.stat(files[1][0]), ALGO))
+    self.assertEqual([u'b', u'a', u'a'], self.hashed)
+    self.assertEqual(first[1], second[0])
+    self.assertEqual(ALGO('A').hexdigest(), second[1]['h'])
+    index = isolated_format.DigestIndex(self.index_path)
+    index.load()
+    self.assertEqual(3, len(index))
+
+  def test_recently_modified(self):
+    path = self._write(u'a', 'a', age=0)
+    index = isolated_format.DigestIndex()
+    isolated_format.file_to_metadata(path, {}, 0, ALGO, index)
+    isolated_format.file_to_metadata(path, {}, 0, ALGO, index)
+    self.assertEqual([u'a', u'a'], self.hashed)
+    self.assertEqual(0, len(index))
+
+  def test_save_merge_and_trim(self):
+    index1 = isolated_format.DigestIndex(self.index_path, max_items=2)
+    index2 = isolated_format.DigestIndex(self.index_path, max_items=2)
+    paths = [self._write(u'%d' % i, str(i)) for i in xrange(3)]
+    index1.hash_file(paths[0], os.stat(paths[0]), ALGO)
+    index2.hash_file(paths[1], os.stat(paths[1]), ALGO)
+    index1.save()
+    index2.save()
+    # Both processes' entries were kept.
+    self.assertEqual(2, len(index2))
+    index1.hash_file(paths[2], os.stat(paths[2]), ALGO)
+    index1.save()
+    # The least recently used entry was evicted.
+    index = isolated_format.DigestIndex(self.index_path)
+    index.load()
+    self.assertEqual(None, index.get(os.stat(paths[0]), ALGO))
+    self.assertEqual(
+        ALGO('1').hexdigest(), index.get(os.stat(paths[1]), ALGO))
+    self.assertEqual(
+        ALGO('2').hexdigest(), index.get(os.stat(paths[2]), ALGO))
+
+  def test_broken_file(self):
+    os.mkdir(os.path.dirname(self.index_path))
+    with open(self.index_path, 'wb') as f:
+      f.write('{"items":')
+    path = self._write(u'a', 'a')
+    with isolated_format.DigestIndex(self.index_path) as index:
+      index.hash_file(path, os.stat(path), ALGO)
+    with isolated_format.DigestIndex(self.index_path) as index:
+      self.assertEqual(ALGO('a').hexdigest(), index.get(os.stat(path), ALGO))
+
+
+class ChunkingTest(auto_stub.TestCase):
+  def setUp(self):
+    super(ChunkingTest, self).setUp()
+    self.mock(isolated_format, 'CHUNK_MASK', 0x3)
+    self.mock(isolated_format, 'CHUNK_MIN_SIZE', 64)
+    self.mock(isolated_format, 'CHUNK_MAX_SIZE', 1024)
+    self.mock(isolated_format, 'DISK_FILE_CHUNK', 100)
+
+  @staticmethod
+  def _chunks(content):
+    return list(isolated_format.iter_file_chunks(StringIO.StringIO(content)))
+
+  def test_iter_file_chunks(self):
+    content = ''.join(
+        chr(i % 251) + ('Z' if i % 7 == 0 else '') for i in xrange(20000))
+    chunks = self._chunks(content)
+    self.assertEqual(content, ''.join(chunks))
+    self.assertTrue(len(chunks) > 20)
+    for c in chunks[:-1]:
+      self.assertTrue(64 <= len(c) <= 1024, len(c))
+    # Inserting data only modifies the chunks around it.
+    modified = self._chunks(content[:10000] + 'inserted' + content[10000:])
+    self.assertEqual(content[:10000] + 'inserted' + content[10000:],
+        ''.join(modified))
+    self.assertEqual(chunks[:3], modified[:3])
+    self.assertEqual(chunks[-3:], modified[-3:])
+    self.assertTrue(len(set(chunks) - set(modified)) <= 3)
+
+  def test_iter_file_chunks_max_size(self):
+    self.assertEqual(['a' * 1024] * 2 + ['a'], self._chunks('a' * 2049))
+    self.assertEqual([], self._chunks(''))
+
+  def test_hash_file_chunks(self):
+    tempdir = tempfile.mkdtemp(prefix=u'isolated_format')
+    try:
+      path = os.path.join(tempdir, u'a')
+      content = ''.join(chr(i % 256) for i in xrange(5000))
+      with open(path, 'wb') as f:
+        f.write(content)
+      digest, chunks = isolated_format.hash_file_chunks(path, ALGO)
+      self.assertEqual(ALGO(content).hexdigest(), digest)
+      expected = [
+        [ALGO(c).hexdigest(), len(c)] for c in self._chunks(content)
+      ]
+      self.assertEqual(expected, chunks)
+      self.assertEqual(5000, sum(s for _, s in chunks))
+
+      metadata = isolated_format.file_to_metadata(
+          path, {}, 0, ALGO, chunked_file_size=1000)
+      self.assertEqual(digest, metadata['h'])
+      self.assertEqual(chunks, metadata['c'])
+      # Small files are not chunked.
+      metadata = isolated_format.file_to_metadata(
+          path, {}, 0, ALGO, chunked_file_size=10000)
+      self.assertEqual(digest, metadata['h'])
+      self.assertNotIn('c', metadata)
+    finally:
+      file_path.rmtree(tempdir)
+
 
 class TestIsolated(auto_stub.TestCase):
   def test_load_isolated_empty(self):
@@ -210,6 +386,50 @@ class TestIsolated(auto_stub.TestCase):
     with self.assertRaises(isolated_format.IsolatedError):
       isolated_format.load_isolated(json.dumps(data), isolateserver_mock.ALGO)
 
+  def test_load_isolated_chunked(self):
+    h = u'0123456789abcdef0123456789abcdef01234567'
+    good = {
+      u'h': h,
+      u's': 5,
+      u't': u'chunked',
+      u'c': [[h, 2], [h, 3]],
+    }
+    data = {
+      u'files': {u'a': good},
+      u'version': isolated_format.CHUNKED_ISOLATED_FILE_VERSION,
+    }
+    m = isolated_format.load_isolated(json.dumps(data), isolateserver_mock.ALGO)
+    self.assertEqual(data, m)
+    bad = [
+      {u't': u'basic'},
+      {u'c': []},
+      {u'c': [[h, 2], [h, 2]]},
+      {u'c': [[u'invalid', 2], [h, 3]]},
+      {u'c': [[h, u'2'], [h, 3]]},
+    ]
+    for b in bad:
+      item = good.copy()
+      item.update(b)
+      data[u'files'][u'a'] = item
+      with self.assertRaises(isolated_format.IsolatedError):
+        isolated_format.load_isolated(
+            json.dumps(data), isolateserver_mock.ALGO)
+    del good[u'c']
+    data[u'files'][u'a'] = good
+    with self.assertRaises(isolated_format.IsolatedError):
+      isolated_format.load_isolated(json.dumps(data), isolateserver_mock.ALGO)
+
+  def test_get_isolated_file_version(self):
+    h = u'0123456789abcdef0123456789abcdef01234567'
+    files = {u'a': {u'h': h, u's': 5}, u'b': {u'l': u'a'}}
+    self.assertEqual(
+        isolated_format.ISOLATED_FILE_VERSION,
+        isolated_format.get_isolated_file_version(files))
+    files[u'c'] = {u'h': h, u's': 5, u't': u'chunked', u'c': [[h, 5]]}
+    self.assertEqual(
+        isolated_format.CHUNKED_ISOLATED_FILE_VERSION,
+        isolated_format.get_isolated_file_version(files))
+
   def test_load_isolated_path(self):
     # Automatically convert the path case.
     wrong_path_sep = u'\\' if os.path.sep == '/' else u'/'
@@ -15,6 +15,8 @@ import os
 import StringIO
 import sys
 import tempfile
+import threading
+import types
 import unittest
 import urllib
 import zlib
@@ -138,7 +140,10 @@ class MockedStorageApi(isolateserver.StorageApi):
     return self._namespace
 
   def push(self, item, push_state, content=None):
-    content = ''.join(item.content() if content is None else content)
+    content = item.content if content is None else content
+    if callable(content):
+      content = content()
+    content = ''.join(content)
     self.push_calls.append((item, push_state, content))
     if self.push_side_effect:
       self.push_side_effect()
@@ -251,15 +256,22 @@ class UtilsTest(TestCase):
       # Copy as not readonly
       cp = os.path.join(tmpoutdir, u'cp')
       with fs.open(infile, 'rb') as f:
-        isolateserver.putfile(f, cp, file_mode=0755)
+        strategy = isolateserver.putfile(f, cp, file_mode=0755)
+      self.assertIn(
+          strategy,
+          (file_path.COPY_REFLINK, file_path.COPY_FILE_RANGE,
+            file_path.COPY_SENDFILE, file_path.COPY_PYTHON))
       self.assertEqual(True, fs.exists(cp))
       self.assertEqual(False, fs.islink(cp))
+      if sys.platform != 'win32':
+        self.assertNotEqual(fs.stat(infile).st_ino, fs.stat(cp).st_ino)
       self.assertFile(cp, 'data')
 
       # Use hardlink
       hl = os.path.join(tmpoutdir, u'hl')
       with fs.open(infile, 'rb') as f:
-        isolateserver.putfile(f, hl, use_symlink=False)
+        self.assertEqual(
+            'hardlink', isolateserver.putfile(f, hl, use_symlink=False))
       self.assertEqual(True, fs.exists(hl))
       self.assertEqual(False, fs.islink(hl))
       self.assertFile(hl, 'data')
@@ -307,6 +319,40 @@ class StorageTest(TestCase):
     batches = list(isolateserver.batch_items_for_check(items))
     self.assertEqual(batches, expected)
 
+  def test_batch_items_for_check_window(self):
+    self.mock(isolateserver, 'CONTAINS_SORT_WINDOW', 3)
+    self.mock(isolateserver, 'ITEMS_PER_CONTAINS_QUERIES', (2, 4))
+    items = [isolateserver.Item(str(i), i) for i in xrange(7)]
+    consumed = []
+    def gen():
+      for item in items:
+        consumed.append(item)
+        yield item
+    batches = isolateserver.batch_items_for_check(gen())
+    # The first batch only needs the first window.
+    self.assertEqual([items[2], items[1]], batches.next())
+    self.assertEqual(3, len(consumed))
+    expected = [
+      [items[0], items[5], items[4], items[3]],
+      [items[6]],
+    ]
+    self.assertEqual(expected, list(batches))
+
+  def test_get_missing_items_streamed(self):
+    # Items without a digest are hashed as they are consumed from a generator.
+    self.mock(isolateserver, 'ITEMS_PER_CONTAINS_QUERIES', (2,))
+    self.mock(isolateserver, 'CONTAINS_SORT_WINDOW', 2)
+    items = [isolateserver.BufferItem(str(i)) for i in xrange(6)]
+    storage_api = MockedStorageApi(
+        {hashlib.sha1(str(i)).hexdigest(): i for i in xrange(0, 6, 2)})
+    storage = isolateserver.Storage(storage_api)
+    result = dict(storage.get_missing_items(i for i in items))
+    self.assertEqual({items[0]: 0, items[2]: 2, items[4]: 4}, result)
+    self.assertEqual(3, len(storage_api.contains_calls))
+    self.assertEqual(
+        sorted(items, key=lambda i: i.digest),
+        sorted(sum(storage_api.contains_calls, []), key=lambda i: i.digest))
+
   def test_get_missing_items(self):
     items = [
       isolateserver.Item('foo', 12),
@@ -345,6 +391,29 @@ class StorageTest(TestCase):
           [(item, 'push_state', item.zipped if use_zip else item.data)],
           storage_api.push_calls)
 
+  def test_async_push_zip_streamed(self):
+    chunks = [os.urandom(256 * 1024) for _ in xrange(8)]
+    item = FakeItem(''.join(chunks))
+    self.mock(item, 'content', lambda: (c for c in chunks))
+    received = []
+
+    class StreamStorageApi(MockedStorageApi):
+      def push(self, item, push_state, content=None):
+        content = content()
+        received.append(isinstance(content, types.GeneratorType))
+        super(StreamStorageApi, self).push(item, push_state, content)
+
+    storage_api = StreamStorageApi(
+        {item.digest: 'push_state'}, namespace='default-gzip')
+    storage = isolateserver.Storage(storage_api)
+    channel = threading_utils.TaskChannel()
+    storage.async_push(channel, item, self.get_push_state(storage, item))
+    self.assertEqual(item, channel.pull())
+    # The compressed content was streamed, not assembled before the push.
+    self.assertEqual([True], received)
+    self.assertEqual(
+        [(item, 'push_state', item.zipped)], storage_api.push_calls)
+
   def test_async_push_generator_errors(self):
     class FakeException(Exception):
       pass
@@ -376,10 +445,8 @@ class StorageTest(TestCase):
     def push_side_effect():
       raise IOError('Nope')
 
-    # TODO(vadimsh): Retrying push when fetching data from a generator is
-    # broken now (it reuses same generator instance when retrying).
     content_sources = (
-        # generator(),
+        _generator,
         lambda: [chunk],
     )
 
@@ -405,6 +472,51 @@ class StorageTest(TestCase):
         self.assertEqual(
             [expected_push] * attempts, storage_api.push_calls)
 
+  def test_async_fetch_order(self):
+    self.mock(isolateserver, 'MAX_CONCURRENT_FETCHES_PER_HOST', 4)
+    self.mock(isolateserver, 'LARGE_FETCH_SIZE', 100)
+    started = []
+    class NetThreadPool(object):
+      @staticmethod
+      def add_task_with_channel(channel, priority, _func, digest, *_args):
+        started.append((digest, priority, channel))
+    storage = isolateserver.Storage(MockedStorageApi({}))
+    storage._net_thread_pool = NetThreadPool()
+    def fetch(digest, size, priority=threading_utils.PRIORITY_MED):
+      storage.async_fetch(None, priority, digest, size, None)
+    def done(digest):
+      for i, (d, _, channel) in enumerate(started):
+        if d == digest:
+          channel._callback()
+          del started[i]
+          return
+      self.fail(digest)
+    def running():
+      return sorted(d for d, _, _ in started)
+
+    fetch('small1', 1)
+    self.assertEqual(['small1'], running())
+    for i in xrange(3):
+      fetch('huge%d' % i, 1000 + i)
+    fetch('small2', 2)
+    fetch('small3', 3)
+    fetch('isolated', None, threading_utils.PRIORITY_HIGH)
+    self.assertEqual(['huge0', 'huge1', 'huge2', 'small1'], running())
+    # The high priority item is started first.
+    done('small1')
+    self.assertEqual(['huge0', 'huge1', 'huge2', 'isolated'], running())
+    # Large items only get half of the slots while small items are waiting.
+    done('huge2')
+    self.assertEqual(['huge0', 'huge1', 'isolated', 'small3'], running())
+    fetch('huge3', 1003)
+    done('huge1')
+    self.assertEqual(['huge0', 'huge3', 'isolated', 'small3'], running())
+    done('isolated')
+    self.assertEqual(['huge0', 'huge3', 'small2', 'small3'], running())
+    for d in ('huge0', 'huge3', 'small2', 'small3'):
+      done(d)
+    self.assertEqual([], running())
+
   def test_upload_tree(self):
     files = {
       u'/a': {
@@ -712,6 +824,111 @@ class IsolateServerStorageApiTest(TestCase):
     self.assertTrue(push_state.uploaded)
     self.assertFalse(push_state.finalized)
 
+  def test_push_gs_streamed(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    data = ''.join(str(x) for x in xrange(1000))
+    item = FakeItem(data)
+    contains_request = {'items': [
+        {'digest': item.digest, 'size': item.size, 'is_isolated': 0}]}
+    contains_response = {'items': [
+        {'index': 0,
+         'gs_upload_url': server + '/FAKE_GCS/whatevs/1234',
+         'upload_ticket': 'ticket!'}]}
+
+    def check_put(kwargs):
+      # The generator is streamed as is, a single attempt is done.
+      self.assertIsInstance(kwargs['data'], types.GeneratorType)
+      self.assertEqual(data, ''.join(kwargs.pop('data')))
+      self.assertEqual(
+          {
+            'content_type': 'application/octet-stream',
+            'headers': {'Cache-Control': 'public, max-age=31536000'},
+            'max_attempts': 1,
+            'method': 'PUT',
+          },
+          kwargs)
+
+    requests = [
+      self.mock_contains_request(
+          server, namespace, contains_request, contains_response),
+      (server + '/FAKE_GCS/whatevs/1234', check_put, '', None),
+      (
+        server + '/api/isolateservice/v1/finalize_gs_upload',
+        {'data': {'upload_ticket': 'ticket!'}},
+        {'ok': True},
+      ),
+    ]
+    self.expected_requests(requests)
+    storage = isolateserver.IsolateServer(server, namespace)
+    missing = storage.contains([item])
+    push_state = missing[item]
+    storage.push(item, push_state, (c for c in (data[:100], data[100:])))
+    self.assertTrue(push_state.uploaded)
+    self.assertTrue(push_state.finalized)
+
+  def test_push_gs_zip_streamed_retry(self):
+    # The zipping thread of a failed attempt must be released before the retry
+    # starts, otherwise the retry may wait for a free zipping thread forever.
+    self.mock(isolateserver, 'ZIP_STREAM_BUFFERED_CHUNKS', 1)
+    server = 'http://example.com'
+    namespace = 'default-gzip'
+    chunks = [os.urandom(64 * 1024) for _ in xrange(8)]
+    item = FakeItem(''.join(chunks))
+    released = threading.Event()
+    def content():
+      try:
+        for chunk in chunks:
+          yield chunk
+      finally:
+        released.set()
+    self.mock(item, 'content', content)
+    contains_request = {'items': [
+        {'digest': item.digest, 'size': item.size, 'is_isolated': 0}]}
+    contains_response = {'items': [
+        {'index': 0,
+         'gs_upload_url': server + '/FAKE_GCS/whatevs/1234',
+         'upload_ticket': 'ticket!'}]}
+
+    def check_put(kwargs):
+      factory = kwargs.pop('data')
+      # The first attempt fails midway, while its zipping thread is blocked on
+      # the full buffer. net then asks for a new body.
+      first = factory()
+      next(first)
+      self.assertFalse(released.is_set())
+      body = factory()
+      self.assertTrue(released.wait(5))
+      self.assertEqual(item.zipped, ''.join(body))
+      self.assertEqual(
+          {
+            'content_type': 'application/octet-stream',
+            'headers': {'Cache-Control': 'public, max-age=31536000'},
+            'method': 'PUT',
+          },
+          kwargs)
+
+    requests = [
+      self.mock_contains_request(
+          server, namespace, contains_request, contains_response,
+          compression='flate'),
+      (server + '/FAKE_GCS/whatevs/1234', check_put, '', None),
+      (
+        server + '/api/isolateservice/v1/finalize_gs_upload',
+        {'data': {'upload_ticket': 'ticket!'}},
+        {'ok': True},
+      ),
+    ]
+    self.expected_requests(requests)
+    storage = isolateserver.Storage(
+        isolateserver.IsolateServer(server, namespace))
+    missing = list(storage.get_missing_items([item]))
+    self.assertEqual([item], [i for i, _ in missing])
+    push_state = missing[0][1]
+    storage.push(item, push_state)
+    self.assertTrue(push_state.uploaded)
+    self.assertTrue(push_state.finalized)
+
   def test_contains_success(self):
     server = 'http://example.com'
     namespace = 'default'
@@ -763,7 +980,7 @@ class IsolateServerStorageApiTest(TestCase):
       storage.contains([])
 
 
-class IsolateServerStorageSmokeTest(unittest.TestCase):
+class IsolateServerStorageSmokeTest(auto_stub.TestCase):
   """Tests public API of Storage class using file system as a store."""
 
   def setUp(self):
@@ -865,6 +1082,88 @@ class IsolateServerStorageSmokeTest(unittest.TestCase):
   def test_push_and_fetch_gzip(self):
     self.run_push_and_fetch_test('default-gzip')
 
+  def test_push_and_fetch_chunked(self):
+    # The mock server can only return the content of small items.
+    self.mock(isolated_format, 'CHUNK_MASK', 0x3)
+    self.mock(isolated_format, 'CHUNK_MIN_SIZE', 64)
+    self.mock(isolated_format, 'CHUNK_MAX_SIZE', 400)
+    storage = isolateserver.get_storage(self.server.url, 'default-gzip')
+    content = os.urandom(5000)
+    root = os.path.join(self.tempdir, u'root')
+    os.mkdir(root)
+    with open(os.path.join(root, u'a'), 'wb') as f:
+      f.write(content)
+    items, metadata = isolateserver.directory_to_metadata(
+        root, storage.hash_algo, [], chunked_file_size=1024)
+    meta = metadata[u'a']
+    self.assertEqual('chunked', meta['t'])
+    self.assertEqual(hashlib.sha1(content).hexdigest(), meta['h'])
+    self.assertTrue(len(meta['c']) >= 13)
+    self.assertEqual([c[0] for c in meta['c']], [i.digest for i in items])
+    self.assertEqual(
+        set(i.digest for i in items),
+        set(i.digest for i in storage.upload_items(items)))
+
+    # Appending data only uploads the last chunk again, possibly split.
+    with open(os.path.join(root, u'a'), 'ab') as f:
+      f.write('appended')
+    items, metadata = isolateserver.directory_to_metadata(
+        root, storage.hash_algo, [], chunked_file_size=1024)
+    uploaded = storage.upload_items(items)
+    self.assertTrue(uploaded)
+    self.assertTrue(set(uploaded) <= set(items[-2:]))
+
+    # The file is assembled from its chunks when fetched.
+    meta = metadata[u'a']
+    cache = isolateserver.MemoryCache()
+    queue = isolateserver.FetchQueue(storage, cache)
+    queue.add_chunked(meta['h'], meta['s'], meta['c'])
+    self.assertEqual(meta['h'], queue.wait([meta['h']]))
+    with cache.getfileobj(meta['h']) as f:
+      self.assertEqual(content + 'appended', f.read())
+
+  def test_prefetch_isolated(self):
+    storage = isolateserver.get_storage(self.server.url, 'default-gzip')
+    files = {'a': 'a' * 10, 'b': 'b' * 20, 'c': 'c' * 5}
+    isolated = {
+      'files': dict(
+          (k, {'h': hashlib.sha1(v).hexdigest(), 's': len(v)})
+          for k, v in files.iteritems()),
+      'version': isolated_format.ISOLATED_FILE_VERSION,
+    }
+    items = dict(
+        (k, isolateserver.BufferItem(v)) for k, v in files.iteritems())
+    isolated_item = isolateserver.BufferItem(
+        json.dumps(isolated, sort_keys=True, separators=(',',':')))
+    storage.upload_items(items.values() + [isolated_item])
+
+    # 'b' doesn't fit in the budget, the files are not mapped anywhere.
+    cache = isolateserver.MemoryCache()
+    self.assertEqual(
+        15,
+        isolateserver.prefetch_isolated(
+            isolated_item.digest, storage, cache, 16))
+    self.assertEqual(
+        set([isolated_item.digest, items['a'].digest, items['c'].digest]),
+        cache.cached_set())
+
+    # The files already in the cache are not accounted for.
+    self.assertEqual(
+        20,
+        isolateserver.prefetch_isolated(
+            isolated_item.digest, storage, cache, 20))
+    self.assertIn(items['b'].digest, cache)
+
+    # Nothing is fetched once asked to stop, except the .isolated.
+    cache = isolateserver.MemoryCache()
+    stop_event = threading.Event()
+    stop_event.set()
+    self.assertEqual(
+        0,
+        isolateserver.prefetch_isolated(
+            isolated_item.digest, storage, cache, 100, stop_event))
+    self.assertEqual(set([isolated_item.digest]), cache.cached_set())
+
   if sys.maxsize == (2**31) - 1:
     def test_archive_multiple_huge_file(self):
       self.server.discard_content()
@@ -1297,6 +1596,42 @@ class DiskCacheTest(TestCase):
     cache.cleanup()
     self.assertEqual([u'state.json'], os.listdir(self.tempdir))
 
+  def test_cleanup_verify(self):
+    self._free_disk = 1100
+    h_a = self.to_hash('a')[0]
+    h_b = self.to_hash('b')[0]
+    with self.get_cache() as cache:
+      cache.write(h_a, 'a')
+      cache.write(h_b, 'b')
+    # Corrupt an item without changing its size.
+    path = os.path.join(self.tempdir, h_b)
+    file_path.set_read_only(path, False)
+    isolateserver.file_write(path, 'c')
+
+    hashed = []
+    hash_file = isolated_format.hash_file
+    def hash_file_mock(p, algo):
+      hashed.append(os.path.basename(p))
+      return hash_file(p, algo)
+    self.mock(isolated_format, 'hash_file', hash_file_mock)
+
+    cache = self.get_cache()
+    cache.cleanup(verify_time_budget=60)
+    self.assertEqual(sorted([h_a, h_b]), sorted(hashed))
+    self.assertEqual([1], cache.corrupted)
+    self.assertEqual(set([h_a]), cache.cached_set())
+    self.assertEqual(
+        sorted([h_a, u'state.json', u'verified.json']),
+        sorted(os.listdir(self.tempdir)))
+
+    # Items verified in a previous run are not hashed again.
+    del hashed[:]
+    cache = self.get_cache()
+    cache.cleanup(verify_time_budget=60)
+    self.assertEqual([], hashed)
+    self.assertEqual([], cache.corrupted)
+    self.assertEqual(set([h_a]), cache.cached_set())
+
   def test_policies_active_trimming(self):
     # Start with a larger cache, add many object.
     # Reload the cache with smaller policies, the cache should be trimmed on
@@ -1343,8 +1678,9 @@ class DiskCacheTest(TestCase):
       self.assertEqual(2, cache.initial_number_items)
       self.assertEqual(2, cache.initial_size)
 
+    # Only the modification was appended to the journal.
     self.assertEqual(
-        sorted([h_b, h_c, h_large, u'state.json']),
+        sorted([h_b, h_c, h_large, u'state.journal', u'state.json']),
         sorted(os.listdir(self.tempdir)))
 
     # Assert that trimming is done in constructor too.
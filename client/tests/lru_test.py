@@ -246,6 +246,70 @@ class LRUDictTest(unittest.TestCase):
     self.assertEqual(lru_dict.get_oldest(), ('kb', ('vb', 1)))
     self.assertEqual(lru_dict.pop_oldest(), ('kb', ('vb', 1)))
 
+  def test_journal(self):
+    tempdir = tempfile.mkdtemp(prefix=u'lru_test')
+    try:
+      state_file = os.path.join(tempdir, 'state.json')
+      journal_file = os.path.join(tempdir, 'state.journal')
+
+      # The first save always writes the whole state.
+      lru_dict = self.prepare_lru_dict([1, 2, 3, 4, 5])
+      self.assertTrue(lru_dict.save(state_file, journal_file))
+      self.assertFalse(os.path.isfile(journal_file))
+
+      # Small modifications are appended to the journal.
+      lru_dict.touch(2)
+      lru_dict.pop(3)
+      lru_dict.add(6, 'six')
+      with open(state_file, 'rb') as f:
+        state = f.read()
+      self.assertTrue(lru_dict.save(state_file, journal_file))
+      with open(state_file, 'rb') as f:
+        self.assertEqual(state, f.read())
+      with open(journal_file, 'rb') as f:
+        self.assertEqual(3, len(f.readlines()))
+
+      # Loading replays the journal.
+      loaded = lru.LRUDict.load(state_file, journal_file)
+      self.assertEqual('six', loaded.get(6))
+      self.assert_order(loaded, [1, 4, 5, 2, 6])
+
+      # Once the journal is as large as the state, the state is compacted.
+      lru_dict = lru.LRUDict.load(state_file, journal_file)
+      lru_dict.touch(1)
+      lru_dict.touch(4)
+      self.assertTrue(lru_dict.save(state_file, journal_file))
+      self.assertFalse(os.path.isfile(journal_file))
+      self.assert_order(
+          lru.LRUDict.load(state_file, journal_file), [5, 2, 6, 1, 4])
+    finally:
+      for f in os.listdir(tempdir):
+        os.unlink(os.path.join(tempdir, f))
+      os.rmdir(tempdir)
+
+  def test_journal_truncated(self):
+    tempdir = tempfile.mkdtemp(prefix=u'lru_test')
+    try:
+      state_file = os.path.join(tempdir, 'state.json')
+      journal_file = os.path.join(tempdir, 'state.journal')
+      lru_dict = self.prepare_lru_dict([1, 2, 3])
+      lru_dict.save(state_file, journal_file)
+      lru_dict.pop(1)
+      lru_dict.save(state_file, journal_file)
+      # Simulate a process dying while appending to the journal.
+      with open(journal_file, 'ab') as f:
+        f.write('["p",')
+
+      loaded = lru.LRUDict.load(state_file, journal_file)
+      # The state is compacted on next save.
+      self.assertTrue(loaded.save(state_file, journal_file))
+      self.assertFalse(os.path.isfile(journal_file))
+      self.assert_order(lru.LRUDict.load(state_file, journal_file), [2, 3])
+    finally:
+      for f in os.listdir(tempdir):
+        os.unlink(os.path.join(tempdir, f))
+      os.rmdir(tempdir)
+
 if __name__ == '__main__':
   VERBOSE = '-v' in sys.argv
   logging.basicConfig(level=logging.DEBUG if VERBOSE else logging.ERROR)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# Copyright 2016 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import logging
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'third_party'))
+
+import named_cache
+from depot_tools import auto_stub
+from depot_tools import fix_encoding
+from utils import file_path
+
+
+def write_file(path, content):
+  with open(path, 'wb') as f:
+    f.write(content)
+
+
+def read_file(path):
+  with open(path, 'rb') as f:
+    return f.read()
+
+
+class CacheManagerTest(auto_stub.TestCase):
+  def setUp(self):
+    super(CacheManagerTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'named_cache_test')
+    self.root_dir = os.path.join(self.tempdir, u'c')
+    self.run_dir = os.path.join(self.tempdir, u'ir')
+    os.mkdir(self.run_dir)
+    self.manager = named_cache.CacheManager(self.root_dir)
+
+  def tearDown(self):
+    try:
+      file_path.rmtree(self.tempdir)
+    finally:
+      super(CacheManagerTest, self).tearDown()
+
+  def cache_dirs(self):
+    return sorted(i for i in os.listdir(self.root_dir) if i != 'state.json')
+
+  def test_install_uninstall(self):
+    path = os.path.join(self.run_dir, u'a', u'git')
+    with self.manager:
+      self.manager.install(path, 'git')
+      self.assertEqual([], os.listdir(path))
+      write_file(os.path.join(path, 'foo'), 'bar')
+      self.manager.uninstall(path, 'git')
+      self.assertFalse(os.path.isdir(path))
+      self.assertEqual(['git'], self.manager.get_names())
+
+    # The state is reloaded from state.json.
+    manager = named_cache.CacheManager(self.root_dir)
+    with manager:
+      self.assertEqual(['git'], manager.get_names())
+      path = os.path.join(self.run_dir, u'git2')
+      manager.install(path, 'git')
+      self.assertEqual('bar', read_file(os.path.join(path, 'foo')))
+      # The cache is not tracked while it is installed.
+      self.assertEqual(0, len(manager))
+      self.assertEqual([], self.cache_dirs())
+      manager.uninstall(path, 'git')
+      self.assertEqual(1, len(self.cache_dirs()))
+
+  def test_install_existing_path(self):
+    with self.manager:
+      with self.assertRaises(named_cache.Error):
+        self.manager.install(self.run_dir, 'git')
+
+  def test_trim(self):
+    # Each cache uses 10 bytes of a 100 bytes disk.
+    self.mock(
+        file_path, 'get_free_space', lambda _: 100 - 10*len(self.cache_dirs()))
+    with self.manager:
+      for name in ('a', 'b', 'c'):
+        path = os.path.join(self.run_dir, name)
+        self.manager.install(path, name)
+        self.manager.uninstall(path, name)
+      # 'a' becomes the most recently used.
+      path = os.path.join(self.run_dir, u'a')
+      self.manager.install(path, 'a')
+      self.manager.uninstall(path, 'a')
+      # Unknown items are always deleted.
+      write_file(os.path.join(self.root_dir, u'unknown'), 'foo')
+      os.mkdir(os.path.join(self.root_dir, u'unknown_dir'))
+
+      self.assertEqual(0, self.manager.trim(0))
+      self.assertEqual(3, len(self.cache_dirs()))
+      self.assertEqual(0, self.manager.trim(70))
+      self.assertEqual(2, self.manager.trim(85))
+      self.assertEqual(['a'], self.manager.get_names())
+      self.assertEqual(1, len(self.cache_dirs()))
+
+  def test_process_named_cache_options(self):
+    parser = named_cache.optparse.OptionParser()
+    named_cache.add_named_cache_options(parser)
+    self.mock(parser, 'error', self.fail)
+    options, _ = parser.parse_args(
+        ['--named-cache-root', self.root_dir, '--named-cache', 'git', 'a/git'])
+    manager = named_cache.process_named_cache_options(parser, options)
+    self.assertEqual(self.root_dir, manager.root_dir)
+    self.assertEqual([('git', 'a/git')], options.named_caches)
+
+  def test_process_named_cache_options_invalid(self):
+    parser = named_cache.optparse.OptionParser()
+    named_cache.add_named_cache_options(parser)
+    errors = []
+    def error(msg):
+      errors.append(msg)
+      raise ValueError()
+    self.mock(parser, 'error', error)
+    for args in (
+        ['--named-cache', 'git', 'git'],
+        ['--named-cache-root', 'c', '--named-cache', 'Git', 'git'],
+        ['--named-cache-root', 'c', '--named-cache', 'git', '../git'],
+        ['--named-cache-root', 'c', '--named-cache', 'git', '/git'],
+        ['--named-cache-root', 'c', '--named-cache', 'git', 'a',
+         '--named-cache', 'git', 'b'],
+        ['--named-cache-root', 'c', '--named-cache', 'a', 'git',
+         '--named-cache', 'b', 'git/'],
+      ):
+      options, _ = parser.parse_args(args)
+      with self.assertRaises(ValueError):
+        named_cache.process_named_cache_options(parser, options)
+    self.assertEqual(6, len(errors))
+
+
+if __name__ == '__main__':
+  fix_encoding.fix_encoding()
+  VERBOSE = '-v' in sys.argv
+  logging.basicConfig(level=logging.DEBUG if VERBOSE else logging.ERROR)
+  unittest.main()
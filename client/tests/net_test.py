@@ -176,6 +176,26 @@ class HttpServiceTest(RetryLoopMockedTest):
     self.assertEqual(service.request('/', data={}).read(), response)
     self.assertAttempts(2, net.URL_OPEN_TIMEOUT)
 
+  def test_request_body_factory_after_failure(self):
+    response = 'True'
+    bodies = []
+
+    def mock_perform_request(request):
+      bodies.append(''.join(request.body))
+      if len(bodies) == 1:
+        raise net.ConnectionError()
+      return net_utils.make_fake_response(response, request.get_full_url())
+
+    service = self.mocked_http_service(perform_request=mock_perform_request)
+    factory = lambda: (c for c in ('a', 'b'))
+    self.assertEqual(
+        service.request(
+            '/', data=factory, content_type='application/octet-stream',
+            method='PUT').read(),
+        response)
+    self.assertEqual(['ab', 'ab'], bodies)
+    self.assertAttempts(2, net.URL_OPEN_TIMEOUT)
+
   def test_request_failure_max_attempts_default(self):
     def mock_perform_request(_request):
       raise net.ConnectionError()
@@ -215,6 +235,16 @@ class HttpServiceTest(RetryLoopMockedTest):
     self.assertEqual(1, len(count))
     self.assertAttempts(1, net.URL_OPEN_TIMEOUT)
 
+  def test_request_HTTP_error_raise_404(self):
+    def mock_perform_request(_request):
+      raise net.HttpError(404, 'application/json', None)
+
+    service = self.mocked_http_service(perform_request=mock_perform_request)
+    with self.assertRaises(net.HttpError) as ctx:
+      service.request('/', data={}, raise_404=True)
+    self.assertEqual(404, ctx.exception.code)
+    self.assertAttempts(1, net.URL_OPEN_TIMEOUT)
+
   def test_request_HTTP_error_retry_404(self):
     response = 'data'
     attempts = []
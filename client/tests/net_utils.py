@@ -58,7 +58,8 @@ class TestCase(auto_stub.TestCase):
       request: list of tuple(url, kwargs, response, headers) for normal requests
           and tuple(url, kwargs, response) for json requests. kwargs can be a
           callable. In that case, it's called with the actual kwargs. It's
-          useful when the kwargs values are not deterministic.
+          useful when the kwargs values are not deterministic. The response of
+          a json request can be an exception instance to raise.
     """
     requests = requests[:]
     for request in requests:
@@ -110,6 +111,8 @@ class TestCase(auto_stub.TestCase):
             expected_kwargs(kwargs)
           else:
             self.assertEqual(expected_kwargs, kwargs)
+          if isinstance(result, Exception):
+            raise result
           if result is not None:
             return result
           return None
@@ -13,6 +13,7 @@ import logging
 import os
 import sys
 import tempfile
+import time
 import unittest
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
@@ -169,6 +170,39 @@ class RunIsolatedTest(RunIsolatedTestBase):
         [([self.temp_join(u'foo.exe'), u'cmd with space'], {'detached': True})],
         self.popen_calls)
 
+  def test_main_prefetch(self):
+    files = {'a': 'a' * 10, 'b': 'b' * 20}
+    isolated = json_dumps(
+        {
+          'files': dict(
+              (k, {'h': isolateserver_mock.hash_content(v), 's': len(v)})
+              for k, v in files.iteritems()),
+        })
+    isolated_hash = isolateserver_mock.hash_content(isolated)
+    contents = dict(
+        (isolateserver_mock.hash_content(v), v) for v in files.itervalues())
+    contents[isolated_hash] = isolated
+    self.mock(
+        isolateserver, 'get_storage', lambda *_: StorageFake(contents))
+
+    cache_dir = os.path.join(self.tempdir, u'cache')
+    cmd = [
+        '--no-log',
+        '--prefetch', isolated_hash,
+        '--cache', cache_dir,
+        '--isolate-server', 'https://localhost',
+        '--min-free-space', '0',
+        '--max-prefetch-size', '15',
+    ]
+    self.assertEqual(0, run_isolated.main(cmd))
+    # Nothing is run and only the files fitting the budget are in the cache.
+    self.assertEqual([], self.popen_calls)
+    self.assertFalse(os.path.isdir(self.run_test_temp_dir))
+    expected = sorted(
+        [isolated_hash, isolateserver_mock.hash_content(files['a'])])
+    cached = [i for i in os.listdir(cache_dir) if len(i) == len(isolated_hash)]
+    self.assertEqual(expected, sorted(cached))
+
   def test_main_args(self):
     self.mock(tools, 'disable_buffering', lambda: None)
     isolated = json_dumps({'command': ['foo.exe', 'cmd w/ space']})
@@ -218,6 +252,8 @@ class RunIsolatedTest(RunIsolatedTestBase):
         None,
         None,
         lambda run_dir: None,
+        False,
+        run_isolated.noop_install_named_caches,
         False)
     self.assertEqual(0, ret)
     return make_tree_call
@@ -421,6 +457,40 @@ class RunIsolatedTest(RunIsolatedTestBase):
         echo_cmd[0])
     self.assertEqual(echo_cmd[1:], ['hello', 'world'])
 
+  def test_main_naked_with_named_caches(self):
+    seen = []
+    def fake_run(args, **_kwargs):
+      # wait() can be called more than once per process.
+      if args[0] == u'/bin/echo' and len(seen) < len(self.popen_calls):
+        git_dir = self.temp_join(u'cache', u'git')
+        seen.append(sorted(os.listdir(git_dir)))
+        write_content(os.path.join(git_dir, 'run%d' % len(seen)), 'foo')
+    self.popen_mocks.append(fake_run)
+    named_cache_root = os.path.join(self.tempdir, 'c')
+    cmd = [
+      '--no-log',
+      '--cache', os.path.join(self.tempdir, 'cache'),
+      '--min-free-space', '0',
+      '--named-cache-root', named_cache_root,
+      '--named-cache', 'git', 'cache/git',
+      '/bin/echo',
+      'hello',
+    ]
+    self.assertEqual(0, run_isolated.main(cmd))
+    # Logging can only be set up once per logger.
+    self.mock(
+        logging_utils.OptionParserWithLogging, 'logger_root',
+        logging.Logger('unittest'))
+    self.assertEqual(0, run_isolated.main(cmd))
+    # The second task sees the content written by the first one.
+    self.assertEqual([[], ['run1']], seen)
+    self.assertFalse(os.path.isdir(self.run_test_temp_dir))
+    dirs = [i for i in os.listdir(named_cache_root) if i != 'state.json']
+    self.assertEqual(1, len(dirs))
+    self.assertEqual(
+        ['run1', 'run2'],
+        sorted(os.listdir(os.path.join(named_cache_root, dirs[0]))))
+
   def test_modified_cwd(self):
     isolated = json_dumps({
         'command': ['../out/some.exe', 'arg'],
@@ -502,6 +572,8 @@ class RunIsolatedTestRun(RunIsolatedTestBase):
           None,
           None,
           lambda run_dir: None,
+          False,
+          run_isolated.noop_install_named_caches,
           False)
       self.assertEqual(0, ret)
 
@@ -538,6 +610,57 @@ class RunIsolatedTestRun(RunIsolatedTestBase):
     finally:
       server.close()
 
+  def test_output_uploader(self):
+    # Files written while the command runs are uploaded right away, they are
+    # not hashed again once it completed.
+    server = isolateserver_mock.MockIsolateServer()
+    try:
+      store = isolateserver.get_storage(server.url, 'default-store')
+      out_dir = os.path.join(self.tempdir, run_isolated.ISOLATED_OUT_DIR)
+      os.mkdir(out_dir)
+      hashed = []
+      hash_file = isolated_format.hash_file
+      def hash_file_mock(path, algo):
+        hashed.append(os.path.basename(path))
+        return hash_file(path, algo)
+      self.mock(isolated_format, 'hash_file', hash_file_mock)
+      self.mock(run_isolated.OutputUploader, 'WAIT_INTERVAL', 0.01)
+
+      uploader = run_isolated.OutputUploader(store, out_dir)
+      uploader.start()
+      try:
+        old = os.path.join(out_dir, u'old')
+        write_content(old, 'old data')
+        # Make it old enough to be uploaded right away.
+        past = time.time() - 60
+        os.utime(old, (past, past))
+        for _ in xrange(500):
+          if uploader.uploaded:
+            break
+          time.sleep(0.01)
+      finally:
+        uploader.stop()
+      self.assertEqual([old], [i.path for i in uploader.uploaded])
+      self.assertIn(
+          isolateserver_mock.hash_content('old data'),
+          server.contents['default-store'])
+      self.assertEqual(['old'], hashed)
+
+      # Written too late to be uploaded while running.
+      write_content(os.path.join(out_dir, u'new'), 'new data')
+      outputs_ref, success, stats = run_isolated.delete_and_upload(
+          store, out_dir, False, uploader)
+      self.assertTrue(success)
+      self.assertEqual('default-store', outputs_ref['namespace'])
+      self.assertEqual(['old', 'new'], hashed[:2])
+      self.assertNotIn('old', hashed[2:])
+      # The .isolated and both files were uploaded.
+      cold = large.unpack(base64.b64decode(stats['items_cold']))
+      self.assertEqual(3, len(cold))
+      self.assertEqual([], large.unpack(base64.b64decode(stats['items_hot'])))
+    finally:
+      server.close()
+
 
 class RunIsolatedJsonTest(RunIsolatedTestBase):
   # Similar to RunIsolatedTest but adds the hacks to process ISOLATED_OUTDIR to
@@ -626,6 +749,7 @@ class RunIsolatedJsonTest(RunIsolatedTestBase):
             u'initial_size': 0,
             u'items_cold': [len(isolated_in_json)],
             u'items_hot': [],
+            u'link_strategies': {},
           },
           u'upload': {
             u'items_cold': [len(isolated_out_json)],
@@ -641,6 +765,9 @@ class RunIsolatedJsonTest(RunIsolatedTestBase):
     self.assertLessEqual(0, actual.pop(u'duration'))
     actual_isolated_stats = actual[u'stats'][u'isolated']
     self.assertLessEqual(0, actual_isolated_stats[u'download'].pop(u'duration'))
+    self.assertLessEqual(
+        actual_isolated_stats[u'download'].pop(u'time_to_first_byte'),
+        actual_isolated_stats[u'download'].pop(u'time_to_last_byte'))
     self.assertLessEqual(0, actual_isolated_stats[u'upload'].pop(u'duration'))
     for i in (u'download', u'upload'):
       for j in (u'items_cold', u'items_hot'):
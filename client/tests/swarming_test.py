@@ -29,6 +29,7 @@ import test_utils
 from depot_tools import fix_encoding
 from utils import file_path
 from utils import logging_utils
+from utils import net
 from utils import tools
 
 import httpserver_mock
@@ -340,15 +341,133 @@ class TestSwarmingTrigger(NetTestCase):
     result_2 = gen_request_response(request_2, task_id='12400')
     self.expected_requests(
         [
+          (
+            'https://localhost:1/api/swarming/v1/tasks/new_batch',
+            {'data': {'items': [request_1, request_2]}, 'raise_404': True},
+            {'items': [result_1, result_2]},
+          ),
+        ])
+
+    tasks = swarming.trigger_task_shards(
+        swarming='https://localhost:1',
+        task_request=task_request,
+        shards=2)
+    expected = {
+      u'unit_tests:0:2': {
+        'shard_index': 0,
+        'task_id': '12300',
+        'view_url': 'https://localhost:1/user/task/12300',
+      },
+      u'unit_tests:1:2': {
+        'shard_index': 1,
+        'task_id': '12400',
+        'view_url': 'https://localhost:1/user/task/12400',
+      },
+    }
+    self.assertEqual(expected, tasks)
+
+  def test_trigger_task_shards_batch_failure(self):
+    self.mock(swarming, 'TRIGGER_BATCH_SIZE', 1)
+    task_request = swarming.NewTaskRequest(
+        expiration_secs=60*60,
+        name=TEST_NAME,
+        parent_task_id=None,
+        priority=101,
+        properties=swarming.TaskProperties(
+            cipd_input=None,
+            command=['a', 'b'],
+            dimensions={'foo': 'bar', 'os': 'Mac'},
+            env={},
+            execution_timeout_secs=60,
+            extra_args=[],
+            grace_period_secs=30,
+            idempotent=False,
+            inputs_ref=None,
+            io_timeout_secs=60),
+        service_account_token=None,
+        tags=['tag:a', 'tag:b'],
+        user='joe@localhost')
+
+    requests = []
+    for index in xrange(2):
+      request = swarming.task_request_to_raw_request(task_request, False)
+      request['name'] = u'unit_tests:%d:2' % index
+      request['properties']['env'] = [
+        {'key': 'GTEST_SHARD_INDEX', 'value': str(index)},
+        {'key': 'GTEST_TOTAL_SHARDS', 'value': '2'},
+      ]
+      requests.append(request)
+    self.expected_requests(
+        [
+          (
+            'https://localhost:1/api/swarming/v1/tasks/new_batch',
+            {'data': {'items': [requests[0]]}, 'raise_404': True},
+            {'items': [gen_request_response(requests[0])]},
+          ),
+          (
+            'https://localhost:1/api/swarming/v1/tasks/new_batch',
+            {'data': {'items': [requests[1]]}, 'raise_404': True},
+            None,
+          ),
+        ])
+
+    tasks = swarming.trigger_task_shards(
+        swarming='https://localhost:1',
+        task_request=task_request,
+        shards=2)
+    self.assertEqual(None, tasks)
+    self._check_output(
+        '',
+        'Failed to trigger tasks unit_tests:1:2 to unit_tests:1:2\n'
+        'Only 1 shard(s) out of 2 were triggered\n')
+
+  def test_trigger_task_shards_no_batch(self):
+    # The server doesn't support tasks/new_batch.
+    task_request = swarming.NewTaskRequest(
+        expiration_secs=60*60,
+        name=TEST_NAME,
+        parent_task_id=None,
+        priority=101,
+        properties=swarming.TaskProperties(
+            cipd_input=None,
+            command=['a', 'b'],
+            dimensions={'foo': 'bar', 'os': 'Mac'},
+            env={},
+            execution_timeout_secs=60,
+            extra_args=[],
+            grace_period_secs=30,
+            idempotent=False,
+            inputs_ref=None,
+            io_timeout_secs=60),
+        service_account_token=None,
+        tags=['tag:a', 'tag:b'],
+        user='joe@localhost')
+
+    requests = []
+    for index in xrange(2):
+      request = swarming.task_request_to_raw_request(task_request, False)
+      request['name'] = u'unit_tests:%d:2' % index
+      request['properties']['env'] = [
+        {'key': 'GTEST_SHARD_INDEX', 'value': str(index)},
+        {'key': 'GTEST_TOTAL_SHARDS', 'value': '2'},
+      ]
+      requests.append(request)
+    self.expected_requests(
+        [
+          (
+            'https://localhost:1/api/swarming/v1/tasks/new_batch',
+            {'data': {'items': requests}, 'raise_404': True},
+            net.HttpError(404, 'application/json', None),
+          ),
           (
             'https://localhost:1/api/swarming/v1/tasks/new',
-            {'data': request_1},
-            result_1,
+            {'data': requests[0]},
+            gen_request_response(requests[0]),
           ),
           (
             'https://localhost:1/api/swarming/v1/tasks/new',
-            {'data': request_2},
-            result_2,
+            {'data': requests[1]},
+            gen_request_response(requests[1], task_id='12400'),
           ),
         ])
 
@@ -498,8 +617,8 @@ class TestSwarmingCollection(NetTestCase):
     self.expected_requests(
         [
           (
-            'https://host:9001/api/swarming/v1/task/10100/result',
-            {'retry_50x': False},
+            'https://host:9001/api/swarming/v1/task/10100/wait?timeout_secs=10',
+            {'raise_404': True, 'retry_50x': False},
             gen_result_response(),
           ),
           (
@@ -515,8 +634,8 @@ class TestSwarmingCollection(NetTestCase):
     self.expected_requests(
         [
           (
-            'https://host:9001/api/swarming/v1/task/10100/result',
-            {'retry_50x': False},
+            'https://host:9001/api/swarming/v1/task/10100/wait?timeout_secs=10',
+            {'raise_404': True, 'retry_50x': False},
             gen_result_response(exit_code=1),
           ),
           (
@@ -544,22 +663,43 @@ class TestSwarmingCollection(NetTestCase):
     self.mock(swarming.net, 'sleep_before_retry', lambda _x, _y: None)
     self.mock(swarming, 'now', get_now)
     # The actual number of requests here depends on 'now' progressing to 10
-    # seconds. It's called once per loop. Loop makes 9 iterations.
-    self.expected_requests(
-        9 * [
-          (
-            'https://host:9001/api/swarming/v1/task/10100/result',
-            {'retry_50x': False},
-            None,
-          )
-        ])
+    # seconds. It's called once per loop. Loop makes 9 iterations, each first
+    # trying to wait for the remaining time then falling back to polling.
+    requests = []
+    for i in xrange(1, 10):
+      requests.extend([
+        (
+          'https://host:9001/api/swarming/v1/task/10100/wait?timeout_secs=%d' %
+              (10 - i),
+          {'raise_404': True, 'retry_50x': False},
+          None,
+        ),
+        (
+          'https://host:9001/api/swarming/v1/task/10100/result',
+          {'retry_50x': False},
+          None,
+        ),
+      ])
+    self.expected_requests(requests)
     actual = get_results(['10100'])
     self.assertEqual([], actual)
     self.assertTrue(all(not v for v in now.itervalues()), now)
 
-  def test_many_shards(self):
+  def test_no_wait(self):
+    # The server doesn't support 'wait', it is only tried once.
+    self.mock(swarming, 'now', lambda: 0)
     self.expected_requests(
         [
+          (
+            'https://host:9001/api/swarming/v1/task/10100/wait?timeout_secs=10',
+            {'raise_404': True, 'retry_50x': False},
+            net.HttpError(404, 'application/json', None),
+          ),
+          (
+            'https://host:9001/api/swarming/v1/task/10100/result',
+            {'retry_50x': False},
+            gen_result_response(state='RUNNING'),
+          ),
           (
             'https://host:9001/api/swarming/v1/task/10100/result',
             {'retry_50x': False},
@@ -568,27 +708,73 @@ class TestSwarmingCollection(NetTestCase):
           (
             'https://host:9001/api/swarming/v1/task/10100/stdout',
             {},
-            {'output': SHARD_OUTPUT_1},
+            {'output': OUTPUT},
           ),
+        ])
+    expected = [gen_yielded_data(0, output=OUTPUT)]
+    self.assertEqual(expected, get_results(['10100']))
+
+  def test_many_shards(self):
+    # The shards are waited for and fetched at once, the pending ones are
+    # waited for again.
+    self.expected_requests(
+        [
           (
-            'https://host:9001/api/swarming/v1/task/10200/result',
-            {'retry_50x': False},
-            gen_result_response(),
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            {
+              'data': {
+                'task_ids': ['10100', '10200', '10300'],
+                'timeout_secs': 10,
+              },
+              'raise_404': True,
+              'retry_50x': False,
+            },
+            {
+              'items': [
+                {'state': 'COMPLETED', 'task_id': '10100'},
+                {'state': 'COMPLETED', 'task_id': '10300'},
+              ],
+            },
           ),
           (
-            'https://host:9001/api/swarming/v1/task/10200/stdout',
-            {},
-            {'output': SHARD_OUTPUT_2},
+            'https://host:9001/api/swarming/v1/tasks/results',
+            {
+              'data': {
+                'include_output': True,
+                'include_performance_stats': False,
+                'task_ids': ['10100', '10300'],
+              },
+              'raise_404': True,
+              'retry_50x': False,
+            },
+            {
+              'items': [
+                gen_result_response(output=SHARD_OUTPUT_1),
+                gen_result_response(output=SHARD_OUTPUT_3),
+              ],
+            },
           ),
           (
-            'https://host:9001/api/swarming/v1/task/10300/result',
-            {'retry_50x': False},
-            gen_result_response(),
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            {
+              'data': {'task_ids': ['10200'], 'timeout_secs': 10},
+              'raise_404': True,
+              'retry_50x': False,
+            },
+            {'items': [{'state': 'COMPLETED', 'task_id': '10200'}]},
           ),
           (
-            'https://host:9001/api/swarming/v1/task/10300/stdout',
-            {},
-            {'output': SHARD_OUTPUT_3},
+            'https://host:9001/api/swarming/v1/tasks/results',
+            {
+              'data': {
+                'include_output': True,
+                'include_performance_stats': False,
+                'task_ids': ['10200'],
+              },
+              'raise_404': True,
+              'retry_50x': False,
+            },
+            {'items': [gen_result_response(output=SHARD_OUTPUT_2)]},
           ),
         ])
     expected = [
@@ -599,39 +785,155 @@ class TestSwarmingCollection(NetTestCase):
     actual = get_results(['10100', '10200', '10300'])
     self.assertEqual(expected, sorted(actual))
 
-  def test_output_collector_called(self):
-    # Three shards, one failed. All results are passed to output collector.
+  def test_many_shards_no_batch(self):
+    # The server doesn't support tasks/wait, the shards are collected one by
+    # one.
+    self.mock(logging, 'warning', lambda *_, **__: None)
+    self.mock(swarming, 'now', lambda: 0)
+    requests = [
+      (
+        'https://host:9001/api/swarming/v1/tasks/wait',
+        {
+          'data': {'task_ids': ['10100', '10200'], 'timeout_secs': 10},
+          'raise_404': True,
+          'retry_50x': False,
+        },
+        net.HttpError(404, 'application/json', None),
+      ),
+    ]
+    for task_id, output in (('10100', SHARD_OUTPUT_1), ('10200', OUTPUT)):
+      requests.extend([
+        (
+          'https://host:9001/api/swarming/v1/task/%s/wait?timeout_secs=10' %
+              task_id,
+          {'raise_404': True, 'retry_50x': False},
+          gen_result_response(task_id=task_id),
+        ),
+        (
+          'https://host:9001/api/swarming/v1/task/%s/stdout' % task_id,
+          {},
+          {'output': output},
+        ),
+      ])
+    self.expected_requests(requests)
+    expected = [
+      gen_yielded_data(0, output=SHARD_OUTPUT_1),
+      gen_yielded_data(1, output=OUTPUT, task_id='10200'),
+    ]
+    self.assertEqual(expected, sorted(get_results(['10100', '10200'])))
+
+  def test_many_shards_output_omitted(self):
+    # The output too large to be sent by tasks/results is fetched separately.
     self.expected_requests(
         [
           (
-            'https://host:9001/api/swarming/v1/task/10100/result',
-            {'retry_50x': False},
-            gen_result_response(),
-          ),
-          (
-            'https://host:9001/api/swarming/v1/task/10100/stdout',
-            {},
-            {'output': SHARD_OUTPUT_1},
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            {
+              'data': {'task_ids': ['10100', '10200'], 'timeout_secs': 10},
+              'raise_404': True,
+              'retry_50x': False,
+            },
+            {
+              'items': [
+                {'state': 'COMPLETED', 'task_id': '10100'},
+                {'state': 'COMPLETED', 'task_id': '10200'},
+              ],
+            },
           ),
           (
-            'https://host:9001/api/swarming/v1/task/10200/result',
-            {'retry_50x': False},
-            gen_result_response(),
+            'https://host:9001/api/swarming/v1/tasks/results',
+            {
+              'data': {
+                'include_output': True,
+                'include_performance_stats': False,
+                'task_ids': ['10100', '10200'],
+              },
+              'raise_404': True,
+              'retry_50x': False,
+            },
+            {
+              'items': [
+                gen_result_response(output=SHARD_OUTPUT_1),
+                gen_result_response(output_omitted=True, task_id='10200'),
+              ],
+            },
           ),
           (
             'https://host:9001/api/swarming/v1/task/10200/stdout',
             {},
             {'output': SHARD_OUTPUT_2},
           ),
+        ])
+    expected = [
+      gen_yielded_data(0, output=SHARD_OUTPUT_1),
+      gen_yielded_data(1, output=SHARD_OUTPUT_2, task_id='10200'),
+    ]
+    self.assertEqual(expected, sorted(get_results(['10100', '10200'])))
+
+  def test_many_shards_url_errors(self):
+    self.mock(logging, 'error', lambda *_, **__: None)
+    self.mock(logging, 'warning', lambda *_, **__: None)
+    self.mock(swarming, 'now', iter(range(11)).next)
+    self.mock(swarming.time, 'sleep', lambda _: None)
+    # now() is called once per loop, the loop makes 9 iterations before
+    # timing out.
+    self.expected_requests(
+        [
           (
-            'https://host:9001/api/swarming/v1/task/10300/result',
-            {'retry_50x': False},
-            gen_result_response(exit_code=1),
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            {
+              'data': {
+                'task_ids': ['10100', '10200'], 'timeout_secs': 10 - i,
+              },
+              'raise_404': True,
+              'retry_50x': False,
+            },
+            None,
+          )
+          for i in xrange(1, 10)
+        ])
+    self.assertEqual([], get_results(['10100', '10200']))
+
+  def test_output_collector_called(self):
+    # Three shards, one failed. All results are passed to output collector.
+    self.expected_requests(
+        [
+          (
+            'https://host:9001/api/swarming/v1/tasks/wait',
+            {
+              'data': {
+                'task_ids': ['10100', '10200', '10300'],
+                'timeout_secs': 10,
+              },
+              'raise_404': True,
+              'retry_50x': False,
+            },
+            {
+              'items': [
+                {'state': 'COMPLETED', 'task_id': '10100'},
+                {'state': 'COMPLETED', 'task_id': '10200'},
+                {'state': 'COMPLETED', 'task_id': '10300'},
+              ],
+            },
           ),
           (
-            'https://host:9001/api/swarming/v1/task/10300/stdout',
-            {},
-            {'output': SHARD_OUTPUT_3},
+            'https://host:9001/api/swarming/v1/tasks/results',
+            {
+              'data': {
+                'include_output': True,
+                'include_performance_stats': False,
+                'task_ids': ['10100', '10200', '10300'],
+              },
+              'raise_404': True,
+              'retry_50x': False,
+            },
+            {
+              'items': [
+                gen_result_response(output=SHARD_OUTPUT_1),
+                gen_result_response(output=SHARD_OUTPUT_2),
+                gen_result_response(output=SHARD_OUTPUT_3, exit_code=1),
+              ],
+            },
           ),
         ])
 
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# Copyright 2016 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Profiler to compare sequential and parallel hashing of all the files in a
+directory, as done when archiving a tree.
+
+The OS file cache will skew the first run, use --warmup to read all the files
+once before measuring.
+"""
+
+import optparse
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+
+from third_party.depot_tools import fix_encoding
+import isolated_format
+from utils import tools
+
+
+def tree_files(root_dir):
+  out = []
+  for root, _, files in os.walk(root_dir):
+    out.extend(os.path.join(root, name) for name in files)
+  return out
+
+
+def hash_sequential(files, algo):
+  return [isolated_format.file_to_metadata(f, {}, 0, algo) for f in files]
+
+
+def hash_parallel(files, algo):
+  return isolated_format.files_to_metadata([(f, {}) for f in files], 0, algo)
+
+
+def profile(name, func, files, algo):
+  start_time = time.time()
+  metadata = func(files, algo)
+  end_time = time.time()
+  total_size = sum(m.get('s', 0) for m in metadata)
+  duration = end_time - start_time
+  print('%10s: %d files, total size %11d, time taken %6.3f, %7.1f MiB/s' % (
+      name, len(files), total_size, duration,
+      total_size / 1024. / 1024. / max(duration, 0.001)))
+  return metadata
+
+
+def main():
+  tools.disable_buffering()
+  parser = optparse.OptionParser(usage='%prog [options] <directory>')
+  parser.add_option(
+      '--algo', default='sha-1',
+      choices=sorted(isolated_format.SUPPORTED_ALGOS),
+      help='Hashing algorithm to use; default: %default')
+  parser.add_option(
+      '--warmup', action='store_true',
+      help='Hash all the files once before measuring')
+  options, args = parser.parse_args()
+  if len(args) != 1 or not os.path.isdir(args[0]):
+    parser.error('A directory must be given.')
+
+  algo = isolated_format.SUPPORTED_ALGOS[options.algo]
+  files = tree_files(unicode(os.path.abspath(args[0])))
+  if options.warmup:
+    hash_sequential(files, algo)
+
+  expected = profile('sequential', hash_sequential, files, algo)
+  actual = profile('parallel', hash_parallel, files, algo)
+  if expected != actual:
+    print('Results differ!')
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  fix_encoding.fix_encoding()
+  sys.exit(main())
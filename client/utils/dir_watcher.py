@@ -0,0 +1,237 @@
+# Copyright 2016 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Reports the files written to a directory tree while it is being populated.
+
+Uses inotify on Linux and falls back to periodically scanning the tree
+elsewhere or if inotify is not usable.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import stat
+import struct
+import sys
+import time
+
+from utils import fs
+
+
+# Interval between two scans of the tree when inotify is not used, in seconds.
+POLL_INTERVAL = 5.
+
+
+# Constants from <sys/inotify.h>.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_Q_OVERFLOW = 0x00004000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 04000
+_IN_CLOEXEC = 02000000
+
+# Events watched on each directory. IN_CREATE is only used to watch the new
+# subdirectories, files are reported once closed or moved into the tree.
+_WATCH_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+
+# struct inotify_event header: wd, mask, cookie, len. It is followed by the
+# NUL padded name of |len| bytes.
+_EVENT = struct.Struct('iIII')
+
+
+def _load_inotify():
+  """Returns the libc handle if it implements inotify, None otherwise."""
+  if not sys.platform.startswith('linux'):
+    return None
+  try:
+    libc = ctypes.CDLL(
+        ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [
+      ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32,
+    ]
+  except (AttributeError, OSError) as e:
+    logging.warning('inotify is not available: %s', e)
+    return None
+  return libc
+
+
+class DirWatcher(object):
+  """Reports the files written to a directory tree.
+
+  With inotify, a file is reported once it is closed after being written or
+  when it is moved into the tree. Otherwise, the tree is scanned every
+  |poll_interval| seconds and a file is reported once its size and modification
+  time didn't change between two scans.
+
+  A file modified again after being reported is reported again. Files present
+  in the tree before the watch started are reported too. Symlinks and other
+  special files are never reported.
+
+  Must be used as a context manager. It is not thread safe.
+  """
+
+  def __init__(self, root, poll_interval=POLL_INTERVAL):
+    assert isinstance(root, unicode), root
+    self.root = root
+    self._poll_interval = poll_interval
+    self._libc = None
+    # inotify file descriptor, None when polling.
+    self._fd = None
+    # inotify watch descriptor -> directory path.
+    self._wds = {}
+    # Files reported on the next get_closed_files() call.
+    self._found = set()
+    # When polling, path -> ((st_size, st_mtime), reported).
+    self._stats = {}
+    self._next_scan = 0
+
+  @property
+  def uses_inotify(self):
+    return self._fd is not None
+
+  def __enter__(self):
+    self._start()
+    return self
+
+  def __exit__(self, _exc_type, _exc_value, _traceback):
+    self._close_fd()
+    return False
+
+  def get_closed_files(self, timeout):
+    """Waits up to |timeout| seconds for files to be written.
+
+    Returns:
+      Sorted list of the absolute paths of the files written since the previous
+      call. It is empty on timeout.
+    """
+    if self.uses_inotify:
+      self._read_events(timeout)
+    else:
+      self._poll(timeout)
+    out = sorted(self._found)
+    self._found.clear()
+    return out
+
+  def _start(self):
+    """Starts watching the tree with inotify, if possible."""
+    self._libc = _load_inotify()
+    if self._libc:
+      fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+      if fd < 0:
+        logging.warning(
+            'inotify_init1() failed: %s', os.strerror(ctypes.get_errno()))
+      else:
+        self._fd = fd
+        try:
+          self._watch_tree(self.root)
+        except OSError as e:
+          logging.warning('Failed to watch %s: %s', self.root, e)
+          self._close_fd()
+    if not self.uses_inotify:
+      logging.info('Polling %s for new files', self.root)
+
+  def _close_fd(self):
+    if self._fd is not None:
+      os.close(self._fd)
+      self._fd = None
+      self._wds.clear()
+
+  def _watch_tree(self, root):
+    """Watches |root| and its subdirectories and reports the files in them.
+
+    The directories are watched before being listed, so a file written
+    concurrently is not missed; it may be reported twice instead.
+    """
+    wd = self._libc.inotify_add_watch(
+        self._fd, root.encode(sys.getfilesystemencoding()), _WATCH_MASK)
+    if wd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err), root)
+    self._wds[wd] = root
+    for name in fs.listdir(root):
+      path = os.path.join(root, name)
+      try:
+        mode = fs.lstat(path).st_mode
+      except OSError:
+        # Deleted in the meantime.
+        continue
+      if stat.S_ISDIR(mode):
+        self._watch_tree(path)
+      elif stat.S_ISREG(mode):
+        self._found.add(path)
+
+  def _read_events(self, timeout):
+    if not select.select([self._fd], [], [], timeout)[0]:
+      return
+    data = ''
+    while True:
+      try:
+        chunk = os.read(self._fd, 65536)
+      except OSError as e:
+        if e.errno != errno.EAGAIN:
+          raise
+        break
+      if not chunk:
+        break
+      data += chunk
+    offset = 0
+    while offset < len(data):
+      wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+      offset += _EVENT.size
+      name = data[offset:offset+length].rstrip('\0')
+      offset += length
+      if mask & _IN_Q_OVERFLOW:
+        # Events were lost, rescan the whole tree.
+        logging.warning('inotify queue overflow, rescanning %s', self.root)
+        self._close_fd()
+        self._start()
+        return
+      parent = self._wds.get(wd)
+      if not parent or not name:
+        continue
+      path = os.path.join(
+          parent, name.decode(sys.getfilesystemencoding()))
+      if mask & _IN_ISDIR:
+        if mask & (_IN_CREATE | _IN_MOVED_TO):
+          try:
+            self._watch_tree(path)
+          except OSError as e:
+            # Deleted in the meantime.
+            logging.debug('Failed to watch %s: %s', path, e)
+      elif mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO):
+        self._found.add(path)
+
+  def _poll(self, timeout):
+    delay = self._next_scan - time.time()
+    if delay > timeout:
+      time.sleep(timeout)
+      return
+    if delay > 0:
+      time.sleep(delay)
+    self._next_scan = time.time() + self._poll_interval
+    stats = {}
+    for root, _dirs, files in fs.walk(self.root):
+      for name in files:
+        path = os.path.join(root, name)
+        try:
+          st = fs.lstat(path)
+        except OSError:
+          continue
+        if not stat.S_ISREG(st.st_mode):
+          continue
+        key = (st.st_size, st.st_mtime)
+        prev = self._stats.get(path)
+        if prev and prev[0] == key:
+          # Unchanged since the previous scan.
+          if not prev[1]:
+            self._found.add(path)
+          stats[path] = (key, True)
+        else:
+          stats[path] = (key, False)
+    self._stats = stats
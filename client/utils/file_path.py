@@ -9,12 +9,14 @@ is running and thus it caches results of functions that depend on FS state.
 """
 
 import ctypes
+import errno
 import getpass
 import logging
 import os
 import posixpath
 import re
 import shlex
+import shutil
 import stat
 import sys
 import tempfile
@@ -30,17 +32,44 @@ HARDLINK, HARDLINK_WITH_FALLBACK, SYMLINK, SYMLINK_WITH_FALLBACK, COPY = range(
     1, 6)
 
 
+# Strategies used by copy_file(), from the fastest to the slowest.
+COPY_REFLINK = 'reflink'
+COPY_FILE_RANGE = 'copy_file_range'
+COPY_SENDFILE = 'sendfile'
+COPY_PYTHON = 'python'
+
+
+# Linux ioctl sharing the extents of a file with another file, supported by
+# btrfs and xfs.
+FICLONE = 0x40049409
+
+# Largest number of bytes to copy in a single copy_file_range() or sendfile()
+# call.
+COPY_MAX_BYTES = 1024 * 1024 * 1024
+
+# errno values meaning that a copy strategy is not supported for this pair of
+# files, so the next one has to be tried.
+_COPY_FALLBACK_ERRNOS = frozenset(
+    getattr(errno, e) for e in (
+      'EBADF', 'EINVAL', 'ENOSYS', 'ENOTSUP', 'ENOTTY', 'EOPNOTSUPP', 'EPERM',
+      'ETXTBSY', 'EXDEV')
+    if hasattr(errno, e))
+
+
 ## OS-specific imports
 
 
 if sys.platform == 'win32':
   import locale
+  import msvcrt  # pylint: disable=F0401
   from ctypes.wintypes import create_unicode_buffer
   from ctypes.wintypes import windll  # pylint: disable=E0611
   from ctypes.wintypes import GetLastError  # pylint: disable=E0611
-elif sys.platform == 'darwin':
-  import Carbon.File  #  pylint: disable=F0401
-  import MacOS  # pylint: disable=F0401
+else:
+  import fcntl  # pylint: disable=F0401
+  if sys.platform == 'darwin':
+    import Carbon.File  #  pylint: disable=F0401
+    import MacOS  # pylint: disable=F0401
 
 
 if sys.platform == 'win32':
@@ -809,12 +838,121 @@ def hardlink(source, link_name):
     fs.link(source, link_name)
 
 
+# libc as loaded by _get_libc() and the copy strategies found not to be
+# supported by the kernel.
+_libc = None
+_copy_unsupported = set()
+
+
+def _get_libc():
+  """Returns libc loaded with ctypes, or None if it can't be loaded."""
+  global _libc
+  if _libc is None:
+    try:
+      _libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+      _libc = False
+  return _libc or None
+
+
+def _raise_errno(name):
+  err = ctypes.get_errno()
+  raise OSError(err, '%s: %s' % (name, os.strerror(err)))
+
+
+def _copy_reflink(libc, dst_fd, src_fd, _size):
+  if libc.ioctl(dst_fd, FICLONE, src_fd) == -1:
+    _raise_errno('ioctl(FICLONE)')
+
+
+def _copy_loop(name, func, size):
+  """Calls func(count) until |size| bytes were copied."""
+  left = size
+  while left:
+    count = func(min(left, COPY_MAX_BYTES))
+    if count == -1:
+      _raise_errno(name)
+    if not count:
+      # The file was truncated while being copied.
+      break
+    left -= count
+
+
+def _copy_file_range(libc, dst_fd, src_fd, size):
+  func = getattr(libc, 'copy_file_range', None)
+  if not func:
+    raise OSError(errno.ENOSYS, 'copy_file_range() is not in libc')
+  func.restype = ctypes.c_ssize_t
+  func.argtypes = [
+    ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+    ctypes.c_size_t, ctypes.c_uint,
+  ]
+  _copy_loop(
+      'copy_file_range',
+      lambda count: func(src_fd, None, dst_fd, None, count, 0), size)
+
+
+def _copy_sendfile(libc, dst_fd, src_fd, size):
+  func = libc.sendfile
+  func.restype = ctypes.c_ssize_t
+  func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+  _copy_loop('sendfile', lambda count: func(dst_fd, src_fd, None, count), size)
+
+
+_COPY_FUNCTIONS = (
+  (COPY_REFLINK, _copy_reflink),
+  (COPY_FILE_RANGE, _copy_file_range),
+  (COPY_SENDFILE, _copy_sendfile),
+)
+
+
+def copy_file(outfile, infile):
+  """Copies the content of |infile| into |outfile|, which is overwritten.
+
+  On linux, the content is first shared with a reflink, then copied in the
+  kernel with copy_file_range() or sendfile(). A copy through python is the last
+  resort, and the only strategy on other OSes.
+
+  Returns:
+    The strategy used, one of the COPY_* strings.
+  """
+  libc = _get_libc() if sys.platform.startswith('linux') else None
+  with fs.open(infile, 'rb') as src:
+    with fs.open(outfile, 'wb') as dst:
+      if libc:
+        size = os.fstat(src.fileno()).st_size
+        for strategy, func in _COPY_FUNCTIONS:
+          if strategy in _copy_unsupported:
+            continue
+          try:
+            func(libc, dst.fileno(), src.fileno(), size)
+            return strategy
+          except OSError as e:
+            if e.errno not in _COPY_FALLBACK_ERRNOS:
+              raise
+            if e.errno == errno.ENOSYS:
+              _copy_unsupported.add(strategy)
+            logging.debug('Copy with %s failed: %s', strategy, e)
+          # Discard what may have been partially copied.
+          src.seek(0)
+          dst.seek(0)
+          dst.truncate()
+      shutil.copyfileobj(src, dst, 1024 * 1024)
+  return COPY_PYTHON
+
+
 def readable_copy(outfile, infile):
-  """Makes a copy of the file that is readable by everyone."""
-  fs.copy2(infile, outfile)
+  """Makes a copy of the file that is readable by everyone.
+
+  Returns:
+    The strategy used by copy_file().
+  """
+  strategy = copy_file(outfile, infile)
+  fs.copystat(infile, outfile)
   fs.chmod(
       outfile,
       fs.stat(outfile).st_mode | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+  return strategy
 
 
 def set_read_only(path, read_only):
@@ -872,7 +1010,8 @@ def link_file(outfile, infile, action):
   """Links a file. The type of link depends on |action|.
 
   Returns:
-    True if the action was carried on, False if fallback was used.
+    'hardlink' or 'symlink' if the file was linked, the strategy used by
+    copy_file() otherwise, including when the fallback was used.
   """
   if action < 1 or action > COPY:
     raise ValueError('Unknown mapping action %s' % action)
@@ -885,27 +1024,24 @@ def link_file(outfile, infile, action):
         (outfile, fs.stat(infile).st_size, fs.stat(outfile).st_size))
 
   if action == COPY:
-    readable_copy(outfile, infile)
-    return True
+    return readable_copy(outfile, infile)
 
   if action in (SYMLINK, SYMLINK_WITH_FALLBACK):
     try:
       fs.symlink(infile, outfile)  # pylint: disable=E1101
-      return True
+      return 'symlink'
     except OSError:
       if action == SYMLINK:
         raise
       logging.warning(
           'Failed to symlink, falling back to copy %s to %s' % (
             infile, outfile))
-      # Signal caller that fallback copy was used.
-      readable_copy(outfile, infile)
-      return False
+      return readable_copy(outfile, infile)
 
   # HARDLINK or HARDLINK_WITH_FALLBACK.
   try:
     hardlink(infile, outfile)
-    return True
+    return 'hardlink'
   except OSError as e:
     if action == HARDLINK:
       raise OSError('Failed to hardlink %s to %s: %s' % (infile, outfile, e))
@@ -914,9 +1050,7 @@ def link_file(outfile, infile, action):
   logging.warning(
       'Failed to hardlink, falling back to copy %s to %s' % (
         infile, outfile))
-  readable_copy(outfile, infile)
-  # Signal caller that fallback copy was used.
-  return False
+  return readable_copy(outfile, infile)
 
 
 def atomic_replace(path, body):
@@ -956,6 +1090,41 @@ def atomic_replace(path, body):
             tmp_name, e)
 
 
+def lock_file(path):
+  """Opens |path| and takes an exclusive lock on it, waiting for it if needed.
+
+  The lock is advisory, it only excludes the other processes calling
+  lock_file() on the same path. It is released when the returned file object
+  is closed or when the process exits, even if it crashed. On POSIX, the file
+  descriptor is not inherited by child processes, so they cannot hold the lock
+  past the lifetime of the caller.
+
+  Returns:
+    The file object holding the lock.
+  """
+  f = fs.open(path, 'a+b')
+  try:
+    if sys.platform == 'win32':
+      while True:
+        try:
+          # Locks the first byte. LK_LOCK retries for 10 seconds before
+          # failing, retry for as long as needed.
+          f.seek(0)
+          msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+          break
+        except IOError:
+          logging.info('Waiting for the lock on %s', path)
+    else:
+      fcntl.fcntl(
+          f.fileno(), fcntl.F_SETFD,
+          fcntl.fcntl(f.fileno(), fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+      fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+  except:
+    f.close()
+    raise
+  return f
+
+
 ### Write directory functions.
 
 
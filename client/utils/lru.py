@@ -6,6 +6,8 @@
 
 import collections
 import json
+import logging
+import os
 import time
 
 
@@ -16,7 +18,11 @@ class LRUDict(object):
   (key, (value, timestamp)) pairs in order they are
   inserted and can effectively pop oldest items.
 
-  Can also store its state as *.json file on disk.
+  Can also store its state as *.json file on disk. Optionally, modifications
+  are appended to a journal file instead of rewriting the whole state on each
+  save. The journal is compacted back into the state file once it becomes as
+  large as the state itself, so the cost of a save is amortized O(1) per
+  modification.
   """
 
   # Used to determine current timestamp.
@@ -29,6 +35,11 @@ class LRUDict(object):
     self._items = collections.OrderedDict()
     # True if was modified after loading.
     self._dirty = True
+    # Modifications not yet saved, as journal entries.
+    self._journal = []
+    # Number of entries in the journal file on disk, or None if the state must
+    # be saved as a whole on the next save().
+    self._journal_length = None
 
   def __nonzero__(self):
     """False if dict is empty."""
@@ -51,9 +62,12 @@ class LRUDict(object):
     return self._items[key][0]
 
   @classmethod
-  def load(cls, state_file):
+  def load(cls, state_file, journal_file=None):
     """Loads previously saved state and returns LRUDict in that state.
 
+    If |journal_file| is given and exists, the modifications it contains are
+    replayed on top of the state file.
+
     Raises ValueError if state file is corrupted.
     """
     try:
@@ -116,28 +130,49 @@ class LRUDict(object):
 
     # Now state from the file corresponds to state in the memory.
     lru._dirty = False
+    lru._journal_length = 0
+    if journal_file and os.path.isfile(journal_file):
+      lru._replay(journal_file)
     return lru
 
-  def save(self, state_file):
-    """Saves cache state to a file if it was modified."""
+  def save(self, state_file, journal_file=None):
+    """Saves cache state to a file if it was modified.
+
+    If |journal_file| is given, only the modifications done since the last
+    load() or save() are appended to it, unless the journal grew as large as
+    the state, in which case the whole state is written to |state_file| and the
+    journal is deleted.
+    """
     if not self._dirty:
       return False
 
-    with open(state_file, 'wb') as f:
-      contents = {
-        'version': 2,
-        'items': self._items.items(),
-      }
-      json.dump(contents, f, separators=(',',':'))
-
+    if (journal_file and self._journal_length is not None and
+        self._journal_length + len(self._journal) < len(self._items)):
+      with open(journal_file, 'ab') as f:
+        for entry in self._journal:
+          f.write(json.dumps(entry, separators=(',',':')) + '\n')
+      self._journal_length += len(self._journal)
+    else:
+      with open(state_file, 'wb') as f:
+        contents = {
+          'version': 2,
+          'items': self._items.items(),
+        }
+        json.dump(contents, f, separators=(',',':'))
+      if journal_file and os.path.isfile(journal_file):
+        os.remove(journal_file)
+      self._journal_length = 0
+
+    self._journal = []
     self._dirty = False
     return True
 
   def add(self, key, value):
     """Adds or replaces a |value| for |key|, marks it as most recently used."""
     self._items.pop(key, None)
-    self._items[key] = (value, self.time_fn())
-    self._dirty = True
+    timestamp = self.time_fn()
+    self._items[key] = (value, timestamp)
+    self._log(('a', key, value, timestamp))
 
   def keys_set(self):
     """Set of keys of items in this dict."""
@@ -153,8 +188,9 @@ class LRUDict(object):
 
     Raises KeyError if |key| is not in the dict.
     """
-    self._items[key] = (self._items.pop(key)[0], self.time_fn())
-    self._dirty = True
+    timestamp = self.time_fn()
+    self._items[key] = (self._items.pop(key)[0], timestamp)
+    self._log(('t', key, timestamp))
 
   def pop(self, key):
     """Removes item from the dict, returns its value.
@@ -162,7 +198,7 @@ class LRUDict(object):
     Raises KeyError if |key| is not in the dict.
     """
     item = self._items.pop(key)
-    self._dirty = True
+    self._log(('p', key))
     return item[0]
 
   def get_oldest(self):
@@ -180,10 +216,52 @@ class LRUDict(object):
     Raises KeyError if dict is empty.
     """
     item = self._items.popitem(last=False)
-    self._dirty = True
+    self._log(('p', item[0]))
     return item
 
   def itervalues(self):
     """Iterator over stored values in arbitrary order."""
     for val, _ in self._items.itervalues():
       yield val
+
+  def _log(self, entry):
+    """Records a modification to be appended to the journal on next save()."""
+    self._dirty = True
+    if self._journal_length is None:
+      return
+    if self._journal_length + len(self._journal) > len(self._items):
+      # The journal is now larger than the state, compact on next save().
+      self._journal = []
+      self._journal_length = None
+      return
+    self._journal.append(entry)
+
+  def _replay(self, journal_file):
+    """Applies the modifications recorded in |journal_file|.
+
+    A journal can be truncated if the process died while appending to it. In
+    that case the entries up to the broken one are applied and the next save()
+    compacts the state.
+    """
+    with open(journal_file, 'rb') as f:
+      for line in f:
+        try:
+          entry = json.loads(line)
+          op = entry[0]
+          if op == 'a':
+            self._items.pop(entry[1], None)
+            self._items[entry[1]] = (entry[2], entry[3])
+          elif op == 't':
+            if entry[1] in self._items:
+              self._items[entry[1]] = (self._items.pop(entry[1])[0], entry[2])
+          elif op == 'p':
+            self._items.pop(entry[1], None)
+          else:
+            raise ValueError('Unknown operation %r' % op)
+        except (IndexError, TypeError, ValueError) as e:
+          logging.warning(
+              'Broken journal file %s, ignoring the rest: %s', journal_file, e)
+          self._journal_length = None
+          self._dirty = True
+          return
+        self._journal_length += 1
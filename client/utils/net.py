@@ -19,6 +19,7 @@ import socket
 import ssl
 import threading
 import time
+import types
 import urllib
 import urlparse
 
@@ -143,6 +144,7 @@ def url_open(url, **kwargs):  # pylint: disable=W0621
     - str for pre-encoded data
     - list for data to be encoded
     - dict for data to be encoded
+    - generator of str chunks for pre-encoded data to stream
 
   See HttpService.request for a full list of arguments.
 
@@ -329,7 +331,7 @@ class HttpService(object):
   def encode_request_body(body, content_type):
     """Returns request body encoded according to its content type."""
     # No body or it is already encoded.
-    if body is None or isinstance(body, str):
+    if body is None or isinstance(body, (str, types.GeneratorType)):
       return body
     # Any body should have content type set.
     assert content_type, 'Request has body, but no content type'
@@ -374,7 +376,8 @@ class HttpService(object):
       stream=True,
       method=None,
       headers=None,
-      follow_redirects=True):
+      follow_redirects=True,
+      raise_404=False):
     """Attempts to open the given url multiple times.
 
     |urlpath| is relative to the server root, i.e. '/some/request?param=1'.
@@ -384,8 +387,17 @@ class HttpService(object):
       - str for pre-encoded data
       - list for data to be form-encoded
       - dict for data to be form-encoded
+      - generator of str chunks for pre-encoded data; it is sent with chunked
+        transfer encoding as it is generated. Since a generator can't be
+        rewound, |max_attempts| must be 1 and retries are the responsibility
+        of the caller.
+      - callable returning such a generator; it is called again on each
+        attempt, so the body is regenerated for the retries.
 
     - Optionally retries HTTP 404 and 50x.
+    - If |raise_404| is True, raises the HttpError of a HTTP 404 that is not
+      retried instead of returning None, so the caller can tell the server
+      doesn't support the request.
     - Retries up to |max_attempts| times. If None or 0, there's no limit in the
       number of retries.
     - Retries up to |timeout| duration in seconds. If None or 0, there's no
@@ -417,11 +429,18 @@ class HttpService(object):
     """
     assert urlpath and urlpath[0] == '/', urlpath
 
+    body_factory = None
     if data is not None:
       assert method in (None, 'DELETE', 'POST', 'PUT')
       method = method or 'POST'
       content_type = content_type or DEFAULT_CONTENT_TYPE
-      body = self.encode_request_body(data, content_type)
+      if callable(data):
+        body_factory = data
+        body = None
+      else:
+        body = self.encode_request_body(data, content_type)
+      if isinstance(body, types.GeneratorType):
+        assert max_attempts == 1, 'A streamed body can only be sent once'
     else:
       assert method in (None, 'DELETE', 'GET')
       method = method or 'GET'
@@ -435,8 +454,9 @@ class HttpService(object):
 
     # Prepare headers.
     headers = get_case_insensitive_dict(headers or {})
-    if body is not None:
-      headers['Content-Length'] = len(body)
+    if body is not None or body_factory:
+      if isinstance(body, str):
+        headers['Content-Length'] = len(body)
       if content_type:
         headers['Content-Type'] = content_type
 
@@ -450,6 +470,11 @@ class HttpService(object):
             'Retrying request %s, attempt %d/%d...',
             resource_url, attempt.attempt, max_attempts)
 
+      if body_factory:
+        if isinstance(body, types.GeneratorType):
+          # Stops the generation of the body of the previous attempt.
+          body.close()
+        body = body_factory()
       try:
         # Prepare and send a new request.
         request = HttpRequest(
@@ -504,6 +529,8 @@ class HttpService(object):
           logging.warning(
               'Able to connect to %s but an exception was thrown.\n%s',
               request.get_full_url(), self._format_error(e, verbose=True))
+          if raise_404 and e.code == 404:
+            raise
           return None
 
         # Retry all other errors.
@@ -518,19 +545,22 @@ class HttpService(object):
         self._format_error(last_error, verbose=True))
     return None
 
-  def json_request(self, urlpath, data=None, **kwargs):
+  def json_request(self, urlpath, data=None, content_type=None, **kwargs):
     """Sends JSON request to the server and parses JSON response it get back.
 
     Arguments:
       urlpath: relative request path (e.g. '/auth/v1/...').
       data: object to serialize to JSON and sent in the request.
+      content_type: if set, |data| is an already encoded str of this content
+          type instead.
 
     See self.request() for more details.
 
     Returns:
       Deserialized JSON response on success, None on error or timeout.
     """
-    content_type = JSON_CONTENT_TYPE if data is not None else None
+    if content_type is None and data is not None:
+      content_type = JSON_CONTENT_TYPE
     response = self.request(
         urlpath, content_type=content_type, data=data, stream=False, **kwargs)
     if not response:
@@ -583,7 +613,7 @@ class HttpRequest(object):
       |method| - HTTP method to use
       |url| - relative URL to the resource, without query parameters
       |params| - list of (key, value) pairs to put into GET parameters
-      |body| - encoded body of the request (None or str)
+      |body| - encoded body of the request (None, str or generator)
       |headers| - dict with request headers
       |timeout| - socket read timeout (None to disable)
       |stream| - True to stream response from socket